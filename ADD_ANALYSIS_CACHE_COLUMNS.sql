@@ -0,0 +1,14 @@
+-- Add result-cache fields to the Can-Do analysis log
+-- Run this in Supabase SQL Editor
+
+-- Whether the analysis was served from the backend's result cache
+ALTER TABLE session_cando_analysis
+ADD COLUMN IF NOT EXISTS cache_hit boolean DEFAULT false;
+
+-- Content hash of (transcript, level, statements, prompt version, model)
+ALTER TABLE session_cando_analysis
+ADD COLUMN IF NOT EXISTS cache_key text;
+
+-- Comments for documentation
+COMMENT ON COLUMN session_cando_analysis.cache_hit IS 'TRUE if the result came from the backend analysis cache instead of a new model call';
+COMMENT ON COLUMN session_cando_analysis.cache_key IS 'SHA-256 key of the analysis inputs used by the backend result cache';
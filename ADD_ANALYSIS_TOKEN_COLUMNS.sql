@@ -0,0 +1,19 @@
+-- Add token usage fields to the Can-Do analysis log
+-- Run this in Supabase SQL Editor
+
+-- Prompt tokens sent to the model, summed over all transcript windows
+ALTER TABLE session_cando_analysis
+ADD COLUMN IF NOT EXISTS input_tokens integer DEFAULT 0;
+
+-- Completion tokens returned by the model, summed over all transcript windows
+ALTER TABLE session_cando_analysis
+ADD COLUMN IF NOT EXISTS output_tokens integer DEFAULT 0;
+
+-- Number of windows the transcript was split into
+ALTER TABLE session_cando_analysis
+ADD COLUMN IF NOT EXISTS chunk_count integer DEFAULT 1;
+
+-- Comments for documentation
+COMMENT ON COLUMN session_cando_analysis.input_tokens IS 'Prompt tokens used by the analysis (0 when served from the result cache)';
+COMMENT ON COLUMN session_cando_analysis.output_tokens IS 'Completion tokens used by the analysis (0 when served from the result cache)';
+COMMENT ON COLUMN session_cando_analysis.chunk_count IS 'Number of transcript windows analyzed separately and merged';
@@ -0,0 +1,27 @@
+-- Add a natural key to cando_statements so the importer can upsert
+-- Run this in Supabase SQL Editor before running import_cando_statements.py
+
+-- SHA-256 (hex) of scale + newline + descriptor, with whitespace collapsed.
+-- The scale is included because CEFR repeats some descriptors under several scales.
+ALTER TABLE cando_statements
+ADD COLUMN IF NOT EXISTS descriptor_hash text;
+
+-- Fill it in for statements imported before this column existed
+UPDATE cando_statements
+SET descriptor_hash = encode(sha256(convert_to(
+    btrim(regexp_replace(coalesce(scale, ''), '\s+', ' ', 'g')) || E'\n' ||
+    btrim(regexp_replace(descriptor, '\s+', ' ', 'g')),
+    'UTF8')), 'hex')
+WHERE descriptor_hash IS NULL;
+
+-- If the import was run more than once, duplicates must be resolved first
+-- (deleting a statement also deletes achievements that point to it):
+-- SELECT level, descriptor_hash, array_agg(id) FROM cando_statements
+-- GROUP BY level, descriptor_hash HAVING count(*) > 1;
+
+-- One row per (level, scale, descriptor); the importer upserts on this key
+CREATE UNIQUE INDEX IF NOT EXISTS idx_cando_level_descriptor_hash
+ON cando_statements(level, descriptor_hash);
+
+-- Comments for documentation
+COMMENT ON COLUMN cando_statements.descriptor_hash IS 'SHA-256 of the whitespace-normalized scale and descriptor; with level, the natural key used by the importer';
@@ -0,0 +1,87 @@
+-- Server-side voice usage metering (app/usage_meter.py)
+-- Run this in Supabase SQL Editor (after INVITATION_SYSTEM_FIXED.sql)
+
+-- Exact monthly usage; monthly_voice_minutes_used is kept as the rounded-up minutes
+ALTER TABLE profiles
+ADD COLUMN IF NOT EXISTS monthly_voice_seconds_used numeric(12, 1) DEFAULT 0;
+
+UPDATE profiles
+SET monthly_voice_seconds_used = coalesce(monthly_voice_minutes_used, 0) * 60
+WHERE monthly_voice_seconds_used = 0 AND coalesce(monthly_voice_minutes_used, 0) > 0;
+
+-- Add a batch of metered usage and finished sessions, rolling counters over
+-- at month boundaries. Called by the backend with the service role key.
+--   usage:    [{"user_id", "month": "YYYY-MM", "seconds"}]
+--   sessions: [{"usage_session_id", "user_id", "started_at", "ended_at", "month", "seconds", "cost_usd"}]
+-- Returns this month's total for every user in the batch.
+CREATE OR REPLACE FUNCTION record_voice_usage(usage jsonb, sessions jsonb DEFAULT '[]'::jsonb)
+RETURNS TABLE (user_id uuid, month text, seconds_used numeric)
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+#variable_conflict use_column
+DECLARE
+  current_month text := to_char(date_trunc('month', now()), 'YYYY-MM');
+BEGIN
+  -- Start the month from zero for counters last reset in an earlier month
+  UPDATE profiles p
+  SET monthly_voice_seconds_used = 0,
+      monthly_voice_minutes_used = 0,
+      last_usage_reset = now()
+  WHERE p.id IN (SELECT (u->>'user_id')::uuid FROM jsonb_array_elements(usage) u)
+    AND COALESCE(p.last_usage_reset, '-infinity') < date_trunc('month', now());
+
+  -- Only this month's seconds count towards the quota; earlier months are only logged
+  UPDATE profiles p
+  SET monthly_voice_seconds_used = p.monthly_voice_seconds_used + d.seconds,
+      monthly_voice_minutes_used = ceil((p.monthly_voice_seconds_used + d.seconds) / 60.0)
+  FROM (
+    SELECT (u->>'user_id')::uuid AS id, sum((u->>'seconds')::numeric) AS seconds
+    FROM jsonb_array_elements(usage) u
+    WHERE u->>'month' = current_month
+    GROUP BY 1
+  ) d
+  WHERE p.id = d.id;
+
+  INSERT INTO usage_logs (user_id, action_type, duration_minutes, cost_usd, metadata)
+  SELECT (s->>'user_id')::uuid,
+         'voice_conversation',
+         round((s->>'seconds')::numeric / 60, 2),
+         (s->>'cost_usd')::numeric,
+         jsonb_build_object(
+           'usage_session_id', s->>'usage_session_id',
+           'started_at', s->>'started_at',
+           'ended_at', s->>'ended_at',
+           'month', s->>'month',
+           'metered_by', 'backend'
+         )
+  FROM jsonb_array_elements(sessions) s;
+
+  RETURN QUERY
+  SELECT p.id, current_month, p.monthly_voice_seconds_used
+  FROM profiles p
+  WHERE p.id IN (SELECT DISTINCT (u->>'user_id')::uuid FROM jsonb_array_elements(usage) u);
+END;
+$$;
+
+-- Only the backend (service role) may record usage
+REVOKE EXECUTE ON FUNCTION record_voice_usage(jsonb, jsonb) FROM PUBLIC, anon, authenticated;
+
+-- The monthly reset also clears the seconds counter
+CREATE OR REPLACE FUNCTION reset_monthly_usage()
+RETURNS void
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  UPDATE profiles
+  SET
+    monthly_voice_minutes_used = 0,
+    monthly_voice_seconds_used = 0,
+    last_usage_reset = now()
+  WHERE COALESCE(last_usage_reset, '-infinity') < date_trunc('month', now());
+END;
+$$;
+
+-- Comments for documentation
+COMMENT ON COLUMN profiles.monthly_voice_seconds_used IS 'Voice seconds metered by the backend this month (reset at the start of each month)';
+COMMENT ON FUNCTION record_voice_usage(jsonb, jsonb) IS 'Batch write of metered voice usage from the backend; returns current monthly totals';
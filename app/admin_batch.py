@@ -0,0 +1,277 @@
+"""
+Batch admin operations for POST /admin/batch.
+
+The caller is authenticated once for the whole batch. Operations are
+grouped so that compatible writes share one PostgREST request:
+- update_tier: one PATCH per tier with id=in.(...)
+- add_cando: one array insert (duplicates ignored)
+- remove_cando: one DELETE per user with cando_id=in.(...)
+- create_user: Auth admin calls, then one array insert of the profiles
+  (if that insert fails, the created users are reported as failed, with
+  their ids, so their profiles can be added)
+
+Auth admin calls (create_user, delete_user, reset_password) have no bulk
+form, so they run in parallel, at most ADMIN_BATCH_AUTH_CONCURRENCY at a
+time. Phases run in that order: Auth calls, tier updates, then Can-Do
+changes.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+import profile_cache
+import tracing
+from supabase_client import supabase
+
+load_dotenv()
+
+# Auth admin calls run at the same time within one batch
+ADMIN_BATCH_AUTH_CONCURRENCY = int(os.getenv("ADMIN_BATCH_AUTH_CONCURRENCY", "8"))
+
+# Max operations accepted in one batch
+ADMIN_BATCH_MAX_OPERATIONS = int(os.getenv("ADMIN_BATCH_MAX_OPERATIONS", "500"))
+
+VALID_TIERS = ('free', 'premium', 'admin')
+
+# Required fields per operation type
+OPERATIONS = {
+    'create_user': ('email', 'password'),
+    'delete_user': ('user_id',),
+    'reset_password': ('user_id', 'password'),
+    'update_tier': ('user_id', 'tier'),
+    'add_cando': ('user_id', 'cando_id'),
+    'remove_cando': ('user_id', 'cando_id'),
+}
+
+
+def _validate(op):
+    """Return an error message for a malformed operation, or None."""
+    if not isinstance(op, dict):
+        return "Operation must be an object"
+    kind = op.get('op')
+    if not isinstance(kind, str) or kind not in OPERATIONS:
+        return f"Unknown op: {kind}"
+    missing = [f for f in OPERATIONS[kind] if not op.get(f)]
+    if missing:
+        return f"Missing required fields: {', '.join(missing)}"
+    not_strings = [f for f in OPERATIONS[kind] if not isinstance(op[f], str)]
+    if not_strings:
+        return f"Fields must be strings: {', '.join(not_strings)}"
+    if kind in ('create_user', 'reset_password') and len(op['password']) < 6:
+        return "Password must be at least 6 characters"
+    if kind == 'update_tier' and op['tier'] not in VALID_TIERS:
+        return "Invalid tier. Must be 'free', 'premium', or 'admin'"
+    if kind == 'create_user' and op.get('tier', 'free') not in VALID_TIERS:
+        return "Invalid tier. Must be 'free', 'premium', or 'admin'"
+    return None
+
+
+def _create_auth_user(op):
+    resp = supabase.post('/auth/v1/admin/users', json={
+        'email': op['email'],
+        'password': op['password'],
+        'email_confirm': True
+    })
+    if resp.status_code not in [200, 201]:
+        return {"error": f"Failed to create user: {resp.text}"}
+    return {"user": {'id': resp.json()['id'], 'email': resp.json()['email']}}
+
+
+def _delete_auth_user(op):
+    resp = supabase.delete(f"/auth/v1/admin/users/{op['user_id']}")
+    profile_cache.invalidate(op['user_id'])
+    if resp.status_code not in [200, 204]:
+        return {"error": "Failed to delete user"}
+    return {}
+
+
+def _reset_password(op):
+    resp = supabase.put(f"/auth/v1/admin/users/{op['user_id']}", json={'password': op['password']})
+    if resp.status_code not in [200, 204]:
+        return {"error": "Failed to reset password"}
+    return {}
+
+
+_AUTH_HANDLERS = {
+    'create_user': _create_auth_user,
+    'delete_user': _delete_auth_user,
+    'reset_password': _reset_password,
+}
+
+
+def _run_auth_calls(indexed_ops, results):
+    """Run the Auth admin operations in parallel and insert the new profiles."""
+    def run(item):
+        index, op = item
+        try:
+            return index, _AUTH_HANDLERS[op['op']](op)
+        except Exception as e:
+            return index, {"error": str(e)}
+
+    workers = min(ADMIN_BATCH_AUTH_CONCURRENCY, len(indexed_ops))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # One context copy per call, so each Auth call's span joins the request's trace
+        futures = [executor.submit(tracing.wrap_context(run), item) for item in indexed_ops]
+        outcomes = [future.result() for future in futures]
+
+    ops_by_index = dict(indexed_ops)
+    profiles = []
+    for index, outcome in outcomes:
+        results[index].update(outcome)
+        op = ops_by_index[index]
+        if op['op'] == 'create_user' and 'user' in outcome:
+            profiles.append({
+                'id': outcome['user']['id'],
+                'name': op.get('name', ''),
+                'surname': op.get('surname', ''),
+                'tier': op.get('tier', 'free'),
+                'is_admin': op.get('is_admin', False)
+            })
+
+    if profiles:
+        error = None
+        try:
+            resp = supabase.post('/rest/v1/profiles', json=profiles)
+            if resp.status_code not in [200, 201]:
+                tracing.log('admin_batch_profiles_failed', level=logging.ERROR, status=resp.status_code, response=resp.text[:500])
+                error = f"Profile insert failed: {resp.status_code}"
+        except Exception as e:
+            tracing.log_error('admin_batch_profiles_failed', e)
+            error = str(e)
+        for profile in profiles:
+            profile_cache.invalidate(profile['id'])
+        if error:
+            # The Auth users exist: report them (with their ids) as not done
+            for index, outcome in outcomes:
+                if ops_by_index[index]['op'] == 'create_user' and 'user' in outcome:
+                    results[index]['error'] = f"User created but profile was not saved ({error})"
+
+
+def _update_tiers(indexed_ops, results):
+    """One PATCH per tier for all users moving to it."""
+    by_tier = {}
+    for index, op in indexed_ops:
+        by_tier.setdefault(op['tier'], []).append((index, op))
+
+    for tier, group in by_tier.items():
+        user_ids = sorted({op['user_id'] for _, op in group})
+        resp = supabase.patch(
+            f"/rest/v1/profiles?id=in.({','.join(user_ids)})&select=id",
+            headers={'Prefer': 'return=representation'},
+            json={'tier': tier}
+        )
+        for user_id in user_ids:
+            profile_cache.invalidate(user_id)
+
+        if resp.status_code not in [200, 204]:
+            for index, _ in group:
+                results[index]['error'] = "Failed to update tier"
+            continue
+
+        updated = {row['id'] for row in resp.json()}
+        for index, op in group:
+            if op['user_id'] in updated:
+                results[index]['tier'] = tier
+            else:
+                results[index]['error'] = "User profile not found"
+
+
+def _add_achievements(indexed_ops, results):
+    """One array insert; rows that already exist are left alone."""
+    reviewed_at = datetime.now(timezone.utc).isoformat()
+    rows = {}
+    for index, op in indexed_ops:
+        key = (op['user_id'], op['cando_id'])
+        if key in rows:
+            results[index]['error'] = "Duplicate operation in batch"
+            continue
+        rows[key] = {
+            'user_id': op['user_id'],
+            'cando_id': op['cando_id'],
+            'detected_by': 'admin_manual',
+            'reviewed_by_admin': True,
+            'admin_approved': True,
+            'admin_notes': op.get('notes', ''),
+            'reviewed_at': reviewed_at
+        }
+    if not rows:
+        return
+
+    resp = supabase.post(
+        '/rest/v1/user_cando_achievements?on_conflict=user_id,cando_id&select=user_id,cando_id',
+        headers={'Prefer': 'resolution=ignore-duplicates,return=representation'},
+        json=list(rows.values())
+    )
+    if resp.status_code not in [200, 201]:
+        for index, _ in indexed_ops:
+            results[index].setdefault('error', "Failed to add achievement")
+        return
+
+    inserted = {(row['user_id'], row['cando_id']) for row in resp.json()}
+    for index, op in indexed_ops:
+        if 'error' not in results[index] and (op['user_id'], op['cando_id']) not in inserted:
+            results[index]['error'] = "Achievement already exists"
+
+
+def _remove_achievements(indexed_ops, results):
+    """One DELETE per user for all of their removed achievements."""
+    by_user = {}
+    for index, op in indexed_ops:
+        by_user.setdefault(op['user_id'], []).append((index, op))
+
+    for user_id, group in by_user.items():
+        cando_ids = sorted({op['cando_id'] for _, op in group})
+        resp = supabase.delete(
+            f"/rest/v1/user_cando_achievements?user_id=eq.{user_id}&cando_id=in.({','.join(cando_ids)})"
+        )
+        if resp.status_code not in [200, 204]:
+            for index, _ in group:
+                results[index]['error'] = "Failed to delete achievement"
+
+
+def run_batch(operations):
+    """
+    Run a list of admin operations and return one result per operation,
+    in order: {"index", "op", "success", ...} with "error" on failure.
+    Raises ValueError if the batch itself is malformed.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("operations must be a non-empty list")
+    if len(operations) > ADMIN_BATCH_MAX_OPERATIONS:
+        raise ValueError(f"At most {ADMIN_BATCH_MAX_OPERATIONS} operations per batch")
+
+    results = []
+    phases = {kind: [] for kind in OPERATIONS}
+    for index, op in enumerate(operations):
+        result = {'index': index, 'op': op.get('op') if isinstance(op, dict) else None}
+        results.append(result)
+        error = _validate(op)
+        if error:
+            result['error'] = error
+        else:
+            phases[op['op']].append((index, op))
+
+    steps = [
+        (_run_auth_calls, phases['create_user'] + phases['delete_user'] + phases['reset_password']),
+        (_update_tiers, phases['update_tier']),
+        (_add_achievements, phases['add_cando']),
+        (_remove_achievements, phases['remove_cando']),
+    ]
+    for step, indexed_ops in steps:
+        if not indexed_ops:
+            continue
+        try:
+            step(indexed_ops, results)
+        except Exception as e:
+            # A failed step only fails its own operations
+            tracing.log_error('admin_batch', e, step=step.__name__)
+            for index, _ in indexed_ops:
+                results[index].setdefault('error', str(e))
+
+    for result in results:
+        result['success'] = 'error' not in result
+    return results
@@ -0,0 +1,226 @@
+"""
+Paginated user listing for /admin/users.
+
+Users are listed by walking the Supabase Auth admin API page by page.
+Auth-side filters (email prefix, created range) are applied to each page,
+and the matching users' profiles are fetched with one id=in.(...) query
+that also carries the profile filters (tier, is_admin) and the requested
+columns. The cursor remembers the Auth page and the position in it, so
+each request touches a bounded number of users whatever the user count.
+"""
+
+import base64
+import binascii
+import json
+import os
+import re
+from urllib.parse import quote
+
+from dotenv import load_dotenv
+
+from supabase_client import supabase
+
+load_dotenv()
+
+# Users per Auth admin API page
+AUTH_PAGE_SIZE = int(os.getenv("ADMIN_USERS_AUTH_PAGE_SIZE", "200"))
+
+# Max Auth pages scanned per request when filters match few users
+MAX_SCAN_PAGES = int(os.getenv("ADMIN_USERS_MAX_SCAN_PAGES", "5"))
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# Fields that come from the Auth user rather than the profile
+AUTH_FIELDS = ('id', 'email', 'created_at', 'email_confirmed_at')
+
+# Profile columns that can be requested with fields= (supabase_schema.sql and the ADD_* migrations)
+PROFILE_FIELDS = (
+    'id', 'name', 'surname', 'profile_picture_url', 'avatar_url', 'age', 'native_language', 'country',
+    'timezone', 'english_level', 'cefr_level', 'learning_goals', 'preferred_skills', 'interests',
+    'preferred_accent', 'study_frequency', 'study_method', 'institution_name', 'tier', 'premium_until',
+    'invitation_code_used', 'is_admin', 'voice_preference', 'monthly_voice_minutes_used',
+    'monthly_voice_seconds_used', 'last_usage_reset', 'created_at', 'updated_at'
+)
+
+# Comma-separated profile columns added since, to allow without a code change
+ADMIN_USERS_EXTRA_FIELDS = os.getenv("ADMIN_USERS_EXTRA_FIELDS", "")
+
+_FIELD_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+ALLOWED_FIELDS = frozenset(AUTH_FIELDS + PROFILE_FIELDS + tuple(
+    f.strip() for f in ADMIN_USERS_EXTRA_FIELDS.split(',') if _FIELD_NAME.match(f.strip())
+))
+
+
+class AdminUsersError(Exception):
+    """Supabase could not be queried."""
+
+
+def encode_cursor(page, offset):
+    raw = json.dumps({'p': page, 'o': offset}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return (auth_page, offset) for a cursor; raises ValueError if invalid."""
+    if not cursor:
+        return 1, 0
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        page, offset = int(data['p']), int(data['o'])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+    if page < 1 or offset < 0:
+        raise ValueError("Invalid cursor")
+    return page, offset
+
+
+def parse_query(args):
+    """
+    Validate the /admin/users query string.
+
+    Supported: limit, cursor, tier, is_admin (true/false), email_prefix,
+    created_after, created_before (ISO dates) and fields (comma-separated
+    names from AUTH_FIELDS and PROFILE_FIELDS). Raises ValueError with a
+    message for the client.
+    """
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+
+    is_admin = args.get('is_admin')
+    if is_admin is not None:
+        if is_admin not in ('true', 'false'):
+            raise ValueError("is_admin must be 'true' or 'false'")
+        is_admin = is_admin == 'true'
+
+    fields = None
+    if args.get('fields'):
+        fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+        # An unknown column would make the profiles query fail upstream
+        unknown = [f for f in fields if f not in ALLOWED_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+    page, offset = decode_cursor(args.get('cursor'))
+
+    return {
+        'limit': limit,
+        'page': page,
+        'offset': offset,
+        'tier': args.get('tier') or None,
+        'is_admin': is_admin,
+        'email_prefix': (args.get('email_prefix') or '').lower() or None,
+        'created_after': args.get('created_after') or None,
+        'created_before': args.get('created_before') or None,
+        'fields': fields
+    }
+
+
+def _auth_match(user, query):
+    if query['email_prefix'] and not (user.get('email') or '').lower().startswith(query['email_prefix']):
+        return False
+    created_at = user.get('created_at') or ''
+    if query['created_after'] and created_at < query['created_after']:
+        return False
+    if query['created_before'] and created_at >= query['created_before']:
+        return False
+    return True
+
+
+def _fetch_auth_page(page, query):
+    path = f'/auth/v1/admin/users?page={page}&per_page={AUTH_PAGE_SIZE}'
+    if query['email_prefix']:
+        # Narrows the page server-side where GoTrue supports it; the prefix
+        # check above still applies
+        path += f"&filter={quote(query['email_prefix'])}"
+    resp = supabase.get(path)
+    if resp.status_code != 200:
+        raise AdminUsersError("Failed to fetch users")
+    return resp.json().get('users', [])
+
+
+def _fetch_profiles(user_ids, query, profile_columns):
+    """Profiles of the given users that match the profile filters, by id."""
+    if profile_columns is None:
+        select = '*'
+    else:
+        select = ','.join(['id'] + [c for c in profile_columns if c != 'id'])
+    path = f"/rest/v1/profiles?select={select}&id=in.({','.join(user_ids)})"
+    if query['tier']:
+        path += f"&tier=eq.{quote(query['tier'])}"
+    if query['is_admin'] is not None:
+        path += f"&is_admin=is.{'true' if query['is_admin'] else 'false'}"
+    resp = supabase.get(path)
+    if resp.status_code != 200:
+        raise AdminUsersError("Failed to fetch profiles")
+    return {p['id']: p for p in resp.json()}
+
+
+def _merge(auth_user, profile, fields):
+    user = {
+        'id': auth_user['id'],
+        'email': auth_user['email'],
+        'created_at': auth_user['created_at'],
+        'email_confirmed_at': auth_user.get('email_confirmed_at'),
+        **profile
+    }
+    if fields:
+        return {f: user.get(f) for f in fields}
+    return user
+
+
+def list_users(query):
+    """
+    Return {"users": [...], "next_cursor": str or None} for a parsed query.
+
+    next_cursor is None once the last Auth page has been read. A page can
+    hold fewer than limit users (even none) when the filters are
+    selective; keep following next_cursor until it is None.
+    """
+    fields = query['fields']
+    profile_filtered = query['tier'] is not None or query['is_admin'] is not None
+    if fields:
+        profile_columns = [f for f in fields if f not in AUTH_FIELDS]
+    else:
+        profile_columns = None
+    need_profiles = profile_filtered or profile_columns is None or bool(profile_columns)
+
+    limit = query['limit']
+    page, offset = query['page'], query['offset']
+    users = []
+
+    for _ in range(MAX_SCAN_PAGES):
+        auth_users = _fetch_auth_page(page, query)
+        last_page = len(auth_users) < AUTH_PAGE_SIZE
+
+        batch = [(i, u) for i, u in enumerate(auth_users) if i >= offset and _auth_match(u, query)]
+        if not profile_filtered:
+            # Every candidate is kept, so only the ones that fit are needed
+            batch = batch[:limit - len(users)]
+
+        profiles = {}
+        if batch and need_profiles:
+            profiles = _fetch_profiles([u['id'] for _, u in batch], query, profile_columns)
+
+        for i, auth_user in batch:
+            profile = profiles.get(auth_user['id'])
+            if profile is None:
+                if profile_filtered:
+                    continue
+                profile = {}
+            users.append(_merge(auth_user, profile, fields))
+            if len(users) == limit:
+                more = i + 1 < len(auth_users) or not last_page
+                return {'users': users, 'next_cursor': encode_cursor(page, i + 1) if more else None}
+
+        if last_page:
+            return {'users': users, 'next_cursor': None}
+        page, offset = page + 1, 0
+
+    # Scan budget used up; continue from the next Auth page
+    return {'users': users, 'next_cursor': encode_cursor(page, 0)}
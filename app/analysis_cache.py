@@ -0,0 +1,144 @@
+"""
+Persistent, content-addressed cache of transcript analysis results.
+
+The key is a hash of everything that determines the model's answer: the
+normalized transcript, the learner level, the catalog version and the
+candidate statement ids, the prompt version and the model. Results are
+stored in a local SQLite file (ANALYSIS_CACHE_DB) and the least recently
+used entries are evicted once the stored results exceed
+ANALYSIS_CACHE_MAX_BYTES.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import tracing
+
+load_dotenv()
+
+ANALYSIS_CACHE_DB = os.getenv(
+    "ANALYSIS_CACHE_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analysis_cache.db')
+)
+
+# Total size of cached results before old entries are evicted
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON analysis_cache(last_used);
+"""
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_transcript(transcript):
+    """Collapse whitespace so formatting-only differences share a cache entry."""
+    return _WHITESPACE.sub(' ', transcript).strip()
+
+
+def make_key(transcript, user_level, catalog_version, statement_ids, prompt_version, model):
+    """Content hash identifying one analysis request."""
+    h = hashlib.sha256()
+    for part in (normalize_transcript(transcript), user_level, catalog_version,
+                 ','.join(sorted(statement_ids)), prompt_version, model):
+        part = str(part).encode('utf-8')
+        # Length-prefix each part so boundaries can't be confused
+        h.update(len(part).to_bytes(8, 'big'))
+        h.update(part)
+    return h.hexdigest()
+
+
+class AnalysisCache:
+    """SQLite-backed LRU cache with a total size limit."""
+
+    def __init__(self, db_path=ANALYSIS_CACHE_DB, max_bytes=ANALYSIS_CACHE_MAX_BYTES):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self):
+        """Return this process's connection, opening a new one after a fork."""
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def get(self, key):
+        """Return the cached result for key, or None."""
+        try:
+            with self._lock:
+                db = self._db()
+                row = db.execute('SELECT value FROM analysis_cache WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                db.execute('UPDATE analysis_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+                self.hits += 1
+        except sqlite3.Error as e:
+            tracing.log_error('analysis_cache_read', e)
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, result):
+        """Store a result and evict the least recently used entries if over size."""
+        value = json.dumps(result)
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._db()
+                db.execute(
+                    'INSERT OR REPLACE INTO analysis_cache (key, value, size, created_at, last_used) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, value, len(value), now, now)
+                )
+                self._evict(db)
+        except sqlite3.Error as e:
+            tracing.log_error('analysis_cache_write', e)
+
+    def _evict(self, db):
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM analysis_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop oldest entries until we're back under 90% of the limit
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        doomed = []
+        for key, size in db.execute('SELECT key, size FROM analysis_cache ORDER BY last_used').fetchall():
+            doomed.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        db.executemany('DELETE FROM analysis_cache WHERE key = ?', doomed)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analysis_cache'
+            ).fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+
+# Shared instance for the whole process
+analysis_cache = AnalysisCache()
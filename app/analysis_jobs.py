@@ -0,0 +1,378 @@
+"""
+Background job queue for transcript Can-Do analysis.
+
+Jobs live in a SQLite table (a local file by default, ANALYSIS_JOBS_DB),
+so they survive restarts and several worker processes on one host can
+share the queue. A bounded pool of worker threads claims jobs with a
+lease, runs the analysis handler, and retries failures with backoff.
+
+Jobs are idempotent on (user_id, session_id): submitting the same
+session again returns the existing job instead of paying for another LLM
+call. Only a job that has failed for good is run again on resubmission.
+Each claim gets a fresh lease token, and only the worker holding the
+current token can finish the job, so a worker whose lease was reclaimed
+cannot overwrite the newer result. The running worker renews its lease,
+so only jobs of a worker that died are reclaimed. Finished jobs are
+purged after ANALYSIS_JOB_RETENTION.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+import tracing
+
+load_dotenv()
+
+ANALYSIS_JOBS_DB = os.getenv(
+    "ANALYSIS_JOBS_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analysis_jobs.db')
+)
+
+# Analyses running at the same time in this process
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "4"))
+
+# Attempts per job before it is marked failed
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "3"))
+
+# Max jobs waiting to run; submissions beyond this are rejected
+ANALYSIS_MAX_QUEUED = int(os.getenv("ANALYSIS_MAX_QUEUED", "200"))
+
+# Seconds a job's lease lasts without renewal; the worker running it renews
+# it every third of that, so only a job whose worker died is reclaimed
+JOB_LEASE_SECONDS = int(os.getenv("ANALYSIS_JOB_LEASE_SECONDS", "60"))
+
+# Seconds finished (done or failed) jobs are kept; resubmitting a purged
+# session queues a new job, which the analysis cache usually answers
+ANALYSIS_JOB_RETENTION = int(os.getenv("ANALYSIS_JOB_RETENTION", str(7 * 24 * 3600)))
+
+# How often a worker purges finished jobs past ANALYSIS_JOB_RETENTION (seconds)
+PURGE_INTERVAL = 3600
+
+# Base delay before retrying a failed attempt (seconds)
+RETRY_BACKOFF = 5
+
+# How often idle workers look for jobs queued by other processes (seconds)
+POLL_INTERVAL = 1.0
+
+# How often wait_async() checks on a job (seconds); it can't be woken like wait()
+ASYNC_POLL_INTERVAL = 0.2
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_jobs (
+    id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    run_after REAL NOT NULL,
+    lease_expires REAL,
+    lease_token TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (user_id, session_id)
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs(status, run_after);
+"""
+
+_COLUMNS = 'id, session_id, user_id, status, attempts, payload, result, error, created_at, updated_at'
+
+
+class QueueFull(Exception):
+    """Too many jobs are already waiting."""
+
+
+def _row_to_job(row):
+    job = dict(zip([c.strip() for c in _COLUMNS.split(',')], row))
+    job['payload'] = json.loads(job['payload'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+class JobQueue:
+    """SQLite-backed analysis job queue with a bounded worker pool."""
+
+    def __init__(self, handler, db_path=ANALYSIS_JOBS_DB, workers=ANALYSIS_WORKERS,
+                 max_attempts=ANALYSIS_MAX_ATTEMPTS, max_queued=ANALYSIS_MAX_QUEUED):
+        """
+        handler(payload, final_attempt) runs one job and returns its
+        JSON-serializable result. Raising an exception fails the attempt.
+        """
+        self.handler = handler
+        self.db_path = db_path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_queued = max_queued
+        self._conn = None
+        self._conn_pid = None
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._threads_pid = None
+        self._last_purge = 0.0
+
+    def _db(self):
+        """Return this process's connection, opening a new one after a fork."""
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def _ensure_workers(self):
+        pid = os.getpid()
+        if self._threads_pid == pid:
+            return
+        with self._db_lock:
+            if self._threads_pid == pid:
+                return
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f'analysis-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._threads_pid = pid
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def submit(self, session_id, user_id, payload):
+        """
+        Queue an analysis for user_id's session_id. Returns (job, created).
+
+        An existing queued, running or finished job for the same user and
+        session is returned as is; a failed one is reset and queued again.
+        """
+        self._ensure_workers()
+        now = time.time()
+        with self._db_lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute(
+                    f'SELECT {_COLUMNS} FROM analysis_jobs WHERE user_id = ? AND session_id = ?',
+                    (user_id, session_id)
+                ).fetchone()
+                if row is not None and row[3] != FAILED:
+                    db.execute('COMMIT')
+                    return _row_to_job(row), False
+
+                queued = db.execute(
+                    'SELECT COUNT(*) FROM analysis_jobs WHERE status IN (?, ?)', (QUEUED, RUNNING)
+                ).fetchone()[0]
+                if queued >= self.max_queued:
+                    raise QueueFull(f"{queued} analysis jobs already waiting")
+
+                if row is None:
+                    job_id = str(uuid.uuid4())
+                    db.execute(
+                        'INSERT INTO analysis_jobs (id, session_id, user_id, status, attempts, payload, '
+                        'run_after, created_at, updated_at) VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)',
+                        (job_id, session_id, user_id, QUEUED, json.dumps(payload), now, now, now)
+                    )
+                else:
+                    job_id = row[0]
+                    db.execute(
+                        'UPDATE analysis_jobs SET status = ?, attempts = 0, payload = ?, result = NULL, '
+                        'error = NULL, run_after = ?, lease_expires = NULL, lease_token = NULL, updated_at = ? '
+                        'WHERE id = ?',
+                        (QUEUED, json.dumps(payload), now, now, job_id)
+                    )
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+        self._notify()
+        return self.get(job_id), True
+
+    def get(self, job_id):
+        """Return a job as a dict, or None."""
+        with self._db_lock:
+            row = self._db().execute(f'SELECT {_COLUMNS} FROM analysis_jobs WHERE id = ?', (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def wait(self, job_id, timeout):
+        """Block until the job is done or failed, or timeout passes. Returns the job."""
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.time()
+            if job is None or job['status'] in (DONE, FAILED) or remaining <= 0:
+                return job
+            with self._wakeup:
+                self._wakeup.wait(min(remaining, POLL_INTERVAL))
+
+    async def wait_async(self, job_id, timeout):
+        """wait() for async code, without holding a thread while the job runs."""
+        deadline = time.time() + timeout
+        while True:
+            job = await asyncio.to_thread(self.get, job_id)
+            remaining = deadline - time.time()
+            if job is None or job['status'] in (DONE, FAILED) or remaining <= 0:
+                return job
+            await asyncio.sleep(min(remaining, ASYNC_POLL_INTERVAL))
+
+    def _claim(self):
+        """Take the next runnable job (queued, or running with an expired lease)."""
+        now = time.time()
+        with self._db_lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute(
+                    f'SELECT {_COLUMNS} FROM analysis_jobs '
+                    'WHERE (status = ? AND run_after <= ?) OR (status = ? AND lease_expires < ?) '
+                    'ORDER BY run_after LIMIT 1',
+                    (QUEUED, now, RUNNING, now)
+                ).fetchone()
+                if row is None:
+                    db.execute('COMMIT')
+                    return None
+                token = uuid.uuid4().hex
+                db.execute(
+                    'UPDATE analysis_jobs SET status = ?, attempts = attempts + 1, lease_expires = ?, '
+                    'lease_token = ?, updated_at = ? WHERE id = ?',
+                    (RUNNING, now + JOB_LEASE_SECONDS, token, now, row[0])
+                )
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        job = _row_to_job(row)
+        job['attempts'] += 1
+        job['status'] = RUNNING
+        job['lease_token'] = token
+        return job
+
+    def _finish(self, job, status, result=None, error=None, run_after=None):
+        """
+        Record the outcome of job's attempt. Returns False (and changes
+        nothing) if the lease was reclaimed by another worker meanwhile.
+        """
+        now = time.time()
+        with self._db_lock:
+            cursor = self._db().execute(
+                'UPDATE analysis_jobs SET status = ?, result = ?, error = ?, run_after = COALESCE(?, run_after), '
+                'lease_expires = NULL, lease_token = NULL, updated_at = ? WHERE id = ? AND lease_token = ?',
+                (status, json.dumps(result) if result is not None else None, error, run_after, now,
+                 job['id'], job['lease_token'])
+            )
+        if cursor.rowcount == 0:
+            tracing.log('analysis_job_lease_lost', logging.WARNING, job_id=job['id'], attempt=job['attempts'])
+            return False
+        self._notify()
+        return True
+
+    def _renew_lease(self, job):
+        """Extend job's lease. Returns False if another worker has reclaimed it."""
+        now = time.time()
+        with self._db_lock:
+            cursor = self._db().execute(
+                'UPDATE analysis_jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND lease_token = ?',
+                (now + JOB_LEASE_SECONDS, now, job['id'], job['lease_token'])
+            )
+        return cursor.rowcount == 1
+
+    def _keep_lease(self, job, done):
+        """Renew job's lease until done is set, so a long analysis isn't reclaimed and run twice."""
+        while not done.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                if not self._renew_lease(job):
+                    if not done.is_set():
+                        tracing.log('analysis_job_lease_lost', logging.WARNING, job_id=job['id'],
+                                    attempt=job['attempts'])
+                    return
+            except sqlite3.Error as e:
+                # The next renewal may still succeed before the lease runs out
+                tracing.log_error('analysis_job_renew', e, job_id=job['id'])
+
+    def _run(self, job):
+        final_attempt = job['attempts'] >= self.max_attempts
+        done = threading.Event()
+        threading.Thread(target=self._keep_lease, args=(job, done), name=f"lease-{job['id'][:8]}",
+                         daemon=True).start()
+        try:
+            result = self.handler(job['payload'], final_attempt)
+        except Exception as e:
+            done.set()
+            tracing.log_error('analysis_job_failed', e, job_id=job['id'], attempt=job['attempts'])
+            if final_attempt:
+                self._finish(job, FAILED, error=str(e))
+            else:
+                # Exponential backoff with jitter before the next attempt
+                delay = RETRY_BACKOFF * (2 ** (job['attempts'] - 1)) * random.uniform(0.5, 1.5)
+                self._finish(job, QUEUED, error=str(e), run_after=time.time() + delay)
+            return
+        done.set()
+        self._finish(job, DONE, result=result)
+
+    def _worker_loop(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                tracing.log_error('analysis_job_claim', e)
+                job = None
+            if job is None:
+                self._purge()
+                with self._wakeup:
+                    self._wakeup.wait(POLL_INTERVAL)
+                continue
+            self._run(job)
+
+    def _purge(self):
+        """Delete finished jobs older than ANALYSIS_JOB_RETENTION, at most once per PURGE_INTERVAL."""
+        now = time.time()
+        if now - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        try:
+            with self._db_lock:
+                cursor = self._db().execute(
+                    'DELETE FROM analysis_jobs WHERE status IN (?, ?) AND updated_at < ?',
+                    (DONE, FAILED, now - ANALYSIS_JOB_RETENTION)
+                )
+        except sqlite3.Error as e:
+            tracing.log_error('analysis_job_purge', e)
+            return
+        if cursor.rowcount:
+            tracing.log('analysis_jobs_purged', count=cursor.rowcount)
+
+    def stats(self):
+        """Number of jobs per status."""
+        with self._db_lock:
+            rows = self._db().execute('SELECT status, COUNT(*) FROM analysis_jobs GROUP BY status').fetchall()
+        return dict(rows)
+
+
+def job_response(job):
+    """Public view of a job for the API."""
+    return {
+        "job_id": job['id'],
+        "session_id": job['session_id'],
+        "status": job['status'],
+        "attempts": job['attempts'],
+        "result": job['result'],
+        "error": job['error']
+    }
@@ -1,29 +1,58 @@
 import os
 import json
+import math
+import time
+import uuid
 import requests
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, request, jsonify, render_template, session, Response
 from dotenv import load_dotenv
 import openai
 from flask_cors import CORS # Import CORS
+from prompt_store import prompt_store
+from supabase_client import supabase, gather
+from auth import get_user_id, get_user_id_async
+import profile_cache
+import admin_users
+import admin_batch
+from cando_catalog import catalog, CatalogError, relevant_levels
+from cando_progress import build_progress
+from cando_achievements import AchievementWriter
+from analysis_jobs import JobQueue, QueueFull, DONE, FAILED, job_response
+from analysis_cache import analysis_cache, make_key
+from cando_retrieval import retriever
+from transcript_analysis import (analyze_transcript, ANALYSIS_MODEL, ANALYSIS_PROMPT_VERSION,
+                                 ANALYSIS_CHUNK_TOKENS)
+from chat_stream import relay_completion, SSE_HEADERS
+from realtime_pool import realtime_pool, RealtimeSessionError
+from usage_meter import usage_meter, QuotaExceeded, USAGE_REQUIRE_AUTH
+from rate_limit import rate_limiter, Throttled, client_ip
+from llm_gateway import llm_gateway, CircuitOpen
+import tracing
+from tracing import log_error
+from conversation_store import ConversationStore
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = "your_secure_secret_key"
-# Initialize CORS with explicit settings - allow Vercel domain
-CORS(app, resources={
-    r"/*": {
-        "origins": [
-            "https://bernardo-s-teaching-assistant.vercel.app",
-            "http://localhost:3000",
-            "http://127.0.0.1:3000"
-        ],
-        "methods": ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"],
-        "supports_credentials": True
-    }
-})
+# Request tracing, Server-Timing and GET /metrics
+tracing.init_app(app)
+# CORS settings - allow Vercel domain (also applied to the async routes in asgi.py)
+CORS_SETTINGS = {
+    "origins": [
+        "https://bernardo-s-teaching-assistant.vercel.app",
+        "http://localhost:3000",
+        "http://127.0.0.1:3000"
+    ],
+    "methods": ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+    "allow_headers": ["Content-Type", "Authorization"],
+    # Lets the frontend read how long to wait after a 429
+    "expose_headers": ["Retry-After"],
+    "supports_credentials": True
+}
+# Initialize CORS with explicit settings
+CORS(app, resources={r"/*": CORS_SETTINGS})
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 openai.api_key = OPENAI_API_KEY
@@ -32,6 +61,18 @@ openai.api_key = OPENAI_API_KEY
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
+# Model used for text chat
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
+
+# Seconds a text chat reply (or history summary) may take, streamed or not
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", "30"))
+
+# Summarize turns that fall out of the chat history window instead of dropping them
+CHAT_HISTORY_SUMMARIZE = os.getenv("CHAT_HISTORY_SUMMARIZE", "0") == "1"
+
+# Longest /analyze_session?wait=N may wait for its job before answering 202 with the job id
+ANALYSIS_MAX_WAIT = int(os.getenv("ANALYSIS_MAX_WAIT", "90"))
+
 # DISABLED: Old template route removed for security
 # The React app on Vercel is the main frontend
 # @app.route("/")
@@ -41,198 +82,302 @@ SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
 @app.route("/clear_context", methods=["POST"])
 def clear_context():
-    # Clears the conversation stored in the session
+    # Clears the conversation stored for this session
+    conversations.clear(session.pop('conversation_id', None))
     session.pop('context', None)
     return jsonify({"message": "Context cleared."})
 
+def summarize_turns(summary, dropped):
+    """Fold turns that left the history window into the running summary."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in dropped)
+    previous = f"Summary so far: {summary}\n\n" if summary else ""
+    response = llm_gateway.chat(
+        'summarize', CHAT_MODEL,
+        messages=[
+            {"role": "system", "content": "Summarize this English practice conversation in at most 120 words. Keep the learner's name, interests, mistakes and topics discussed."},
+            {"role": "user", "content": f"{previous}New turns:\n{transcript}"}
+        ],
+        deadline=CHAT_DEADLINE,
+        temperature=0.2,
+        max_tokens=200
+    )
+    return response.choices[0].message.content.strip()
+
+conversations = ConversationStore(summarizer=summarize_turns if CHAT_HISTORY_SUMMARIZE else None)
+
+def unavailable_response(e):
+    """503 for an llm_gateway.CircuitOpen error, with Retry-After."""
+    retry_after = str(max(1, round(e.retry_after)))
+    return jsonify({"error": str(e), "retry_after": int(retry_after)}), 503, {"Retry-After": retry_after}
+
+def throttled_response(e):
+    """429 for a rate_limit.Throttled error, with Retry-After."""
+    body = {"error": str(e), "retry_after": int(e.retry_after_header), "scope": e.scope}
+    return jsonify(body), 429, {"Retry-After": e.retry_after_header}
+
+def check_rate_limit(endpoint, user_id=None):
+    """
+    Count this request against the user's (if known) and the client IP's
+    limits for the endpoint. Returns a 429 response, or None if admitted.
+    """
+    try:
+        rate_limiter.hit(endpoint, user_id,
+                         client_ip(request.remote_addr, request.headers.get('X-Forwarded-For')))
+    except Throttled as e:
+        return throttled_response(e)
+    return None
+
+def get_conversation_id():
+    """Return this session's conversation id, starting a conversation if needed."""
+    conversation_id = session.get('conversation_id')
+    if not conversation_id:
+        conversation_id = uuid.uuid4().hex
+        session['conversation_id'] = conversation_id
+        # Carry over a conversation from the old cookie-stored context
+        legacy_context = session.pop('context', None)
+        if legacy_context:
+            conversations.append(conversation_id, *legacy_context)
+    return conversation_id
+
 @app.route("/chat_text", methods=["POST"])
-def chat_text():
+def chat_text(stream=False):
     """
     Handles text chat with the ChatCompletion API. 
     Combines prompt.json as a system_prompt to maintain consistency
     between text and Realtime.
+
+    The conversation is kept server-side under the session's
+    conversation id, windowed to CHAT_HISTORY_TOKEN_BUDGET tokens.
+
+    With ?stream=1 (or via /chat_text/stream) the reply is relayed as
+    server-sent events while it is generated: {"delta": ...} messages,
+    then a "done" event with {"response_text": ...}.
+
+    Rate limited per client IP, and per user when a valid Bearer token is
+    sent (429 with Retry-After).
     """
     data = request.json
     if not data or 'text' not in data:
         return jsonify({"error": "You have not entered text"}), 400
 
-    user_input = data['text']
-    context = session.get('context', [])
+    user_id = None
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('Bearer '):
+        user_id, error = get_user_id(auth_header.split(' ')[1])
+    limited = check_rate_limit('chat', user_id)
+    if limited:
+        return limited
+
+    conversation_id = get_conversation_id()
+    user_message = {"role": "user", "content": data['text']}
 
-    # Load the content of prompt.json as a dictionary
-    with open('prompt.json', 'r') as f:
-        prompt_data = json.load(f)
+    # Cached, pre-serialized prompt.json
+    system_prompt = prompt_store.base_instructions()
 
-    # Convert the entire prompt data to a JSON string
-    system_prompt = json.dumps(prompt_data)
+    # Stored history (summary + recent turns) followed by the user's input
+    history = conversations.prompt_messages(conversations.load(conversation_id))
+    messages = [{"role": "system", "content": system_prompt}] + history + [user_message]
 
-    # Add the user's input to the context
-    context.append({"role": "user", "content": user_input})
+    if stream or request.args.get('stream') in ('1', 'true'):
+        return stream_chat_reply(conversation_id, user_message, messages)
 
     try:
-        chat_response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt}
-            ] + context
-        )
+        # Hedged: a slow first attempt gets a second one after the recent p95 latency
+        chat_response = llm_gateway.chat('chat', CHAT_MODEL, messages, deadline=CHAT_DEADLINE, hedge=True)
         response_message = chat_response.choices[0].message.content.strip()
 
-        # Save the assistant's response in the context
-        context.append({"role": "assistant", "content": response_message})
-        session['context'] = context
+        # Save the turn in the conversation
+        conversations.append(conversation_id, user_message,
+                             {"role": "assistant", "content": response_message})
 
         return jsonify({"response_text": response_message})
 
+    except Throttled as e:
+        return throttled_response(e)
+    except CircuitOpen as e:
+        return unavailable_response(e)
+    except Exception as e:
+        log_error('chat_text', e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/chat_text/stream", methods=["POST"])
+def chat_text_stream():
+    """Same as POST /chat_text?stream=1."""
+    return chat_text(stream=True)
+
+def stream_chat_reply(conversation_id, user_message, messages):
+    """Open a streamed completion and relay it to the client as SSE."""
+    try:
+        # Opening is timed as llm.chat_stream.open; the whole stream is timed in relay_completion
+        completion = llm_gateway.stream('chat_stream', CHAT_MODEL, messages, deadline=CHAT_DEADLINE,
+                                        stream_options={"include_usage": True})
+    except Throttled as e:
+        return throttled_response(e)
+    except CircuitOpen as e:
+        return unavailable_response(e)
     except Exception as e:
+        log_error('chat_text_stream', e)
         return jsonify({"error": str(e)}), 500
 
+    def save_turn(response_message):
+        conversations.append(conversation_id, user_message,
+                             {"role": "assistant", "content": response_message})
+
+    response = Response(
+        relay_completion(completion, save_turn),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
+    # Frees the model slot, also when the client goes away mid-stream
+    response.call_on_close(completion.close)
+    return response
+
 @app.route("/webrtc_session", methods=["POST"])
 def webrtc_session():
     """
     Handles the creation of the Realtime (WebRTC) session for voice.
     Includes VAD configuration and prompt.json as instructions.
+
+    Sessions come from the pre-warmed pool in realtime_pool; for a topic,
+    the client applies the returned session_update before talking.
+
+    The learner's monthly voice minutes are checked first (403 with
+    limit_reached when used up). The response's usage object holds the
+    usage_session_id the client reports to /voice_usage/heartbeat and
+    /voice_usage/end.
+
+    Rate limited per client IP and per authenticated user, and session
+    creation is capped by MODEL_CONCURRENCY (429 with Retry-After).
     """
     try:
-        # Load the prompt from prompt.json as a dictionary
-        with open('prompt.json', 'r') as f:
-            prompt_data = json.load(f)
-
         # Check if there's a topic in the request
         data = request.json or {}
         topic = data.get('topic')
         user_id = data.get('user_id')
 
-        if topic:
-            # Add topic context to the prompt data
-            prompt_data['behavior']['current_topic'] = {
-                "title": topic.get('title', ''),
-                "description": topic.get('description', ''),
-                "instructions": "Please start the conversation by introducing this topic and engaging the user in a natural, friendly way remember always in english."
-            }
+        # The token's user when the client sends one. Without metering, older
+        # clients that only send user_id still get a session
+        auth_header = request.headers.get('Authorization')
+        authenticated = bool(auth_header and auth_header.startswith('Bearer '))
+        if authenticated:
+            user_id, error = get_user_id(auth_header.split(' ')[1])
+            if error:
+                return jsonify({"error": error}), 401
+        elif USAGE_REQUIRE_AUTH or usage_meter.enabled:
+            # An unauthenticated session could not be metered against anyone's quota
+            return jsonify({"error": "Unauthorized"}), 401
+
+        # Only a verified user id gets its own bucket; the body's user_id could be anyone's
+        limited = check_rate_limit('voice', user_id if authenticated else None)
+        if limited:
+            return limited
 
-        # Fetch user's voice preference from Supabase
+        # Fetch user's voice preference (cached profile)
         voice = "sage"  # Default voice
+        profile = None
         if user_id and SUPABASE_URL and SUPABASE_SERVICE_KEY:
             try:
-                supabase_headers = {
-                    "apikey": SUPABASE_SERVICE_KEY,
-                    "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-                    "Content-Type": "application/json"
-                }
-                profile_response = requests.get(
-                    f"{SUPABASE_URL}/rest/v1/profiles?id=eq.{user_id}&select=voice_preference",
-                    headers=supabase_headers
-                )
-                if profile_response.status_code == 200:
-                    profiles = profile_response.json()
-                    if profiles and len(profiles) > 0:
-                        voice = profiles[0].get('voice_preference', 'sage')
+                profile, error = profile_cache.get_profile(user_id)
+                if profile:
+                    voice = profile.get('voice_preference', 'sage')
             except Exception as e:
-                print(f"Error fetching voice preference: {e}")
+                log_error('webrtc_session_voice_preference', e, user_id=user_id)
                 # Continue with default voice if fetch fails
 
-        # Convert the entire prompt data to a JSON string
-        instructions_str = json.dumps(prompt_data)
-
-        # Define the model name for the WebSocket URL
-        realtime_model_name = "gpt-4o-realtime-preview"
-
-        url = "https://api.openai.com/v1/realtime/sessions"
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        body = {
-            "model": realtime_model_name, # Use the defined model name
-            "voice": voice,
-            "modalities": ["audio", "text"],
-            "instructions": instructions_str,
-            # Audio format configuration
-            "input_audio_format": "pcm16",
-            "output_audio_format": "pcm16",
-            # Enable input audio transcription
-            "input_audio_transcription": {
-                "model": "whisper-1"
-            },
-            # VAD configuration (server-side voice activity detection)
-            "turn_detection": {
-                "type": "server_vad",
-                "threshold": 0.5,
-                "prefix_padding_ms": 300,
-                "silence_duration_ms": 1000,
-                "create_response": True,
-                "interrupt_response": True
-            }
-        }
-
-        resp = requests.post(url, headers=headers, json=body, timeout=30)
-        resp.raise_for_status() # This will raise an HTTPError for bad responses (4xx or 5xx)
-        session_json = resp.json()  # Ephemeral token returned
-
-        print(f"OpenAI Realtime API session_json response: {session_json}") # Log the full response
-
-        session_id = session_json.get('id')
-        ephemeral_token = session_json.get('client_secret', {}).get('value')
-
-        if not session_id:
-            print(f"Error: Session ID not found in OpenAI response. Full response: {session_json}")
-            return jsonify({"error": "Session ID not found in OpenAI response"}), 500
-
-        if not ephemeral_token:
-            print(f"Error: Ephemeral token not found in OpenAI response. Full response: {session_json}")
-            return jsonify({"error": "Ephemeral token not found in OpenAI response"}), 500
+        # Monthly quota from the in-memory usage counter (no database call)
+        metered = bool(usage_meter.enabled and user_id and SUPABASE_URL and SUPABASE_SERVICE_KEY)
+        if metered:
+            try:
+                usage_meter.check(user_id, profile)
+            except QuotaExceeded as e:
+                return jsonify({"error": str(e), "limit_reached": True, "remaining_seconds": 0}), 403
 
-        # Construct the WebSocket URL as wss://api.openai.com/v1/realtime?model={model_name}
-        websocket_url = f"wss://api.openai.com/v1/realtime?model={realtime_model_name}"
-        print(f"Constructed WebSocket URL: {websocket_url}") # Log the constructed URL
+        # A pre-created session from the pool, or a new one if the pool is empty
+        session_info = realtime_pool.acquire(voice, topic)
 
         return jsonify({
-            "session_id": session_id,
-            "websocket_url": websocket_url,
-            "ephemeral_token": ephemeral_token # Return the ephemeral token to the frontend
+            "session_id": session_info['session_id'],
+            "websocket_url": session_info['websocket_url'],
+            "ephemeral_token": session_info['ephemeral_token'],  # Return the ephemeral token to the frontend
+            # session.update event to send first when the topic is applied to a pooled session
+            "session_update": session_info['session_update'],
+            # Metered from here on: usage_session_id, remaining_seconds, heartbeat_interval
+            "usage": usage_meter.start_session(user_id, profile) if metered else None
         })
 
     except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        print(f"Response status code: {http_err.response.status_code}")
-        print(f"Response text: {http_err.response.text}")
+        log_error('webrtc_session_openai_http', http_err, status=http_err.response.status_code,
+                  response=http_err.response.text[:500])
         return jsonify({"error": f"HTTP error from OpenAI: {http_err.response.status_code} - {http_err.response.text}"}), 500
+    except Throttled as e:
+        return throttled_response(e)
+    except RealtimeSessionError as e:
+        log_error('webrtc_session_invalid_response', e)
+        return jsonify({"error": str(e)}), 500
+    except Exception as e:
+        log_error('webrtc_session', e)
+        return jsonify({"error": str(e)}), 500
+
+def voice_usage_event(event):
+    """Apply a heartbeat or end event to the usage session named in the body."""
+    try:
+        # Also accepts text/plain bodies from fetch(..., {keepalive: true}) on page unload
+        data = request.get_json(force=True, silent=True) or {}
+        usage_session_id = data.get('usage_session_id')
+        if not usage_session_id:
+            return jsonify({"error": "Missing required field: usage_session_id"}), 400
+
+        result = event(usage_session_id)
+        if result is None:
+            return jsonify({"error": "Unknown or expired usage session"}), 404
+        return jsonify(result)
+
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        log_error('voice_usage_event', e)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/voice_usage/heartbeat", methods=["POST"])
+def voice_usage_heartbeat():
+    """
+    Meter an ongoing voice session. Sent every usage.heartbeat_interval
+    seconds; the client ends the conversation when limit_reached is true.
+    """
+    return voice_usage_event(usage_meter.heartbeat)
+
+@app.route("/voice_usage/end", methods=["POST"])
+def voice_usage_end():
+    """Meter the last part of a voice session and close it."""
+    return voice_usage_event(usage_meter.end_session)
+
 # Helper function to verify admin access
 def verify_admin(user_token):
     """Verify user is admin using Supabase REST API"""
-    # Get user from token
-    headers = {
-        'Authorization': f'Bearer {user_token}',
-        'apikey': SUPABASE_SERVICE_KEY
-    }
-    user_resp = requests.get(f'{SUPABASE_URL}/auth/v1/user', headers=headers)
-    if user_resp.status_code != 200:
-        return None, "Invalid token"
-
-    user_data = user_resp.json()
-    user_id = user_data.get('id')
-
-    # Check if user is admin
-    headers = {
-        'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-        'apikey': SUPABASE_SERVICE_KEY,
-        'Content-Type': 'application/json'
-    }
-    profile_resp = requests.get(
-        f'{SUPABASE_URL}/rest/v1/profiles?id=eq.{user_id}&select=is_admin',
-        headers=headers
-    )
+    # Get user from token (verified locally and cached)
+    user_id, error = get_user_id(user_token)
+    if error:
+        return None, error
+
+    # Check if user is admin (cached profile)
+    profile, error = profile_cache.get_profile(user_id)
+    if error:
+        return None, "Failed to check admin status"
+
+    if not profile.get('is_admin'):
+        return None, "Forbidden: Admin access required"
+
+    return user_id, None
+
+async def verify_admin_async(user_token):
+    """verify_admin() for the async routes in asgi.py."""
+    user_id, error = await get_user_id_async(user_token)
+    if error:
+        return None, error
 
-    if profile_resp.status_code != 200:
+    profile, error = await profile_cache.get_profile_async(user_id)
+    if error:
         return None, "Failed to check admin status"
 
-    profiles = profile_resp.json()
-    if not profiles or not profiles[0].get('is_admin'):
+    if not profile.get('is_admin'):
         return None, "Forbidden: Admin access required"
 
     return user_id, None
@@ -241,8 +386,13 @@ def verify_admin(user_token):
 @app.route("/admin/users", methods=["GET"])
 def admin_list_users():
     """
-    Lists all users (requires admin authentication).
-    Returns merged auth and profile data.
+    Lists users a page at a time (requires admin authentication).
+    Returns merged auth and profile data and a next_cursor to pass back
+    as ?cursor= (null on the last page).
+
+    Optional query parameters: limit (default 50, max 200), cursor, tier,
+    is_admin=true|false, email_prefix, created_after, created_before and
+    fields (comma-separated, e.g. fields=id,email,tier).
     """
     try:
         # Verify admin access
@@ -255,39 +405,18 @@ def admin_list_users():
         if error:
             return jsonify({"error": error}), 403 if "Forbidden" in error else 401
 
-        # List all users using Supabase Admin API
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY
-        }
-        users_resp = requests.get(f'{SUPABASE_URL}/auth/v1/admin/users', headers=headers)
-        if users_resp.status_code != 200:
-            return jsonify({"error": "Failed to fetch users"}), 500
-
-        auth_users = users_resp.json().get('users', [])
-
-        # Get all profiles
-        headers['Content-Type'] = 'application/json'
-        profiles_resp = requests.get(f'{SUPABASE_URL}/rest/v1/profiles?select=*', headers=headers)
-        profiles = profiles_resp.json() if profiles_resp.status_code == 200 else []
-        profiles_dict = {p['id']: p for p in profiles}
-
-        # Merge auth and profile data
-        merged_users = []
-        for auth_user in auth_users:
-            profile = profiles_dict.get(auth_user['id'], {})
-            merged_users.append({
-                'id': auth_user['id'],
-                'email': auth_user['email'],
-                'created_at': auth_user['created_at'],
-                'email_confirmed_at': auth_user.get('email_confirmed_at'),
-                **profile
-            })
-
-        return jsonify({"users": merged_users})
+        try:
+            query = admin_users.parse_query(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        try:
+            return jsonify(admin_users.list_users(query))
+        except admin_users.AdminUsersError as e:
+            return jsonify({"error": str(e)}), 500
 
     except Exception as e:
-        print(f"Error in admin_list_users: {e}")
+        log_error('admin_list_users', e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/admin/users", methods=["POST"])
@@ -319,14 +448,8 @@ def admin_create_user():
             return jsonify({"error": "Email and password are required"}), 400
 
         # Create auth user using Supabase Admin API
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY,
-            'Content-Type': 'application/json'
-        }
-        create_resp = requests.post(
-            f'{SUPABASE_URL}/auth/v1/admin/users',
-            headers=headers,
+        create_resp = supabase.post(
+            '/auth/v1/admin/users',
             json={
                 'email': email,
                 'password': password,
@@ -340,9 +463,8 @@ def admin_create_user():
         new_user = create_resp.json()
 
         # Create profile
-        profile_resp = requests.post(
-            f'{SUPABASE_URL}/rest/v1/profiles',
-            headers=headers,
+        profile_resp = supabase.post(
+            '/rest/v1/profiles',
             json={
                 'id': new_user['id'],
                 'name': name,
@@ -351,6 +473,7 @@ def admin_create_user():
                 'is_admin': is_admin
             }
         )
+        profile_cache.invalidate(new_user['id'])
 
         return jsonify({
             "success": True,
@@ -361,7 +484,7 @@ def admin_create_user():
         })
 
     except Exception as e:
-        print(f"Error in admin_create_user: {e}")
+        log_error('admin_create_user', e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/admin/users/<user_id>", methods=["DELETE"])
@@ -381,11 +504,8 @@ def admin_delete_user(user_id):
             return jsonify({"error": error}), 403 if "Forbidden" in error else 401
 
         # Delete user using Supabase Admin API
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY
-        }
-        delete_resp = requests.delete(f'{SUPABASE_URL}/auth/v1/admin/users/{user_id}', headers=headers)
+        delete_resp = supabase.delete(f'/auth/v1/admin/users/{user_id}')
+        profile_cache.invalidate(user_id)
 
         if delete_resp.status_code not in [200, 204]:
             return jsonify({"error": "Failed to delete user"}), 500
@@ -393,7 +513,7 @@ def admin_delete_user(user_id):
         return jsonify({"success": True})
 
     except Exception as e:
-        print(f"Error in admin_delete_user: {e}")
+        log_error('admin_delete_user', e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/admin/users/<user_id>/reset-password", methods=["POST"])
@@ -420,14 +540,8 @@ def admin_reset_password(user_id):
             return jsonify({"error": "Password must be at least 6 characters"}), 400
 
         # Update password using Supabase Admin API
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY,
-            'Content-Type': 'application/json'
-        }
-        update_resp = requests.put(
-            f'{SUPABASE_URL}/auth/v1/admin/users/{user_id}',
-            headers=headers,
+        update_resp = supabase.put(
+            f'/auth/v1/admin/users/{user_id}',
             json={'password': new_password}
         )
 
@@ -437,7 +551,7 @@ def admin_reset_password(user_id):
         return jsonify({"success": True})
 
     except Exception as e:
-        print(f"Error in admin_reset_password: {e}")
+        log_error('admin_reset_password', e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/admin/users/<user_id>/tier", methods=["PATCH"])
@@ -464,17 +578,12 @@ def admin_update_tier(user_id):
             return jsonify({"error": "Invalid tier. Must be 'free', 'premium', or 'admin'"}), 400
 
         # Update tier in profiles table
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY,
-            'Content-Type': 'application/json',
-            'Prefer': 'return=representation'
-        }
-        update_resp = requests.patch(
-            f'{SUPABASE_URL}/rest/v1/profiles?id=eq.{user_id}',
-            headers=headers,
+        update_resp = supabase.patch(
+            f'/rest/v1/profiles?id=eq.{user_id}',
+            headers={'Prefer': 'return=representation'},
             json={'tier': new_tier}
         )
+        profile_cache.invalidate(user_id)
 
         if update_resp.status_code not in [200, 204]:
             return jsonify({"error": "Failed to update tier"}), 500
@@ -482,7 +591,144 @@ def admin_update_tier(user_id):
         return jsonify({"success": True, "tier": new_tier})
 
     except Exception as e:
-        print(f"Error in admin_update_tier: {e}")
+        log_error('admin_update_tier', e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/batch", methods=["POST"])
+def admin_batch_operations():
+    """
+    Runs several admin operations in one request (requires admin authentication).
+
+    Request body:
+    {
+        "operations": [
+            {"op": "update_tier", "user_id": "uuid", "tier": "premium"},
+            {"op": "reset_password", "user_id": "uuid", "password": "..."},
+            {"op": "create_user", "email": "...", "password": "...", "name": "...", "tier": "free"},
+            {"op": "delete_user", "user_id": "uuid"},
+            {"op": "add_cando", "user_id": "uuid", "cando_id": "uuid", "notes": "..."},
+            {"op": "remove_cando", "user_id": "uuid", "cando_id": "uuid"}
+        ]
+    }
+
+    Returns one result per operation, in order, each with "success" and
+    an "error" message if it failed.
+    """
+    try:
+        # Verify admin access once for the whole batch
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Unauthorized"}), 401
+
+        user_token = auth_header.split(' ')[1]
+        admin_id, error = verify_admin(user_token)
+        if error:
+            return jsonify({"error": error}), 403 if "Forbidden" in error else 401
+
+        data = request.json or {}
+        try:
+            results = admin_batch.run_batch(data.get('operations'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        succeeded = sum(1 for r in results if r['success'])
+        return jsonify({
+            "results": results,
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded
+        })
+
+    except Exception as e:
+        log_error('admin_batch_operations', e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/realtime_pool", methods=["GET"])
+def admin_realtime_pool_metrics():
+    """
+    Voice session pool metrics (admin only): hit rate, time to token for
+    pooled and on-demand sessions, and ready sessions per voice.
+    """
+    try:
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Unauthorized"}), 401
+
+        user_token = auth_header.split(' ')[1]
+        admin_id, error = verify_admin(user_token)
+        if error:
+            return jsonify({"error": error}), 403 if "Forbidden" in error else 401
+
+        return jsonify(realtime_pool.metrics())
+
+    except Exception as e:
+        log_error('admin_realtime_pool_metrics', e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/usage_meter", methods=["GET"])
+def admin_usage_meter_metrics():
+    """
+    Voice usage metering state (admin only): open sessions, pending
+    writes, flushes and rejected session starts.
+    """
+    try:
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Unauthorized"}), 401
+
+        user_token = auth_header.split(' ')[1]
+        admin_id, error = verify_admin(user_token)
+        if error:
+            return jsonify({"error": error}), 403 if "Forbidden" in error else 401
+
+        return jsonify(usage_meter.metrics())
+
+    except Exception as e:
+        log_error('admin_usage_meter_metrics', e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/rate_limits", methods=["GET"])
+def admin_rate_limit_metrics():
+    """
+    Rate limit and model concurrency metrics (admin only): admitted and
+    throttled requests per endpoint, and slots in use per model.
+    """
+    try:
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Unauthorized"}), 401
+
+        user_token = auth_header.split(' ')[1]
+        admin_id, error = verify_admin(user_token)
+        if error:
+            return jsonify({"error": error}), 403 if "Forbidden" in error else 401
+
+        return jsonify(rate_limiter.metrics())
+
+    except Exception as e:
+        log_error('admin_rate_limit_metrics', e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/llm_gateway", methods=["GET"])
+def admin_llm_gateway_metrics():
+    """
+    OpenAI gateway metrics (admin only): breaker state per model, and
+    calls, errors, hedges, fallbacks, tokens and latency per model and
+    purpose.
+    """
+    try:
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Unauthorized"}), 401
+
+        user_token = auth_header.split(' ')[1]
+        admin_id, error = verify_admin(user_token)
+        if error:
+            return jsonify({"error": error}), 403 if "Forbidden" in error else 401
+
+        return jsonify(llm_gateway.metrics())
+
+    except Exception as e:
+        log_error('admin_llm_gateway_metrics', e)
         return jsonify({"error": str(e)}), 500
 
 # ============================================================================
@@ -494,6 +740,7 @@ def get_user_cando_achievements(user_id):
     """
     Get user's Can-Do achievements and progress.
     Returns achievements grouped by level with progress percentages.
+    With ?summary=1 only the per-level counts and percentages are returned.
     """
     try:
         # Verify user authentication
@@ -504,130 +751,68 @@ def get_user_cando_achievements(user_id):
         user_token = auth_header.split(' ')[1]
 
         # Get authenticated user ID from token
-        headers = {
-            'Authorization': f'Bearer {user_token}',
-            'apikey': SUPABASE_SERVICE_KEY
-        }
-        user_resp = requests.get(f'{SUPABASE_URL}/auth/v1/user', headers=headers)
-        if user_resp.status_code != 200:
-            return jsonify({"error": "Invalid token"}), 401
+        auth_user_id, error = get_user_id(user_token)
+        if error:
+            return jsonify({"error": error}), 401
 
-        auth_user_id = user_resp.json().get('id')
+        # Get user's achievements (statement details come from the catalog)
+        def fetch_achievements():
+            return supabase.get(
+                f'/rest/v1/user_cando_achievements?user_id=eq.{user_id}&select=cando_id,admin_approved,achieved_at,detected_by,confidence_score&order=achieved_at.desc'
+            )
 
         # Check if user is requesting their own data or is admin
         if auth_user_id != user_id:
-            # Check if user is admin
-            admin_id, error = verify_admin(user_token)
+            # Check admin access while the achievements are being fetched
+            (admin_id, error), achievements_resp = gather(
+                lambda: verify_admin(user_token),
+                fetch_achievements
+            )
             if error:
                 return jsonify({"error": "Forbidden: Can only access your own data"}), 403
-
-        # Get all Can-Do statements
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY,
-            'Content-Type': 'application/json'
-        }
-
-        statements_resp = requests.get(
-            f'{SUPABASE_URL}/rest/v1/cando_statements?select=*&order=display_order.asc',
-            headers=headers
-        )
-
-        if statements_resp.status_code != 200:
-            return jsonify({"error": "Failed to fetch Can-Do statements"}), 500
-
-        statements = statements_resp.json()
-
-        # Get user's achievements WITH statement details
-        achievements_resp = requests.get(
-            f'{SUPABASE_URL}/rest/v1/user_cando_achievements?user_id=eq.{user_id}&select=*,cando_statements(level,descriptor,skill_type)&order=achieved_at.desc',
-            headers=headers
-        )
+        else:
+            achievements_resp = fetch_achievements()
 
         if achievements_resp.status_code != 200:
             return jsonify({"error": "Failed to fetch achievements"}), 500
 
-        achievements = achievements_resp.json()
-        achieved_ids = {a['cando_id'] for a in achievements if a.get('admin_approved') != False}
-
-        # Map achievements to statement details for frontend
-        achievements_by_statement = {}
-        for ach in achievements:
-            if ach.get('admin_approved') != False and 'cando_statements' in ach:
-                stmt_data = ach['cando_statements']
-                achievements_by_statement[ach['cando_id']] = {
-                    'descriptor': stmt_data.get('descriptor'),
-                    'level': stmt_data.get('level'),
-                    'skill_type': stmt_data.get('skill_type'),
-                    'achieved_at': ach.get('achieved_at'),
-                    'detected_by': ach.get('detected_by'),
-                    'confidence_score': ach.get('confidence_score')
-                }
-
-        # Group statements by level and calculate progress
-        levels_data = {}
-        for stmt in statements:
-            level = stmt['level']
-            if level not in levels_data:
-                levels_data[level] = {
-                    'level': level,
-                    'total': 0,
-                    'achieved': 0,
-                    'statements': [],
-                    'recent_achievements': []
-                }
-
-            is_achieved = stmt['id'] in achieved_ids
-            levels_data[level]['total'] += 1
-            if is_achieved:
-                levels_data[level]['achieved'] += 1
-                # Add to recent achievements
-                if stmt['id'] in achievements_by_statement:
-                    levels_data[level]['recent_achievements'].append(
-                        achievements_by_statement[stmt['id']]
-                    )
-
-            levels_data[level]['statements'].append({
-                'id': stmt['id'],
-                'descriptor': stmt['descriptor'],
-                'skill_type': stmt['skill_type'],
-                'is_achieved': is_achieved
-            })
-
-        # Calculate percentages and sort recent achievements
-        for level_data in levels_data.values():
-            total = level_data['total']
-            achieved = level_data['achieved']
-            level_data['percentage'] = round((achieved / total * 100), 1) if total > 0 else 0
-            # Sort recent achievements by date (most recent first)
-            level_data['recent_achievements'].sort(
-                key=lambda x: x.get('achieved_at', ''),
-                reverse=True
-            )
+        # ?summary=1 returns only per-level counts and percentages
+        summary = request.args.get('summary') in ('1', 'true')
 
-        # Order levels
-        level_order = ['A1', 'A2', 'A2+', 'B1', 'B1+', 'B2', 'B2+', 'C1', 'C2']
-        ordered_levels = [levels_data[lvl] for lvl in level_order if lvl in levels_data]
-
-        # Calculate total achievements
-        total_achievements = len(achieved_ids)
+        try:
+            progress = build_progress(user_id, achievements_resp.json(), summary=summary)
+        except CatalogError:
+            return jsonify({"error": "Failed to fetch Can-Do statements"}), 500
 
-        return jsonify({
-            "user_id": user_id,
-            "total_achievements": total_achievements,
-            "progress_by_level": ordered_levels
-        })
+        return jsonify(progress)
 
     except Exception as e:
-        print(f"Error in get_user_cando_achievements: {e}")
+        log_error('get_user_cando_achievements', e)
         return jsonify({"error": str(e)}), 500
 
+def analysis_wait(args):
+    """Seconds /analyze_session?wait=N asks to wait for its job (0 without it). Raises ValueError."""
+    try:
+        wait = float(args.get('wait') or 0)
+    except ValueError:
+        raise ValueError("wait must be a number of seconds")
+    if not math.isfinite(wait):
+        raise ValueError("wait must be a number of seconds")
+    return min(max(wait, 0), ANALYSIS_MAX_WAIT)
+
 @app.route("/analyze_session", methods=["POST"])
 def analyze_session_cando():
     """
     Analyze a voice session transcript for Can-Do achievements.
     Uses GPT-4 to detect which Can-Do statements were demonstrated.
 
+    The analysis runs on the background job queue, and the request returns
+    202 with the job id immediately; poll GET /analyze_session/<job_id>
+    for the result. With ?wait=N the request waits up to N seconds (at
+    most ANALYSIS_MAX_WAIT) for the result, holding its worker meanwhile.
+    Submissions are rate limited per user and per client IP (429 with
+    Retry-After).
+
     Request body:
     {
         "session_id": "string",
@@ -645,13 +830,13 @@ def analyze_session_cando():
         user_token = auth_header.split(' ')[1]
 
         # Get authenticated user
-        headers = {
-            'Authorization': f'Bearer {user_token}',
-            'apikey': SUPABASE_SERVICE_KEY
-        }
-        user_resp = requests.get(f'{SUPABASE_URL}/auth/v1/user', headers=headers)
-        if user_resp.status_code != 200:
-            return jsonify({"error": "Invalid token"}), 401
+        auth_user_id, error = get_user_id(user_token)
+        if error:
+            return jsonify({"error": error}), 401
+
+        limited = check_rate_limit('analysis', auth_user_id)
+        if limited:
+            return limited
 
         # Get request data
         data = request.json
@@ -663,238 +848,177 @@ def analyze_session_cando():
         if not all([session_id, user_id, transcript]):
             return jsonify({"error": "Missing required fields: session_id, user_id, transcript"}), 400
 
-        # If no level provided, get from user profile
-        if not user_level:
-            headers = {
-                'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-                'apikey': SUPABASE_SERVICE_KEY
-            }
-            profile_resp = requests.get(
-                f'{SUPABASE_URL}/rest/v1/profiles?id=eq.{user_id}&select=cefr_level',
-                headers=headers
-            )
-            if profile_resp.status_code == 200 and profile_resp.json():
-                user_level = profile_resp.json()[0].get('cefr_level', 'A2')
-            else:
-                user_level = 'A2'  # Default
-
-        # Get Can-Do statements for user's level and adjacent levels (ZPD)
-        # Include current level + 2 below + ALL above to detect when learners exceed expectations
-        level_map = {'A1': 0, 'A2': 1, 'A2+': 2, 'B1': 3, 'B1+': 4, 'B2': 5, 'B2+': 6, 'C1': 7, 'C2': 8}
-        current_level_idx = level_map.get(user_level, 1)
-        # Include 2 levels below (for context) and all levels at or above current
-        relevant_levels = [k for k, v in level_map.items() if v >= current_level_idx - 2]
-
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY
-        }
-
-        # Build query for relevant levels
-        level_query = ','.join(relevant_levels)
-        statements_resp = requests.get(
-            f'{SUPABASE_URL}/rest/v1/cando_statements?level=in.({level_query})&select=id,level,skill_type,descriptor',
-            headers=headers
-        )
-
-        if statements_resp.status_code != 200:
-            return jsonify({"error": "Failed to fetch Can-Do statements"}), 500
-
-        statements = statements_resp.json()
-
-        # Call GPT-4 for analysis
-        import time
-        start_time = time.time()
-
-        analysis_result = analyze_transcript_with_gpt(transcript, statements, user_level)
+        try:
+            wait = analysis_wait(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        processing_time = int((time.time() - start_time) * 1000)
+        # Users can only analyze their own sessions, admins can analyze any
+        if user_id != auth_user_id:
+            admin_id, error = verify_admin(user_token)
+            if error:
+                return jsonify({"error": "Forbidden: Can only access your own data"}), 403
 
-        # Save analysis log to database
-        headers['Content-Type'] = 'application/json'
-        log_data = {
+        payload = {
             'session_id': session_id,
             'user_id': user_id,
-            'transcript_length': len(transcript),
-            'detected_achievements': analysis_result.get('detected_achievements', []),
-            'model_used': 'gpt-4o',
-            'prompt_version': 'v1.0',
-            'processing_time_ms': processing_time,
-            'error_occurred': analysis_result.get('error', False),
-            'error_message': analysis_result.get('error_message')
+            'transcript': transcript,
+            'user_level': user_level
         }
 
-        requests.post(
-            f'{SUPABASE_URL}/rest/v1/session_cando_analysis',
-            headers=headers,
-            json=log_data
-        )
-
-        # If AI detected achievements, save them to user_cando_achievements
-        detected = analysis_result.get('detected_achievements', [])
-        new_achievements = []
-
-        for achievement in detected:
-            # Check if already achieved
-            check_resp = requests.get(
-                f'{SUPABASE_URL}/rest/v1/user_cando_achievements?user_id=eq.{user_id}&cando_id=eq.{achievement["cando_id"]}',
-                headers=headers
-            )
-
-            if check_resp.status_code == 200 and len(check_resp.json()) == 0:
-                # Not yet achieved - add it
-                achievement_data = {
-                    'user_id': user_id,
-                    'cando_id': achievement['cando_id'],
-                    'session_id': session_id,
-                    'detected_by': 'ai_automatic',
-                    'confidence_score': achievement['confidence'],
-                    'evidence_text': achievement['evidence']
-                }
-
-                insert_resp = requests.post(
-                    f'{SUPABASE_URL}/rest/v1/user_cando_achievements',
-                    headers=headers,
-                    json=achievement_data
-                )
-
-                if insert_resp.status_code in [200, 201]:
-                    new_achievements.append(achievement)
-
-        return jsonify({
-            "success": True,
-            "session_id": session_id,
-            "user_id": user_id,
-            "analyzed_level": user_level,
-            "total_statements_analyzed": len(statements),
-            "detected_achievements": detected,
-            "new_achievements": new_achievements,
-            "processing_time_ms": processing_time
-        })
+        # Queue the analysis; resubmitting a session reuses that user's job
+        try:
+            job, created = analysis_queue.submit(session_id, user_id, payload)
+        except QueueFull:
+            return jsonify({"error": "Too many analyses in progress, please try again later"}), 503
+
+        # Without ?wait=N the job id comes back right away; poll GET /analyze_session/<job_id>
+        if not wait:
+            return jsonify(job_response(job)), 202
+
+        job = analysis_queue.wait(job['id'], wait)
+        if job['status'] == DONE:
+            return jsonify(job['result'])
+        if job['status'] == FAILED:
+            return jsonify({"error": job['error']}), 500
+        # Still running: hand back the job id so the client can poll
+        return jsonify(job_response(job)), 202
 
     except Exception as e:
-        print(f"Error in analyze_session_cando: {e}")
+        log_error('analyze_session_cando', e)
         return jsonify({"error": str(e)}), 500
 
-def analyze_transcript_with_gpt(transcript, statements, user_level):
+@app.route("/analyze_session/<job_id>", methods=["GET"])
+def get_analysis_job(job_id):
     """
-    Use GPT-4 to analyze transcript and detect Can-Do achievements.
-
-    Returns:
-    {
-        "detected_achievements": [
-            {
-                "cando_id": "uuid",
-                "descriptor": "Can do X",
-                "confidence": 0.85,
-                "evidence": "excerpt from transcript"
-            }
-        ]
-    }
+    Get the status of a queued session analysis, and its result once done.
     """
     try:
-        # Build prompt for GPT-4
-        statements_text = "\n".join([
-            f"{i+1}. [{stmt['id']}] ({stmt['level']} - {stmt['skill_type']}): {stmt['descriptor']}"
-            for i, stmt in enumerate(statements)
-        ])
-
-        prompt = f"""You are an expert CEFR language assessor analyzing a learner's English conversation transcript for a PhD research project on senior language learners.
-
-The learner's assigned level is: {user_level}
-IMPORTANT: The learner may demonstrate capabilities ABOVE this assigned level. Recognize ALL achievements.
-
-Analyze the conversation transcript and identify which Can-Do statements the learner has DEMONSTRATED through their language production.
-
-ASSESSMENT CRITERIA:
-- The learner must have PRODUCED the language (speaking/interaction), not just comprehended it
-- Look for evidence of the capability described in the Can-Do statement
-- The learner may perform ABOVE their assigned level - recognize this
-- Use confidence scores to indicate strength of evidence (0.6+ = demonstrated, 0.8+ = clearly demonstrated, 0.95+ = exceptionally demonstrated)
-- Focus on what the learner ACTUALLY DID in the conversation
-
-TRANSCRIPT:
-{transcript}
-
-CAN-DO STATEMENTS TO EVALUATE:
-{statements_text}
-
-For each Can-Do statement demonstrated in the transcript, respond with:
-1. The statement ID (in brackets from above)
-2. Confidence score (0.6-1.0, where 0.6 = minimal evidence, 1.0 = perfect demonstration)
-3. A brief excerpt from the transcript showing the evidence (max 100 words)
-
-Respond in JSON format:
-{{
-  "detected_achievements": [
-    {{
-      "cando_id": "uuid-here",
-      "confidence": 0.85,
-      "evidence": "Brief excerpt from transcript that demonstrates this capability..."
-    }}
-  ]
-}}
-
-Include any statement with confidence >= 0.6. If no statements were demonstrated, return an empty array."""
-
-        # Call GPT-4
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are an expert CEFR language assessor. Respond only in valid JSON format."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=2000
-        )
+        # Verify authentication
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Unauthorized"}), 401
 
-        result_text = response.choices[0].message.content.strip()
+        user_token = auth_header.split(' ')[1]
+        auth_user_id, error = get_user_id(user_token)
+        if error:
+            return jsonify({"error": error}), 401
 
-        # Log the raw response for debugging
-        print(f"GPT-4 raw response (first 500 chars): {result_text[:500]}")
+        job = analysis_queue.get(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
 
-        # Parse JSON response - handle markdown code blocks
-        import json
-        import re
+        # Users can only see their own jobs, admins can see all
+        if job['user_id'] != auth_user_id:
+            admin_id, error = verify_admin(user_token)
+            if error:
+                return jsonify({"error": "Forbidden: Can only access your own data"}), 403
 
-        # Try to extract JSON from markdown code blocks
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', result_text, re.DOTALL)
-        if json_match:
-            result_text = json_match.group(1)
-            print("Extracted JSON from markdown code block")
+        return jsonify(job_response(job))
 
-        # Try to find JSON object even if there's text before/after
-        if not result_text.startswith('{'):
-            json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
-            if json_match:
-                result_text = json_match.group(0)
-                print("Extracted JSON from text")
+    except Exception as e:
+        log_error('get_analysis_job', e)
+        return jsonify({"error": str(e)}), 500
 
-        result = json.loads(result_text)
+def run_session_analysis(payload, final_attempt):
+    """
+    Analysis job handler: detect Can-Do achievements in a transcript,
+    log the analysis and save new achievements.
+
+    Returns the /analyze_session response body. An analysis with parts
+    still missing after their retries is not run again: what it confirmed
+    is saved and returned, and the log records error_occurred. Only when
+    no model answered at all (nothing was analyzed or paid for), and this
+    is not the final attempt, does it raise so the job is retried.
+    """
+    session_id = payload['session_id']
+    user_id = payload['user_id']
+    transcript = payload['transcript']
+    user_level = payload.get('user_level')
+
+    # If no level provided, get from user profile
+    if not user_level:
+        profile, error = profile_cache.get_profile(user_id)
+        if profile:
+            user_level = profile.get('cefr_level', 'A2')
+        else:
+            user_level = 'A2'  # Default
+
+    # Get Can-Do statements for user's level and adjacent levels (ZPD)
+    # Include current level + 2 below + ALL above to detect when learners exceed expectations
+    statements = catalog.for_levels(relevant_levels(user_level))
+
+    # Call GPT-4 for analysis, unless the same analysis is already cached
+    start_time = time.time()
+
+    cache_key = make_key(transcript, user_level, catalog.version, [stmt.id for stmt in statements],
+                         f'{ANALYSIS_PROMPT_VERSION}/{retriever.config_tag}/chunk:{ANALYSIS_CHUNK_TOKENS}',
+                         ANALYSIS_MODEL)
+    analysis_result = analysis_cache.get(cache_key)
+    cache_hit = analysis_result is not None
+
+    # Detections are saved as soon as the analysis confirms them
+    valid_ids = {stmt.id for stmt in statements}
+    writer = AchievementWriter(user_id, session_id, valid_ids)
+
+    if not cache_hit:
+        # Only send the statements that best match what the learner said
+        candidates, selection = retriever.select(transcript, statements)
+        analysis_result = analyze_transcript(transcript, candidates, user_level, on_detection=writer.add)
+        analysis_result['selection'] = selection
+        # Answers from a fallback model are not cached under ANALYSIS_MODEL's key,
+        # nor lexically filtered ones under the embedding pre-filter's config_tag
+        if (not analysis_result.get('error') and analysis_result.get('models') == [ANALYSIS_MODEL]
+                and not retriever.fell_back(selection)):
+            analysis_cache.set(cache_key, analysis_result)
+
+    processing_time = int((time.time() - start_time) * 1000)
+
+    if analysis_result.get('error') and not analysis_result.get('models') and not final_attempt:
+        raise RuntimeError(analysis_result.get('error_message') or "Analysis failed")
+
+    # Save analysis log to database
+    log_data = {
+        'session_id': session_id,
+        'user_id': user_id,
+        'transcript_length': len(transcript),
+        'detected_achievements': analysis_result.get('detected_achievements', []),
+        'model_used': ', '.join(analysis_result.get('models') or [ANALYSIS_MODEL]),
+        'prompt_version': ANALYSIS_PROMPT_VERSION,
+        'processing_time_ms': processing_time,
+        # Tokens actually sent to the model for this run (none on a cache hit)
+        'input_tokens': 0 if cache_hit else analysis_result.get('input_tokens', 0),
+        'output_tokens': 0 if cache_hit else analysis_result.get('output_tokens', 0),
+        'chunk_count': analysis_result.get('chunks', 1),
+        'cache_hit': cache_hit,
+        'cache_key': cache_key,
+        'error_occurred': analysis_result.get('error', False),
+        'error_message': analysis_result.get('error_message')
+    }
 
-        # Add descriptor to each achievement for frontend display
-        stmt_dict = {s['id']: s for s in statements}
-        for achievement in result.get('detected_achievements', []):
-            cando_id = achievement['cando_id']
-            if cando_id in stmt_dict:
-                achievement['descriptor'] = stmt_dict[cando_id]['descriptor']
-                achievement['level'] = stmt_dict[cando_id]['level']
+    # Save the detections not saved during the analysis (or whose save
+    # failed) in a single upsert, alongside the log insert. A failed save
+    # fails the attempt, so the job is retried
+    detected = analysis_result.get('detected_achievements', [])
+    _, new_achievements = gather(
+        lambda: supabase.post('/rest/v1/session_cando_analysis', json=log_data),
+        lambda: writer.finish(detected)
+    )
 
-        return result
+    return {
+        "success": True,
+        "session_id": session_id,
+        "user_id": user_id,
+        "analyzed_level": user_level,
+        "total_statements_analyzed": analysis_result.get('selection', {}).get('selected', len(statements)),
+        "detected_achievements": detected,
+        "new_achievements": new_achievements,
+        "processing_time_ms": processing_time,
+        "cache_hit": cache_hit,
+        "error_occurred": analysis_result.get('error', False)
+    }
 
-    except Exception as e:
-        print(f"Error in GPT analysis: {e}")
-        # Try to get the raw response if available
-        try:
-            if 'result_text' in locals():
-                print(f"Raw GPT response that caused error: {result_text}")
-        except:
-            pass
-        return {
-            "detected_achievements": [],
-            "error": True,
-            "error_message": str(e)
-        }
+analysis_queue = JobQueue(run_session_analysis)
 
 @app.route("/admin/users/<user_id>/cando/<cando_id>", methods=["POST"])
 def admin_add_cando_achievement(user_id, cando_id):
@@ -917,15 +1041,8 @@ def admin_add_cando_achievement(user_id, cando_id):
         admin_notes = data.get('notes', '')
 
         # Check if already achieved
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY,
-            'Content-Type': 'application/json'
-        }
-
-        check_resp = requests.get(
-            f'{SUPABASE_URL}/rest/v1/user_cando_achievements?user_id=eq.{user_id}&cando_id=eq.{cando_id}',
-            headers=headers
+        check_resp = supabase.get(
+            f'/rest/v1/user_cando_achievements?user_id=eq.{user_id}&cando_id=eq.{cando_id}'
         )
 
         if check_resp.status_code == 200 and len(check_resp.json()) > 0:
@@ -942,11 +1059,7 @@ def admin_add_cando_achievement(user_id, cando_id):
             'reviewed_at': 'now()'
         }
 
-        insert_resp = requests.post(
-            f'{SUPABASE_URL}/rest/v1/user_cando_achievements',
-            headers=headers,
-            json=achievement_data
-        )
+        insert_resp = supabase.post('/rest/v1/user_cando_achievements', json=achievement_data)
 
         if insert_resp.status_code not in [200, 201]:
             return jsonify({"error": "Failed to add achievement"}), 500
@@ -954,7 +1067,7 @@ def admin_add_cando_achievement(user_id, cando_id):
         return jsonify({"success": True})
 
     except Exception as e:
-        print(f"Error in admin_add_cando_achievement: {e}")
+        log_error('admin_add_cando_achievement', e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/admin/users/<user_id>/cando/<cando_id>", methods=["DELETE"])
@@ -974,14 +1087,8 @@ def admin_remove_cando_achievement(user_id, cando_id):
             return jsonify({"error": error}), 403 if "Forbidden" in error else 401
 
         # Delete achievement
-        headers = {
-            'Authorization': f'Bearer {SUPABASE_SERVICE_KEY}',
-            'apikey': SUPABASE_SERVICE_KEY
-        }
-
-        delete_resp = requests.delete(
-            f'{SUPABASE_URL}/rest/v1/user_cando_achievements?user_id=eq.{user_id}&cando_id=eq.{cando_id}',
-            headers=headers
+        delete_resp = supabase.delete(
+            f'/rest/v1/user_cando_achievements?user_id=eq.{user_id}&cando_id=eq.{cando_id}'
         )
 
         if delete_resp.status_code not in [200, 204]:
@@ -990,7 +1097,7 @@ def admin_remove_cando_achievement(user_id, cando_id):
         return jsonify({"success": True})
 
     except Exception as e:
-        print(f"Error in admin_remove_cando_achievement: {e}")
+        log_error('admin_remove_cando_achievement', e)
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
@@ -0,0 +1,368 @@
+"""
+ASGI entry point: the upstream-bound routes served as coroutines, and the
+rest of the Flask app mounted behind them.
+
+    uvicorn asgi:app --workers 4
+
+POST /chat_text (and /chat_text/stream), GET /users/<user_id>/cando and
+POST /analyze_session spend nearly all their time waiting on OpenAI and
+Supabase. Here each of those waits is a coroutine on the worker's event
+loop instead of a blocked thread, so hundreds of them can be in flight
+per worker; the model caps in rate_limit still bound what reaches
+OpenAI. Request and response contracts are the same as the Flask routes
+in app.py, which keep serving `python app.py` and WSGI deployments.
+Every other route is passed to the Flask app unchanged.
+
+The Flask session cookie is read and written here too, so a
+conversation carries over between the async and Flask routes.
+"""
+
+import asyncio
+import contextlib
+import uuid
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route, request_response
+
+import tracing
+from analysis_jobs import QueueFull, DONE, FAILED, job_response
+from app import (app as flask_app, analysis_queue, conversations, verify_admin_async, analysis_wait,
+                 CHAT_MODEL, CHAT_DEADLINE, CORS_SETTINGS)
+from auth import get_user_id_async
+from cando_catalog import catalog, CatalogError
+from cando_progress import build_progress
+from chat_stream import relay_completion_async, SSE_HEADERS
+from llm_gateway import llm_gateway, CircuitOpen
+from prompt_store import prompt_store
+from rate_limit import rate_limiter, Throttled, client_ip
+from supabase_client import async_supabase, gather_async
+from tracing import log_error
+
+_session_serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+
+
+def load_session(request):
+    """The Flask session from the request's cookie (empty if missing or not valid)."""
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+    try:
+        max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+        return dict(_session_serializer.loads(cookie, max_age=max_age))
+    except BadSignature:
+        return {}
+
+
+def save_session(response, session):
+    """Set the Flask session cookie, with the attributes Flask would give it."""
+    interface = flask_app.session_interface
+    response.set_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        _session_serializer.dumps(session),
+        path=interface.get_cookie_path(flask_app),
+        domain=interface.get_cookie_domain(flask_app),
+        secure=interface.get_cookie_secure(flask_app),
+        httponly=interface.get_cookie_httponly(flask_app),
+        samesite=interface.get_cookie_samesite(flask_app)
+    )
+
+
+async def get_conversation_id(session):
+    """
+    Return this session's conversation id, starting a conversation if
+    needed. Returns (conversation_id, whether the session changed).
+    """
+    conversation_id = session.get('conversation_id')
+    if conversation_id:
+        return conversation_id, False
+    conversation_id = uuid.uuid4().hex
+    session['conversation_id'] = conversation_id
+    # Carry over a conversation from the old cookie-stored context
+    legacy_context = session.pop('context', None)
+    if legacy_context:
+        await asyncio.to_thread(conversations.append, conversation_id, *legacy_context)
+    return conversation_id, True
+
+
+async def read_json(request):
+    """The request's JSON body, or None if it has none."""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def bearer_token(request):
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('Bearer '):
+        return auth_header.split(' ')[1]
+    return None
+
+
+def unavailable_response(e):
+    """503 for an llm_gateway.CircuitOpen error, with Retry-After."""
+    retry_after = str(max(1, round(e.retry_after)))
+    return JSONResponse({"error": str(e), "retry_after": int(retry_after)}, 503, {"Retry-After": retry_after})
+
+
+def throttled_response(e):
+    """429 for a rate_limit.Throttled error, with Retry-After."""
+    body = {"error": str(e), "retry_after": int(e.retry_after_header), "scope": e.scope}
+    return JSONResponse(body, 429, {"Retry-After": e.retry_after_header})
+
+
+async def check_rate_limit(request, endpoint, user_id=None):
+    """check_rate_limit() from app.py. Returns a 429 response, or None if admitted."""
+    remote_addr = request.client.host if request.client else None
+    try:
+        await asyncio.to_thread(rate_limiter.hit, endpoint, user_id,
+                                client_ip(remote_addr, request.headers.get('X-Forwarded-For')))
+    except Throttled as e:
+        return throttled_response(e)
+    return None
+
+
+@tracing.traced('/chat_text')
+async def chat_text(request):
+    """POST /chat_text, as in app.py (with ?stream=1 relayed as server-sent events)."""
+    return await _chat_text(request, stream=request.query_params.get('stream') in ('1', 'true'))
+
+
+@tracing.traced('/chat_text/stream')
+async def chat_text_stream(request):
+    """Same as POST /chat_text?stream=1."""
+    return await _chat_text(request, stream=True)
+
+
+async def _chat_text(request, stream):
+    data = await read_json(request)
+    if not data or 'text' not in data:
+        return JSONResponse({"error": "You have not entered text"}, 400)
+
+    user_id = None
+    user_token = bearer_token(request)
+    if user_token:
+        user_id, error = await get_user_id_async(user_token)
+    limited = await check_rate_limit(request, 'chat', user_id)
+    if limited:
+        return limited
+
+    session = load_session(request)
+    conversation_id, session_changed = await get_conversation_id(session)
+    user_message = {"role": "user", "content": data['text']}
+
+    # Stored history (summary + recent turns) followed by the user's input
+    record = await asyncio.to_thread(conversations.load, conversation_id)
+    messages = ([{"role": "system", "content": prompt_store.base_instructions()}]
+                + conversations.prompt_messages(record) + [user_message])
+
+    if stream:
+        response = await stream_chat_reply(conversation_id, user_message, messages)
+    else:
+        response = await chat_reply(conversation_id, user_message, messages)
+    if session_changed:
+        save_session(response, session)
+    return response
+
+
+async def chat_reply(conversation_id, user_message, messages):
+    try:
+        # Hedged: a slow first attempt gets a second one after the recent p95 latency
+        chat_response = await llm_gateway.chat_async('chat', CHAT_MODEL, messages, deadline=CHAT_DEADLINE,
+                                                     hedge=True)
+        response_message = chat_response.choices[0].message.content.strip()
+
+        # Saving may summarize old turns, which is a blocking LLM call
+        await asyncio.to_thread(conversations.append, conversation_id, user_message,
+                                {"role": "assistant", "content": response_message})
+
+        return JSONResponse({"response_text": response_message})
+
+    except Throttled as e:
+        return throttled_response(e)
+    except CircuitOpen as e:
+        return unavailable_response(e)
+    except Exception as e:
+        log_error('chat_text', e)
+        return JSONResponse({"error": str(e)}, 500)
+
+
+async def stream_chat_reply(conversation_id, user_message, messages):
+    """Open a streamed completion and relay it to the client as SSE."""
+    try:
+        completion = await llm_gateway.stream_async('chat_stream', CHAT_MODEL, messages, deadline=CHAT_DEADLINE,
+                                                    stream_options={"include_usage": True})
+    except Throttled as e:
+        return throttled_response(e)
+    except CircuitOpen as e:
+        return unavailable_response(e)
+    except Exception as e:
+        log_error('chat_text_stream', e)
+        return JSONResponse({"error": str(e)}, 500)
+
+    async def save_turn(response_message):
+        await asyncio.to_thread(conversations.append, conversation_id, user_message,
+                                {"role": "assistant", "content": response_message})
+
+    async def relay():
+        try:
+            async for message in relay_completion_async(completion, save_turn):
+                yield message
+        finally:
+            # Frees the model slot, also when the client goes away mid-stream
+            await completion.aclose()
+
+    return StreamingResponse(relay(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+@tracing.traced('/users/<user_id>/cando')
+async def get_user_cando_achievements(request):
+    """GET /users/<user_id>/cando, as in app.py."""
+    user_id = request.path_params['user_id']
+    try:
+        user_token = bearer_token(request)
+        if not user_token:
+            return JSONResponse({"error": "Unauthorized"}, 401)
+
+        auth_user_id, error = await get_user_id_async(user_token)
+        if error:
+            return JSONResponse({"error": error}, 401)
+
+        # Statement details come from the catalog
+        achievements = async_supabase.get(
+            f'/rest/v1/user_cando_achievements?user_id=eq.{user_id}&select=cando_id,admin_approved,achieved_at,detected_by,confidence_score&order=achieved_at.desc'
+        )
+
+        if auth_user_id != user_id:
+            # Check admin access while the achievements are being fetched
+            (admin_id, error), achievements_resp = await gather_async(verify_admin_async(user_token), achievements)
+            if error:
+                return JSONResponse({"error": "Forbidden: Can only access your own data"}, 403)
+        else:
+            achievements_resp = await achievements
+
+        if achievements_resp.status_code != 200:
+            return JSONResponse({"error": "Failed to fetch achievements"}, 500)
+
+        summary = request.query_params.get('summary') in ('1', 'true')
+
+        try:
+            # Loads the catalog first if it isn't yet
+            progress = await asyncio.to_thread(build_progress, user_id, achievements_resp.json(), summary=summary)
+        except CatalogError:
+            return JSONResponse({"error": "Failed to fetch Can-Do statements"}, 500)
+
+        return JSONResponse(progress)
+
+    except Exception as e:
+        log_error('get_user_cando_achievements', e)
+        return JSONResponse({"error": str(e)}, 500)
+
+
+@tracing.traced('/analyze_session')
+async def analyze_session_cando(request):
+    """
+    POST /analyze_session, as in app.py. The analysis itself runs on the
+    job queue's worker threads; waiting for it holds no thread here.
+    """
+    try:
+        user_token = bearer_token(request)
+        if not user_token:
+            return JSONResponse({"error": "Unauthorized"}, 401)
+
+        auth_user_id, error = await get_user_id_async(user_token)
+        if error:
+            return JSONResponse({"error": error}, 401)
+
+        limited = await check_rate_limit(request, 'analysis', auth_user_id)
+        if limited:
+            return limited
+
+        data = await read_json(request)
+        session_id = data.get('session_id')
+        user_id = data.get('user_id')
+        transcript = data.get('transcript')
+        user_level = data.get('user_level')
+
+        if not all([session_id, user_id, transcript]):
+            return JSONResponse({"error": "Missing required fields: session_id, user_id, transcript"}, 400)
+
+        try:
+            wait = analysis_wait(request.query_params)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, 400)
+
+        # Users can only analyze their own sessions, admins can analyze any
+        if user_id != auth_user_id:
+            admin_id, error = await verify_admin_async(user_token)
+            if error:
+                return JSONResponse({"error": "Forbidden: Can only access your own data"}, 403)
+
+        payload = {
+            'session_id': session_id,
+            'user_id': user_id,
+            'transcript': transcript,
+            'user_level': user_level
+        }
+
+        try:
+            job, created = await asyncio.to_thread(analysis_queue.submit, session_id, user_id, payload)
+        except QueueFull:
+            return JSONResponse({"error": "Too many analyses in progress, please try again later"}, 503)
+
+        if not wait:
+            return JSONResponse(job_response(job), 202)
+
+        job = await analysis_queue.wait_async(job['id'], wait)
+        if job['status'] == DONE:
+            return JSONResponse(job['result'])
+        if job['status'] == FAILED:
+            return JSONResponse({"error": job['error']}, 500)
+        # Still running: hand back the job id so the client can poll
+        return JSONResponse(job_response(job), 202)
+
+    except Exception as e:
+        log_error('analyze_session_cando', e)
+        return JSONResponse({"error": str(e)}, 500)
+
+
+def native(path, endpoint, methods):
+    """Route for an async endpoint, with the CORS headers Flask-Cors gives the Flask routes."""
+    cors = CORSMiddleware(
+        request_response(endpoint),
+        allow_origins=CORS_SETTINGS['origins'],
+        allow_methods=CORS_SETTINGS['methods'],
+        allow_headers=CORS_SETTINGS['allow_headers'],
+        expose_headers=CORS_SETTINGS['expose_headers'],
+        allow_credentials=CORS_SETTINGS['supports_credentials']
+    )
+    return Route(path, cors, methods=methods)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    try:
+        # Load the catalog before the first request needs it
+        await asyncio.to_thread(catalog.all)
+    except Exception as e:
+        log_error('catalog_preload', e)
+    yield
+    await async_supabase.aclose()
+    await llm_gateway.aclose()
+
+
+# Other methods on these paths (OPTIONS preflights included) fall through to Flask
+app = Starlette(
+    routes=[
+        native('/chat_text', chat_text, ['POST']),
+        native('/chat_text/stream', chat_text_stream, ['POST']),
+        native('/users/{user_id}/cando', get_user_cando_achievements, ['GET']),
+        native('/analyze_session', analyze_session_cando, ['POST']),
+        Mount('/', WSGIMiddleware(flask_app))
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,257 @@
+"""
+Supabase access-token verification with a local TTL cache.
+
+Tokens are verified locally when a key is configured:
+- SUPABASE_JWT_SECRET: the project's HS256 JWT secret
+- SUPABASE_JWKS_FILE: a JWKS JSON file (e.g. a saved copy of
+  /auth/v1/.well-known/jwks.json). "oct" keys are checked with the standard
+  library; RSA/EC keys need PyJWT with its crypto extra installed.
+
+Verified claims are cached until the token expires, so repeated requests
+with the same token cost a dict lookup. Without a usable key (or when
+AUTH_VERIFY_REMOTE=1) the token is resolved through GET /auth/v1/user on
+cache miss, as before.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+
+import tracing
+from supabase_client import supabase, async_supabase
+from ttl_cache import TTLCache
+
+load_dotenv()
+
+try:
+    import jwt as pyjwt
+except ImportError:  # PyJWT is optional, only needed for RSA/EC JWKS keys
+    pyjwt = None
+
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+SUPABASE_JWKS_FILE = os.getenv("SUPABASE_JWKS_FILE")
+
+# Always ask Supabase on cache miss, even if a local key is configured
+AUTH_VERIFY_REMOTE = os.getenv("AUTH_VERIFY_REMOTE", "0") == "1"
+
+# Fall back to Supabase when a token can't be checked locally (unknown kid/alg)
+AUTH_REMOTE_FALLBACK = os.getenv("AUTH_REMOTE_FALLBACK", "1") == "1"
+
+# Max number of verified tokens kept in memory
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+# Upper bound on how long a remotely verified token is trusted (seconds)
+AUTH_REMOTE_CACHE_TTL = int(os.getenv("AUTH_REMOTE_CACHE_TTL", "60"))
+
+# Allowed clock skew when checking exp/nbf (seconds)
+CLOCK_SKEW = 10
+
+_HMAC_ALGS = {
+    'HS256': hashlib.sha256,
+    'HS384': hashlib.sha384,
+    'HS512': hashlib.sha512,
+}
+
+
+class TokenError(Exception):
+    """The token is malformed, expired or has a bad signature."""
+
+
+class CannotVerifyLocally(Exception):
+    """No local key matches the token; it has to be checked remotely."""
+
+
+def _b64url_decode(segment):
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def _b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def encode_hs256(claims, secret):
+    """Mint an HS256 JWT. Used for local testing and the benchmark fakes."""
+    header = _b64url_encode(json.dumps({'alg': 'HS256', 'typ': 'JWT'}, separators=(',', ':')).encode())
+    payload = _b64url_encode(json.dumps(claims, separators=(',', ':')).encode())
+    signing_input = f'{header}.{payload}'.encode('ascii')
+    signature = hmac.new(secret.encode('utf-8'), signing_input, hashlib.sha256).digest()
+    return f'{header}.{payload}.{_b64url_encode(signature)}'
+
+
+def decode_unverified(token):
+    """Split a JWT into (header, claims, signing_input, signature) without checking it."""
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(_b64url_decode(header_b64))
+        claims = json.loads(_b64url_decode(payload_b64))
+        signature = _b64url_decode(signature_b64)
+    except (ValueError, TypeError) as e:
+        raise TokenError(f"Malformed token: {e}")
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise TokenError("Malformed token")
+    return header, claims, f'{header_b64}.{payload_b64}'.encode('ascii'), signature
+
+
+def load_jwks(path):
+    """Load a JWKS file and return its keys indexed by kid."""
+    with open(path, 'r') as f:
+        jwks = json.load(f)
+    return {key.get('kid'): key for key in jwks.get('keys', [])}
+
+
+class TokenVerifier:
+    """Verifies Supabase access tokens and caches the resulting claims."""
+
+    def __init__(self, jwt_secret=SUPABASE_JWT_SECRET, jwks_file=SUPABASE_JWKS_FILE,
+                 verify_remote=AUTH_VERIFY_REMOTE, remote_fallback=AUTH_REMOTE_FALLBACK,
+                 cache_size=AUTH_CACHE_SIZE, remote_cache_ttl=AUTH_REMOTE_CACHE_TTL):
+        self.jwt_secret = jwt_secret
+        self.jwks = {}
+        if jwks_file:
+            try:
+                self.jwks = load_jwks(jwks_file)
+            except (OSError, ValueError) as e:
+                tracing.log_error('auth_jwks_load', e, path=jwks_file)
+        self.verify_remote = verify_remote
+        self.remote_fallback = remote_fallback
+        self.remote_cache_ttl = remote_cache_ttl
+        self._cache = TTLCache(cache_size, remote_cache_ttl)
+
+    @property
+    def has_local_key(self):
+        return bool(self.jwt_secret or self.jwks)
+
+    def invalidate(self, token):
+        """Forget a cached token (e.g. on logout)."""
+        self._cache.pop(hashlib.sha256(token.encode('utf-8')).digest())
+
+    def _check_signature(self, header, signing_input, signature, token):
+        alg = header.get('alg')
+        kid = header.get('kid')
+        jwk = self.jwks.get(kid) if kid is not None else None
+
+        if jwk is None and alg in _HMAC_ALGS and self.jwt_secret:
+            secret = self.jwt_secret.encode('utf-8')
+        elif jwk is not None and jwk.get('kty') == 'oct' and alg in _HMAC_ALGS:
+            secret = _b64url_decode(jwk['k'])
+        elif jwk is not None and pyjwt is not None:
+            try:
+                key = pyjwt.PyJWK(jwk, algorithm=alg).key
+                pyjwt.decode(token, key=key, algorithms=[alg], options={
+                    'verify_exp': False, 'verify_nbf': False, 'verify_aud': False
+                })
+            except pyjwt.InvalidSignatureError:
+                raise TokenError("Invalid token signature")
+            except pyjwt.PyJWTError as e:
+                raise CannotVerifyLocally(str(e))
+            return
+        else:
+            raise CannotVerifyLocally(f"No local key for alg={alg} kid={kid}")
+
+        expected = hmac.new(secret, signing_input, _HMAC_ALGS[alg]).digest()
+        if not hmac.compare_digest(expected, signature):
+            raise TokenError("Invalid token signature")
+
+    def _verify_local(self, token, now):
+        header, claims, signing_input, signature = decode_unverified(token)
+        self._check_signature(header, signing_input, signature, token)
+
+        exp = claims.get('exp')
+        if not isinstance(exp, (int, float)):
+            raise TokenError("Token has no expiry")
+        if exp + CLOCK_SKEW <= now:
+            raise TokenError("Token expired")
+        nbf = claims.get('nbf')
+        if isinstance(nbf, (int, float)) and nbf - CLOCK_SKEW > now:
+            raise TokenError("Token not yet valid")
+        if not claims.get('sub'):
+            raise TokenError("Token has no subject")
+        return claims, exp
+
+    def _remote_claims(self, user_resp, token, now):
+        """Claims and cache expiry from a GET /auth/v1/user response."""
+        if user_resp.status_code != 200:
+            raise TokenError("Invalid token")
+        user_data = user_resp.json()
+
+        claims = {'sub': user_data.get('id'), 'email': user_data.get('email'), 'role': user_data.get('role')}
+        expires_at = now + self.remote_cache_ttl
+        try:
+            exp = decode_unverified(token)[1].get('exp')
+            if isinstance(exp, (int, float)):
+                expires_at = min(expires_at, exp)
+        except TokenError:
+            pass
+        return claims, expires_at
+
+    def _check(self, token, now):
+        """
+        (cache key, claims) from the cache or the local key. claims is None
+        when the token has to be checked by Supabase.
+        """
+        key = hashlib.sha256(token.encode('utf-8')).digest()
+        claims = self._cache.get(key)
+        if claims is not None:
+            return key, claims
+
+        if self.has_local_key and not self.verify_remote:
+            try:
+                claims, expires_at = self._verify_local(token, now)
+            except CannotVerifyLocally:
+                if not self.remote_fallback:
+                    raise TokenError("Invalid token")
+                return key, None
+            self._cache.set(key, claims, expires_at)
+            return key, claims
+        return key, None
+
+    def verify(self, token):
+        """Return the token's claims, or raise TokenError."""
+        now = time.time()
+        key, claims = self._check(token, now)
+        if claims is None:
+            user_resp = supabase.get('/auth/v1/user', user_token=token)
+            claims, expires_at = self._remote_claims(user_resp, token, now)
+            self._cache.set(key, claims, expires_at)
+        return claims
+
+    async def verify_async(self, token):
+        """verify() for async code: a remote check doesn't block the event loop."""
+        now = time.time()
+        key, claims = self._check(token, now)
+        if claims is None:
+            user_resp = await async_supabase.get('/auth/v1/user', user_token=token)
+            claims, expires_at = self._remote_claims(user_resp, token, now)
+            self._cache.set(key, claims, expires_at)
+        return claims
+
+
+# Shared instance for the whole process
+token_verifier = TokenVerifier()
+
+
+def get_user_id(user_token):
+    """Resolve a bearer token to a user id. Returns (user_id, error)."""
+    with tracing.span('auth') as span:
+        try:
+            claims = token_verifier.verify(user_token)
+        except TokenError:
+            span.status = 'invalid'
+            return None, "Invalid token"
+        return claims.get('sub'), None
+
+
+async def get_user_id_async(user_token):
+    """get_user_id() for the async routes."""
+    with tracing.span('auth') as span:
+        try:
+            claims = await token_verifier.verify_async(user_token)
+        except TokenError:
+            span.status = 'invalid'
+            return None, "Invalid token"
+        return claims.get('sub'), None
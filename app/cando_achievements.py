@@ -0,0 +1,167 @@
+"""
+Persistence of AI-detected Can-Do achievements.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import tracing
+from supabase_client import supabase, submit
+
+load_dotenv()
+
+# Detections AchievementWriter collects before saving them in one request
+ACHIEVEMENT_BATCH_SIZE = int(os.getenv("ACHIEVEMENT_BATCH_SIZE", "5"))
+
+# Seconds a collected detection may wait for its batch to fill up
+ACHIEVEMENT_BATCH_WAIT = float(os.getenv("ACHIEVEMENT_BATCH_WAIT", "2"))
+
+
+class AchievementSaveError(Exception):
+    """Supabase did not accept the achievements."""
+
+
+def save_detected_achievements(user_id, session_id, detected, valid_ids):
+    """
+    Insert detected achievements the user doesn't have yet, in one request.
+
+    Uses a PostgREST upsert on the (user_id, cando_id) unique key with
+    ignore-duplicates, so existing achievements are left untouched and
+    only newly inserted rows come back. Detections whose cando_id is not in
+    valid_ids (e.g. ids the model made up) are skipped, as are repeats of
+    the same cando_id. Returns the detections that were newly saved;
+    raises AchievementSaveError if the request fails.
+    """
+    rows = []
+    by_cando_id = {}
+    for achievement in detected:
+        cando_id = achievement.get('cando_id')
+        if cando_id not in valid_ids or cando_id in by_cando_id:
+            continue
+        by_cando_id[cando_id] = achievement
+        rows.append({
+            'user_id': user_id,
+            'cando_id': cando_id,
+            'session_id': session_id,
+            'detected_by': 'ai_automatic',
+            'confidence_score': achievement.get('confidence'),
+            'evidence_text': achievement.get('evidence')
+        })
+
+    if not rows:
+        return []
+
+    insert_resp = supabase.post(
+        '/rest/v1/user_cando_achievements?on_conflict=user_id,cando_id&select=cando_id',
+        headers={'Prefer': 'resolution=ignore-duplicates,return=representation'},
+        json=rows
+    )
+
+    if insert_resp.status_code not in [200, 201]:
+        tracing.log('achievements_save_failed', level=logging.ERROR, status=insert_resp.status_code,
+                    response=insert_resp.text[:500])
+        raise AchievementSaveError(f"Saving achievements failed: {insert_resp.status_code}")
+
+    inserted_ids = {row['cando_id'] for row in insert_resp.json()}
+    return [by_cando_id[cando_id] for cando_id in by_cando_id if cando_id in inserted_ids]
+
+
+def earned_in_session(user_id, session_id, cando_ids):
+    """
+    The cando_ids the user earned in this session: those whose achievement
+    row was saved with the session's id. Achievements the user had before
+    the analysis carry another session (or none), and unlike the upsert's
+    return value this still counts rows saved by an earlier, failed
+    attempt of the same analysis.
+    """
+    if not cando_ids:
+        return set()
+    resp = supabase.get('/rest/v1/user_cando_achievements', params={
+        'user_id': f'eq.{user_id}',
+        'session_id': f'eq.{session_id}',
+        'cando_id': f'in.({",".join(str(cando_id) for cando_id in cando_ids)})',
+        'select': 'cando_id'
+    })
+    if resp.status_code != 200:
+        raise AchievementSaveError(f"Reading saved achievements failed: {resp.status_code}")
+    return {row['cando_id'] for row in resp.json()}
+
+
+class AchievementWriter:
+    """
+    Saves detections while the analysis is still running.
+
+    add() is called as each detection is final and collects it; once
+    ACHIEVEMENT_BATCH_SIZE detections are collected, or the oldest has
+    waited ACHIEVEMENT_BATCH_WAIT seconds when the next one arrives, the
+    batch is saved in one request in the background on the shared fan-out
+    pool. finish() saves whatever was not sent yet or failed to save, and
+    returns the detections earned in this session.
+
+    Batching trades how soon a detection shows up in the learner's
+    progress for round trips: a session with n detections costs about
+    n / ACHIEVEMENT_BATCH_SIZE saves instead of n, plus the final upsert
+    and one read in finish(). ACHIEVEMENT_BATCH_SIZE=1 saves each
+    detection right away.
+    """
+
+    def __init__(self, user_id, session_id, valid_ids):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.valid_ids = valid_ids
+        self._seen = set()
+        self._batch = []
+        self._batch_started = None
+        self._sent = []  # (cando_ids, Future) per batch
+        self._lock = threading.Lock()
+
+    def add(self, achievement):
+        cando_id = achievement.get('cando_id')
+        with self._lock:
+            if cando_id not in self.valid_ids or cando_id in self._seen:
+                return
+            self._seen.add(cando_id)
+            if not self._batch:
+                self._batch_started = time.monotonic()
+            self._batch.append(achievement)
+            if len(self._batch) < ACHIEVEMENT_BATCH_SIZE \
+                    and time.monotonic() - self._batch_started < ACHIEVEMENT_BATCH_WAIT:
+                return
+            batch, self._batch = self._batch, []
+            self._sent.append(({a['cando_id'] for a in batch}, submit(
+                save_detected_achievements, self.user_id, self.session_id, batch, self.valid_ids
+            )))
+
+    def finish(self, detected):
+        """
+        Save the rest of detected, including batches not sent yet or whose
+        save failed, in one request. Returns the detections earned in this
+        session, in detected order. Raises if some of them could not be saved.
+        """
+        with self._lock:
+            sent = list(self._sent)
+
+        sent_ids = set()
+        for cando_ids, future in sent:
+            try:
+                future.result()
+                sent_ids |= cando_ids
+            except Exception as e:
+                tracing.log_error('achievement_save', e, cando_ids=sorted(cando_ids), retry=True)
+
+        rest = [a for a in detected if a.get('cando_id') not in sent_ids]
+        save_detected_achievements(self.user_id, self.session_id, rest, self.valid_ids)
+
+        earned = earned_in_session(self.user_id, self.session_id,
+                                   {a.get('cando_id') for a in detected if a.get('cando_id') in self.valid_ids})
+        new_achievements = []
+        for achievement in detected:
+            cando_id = achievement.get('cando_id')
+            if cando_id in earned:
+                new_achievements.append(achievement)
+                earned.discard(cando_id)
+        return new_achievements
@@ -0,0 +1,187 @@
+"""
+Process-local, versioned copy of the cando_statements table.
+
+The catalog (~330 rows) is loaded from Supabase once, on first use, and
+kept as compact __slots__ records with indexes by level, skill_type and
+(level, skill_type). A background thread checks a cheap version stamp
+(row count + latest updated_at) and reloads only when it changes.
+"""
+
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import tracing
+from supabase_client import supabase
+
+load_dotenv()
+
+# Seconds between version checks against Supabase
+CANDO_CATALOG_REFRESH_INTERVAL = int(os.getenv("CANDO_CATALOG_REFRESH_INTERVAL", "300"))
+
+# CEFR levels in ascending order
+LEVEL_ORDER = ['A1', 'A2', 'A2+', 'B1', 'B1+', 'B2', 'B2+', 'C1', 'C2']
+
+# Levels below the learner's level still included in analysis
+LEVELS_BELOW = 2
+
+CATALOG_COLUMNS = 'id,level,skill_type,mode,activity,scale,descriptor,keywords,display_order,updated_at'
+
+
+def relevant_levels(user_level):
+    """
+    Levels to analyze for a learner: 2 below their level (for context) and
+    all levels at or above it, to catch learners exceeding expectations.
+    Unknown levels are treated as A2.
+    """
+    level_map = {level: idx for idx, level in enumerate(LEVEL_ORDER)}
+    current_level_idx = level_map.get(user_level, 1)
+    return [level for level, idx in level_map.items() if idx >= current_level_idx - LEVELS_BELOW]
+
+
+class CatalogError(Exception):
+    """The catalog could not be loaded from Supabase."""
+
+
+class CandoStatement:
+    """One Can-Do statement."""
+
+    __slots__ = ('id', 'level', 'skill_type', 'mode', 'activity', 'scale',
+                 'descriptor', 'keywords', 'display_order')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.level = row['level']
+        self.skill_type = row['skill_type']
+        self.mode = row.get('mode')
+        self.activity = row.get('activity')
+        self.scale = row.get('scale')
+        self.descriptor = row['descriptor']
+        self.keywords = tuple(row.get('keywords') or ())
+        self.display_order = row.get('display_order')
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _Snapshot:
+    """Immutable set of records and indexes for one catalog version."""
+
+    __slots__ = ('version', 'statements', 'by_id', 'by_level', 'by_skill', 'by_level_skill')
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.statements = tuple(CandoStatement(row) for row in rows)
+        self.by_id = {}
+        by_level = {}
+        by_skill = {}
+        by_level_skill = {}
+        for stmt in self.statements:
+            self.by_id[stmt.id] = stmt
+            by_level.setdefault(stmt.level, []).append(stmt)
+            by_skill.setdefault(stmt.skill_type, []).append(stmt)
+            by_level_skill.setdefault((stmt.level, stmt.skill_type), []).append(stmt)
+        self.by_level = {k: tuple(v) for k, v in by_level.items()}
+        self.by_skill = {k: tuple(v) for k, v in by_skill.items()}
+        self.by_level_skill = {k: tuple(v) for k, v in by_level_skill.items()}
+
+
+def _fetch_version():
+    """Return a version stamp for the table: '<row count>:<latest updated_at>'."""
+    resp = supabase.get(
+        '/rest/v1/cando_statements?select=updated_at&order=updated_at.desc.nullslast&limit=1',
+        headers={'Prefer': 'count=exact'}
+    )
+    if resp.status_code not in [200, 206]:
+        raise CatalogError(f"Failed to check Can-Do catalog version: {resp.status_code}")
+    count = resp.headers.get('Content-Range', '').rpartition('/')[2]
+    rows = resp.json()
+    latest = rows[0].get('updated_at') if rows else None
+    return f'{count}:{latest}'
+
+
+def _fetch_rows():
+    resp = supabase.get(f'/rest/v1/cando_statements?select={CATALOG_COLUMNS}&order=display_order.asc')
+    if resp.status_code != 200:
+        raise CatalogError(f"Failed to fetch Can-Do statements: {resp.status_code}")
+    return resp.json()
+
+
+class CandoCatalog:
+    """Lazily loaded, background-refreshed Can-Do statement catalog."""
+
+    def __init__(self, refresh_interval=CANDO_CATALOG_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def _load(self):
+        with tracing.span('catalog.load'):
+            version = _fetch_version()
+            rows = _fetch_rows()
+            self._snapshot = _Snapshot(version, rows)
+        tracing.log('catalog_loaded', statements=len(rows), version=version)
+
+    def refresh(self, force=False):
+        """Reload the catalog if its version changed (or always, if force)."""
+        with self._lock:
+            if not force and self._snapshot is not None:
+                if _fetch_version() == self._snapshot.version:
+                    return False
+            self._load()
+            return True
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the last loaded catalog
+                tracing.log_error('catalog_refresh', e)
+
+    def _get(self):
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None:
+                self._load()
+            if self._refresher is None and self.refresh_interval > 0:
+                self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+                self._refresher.start()
+            return self._snapshot
+
+    @property
+    def version(self):
+        return self._get().version
+
+    def all(self):
+        """All statements in display order."""
+        return self._get().statements
+
+    def get(self, cando_id):
+        return self._get().by_id.get(cando_id)
+
+    def by_level(self, level):
+        return self._get().by_level.get(level, ())
+
+    def by_skill(self, skill_type):
+        return self._get().by_skill.get(skill_type, ())
+
+    def by_level_skill(self, level, skill_type):
+        return self._get().by_level_skill.get((level, skill_type), ())
+
+    def for_levels(self, levels):
+        """Statements for the given levels, in display order."""
+        snapshot = self._get()
+        wanted = set(levels)
+        return [stmt for stmt in snapshot.statements if stmt.level in wanted]
+
+
+# Shared instance for the whole process
+catalog = CandoCatalog()
@@ -0,0 +1,345 @@
+"""
+Idempotent bulk import of CEFR Can-Do statements into cando_statements.
+
+Each statement is identified by its natural key: level plus a hash of the
+normalized scale and descriptor (descriptor_hash, see
+ADD_CANDO_NATURAL_KEY.sql). The scale is part of the hash because CEFR
+repeats some descriptors, word for word, under several scales.
+The source file is read as a stream (a JSON array or JSON Lines), compared
+with the rows already in Supabase, and only new or changed rows are sent,
+as upserts on (level, descriptor_hash) with resolution=merge-duplicates.
+
+Keywords are each statement's highest-weighted TF-IDF terms across the
+whole source file (cando_lexical).
+
+Batches go through a bounded thread pool and are retried with jittered
+backoff. Written keys are recorded in a checkpoint file, so an
+interrupted import resumes where it stopped, and running it again is safe.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from cando_lexical import LexicalIndex
+from supabase_client import supabase
+
+load_dotenv()
+
+# Rows per upsert request
+IMPORT_BATCH_SIZE = int(os.getenv("CANDO_IMPORT_BATCH_SIZE", "200"))
+
+# Upsert requests in flight at once
+IMPORT_WORKERS = int(os.getenv("CANDO_IMPORT_WORKERS", "4"))
+
+# Extra attempts per batch after the first one
+IMPORT_MAX_RETRIES = int(os.getenv("CANDO_IMPORT_MAX_RETRIES", "4"))
+
+# Base delay for exponential backoff between attempts (seconds)
+IMPORT_RETRY_BACKOFF = 0.5
+
+# Rows per page when reading existing statements
+FETCH_PAGE_SIZE = 1000
+
+# Columns compared to decide whether a row changed
+COMPARED_COLUMNS = ('skill_type', 'mode', 'activity', 'scale', 'descriptor', 'keywords', 'display_order')
+
+UPSERT_PATH = '/rest/v1/cando_statements?on_conflict=level,descriptor_hash'
+
+# Keywords stored per statement (its highest-weighted TF-IDF terms)
+KEYWORDS_PER_STATEMENT = 10
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class CandoImportError(Exception):
+    """Supabase could not be read or written."""
+
+
+def _normalize(text):
+    return _WHITESPACE.sub(' ', text or '').strip()
+
+
+def descriptor_hash(scale, descriptor):
+    """Hash of the whitespace-normalized scale and descriptor, part of the natural key."""
+    normalized = f'{_normalize(scale)}\n{_normalize(descriptor)}'
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def natural_key(row):
+    return f"{row['level']}|{row['descriptor_hash']}"
+
+
+def iter_statements(path, chunk_size=65536):
+    """
+    Yield statements from a JSON array or JSON Lines file without loading
+    the whole file.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        in_array = None
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            pos = 0
+            while True:
+                # Skip whitespace and separators between values
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buffer) and in_array is None:
+                    in_array = buffer[pos] == '['
+                    if in_array:
+                        pos += 1
+                        continue
+                if pos < len(buffer) and buffer[pos] == ']' and in_array:
+                    return
+                if pos >= len(buffer):
+                    break
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+                    break  # Value continues in the next chunk
+                yield value
+                pos = end
+            buffer = buffer[pos:]
+            if not chunk:
+                return
+
+
+def build_row(stmt, display_order, keywords):
+    """cando_statements row for one source statement."""
+    return {
+        "level": stmt['level'],
+        "descriptor_hash": descriptor_hash(stmt.get('scale'), stmt['descriptor']),
+        "skill_type": stmt['skill_type'],
+        "mode": stmt['mode'],
+        "activity": stmt['activity'],
+        "scale": stmt['scale'] if stmt.get('scale') else None,
+        "descriptor": stmt['descriptor'],
+        "keywords": keywords,
+        "display_order": display_order
+    }
+
+
+def fetch_existing():
+    """Existing rows by natural key (rows without descriptor_hash are skipped)."""
+    columns = ','.join(('level', 'descriptor_hash') + COMPARED_COLUMNS)
+    existing = {}
+    offset = 0
+    while True:
+        resp = supabase.get(
+            f'/rest/v1/cando_statements?select={columns}&descriptor_hash=not.is.null'
+            f'&order=id&limit={FETCH_PAGE_SIZE}&offset={offset}'
+        )
+        if resp.status_code != 200:
+            raise CandoImportError(f"Failed to read existing statements: {resp.status_code} {resp.text}")
+        rows = resp.json()
+        for row in rows:
+            existing[natural_key(row)] = row
+        if len(rows) < FETCH_PAGE_SIZE:
+            return existing
+        offset += FETCH_PAGE_SIZE
+
+
+def changed_columns(row, current):
+    return [c for c in COMPARED_COLUMNS if row.get(c) != current.get(c)]
+
+
+class Checkpoint:
+    """Natural keys already written for one version of the source file."""
+
+    def __init__(self, path, source_hash):
+        self.path = path
+        self.source_hash = source_hash
+        self.done = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('source_hash') == source_hash:
+                self.done = set(data.get('done', []))
+
+    def add(self, keys):
+        if not self.path:
+            return
+        with self._lock:
+            self.done.update(keys)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'source_hash': self.source_hash, 'done': sorted(self.done)}, f)
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def upsert_batch(rows, max_retries=IMPORT_MAX_RETRIES):
+    """Upsert one batch, retrying gateway errors, rate limits and network failures."""
+    attempt = 0
+    while True:
+        try:
+            resp = supabase.post(
+                UPSERT_PATH,
+                headers={'Prefer': 'resolution=merge-duplicates,return=minimal'},
+                json=rows
+            )
+            if resp.status_code in [200, 201, 204]:
+                return
+            error = CandoImportError(f"{resp.status_code} {resp.text}")
+            retryable = resp.status_code == 429 or resp.status_code >= 500
+        except Exception as e:
+            error = e
+            retryable = True
+        if not retryable or attempt >= max_retries:
+            raise error
+        # Exponential backoff with full jitter
+        time.sleep(random.uniform(0, IMPORT_RETRY_BACKOFF * (2 ** attempt)))
+        attempt += 1
+
+
+def plan_import(path, existing, checkpoint):
+    """
+    Split the source rows into new and changed rows, and count the
+    unchanged, already imported (per checkpoint) and duplicate ones.
+    """
+    # First pass: TF-IDF over all descriptors, for the keywords
+    descriptors = [stmt['descriptor'] for stmt in iter_statements(path)]
+    lexical = LexicalIndex.build([str(i) for i in range(len(descriptors))], descriptors)
+    del descriptors
+
+    new, changed = [], []
+    unchanged = skipped = duplicates = 0
+    seen = set()
+    for index, stmt in enumerate(iter_statements(path)):
+        keywords = lexical.top_terms(str(index), KEYWORDS_PER_STATEMENT)
+        row = build_row(stmt, index + 1, keywords)
+        key = natural_key(row)
+        if key in seen:
+            duplicates += 1  # Same statement twice in the source
+            continue
+        seen.add(key)
+        if key in checkpoint.done:
+            skipped += 1
+            continue
+        current = existing.get(key)
+        if current is None:
+            new.append(row)
+        elif changed_columns(row, current):
+            changed.append(row)
+        else:
+            unchanged += 1
+    return new, changed, unchanged, skipped, duplicates
+
+
+def import_statements(path, dry_run=False, batch_size=IMPORT_BATCH_SIZE, workers=IMPORT_WORKERS,
+                      checkpoint_path=None, log=print):
+    """
+    Import the statements in path and return a summary dict with the
+    new/changed/unchanged/skipped/duplicates/written/failed row counts.
+
+    With dry_run, nothing is written and the new and changed rows are
+    logged instead.
+    """
+    checkpoint = Checkpoint(None if dry_run else checkpoint_path, file_hash(path))
+    existing = fetch_existing()
+    new, changed, unchanged, skipped, duplicates = plan_import(path, existing, checkpoint)
+
+    summary = {
+        'new': len(new), 'changed': len(changed), 'unchanged': unchanged,
+        'skipped': skipped, 'duplicates': duplicates, 'written': 0, 'failed': 0
+    }
+
+    if dry_run:
+        for row in new:
+            log(f"  + [{row['level']}] {row['descriptor'][:100]}")
+        for row in changed:
+            current = existing[natural_key(row)]
+            log(f"  ~ [{row['level']}] {row['descriptor'][:100]}")
+            for column in changed_columns(row, current):
+                log(f"      {column}: {current.get(column)!r} -> {row.get(column)!r}")
+        return summary
+
+    rows = new + changed
+    batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    if not batches:
+        checkpoint.clear()
+        return summary
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches)))) as executor:
+        futures = {executor.submit(upsert_batch, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                summary['failed'] += len(batch)
+                log(f"  Batch of {len(batch)} failed: {e}")
+                continue
+            summary['written'] += len(batch)
+            checkpoint.add(natural_key(row) for row in batch)
+            log(f"  Wrote {summary['written']}/{len(rows)} rows")
+
+    # A complete run leaves nothing to resume
+    if summary['failed'] == 0:
+        checkpoint.clear()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import CEFR Can-Do statements into Supabase.")
+    parser.add_argument('source', nargs='?', default='cefr_statements_filtered.json',
+                        help="JSON array or JSON Lines file of statements")
+    parser.add_argument('--dry-run', action='store_true', help="show new and changed rows without writing")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=IMPORT_WORKERS)
+    parser.add_argument('--checkpoint', default=None,
+                        help="progress file used to resume (default: <source>.import-checkpoint.json)")
+    args = parser.parse_args(argv)
+
+    if not supabase.configured:
+        print("ERROR: set SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY in the .env file")
+        return 1
+
+    checkpoint_path = args.checkpoint or f'{args.source}.import-checkpoint.json'
+    start = time.perf_counter()
+    try:
+        summary = import_statements(args.source, dry_run=args.dry_run, batch_size=args.batch_size,
+                                    workers=args.workers, checkpoint_path=checkpoint_path)
+    except CandoImportError as e:
+        print(f"ERROR: {e}")
+        return 1
+    elapsed = time.perf_counter() - start
+
+    mode = "Dry run" if args.dry_run else "Import"
+    print(f"{mode} finished in {elapsed:.1f}s: {summary['new']} new, {summary['changed']} changed, "
+          f"{summary['unchanged']} unchanged, {summary['skipped']} already done, "
+          f"{summary['duplicates']} duplicates in source")
+    if not args.dry_run:
+        print(f"Wrote {summary['written']} rows, {summary['failed']} failed")
+        if summary['failed']:
+            print("Run the command again to retry the failed rows.")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
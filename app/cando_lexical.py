@@ -0,0 +1,241 @@
+"""
+TF-IDF lexical index over Can-Do statement descriptors.
+
+The whole catalog is tokenized in one pass and turned into sparse
+L2-normalized TF-IDF vectors held as NumPy arrays (per-term posting
+lists). Scoring a transcript is one bincount over the postings of its
+terms, with no network call. The index for each catalog version is
+saved as an .npz file in CANDO_INDEX_DIR, next to the embedding index,
+and loaded from there by later processes.
+
+The importer uses the same index to fill cando_statements.keywords with
+each statement's highest-weighted terms.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+from dotenv import load_dotenv
+
+import tracing
+from cando_catalog import catalog
+
+load_dotenv()
+
+# Where the lexical and embedding indexes are saved: a cache directory, rebuilt when missing
+CANDO_INDEX_DIR = os.getenv("CANDO_INDEX_DIR", os.path.join(
+    os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser('~'), '.cache')),
+    'teaching-assistant', 'cando_index'
+))
+
+# Bump when tokenization or weighting changes, so saved indexes are rebuilt
+INDEX_FORMAT = 1
+
+STOP_WORDS = frozenset({
+    'can', 'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by',
+    'from', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'do', 'does',
+    'did', 'will', 'would', 'should', 'could', 'may', 'might', 'must', 'shall', 'their', 'they',
+    'them', 'this', 'that', 'these', 'those', 'which', 'what', 'when', 'where', 'who', 'how',
+    'such', 'some', 'any', 'very', 'also', 'about', 'into', 'than', 'there', 'its', 'etc',
+    'i', 'you', 'he', 'she', 'it', 'we', 'me', 'my', 'your', 'our', 'his', 'her', 'not', 'as',
+    'if', 'so', 'yes', 'no', 'just', 'yeah', 'okay', 'ok', 'um', 'uh', 'well', 'really'
+})
+
+_WORD = re.compile(r"[a-z]+(?:'[a-z]+)?")
+
+# Suffixes stripped so that "describe", "describes" and "describing" share a term
+_SUFFIXES = ('ations', 'ation', 'ings', 'ing', 'edly', 'ies', 'ed', 'es', 'ly', 's', 'e')
+
+
+def stem(word):
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text):
+    """Content words of text as (stem, surface word) pairs."""
+    return [(stem(word), word) for word in _WORD.findall(text.lower())
+            if len(word) > 2 and word not in STOP_WORDS]
+
+
+class LexicalIndex:
+    """Sparse TF-IDF vectors for a list of documents."""
+
+    def __init__(self, ids, vocabulary, idf, term_ptr, postings_doc, postings_weight, labels):
+        self.ids = list(ids)
+        self.vocabulary = vocabulary            # term -> column
+        self.idf = idf                          # float32[n_terms]
+        self.term_ptr = term_ptr                # int64[n_terms + 1], postings of term t are [ptr[t], ptr[t+1])
+        self.postings_doc = postings_doc        # int32[n_postings]
+        self.postings_weight = postings_weight  # float32[n_postings]
+        self.labels = labels                    # column -> most common surface word
+        self.row_of = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self._by_doc = None
+
+    @classmethod
+    def build(cls, ids, texts):
+        """Tokenize every text once and compute normalized TF-IDF weights."""
+        vocabulary = {}
+        surface = []
+        doc_rows = []
+        term_cols = []
+        for row, text in enumerate(texts):
+            for term, word in tokenize(text):
+                col = vocabulary.get(term)
+                if col is None:
+                    col = vocabulary[term] = len(surface)
+                    surface.append(Counter())
+                surface[col][word] += 1
+                doc_rows.append(row)
+                term_cols.append(col)
+
+        n_docs = len(texts)
+        n_terms = len(vocabulary)
+        doc_rows = np.asarray(doc_rows, dtype=np.int64)
+        term_cols = np.asarray(term_cols, dtype=np.int64)
+
+        # Term frequency per (term, doc) pair, sorted by term then doc
+        pairs, tf = np.unique(term_cols * max(n_docs, 1) + doc_rows, return_counts=True)
+        pair_terms = pairs // max(n_docs, 1)
+        pair_docs = (pairs % max(n_docs, 1)).astype(np.int32)
+
+        df = np.bincount(pair_terms, minlength=n_terms)
+        idf = (np.log((1 + n_docs) / (1 + df)) + 1).astype(np.float32)
+        weights = (1 + np.log(tf)) * idf[pair_terms]
+
+        # L2-normalize each document vector
+        norms = np.sqrt(np.bincount(pair_docs, weights=weights ** 2, minlength=n_docs))
+        norms[norms == 0] = 1.0
+        weights = (weights / norms[pair_docs]).astype(np.float32)
+
+        term_ptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pair_terms, minlength=n_terms), out=term_ptr[1:])
+
+        labels = [counts.most_common(1)[0][0] for counts in surface]
+        return cls(ids, vocabulary, idf, term_ptr, pair_docs, weights, labels)
+
+    def _query_vector(self, text):
+        counts = Counter(self.vocabulary[term] for term, _ in tokenize(text) if term in self.vocabulary)
+        if not counts:
+            return None, None
+        cols = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        weights = (1 + np.log(tf)) * self.idf[cols]
+        return cols, weights / np.linalg.norm(weights)
+
+    def scores(self, text):
+        """Cosine similarity of text with every document, as a float32 array."""
+        result = np.zeros(len(self.ids), dtype=np.float32)
+        cols, query_weights = self._query_vector(text)
+        if cols is None:
+            return result
+        starts = self.term_ptr[cols]
+        lengths = self.term_ptr[cols + 1] - starts
+        # Gather the postings of every query term in one go
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        contributions = self.postings_weight[offsets] * np.repeat(query_weights, lengths)
+        result += np.bincount(self.postings_doc[offsets], weights=contributions,
+                              minlength=len(self.ids)).astype(np.float32)
+        return result
+
+    def score(self, text, limit=None):
+        """Document ids ranked by similarity to text, as (id, score) pairs with score > 0."""
+        scores = self.scores(text)
+        order = np.argsort(-scores, kind='stable')
+        ranked = [(self.ids[i], float(scores[i])) for i in order if scores[i] > 0]
+        return ranked[:limit] if limit else ranked
+
+    def _doc_major(self):
+        """Postings regrouped by document, built on first use."""
+        if self._by_doc is None:
+            order = np.argsort(self.postings_doc, kind='stable')
+            cols = np.searchsorted(self.term_ptr, order, side='right') - 1
+            doc_ptr = np.zeros(len(self.ids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.postings_doc, minlength=len(self.ids)), out=doc_ptr[1:])
+            self._by_doc = (doc_ptr, cols, self.postings_weight[order])
+        return self._by_doc
+
+    def top_terms(self, doc_id, n=10):
+        """The n highest-weighted terms of a document, as surface words."""
+        doc_ptr, cols, weights = self._doc_major()
+        row = self.row_of[doc_id]
+        start, end = doc_ptr[row], doc_ptr[row + 1]
+        order = np.argsort(-weights[start:end], kind='stable')[:n]
+        return [self.labels[cols[start + i]] for i in order]
+
+    def save(self, path):
+        terms = [None] * len(self.vocabulary)
+        for term, col in self.vocabulary.items():
+            terms[col] = term
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, ids=np.asarray(self.ids), terms=np.asarray(terms), labels=np.asarray(self.labels),
+                 idf=self.idf, term_ptr=self.term_ptr, postings_doc=self.postings_doc,
+                 postings_weight=self.postings_weight)
+        # Other processes never see half an index
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            vocabulary = {str(term): col for col, term in enumerate(data['terms'])}
+            return cls([str(i) for i in data['ids']], vocabulary, data['idf'], data['term_ptr'],
+                       data['postings_doc'], data['postings_weight'], [str(w) for w in data['labels']])
+
+
+def index_path(version, index_dir=CANDO_INDEX_DIR):
+    tag = hashlib.sha256(f'{version}:lexical:{INDEX_FORMAT}'.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(index_dir, f'cando_index_lexical_{tag}.npz')
+
+
+def load_or_build(version, statements, index_dir=CANDO_INDEX_DIR):
+    """Load the saved index for this catalog version, or build and save it."""
+    path = index_path(version, index_dir)
+    ids = [stmt.id for stmt in statements]
+    if os.path.exists(path):
+        try:
+            index = LexicalIndex.load(path)
+            if index.ids == ids:
+                return index
+        except (OSError, ValueError, KeyError) as e:
+            tracing.log_error('lexical_index_load', e, fallback='rebuild')
+
+    index = LexicalIndex.build(ids, [stmt.descriptor for stmt in statements])
+    try:
+        index.save(path)
+    except OSError as e:
+        tracing.log_error('lexical_index_save', e)
+    return index
+
+
+class CatalogLexicalIndex:
+    """Lexical index that follows the catalog version."""
+
+    def __init__(self, source=lambda: (catalog.version, catalog.all())):
+        self.source = source
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        version, statements = self.source()
+        index = self._index
+        if index is not None and index[0] == version:
+            return index[1]
+        with self._lock:
+            if self._index is None or self._index[0] != version:
+                self._index = (version, load_or_build(version, statements))
+            return self._index[1]
+
+    def score(self, transcript, limit=None):
+        """Catalog cando_ids ranked by lexical similarity to the transcript."""
+        return self.get().score(transcript, limit)
+
+
+# Shared instance for the whole process
+lexical_index = CatalogLexicalIndex()
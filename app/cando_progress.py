@@ -0,0 +1,109 @@
+"""
+Per-level Can-Do progress for /users/<user_id>/cando.
+
+Everything that only depends on the catalog (level order, per-level
+totals, statement order and the per-statement response dicts) is built
+once per catalog version. A request then only intersects the user's
+achieved ids with each level's id set and fills in is_achieved.
+"""
+
+import threading
+
+from cando_catalog import catalog, LEVEL_ORDER
+
+
+class _LevelLayout:
+    __slots__ = ('level', 'total', 'ids', 'templates')
+
+    def __init__(self, level, statements):
+        self.level = level
+        self.total = len(statements)
+        self.ids = frozenset(stmt.id for stmt in statements)
+        # (id, response dict without is_achieved) in display order
+        self.templates = tuple(
+            (stmt.id, {'id': stmt.id, 'descriptor': stmt.descriptor, 'skill_type': stmt.skill_type})
+            for stmt in statements
+        )
+
+
+class _Layout:
+    __slots__ = ('statements', 'levels')
+
+    def __init__(self, statements):
+        self.statements = statements
+        grouped = {}
+        for stmt in statements:
+            grouped.setdefault(stmt.level, []).append(stmt)
+        self.levels = tuple(_LevelLayout(level, grouped[level]) for level in LEVEL_ORDER if level in grouped)
+
+
+_layout = None
+_layout_lock = threading.Lock()
+
+
+def _get_layout():
+    """Return the layout for the current catalog, rebuilding it after a reload."""
+    global _layout
+    statements = catalog.all()
+    layout = _layout
+    if layout is not None and layout.statements is statements:
+        return layout
+    with _layout_lock:
+        if _layout is None or _layout.statements is not statements:
+            _layout = _Layout(statements)
+        return _layout
+
+
+def build_progress(user_id, achievements, summary=False):
+    """
+    Build the progress response body.
+
+    achievements are user_cando_achievements rows ordered by achieved_at
+    (most recent first). Rows rejected by an admin don't count. With
+    summary=True only the per-level counts and percentages are returned.
+    """
+    layout = _get_layout()
+
+    approved = [a for a in achievements if a.get('admin_approved') != False]
+    achieved_ids = {a['cando_id'] for a in approved}
+
+    recent_by_level = {}
+    if not summary:
+        # Rows are already newest first, so grouping keeps them sorted
+        for ach in approved:
+            stmt = catalog.get(ach['cando_id'])
+            if stmt is None:
+                continue
+            recent_by_level.setdefault(stmt.level, []).append({
+                'descriptor': stmt.descriptor,
+                'level': stmt.level,
+                'skill_type': stmt.skill_type,
+                'achieved_at': ach.get('achieved_at'),
+                'detected_by': ach.get('detected_by'),
+                'confidence_score': ach.get('confidence_score')
+            })
+
+    progress_by_level = []
+    for level_layout in layout.levels:
+        total = level_layout.total
+        level_achieved = level_layout.ids & achieved_ids
+        achieved = len(level_achieved)
+        level_data = {
+            'level': level_layout.level,
+            'total': total,
+            'achieved': achieved,
+            'percentage': round((achieved / total * 100), 1) if total > 0 else 0
+        }
+        if not summary:
+            level_data['statements'] = [
+                dict(template, is_achieved=stmt_id in level_achieved)
+                for stmt_id, template in level_layout.templates
+            ]
+            level_data['recent_achievements'] = recent_by_level.get(level_layout.level, [])
+        progress_by_level.append(level_data)
+
+    return {
+        "user_id": user_id,
+        "total_achievements": len(achieved_ids),
+        "progress_by_level": progress_by_level
+    }
@@ -0,0 +1,278 @@
+"""
+Candidate pre-filter for Can-Do transcript analysis.
+
+Instead of pasting every statement from the learner's level range into
+the analysis prompt, statements are ranked against the learner's turns
+and only the best matches are sent to the model.
+
+The ranking uses a local vector index of statement descriptors: each
+descriptor is embedded once per catalog version and the normalized
+vectors are saved as a .npy file (CANDO_INDEX_DIR) that later processes
+memory-map instead of re-embedding. Learner turns are embedded per
+request and scored against the index with one matrix product. Embedding
+calls go through llm_gateway, so they share its deadlines, breakers and
+model concurrency caps. If embeddings are unavailable, or
+CANDO_PREFILTER_METHOD=lexical, the TF-IDF index from cando_lexical is
+used instead, which needs no network call.
+
+The pre-filter is off by default (CANDO_PREFILTER_ENABLED): statements it
+drops are never detected, and on benchmarks/retrieval_eval.py the
+lexical method keeps only about two thirds of the expected statements.
+Turn it on only for a method whose recall on a realistic fixture is
+close to 1.0.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+import tracing
+from cando_catalog import catalog
+from cando_lexical import CatalogLexicalIndex, CANDO_INDEX_DIR
+from llm_gateway import llm_gateway
+
+load_dotenv()
+
+# Turn the pre-filter on to send only the best-matching statements to the model
+CANDO_PREFILTER_ENABLED = os.getenv("CANDO_PREFILTER_ENABLED", "0") == "1"
+
+# Statements always kept, best scores first
+CANDO_PREFILTER_TOP_K = int(os.getenv("CANDO_PREFILTER_TOP_K", "40"))
+
+# Also keep statements scoring within this much of the K-th best score
+CANDO_PREFILTER_MARGIN = float(os.getenv("CANDO_PREFILTER_MARGIN", "0.03"))
+
+# "embedding" (falls back to lexical when the API fails) or "lexical"
+CANDO_PREFILTER_METHOD = os.getenv("CANDO_PREFILTER_METHOD", "embedding")
+
+EMBEDDING_MODEL = os.getenv("CANDO_EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Seconds one embeddings request may take
+EMBEDDING_DEADLINE = 15
+
+# Learner turns are joined into windows of about this many characters
+# before embedding, to keep the number of vectors per request small
+TURN_WINDOW_CHARS = 1000
+
+# Texts per embeddings request
+EMBEDDING_BATCH_SIZE = 100
+
+# Seconds to use the keyword fallback after an embeddings call fails
+EMBEDDING_RETRY_AFTER = 60
+
+_SPEAKER = re.compile(r'^\s*(User|Learner|Student|Assistant|Tutor|AI)\s*:\s*', re.IGNORECASE)
+_LEARNER_SPEAKERS = {'user', 'learner', 'student'}
+
+
+def embed_texts(texts):
+    """Embed texts with the OpenAI embeddings API. Returns a float32 array."""
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        batch = texts[start:start + EMBEDDING_BATCH_SIZE]
+        response = llm_gateway.embed('embedding', EMBEDDING_MODEL, batch, deadline=EMBEDDING_DEADLINE)
+        vectors.extend(item['embedding'] for item in sorted(response['data'], key=lambda d: d['index']))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def learner_turns(transcript):
+    """
+    Return what the learner said, grouped into windows of whole turns.
+
+    Transcripts use "User: ..." / "Assistant: ..." lines; lines without a
+    speaker label continue the previous turn. A transcript with no labels
+    is treated as all learner speech.
+    """
+    turns = []
+    current = None
+    labelled = False
+    for line in transcript.splitlines():
+        match = _SPEAKER.match(line)
+        if match:
+            labelled = True
+            is_learner = match.group(1).lower() in _LEARNER_SPEAKERS
+            current = [] if is_learner else None
+            if current is not None:
+                turns.append(current)
+            line = line[match.end():]
+        if current is not None and line.strip():
+            current.append(line.strip())
+
+    if not labelled:
+        return [transcript.strip()] if transcript.strip() else []
+
+    windows = []
+    window = ''
+    for turn in (' '.join(parts) for parts in turns):
+        if not turn:
+            continue
+        if window and len(window) + len(turn) + 1 > TURN_WINDOW_CHARS:
+            windows.append(window)
+            window = ''
+        window = f'{window} {turn}'.strip()
+    if window:
+        windows.append(window)
+    return windows
+
+
+class StatementIndex:
+    """Normalized descriptor embeddings for one catalog version."""
+
+    def __init__(self, version, ids, matrix):
+        self.version = version
+        self.ids = ids
+        self.row_of = {cando_id: row for row, cando_id in enumerate(ids)}
+        self.matrix = matrix
+
+    @classmethod
+    def load_or_build(cls, version, statements, embed_fn=embed_texts, index_dir=CANDO_INDEX_DIR):
+        """Memory-map a saved index for this version, or embed the catalog and save it."""
+        tag = hashlib.sha256(f'{version}:{EMBEDDING_MODEL}'.encode('utf-8')).hexdigest()[:16]
+        matrix_path = os.path.join(index_dir, f'cando_index_{tag}.npy')
+        ids_path = os.path.join(index_dir, f'cando_index_{tag}.json')
+        ids = [stmt.id for stmt in statements]
+
+        if os.path.exists(matrix_path) and os.path.exists(ids_path):
+            with open(ids_path, 'r') as f:
+                saved_ids = json.load(f)
+            if saved_ids == ids:
+                return cls(version, ids, np.load(matrix_path, mmap_mode='r'))
+
+        matrix = _normalize_rows(embed_fn([stmt.descriptor for stmt in statements]))
+        try:
+            os.makedirs(index_dir, exist_ok=True)
+            # Write to temp files first so other processes never see half an index
+            np.save(matrix_path + '.tmp.npy', matrix)
+            os.replace(matrix_path + '.tmp.npy', matrix_path)
+            with open(ids_path + '.tmp', 'w') as f:
+                json.dump(ids, f)
+            os.replace(ids_path + '.tmp', ids_path)
+        except OSError as e:
+            tracing.log_error('cando_index_save', e)
+        return cls(version, ids, matrix)
+
+
+def _catalog_source():
+    return catalog.version, catalog.all()
+
+
+class CandoRetriever:
+    """Ranks Can-Do statements against a transcript and keeps the best ones."""
+
+    def __init__(self, top_k=CANDO_PREFILTER_TOP_K, margin=CANDO_PREFILTER_MARGIN,
+                 enabled=CANDO_PREFILTER_ENABLED, embed_fn=embed_texts, source=_catalog_source,
+                 method=CANDO_PREFILTER_METHOD):
+        self.top_k = top_k
+        self.margin = margin
+        self.enabled = enabled
+        self.embed_fn = embed_fn
+        self.source = source
+        self.method = method
+        self.lexical = CatalogLexicalIndex(source)
+        self._index = None
+        self._lock = threading.Lock()
+        self._embeddings_down_until = 0.0
+
+    @property
+    def config_tag(self):
+        """Describes the selection settings, for cache keys and logs."""
+        if not self.enabled:
+            return 'all'
+        if self.method == 'lexical':
+            return f'lex:k{self.top_k}:m{self.margin}'
+        return f'emb:{EMBEDDING_MODEL}:k{self.top_k}:m{self.margin}'
+
+    def fell_back(self, info):
+        """Whether a select() used the lexical index because embeddings were unavailable."""
+        return info['method'] == 'lexical' and self.method != 'lexical'
+
+    def _get_index(self):
+        version, statements = self.source()
+        index = self._index
+        if index is not None and index.version == version:
+            return index
+        with self._lock:
+            if self._index is None or self._index.version != version:
+                self._index = StatementIndex.load_or_build(version, statements, self.embed_fn)
+            return self._index
+
+    def _embedding_scores(self, turns, statements):
+        index = self._get_index()
+        rows = [index.row_of.get(stmt.id) for stmt in statements]
+        if any(row is None for row in rows):
+            raise KeyError("Statement missing from the index")
+        turn_vectors = _normalize_rows(self.embed_fn(turns))
+        # Cosine similarity of every turn window with every candidate,
+        # keeping each statement's best-matching window
+        similarities = np.asarray(index.matrix[rows]) @ turn_vectors.T
+        return similarities.max(axis=1)
+
+    def _lexical_scores(self, turns, statements):
+        index = self.lexical.get()
+        rows = np.fromiter((index.row_of.get(stmt.id, -1) for stmt in statements), dtype=np.int64,
+                           count=len(statements))
+        if (rows < 0).any():
+            raise KeyError("Statement missing from the lexical index")
+        # Best-matching turn window per statement, as with embeddings
+        return np.max([index.scores(turn)[rows] for turn in turns], axis=0)
+
+    def _keep(self, scores):
+        """Indexes of the top_k scores plus any positive ones within margin of the K-th."""
+        order = np.argsort(-scores, kind='stable')
+        if len(order) <= self.top_k:
+            return order
+        threshold = scores[order[self.top_k - 1]] - self.margin
+        keep = list(order[:self.top_k])
+        for i in order[self.top_k:]:
+            # Statements with no match at all never ride along on the margin
+            if scores[i] < threshold or scores[i] <= 0:
+                break
+            keep.append(i)
+        return keep
+
+    def select(self, transcript, statements):
+        """
+        Return (candidates, info): the statements worth sending to the
+        model, in their original order, and a dict describing the selection.
+        """
+        start = time.perf_counter()
+        info = {'method': 'all', 'considered': len(statements), 'selected': len(statements)}
+        if not self.enabled or len(statements) <= self.top_k:
+            return list(statements), info
+
+        turns = learner_turns(transcript)
+        if not turns:
+            return list(statements), info
+
+        scores = None
+        if self.method != 'lexical' and time.time() >= self._embeddings_down_until:
+            try:
+                scores = self._embedding_scores(turns, statements)
+                info['method'] = 'embedding'
+            except Exception as e:
+                tracing.log_error('cando_prefilter_embedding', e, fallback='lexical')
+                self._embeddings_down_until = time.time() + EMBEDDING_RETRY_AFTER
+        if scores is None:
+            scores = self._lexical_scores(turns, statements)
+            info['method'] = 'lexical'
+
+        keep = set(int(i) for i in self._keep(scores))
+        candidates = [stmt for i, stmt in enumerate(statements) if i in keep]
+        info['selected'] = len(candidates)
+        info['ms'] = round((time.perf_counter() - start) * 1000, 2)
+        return candidates, info
+
+
+# Shared instance for the whole process
+retriever = CandoRetriever()
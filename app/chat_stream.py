@@ -0,0 +1,95 @@
+"""
+Server-sent events relay for streamed text chat replies.
+
+/chat_text?stream=1 (or /chat_text/stream) opens a streaming chat
+completion and relays each token to the client as an SSE "data" event as
+soon as it arrives, followed by a "done" event with the full reply.
+Nothing is buffered beyond the reply text accumulated for the context.
+
+The caller saves the finished turn from the on_complete callback.
+relay_completion_async() is the same relay for the async routes
+(asgi.py), over an AsyncLLMStream.
+"""
+
+import json
+import time
+
+import tracing
+
+# Response headers that stop proxies (nginx, Render) from buffering the stream
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+
+def sse_event(data, event=None):
+    """Format one SSE message with a JSON payload."""
+    message = f'data: {json.dumps(data)}\n\n'
+    if event:
+        message = f'event: {event}\n' + message
+    return message
+
+
+def relay_completion(completion, on_complete=None):
+    """
+    Yield SSE messages for a streamed ChatCompletion.
+
+    Each content delta becomes {"delta": "..."}; the stream ends with a
+    "done" event carrying {"response_text": "..."}, after on_complete is
+    called with the full reply. If the upstream stream breaks, an "error"
+    event is sent instead and on_complete is not called.
+    """
+    parts = []
+    span = tracing.Span()
+    start = time.perf_counter()
+    try:
+        for chunk in completion:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].get('delta', {}).get('content')
+            if delta:
+                parts.append(delta)
+                yield sse_event({'delta': delta})
+    except Exception as e:
+        tracing.log_error('chat_stream_relay', e)
+        span.status = 'error'
+        tracing.record('llm.chat_stream', start, time.perf_counter() - start, span)
+        yield sse_event({'error': str(e)}, event='error')
+        return
+
+    response_text = ''.join(parts).strip()
+    # Runs after the request has returned, so this only reaches /metrics
+    span.bytes_in = len(response_text)
+    tracing.record('llm.chat_stream', start, time.perf_counter() - start, span)
+    if on_complete:
+        on_complete(response_text)
+    yield sse_event({'response_text': response_text}, event='done')
+
+
+async def relay_completion_async(completion, on_complete=None):
+    """relay_completion() for an async stream; on_complete is awaited."""
+    parts = []
+    span = tracing.Span()
+    start = time.perf_counter()
+    try:
+        async for chunk in completion:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].get('delta', {}).get('content')
+            if delta:
+                parts.append(delta)
+                yield sse_event({'delta': delta})
+    except Exception as e:
+        tracing.log_error('chat_stream_relay', e)
+        span.status = 'error'
+        tracing.record('llm.chat_stream', start, time.perf_counter() - start, span)
+        yield sse_event({'error': str(e)}, event='error')
+        return
+
+    response_text = ''.join(parts).strip()
+    span.bytes_in = len(response_text)
+    tracing.record('llm.chat_stream', start, time.perf_counter() - start, span)
+    if on_complete:
+        await on_complete(response_text)
+    yield sse_event({'response_text': response_text}, event='done')
@@ -0,0 +1,248 @@
+"""
+Server-side store for text chat conversations.
+
+The session cookie only carries a conversation id; the turns live here,
+in one of three backends chosen with CONVERSATION_STORE:
+- "sqlite" (default): a local SQLite file (CONVERSATION_DB), shared by
+  the worker processes on one host
+- "memory": per-process LRU with a TTL; only for a single worker, since
+  a request landing on another worker would not see the history
+- a "redis://..." URL: any Redis-compatible server (needs the redis package),
+  for workers on more than one host
+
+History is windowed on write to CHAT_HISTORY_TOKEN_BUDGET estimated
+tokens. The oldest turns are dropped first; if a summarizer is given,
+they are folded into a running summary that is sent ahead of the
+remaining turns, so the prompt stays about the same size every turn.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import tracing
+from ttl_cache import TTLCache
+
+load_dotenv()
+
+try:
+    import redis
+except ImportError:  # redis is optional, only needed for a redis:// store
+    redis = None
+
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "sqlite")
+
+CONVERSATION_DB = os.getenv(
+    "CONVERSATION_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversations.db')
+)
+
+# Seconds an idle conversation is kept
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", str(24 * 3600)))
+
+# Max number of conversations kept by the in-memory backend
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "5000"))
+
+# Estimated tokens of history (summary + turns) sent with each message
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "3000"))
+
+# Rough per-message overhead of the chat format, in tokens
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_expires_at ON conversations(expires_at);
+"""
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about 4 characters per token for English)."""
+    return len(text) // 4 + 1
+
+
+def message_tokens(message):
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+
+class MemoryBackend:
+    """Conversations in a per-process LRU cache."""
+
+    def __init__(self, maxsize=CONVERSATION_CACHE_SIZE, ttl=CONVERSATION_TTL):
+        self._cache = TTLCache(maxsize, ttl)
+
+    def get(self, conversation_id):
+        record = self._cache.get(conversation_id)
+        if record is None:
+            return None
+        # Copy so callers can't change the stored turns in place
+        return {'summary': record['summary'], 'messages': list(record['messages'])}
+
+    def set(self, conversation_id, record):
+        self._cache.set(conversation_id, record)
+
+    def delete(self, conversation_id):
+        self._cache.pop(conversation_id)
+
+
+class SQLiteBackend:
+    """Conversations in a local SQLite file, shared between processes."""
+
+    def __init__(self, db_path=CONVERSATION_DB, ttl=CONVERSATION_TTL):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _db(self):
+        """Return this process's connection, opening a new one after a fork."""
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def get(self, conversation_id):
+        with self._lock:
+            row = self._db().execute(
+                'SELECT value FROM conversations WHERE id = ? AND expires_at > ?',
+                (conversation_id, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, conversation_id, record):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute(
+                'INSERT OR REPLACE INTO conversations (id, value, expires_at) VALUES (?, ?, ?)',
+                (conversation_id, json.dumps(record), now + self.ttl)
+            )
+            # Expired rows are removed at most once a minute
+            if now - self._last_purge > 60:
+                db.execute('DELETE FROM conversations WHERE expires_at <= ?', (now,))
+                self._last_purge = now
+
+    def delete(self, conversation_id):
+        with self._lock:
+            self._db().execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
+
+
+class RedisBackend:
+    """Conversations in a Redis-compatible server, shared between hosts."""
+
+    def __init__(self, url, ttl=CONVERSATION_TTL, prefix='conversation:'):
+        if redis is None:
+            raise RuntimeError("CONVERSATION_STORE is a redis:// URL but the redis package is not installed")
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, conversation_id):
+        value = self._client.get(self.prefix + conversation_id)
+        return json.loads(value) if value else None
+
+    def set(self, conversation_id, record):
+        self._client.setex(self.prefix + conversation_id, self.ttl, json.dumps(record))
+
+    def delete(self, conversation_id):
+        self._client.delete(self.prefix + conversation_id)
+
+
+def make_backend(spec=CONVERSATION_STORE):
+    """Build the backend named by CONVERSATION_STORE."""
+    if spec.startswith(('redis://', 'rediss://')):
+        return RedisBackend(spec)
+    if spec == 'sqlite':
+        return SQLiteBackend()
+    if spec == 'memory':
+        return MemoryBackend()
+    raise ValueError(f"Unknown CONVERSATION_STORE: {spec}")
+
+
+def empty_record():
+    return {'summary': None, 'messages': []}
+
+
+class ConversationStore:
+    """Token-windowed chat histories keyed by conversation id."""
+
+    def __init__(self, backend=None, token_budget=CHAT_HISTORY_TOKEN_BUDGET, summarizer=None):
+        """
+        summarizer(summary, dropped_messages) returns a new summary string
+        covering the previous summary and the dropped turns. Without one,
+        dropped turns are simply forgotten.
+        """
+        self.backend = backend or make_backend()
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+
+    def load(self, conversation_id):
+        """Return the stored {'summary', 'messages'} record (empty if unknown)."""
+        if not conversation_id:
+            return empty_record()
+        return self.backend.get(conversation_id) or empty_record()
+
+    def append(self, conversation_id, *messages):
+        """Add messages to a conversation, window it and store it."""
+        # No lock: only one browser session writes to a conversation, and
+        # a slow summarizer call must not hold up other conversations
+        record = self.load(conversation_id)
+        record['messages'].extend(messages)
+        record = self._window(record)
+        self.backend.set(conversation_id, record)
+        return record
+
+    def clear(self, conversation_id):
+        if conversation_id:
+            self.backend.delete(conversation_id)
+
+    def prompt_messages(self, record):
+        """Messages to send after the system prompt: summary first, then turns."""
+        messages = list(record['messages'])
+        if record.get('summary'):
+            messages.insert(0, {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {record['summary']}"
+            })
+        return messages
+
+    def _window(self, record):
+        """Drop (or summarize) the oldest turns until the record fits the budget."""
+        messages = record['messages']
+        summary = record.get('summary')
+        used = sum(message_tokens(m) for m in messages)
+        if summary:
+            used += estimate_tokens(summary) + MESSAGE_OVERHEAD_TOKENS
+        if used <= self.token_budget:
+            return record
+
+        dropped = []
+        # Always keep the newest message
+        while len(messages) > 1 and used > self.token_budget:
+            message = messages.pop(0)
+            dropped.append(message)
+            used -= message_tokens(message)
+        # Start the window on a user turn
+        while len(messages) > 1 and messages[0]['role'] != 'user':
+            dropped.append(messages.pop(0))
+
+        if self.summarizer and dropped:
+            try:
+                summary = self.summarizer(summary, dropped)
+            except Exception as e:
+                tracing.log_error('conversation_summarize', e, fallback='drop_old_turns')
+
+        return {'summary': summary, 'messages': messages}
@@ -0,0 +1,763 @@
+"""
+Gateway for OpenAI calls: deadlines, circuit breakers, hedged
+requests, model fallback and per-call accounting.
+
+Every OpenAI call the backend makes goes through llm_gateway:
+- chat() for plain completions (text chat, history summaries)
+- stream() for streamed ones (streamed text chat, transcript analysis)
+- embed() for embeddings (the Can-Do pre-filter); these never fall back,
+  since vectors from another model can't be compared with the index
+
+Each call has a deadline, passed to OpenAI as the request timeout (and
+checked between stream events), so a slow upstream fails the call
+instead of holding the worker until gunicorn kills it.
+
+A circuit breaker per model opens after LLM_BREAKER_FAILURES failures in
+a row (timeouts, connection errors, 429 and 5xx answers) and refuses
+calls for LLM_BREAKER_COOLDOWN seconds; after that, one trial call
+decides whether it closes again. While a model's breaker is open, or
+after a failed attempt with time left before the deadline, the call goes
+to the model's fallback from LLM_FALLBACKS. CircuitOpen is raised when
+no model can take the call.
+
+With hedge=True (text chat), when the first attempt has not answered
+after the p95 latency of recent calls, an identical second request is
+sent and whichever answers first is used. Hedges only start once
+LLM_HEDGE_MIN_SAMPLES latencies are known, and only when a model slot
+is free right away (see rate_limit.MODEL_CONCURRENCY).
+
+Attempts, errors, hedges, fallbacks, tokens and latency are counted per
+model and purpose (GET /admin/llm_gateway, /metrics), and every attempt
+is recorded as an llm.<purpose> span (llm.<purpose>.open for streams).
+
+chat_async() and stream_async() are the same calls for the async routes
+(asgi.py), on openai's aiohttp client: a call in flight is a coroutine
+waiting on a socket, not a thread, and the losing attempt of a hedge is
+cancelled. Breakers, latency windows and counts are shared with the
+sync calls.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import aiohttp
+import openai
+import requests
+from dotenv import load_dotenv
+
+import tracing
+from rate_limit import rate_limiter, Throttled, CONCURRENCY_WAIT
+
+load_dotenv()
+
+# Deadline for calls that don't pass one (seconds)
+LLM_DEFAULT_DEADLINE = float(os.getenv("LLM_DEFAULT_DEADLINE", "60"))
+
+# Model to use when a model fails or its breaker is open: "model:fallback,..."
+LLM_FALLBACKS = os.getenv("LLM_FALLBACKS", "gpt-4o:gpt-4o-mini")
+
+# Failures in a row that open a model's circuit breaker
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+
+# Seconds an open breaker refuses calls before letting a trial call through
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# Set to 0 to never send hedged requests
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "1") == "1"
+
+# Latency percentile after which a hedged request is sent
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+
+# Never hedge earlier than this (seconds)
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+
+# Successful calls needed before the percentile is trusted
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# Recent latencies kept per model and purpose
+LATENCY_WINDOW = 200
+
+# A fallback attempt is not started with less time than this left (seconds)
+MIN_ATTEMPT_TIME = 1.0
+
+# Threads running hedged calls
+HEDGE_THREADS = 32
+
+# Connections the async calls may open to OpenAI per process
+LLM_ASYNC_MAX_CONNECTIONS = int(os.getenv("LLM_ASYNC_MAX_CONNECTIONS", "500"))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class DeadlineExceeded(openai.error.Timeout):
+    """The call's deadline passed (before or during the request)."""
+
+
+class CircuitOpen(Exception):
+    """Every model that could take the call has its breaker open."""
+
+    def __init__(self, model, retry_after):
+        super().__init__(f"{model} is unavailable, please try again shortly")
+        self.model = model
+        self.retry_after = retry_after
+
+
+# Errors that say the model is slow or unavailable: they count against the
+# breaker and are worth a fallback. Anything else (bad request, bad key) is
+# the caller's problem and is raised as is.
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.TryAgain,
+    requests.exceptions.RequestException,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+
+def is_timeout(error):
+    return isinstance(error, (openai.error.Timeout, asyncio.TimeoutError))
+
+
+def parse_fallbacks(spec):
+    """'gpt-4o:gpt-4o-mini' -> {'gpt-4o': 'gpt-4o-mini'}"""
+    fallbacks = {}
+    for item in spec.split(','):
+        model, _, fallback = item.partition(':')
+        if model.strip() and fallback.strip():
+            fallbacks[model.strip()] = fallback.strip()
+    return fallbacks
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class CircuitBreaker:
+    """Opens after `failures` failures in a row; one trial call after `cooldown` seconds."""
+
+    def __init__(self, model, failures=LLM_BREAKER_FAILURES, cooldown=LLM_BREAKER_COOLDOWN):
+        self.model = model
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened = 0
+        self._failed = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go to the model now."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+                self._trial = False
+            if self.state == HALF_OPEN:
+                if self._trial:
+                    return False
+                self._trial = True
+            return self.state != OPEN
+
+    def retry_after(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return 0.0
+            return max(1.0, self._opened_at + self.cooldown - time.monotonic())
+
+    def end_trial(self):
+        """Let another trial call through if this one ended without a verdict (e.g. no model slot)."""
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                tracing.log('llm_breaker_closed', model=self.model)
+            self.state = CLOSED
+            self._failed = 0
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failed >= self.failures):
+                self.state = OPEN
+                self.opened += 1
+                self._opened_at = time.monotonic()
+                self._trial = False
+                tracing.log('llm_breaker_opened', model=self.model, failures=self._failed,
+                            cooldown=self.cooldown)
+
+
+class LLMStream:
+    """
+    Iterator over a streamed completion's events. Enforces the call's
+    deadline between events, accounts tokens and latency when the stream
+    ends, and gives the model slot back on close().
+    """
+
+    def __init__(self, gateway, response, model, purpose, breaker, lease, deadline_at, start):
+        self.model = model
+        self._gateway = gateway
+        self._response = response
+        self._purpose = purpose
+        self._breaker = breaker
+        self._lease = lease
+        self._deadline_at = deadline_at
+        self._start = start
+        self._usage = {}
+        self._finished = False
+
+    def __iter__(self):
+        try:
+            for event in self._response:
+                if event.get('usage'):
+                    self._usage = tracing.token_usage(event)
+                yield event
+                if time.monotonic() > self._deadline_at:
+                    raise DeadlineExceeded(f"{self.model} stream passed its deadline")
+        except Exception as e:
+            self._finish(e)
+            raise
+        self._finish(None)
+
+    def _finish(self, error):
+        if self._finished:
+            return
+        self._finished = True
+        rate_limiter.release(self._lease)
+        elapsed = time.perf_counter() - self._start
+        if error is None:
+            self._breaker.success()
+            self._gateway._observe(self.model, self._purpose, elapsed, self._usage)
+        elif isinstance(error, RETRYABLE_ERRORS):
+            self._breaker.failure()
+            self._gateway._count(self.model, self._purpose, 'timeouts' if is_timeout(error) else 'errors')
+        else:
+            self._gateway._count(self.model, self._purpose, 'errors')
+
+    def close(self):
+        """Stop reading (the client went away, or the caller is done) and free the slot."""
+        if not self._finished:
+            # Not a failure of the model: the stream was only cut short
+            self._finished = True
+            rate_limiter.release(self._lease)
+        close = getattr(self._response, 'close', None)
+        if close:
+            close()
+
+
+class AsyncLLMStream(LLMStream):
+    """LLMStream for stream_async(): iterate with async for, and await aclose() when done."""
+
+    async def __aiter__(self):
+        try:
+            async for event in self._response:
+                if event.get('usage'):
+                    self._usage = tracing.token_usage(event)
+                yield event
+                if time.monotonic() > self._deadline_at:
+                    raise DeadlineExceeded(f"{self.model} stream passed its deadline")
+        except Exception as e:
+            self._finish(e)
+            raise
+        self._finish(None)
+
+    async def aclose(self):
+        """Stop reading (the client went away, or the caller is done) and free the slot."""
+        if not self._finished:
+            self._finished = True
+            rate_limiter.release(self._lease)
+        aclose = getattr(self._response, 'aclose', None)
+        if aclose:
+            await aclose()
+
+
+class LLMGateway:
+    """OpenAI calls with deadlines, breakers, hedging, fallback and accounting."""
+
+    def __init__(self, fallbacks=LLM_FALLBACKS, hedge_enabled=LLM_HEDGE_ENABLED,
+                 hedge_percentile=LLM_HEDGE_PERCENTILE, hedge_min_delay=LLM_HEDGE_MIN_DELAY,
+                 hedge_min_samples=LLM_HEDGE_MIN_SAMPLES, breaker_failures=LLM_BREAKER_FAILURES,
+                 breaker_cooldown=LLM_BREAKER_COOLDOWN, create_fn=None, embed_fn=None, acreate_fn=None):
+        self.fallbacks = parse_fallbacks(fallbacks)
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        # Looked up on each call so the openai module can be configured after import
+        self._create = create_fn
+        self._embed = embed_fn
+        self._acreate = acreate_fn
+
+        self._lock = threading.Lock()
+        self._breakers = {}   # model -> CircuitBreaker
+        self._latency = {}    # (model, purpose) -> deque of recent successful latencies (seconds)
+        self._counts = {}     # (model, purpose) -> {event: count}
+        self._executor = None
+        self._executor_pid = None
+        self._aiohttp = None
+        self._aiohttp_owner = None
+
+    def _get_executor(self):
+        """Thread pool for hedged calls (a new one after a fork)."""
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix='llm-hedge')
+                    self._executor_pid = pid
+        return self._executor
+
+    def breaker(self, model):
+        with self._lock:
+            breaker = self._breakers.get(model)
+            if breaker is None:
+                breaker = self._breakers[model] = CircuitBreaker(model, self.breaker_failures,
+                                                                 self.breaker_cooldown)
+            return breaker
+
+    def chat(self, purpose, model, messages, deadline=None, hedge=False, slot_wait=None, **params):
+        """
+        ChatCompletion for `purpose` (used in spans and metrics), on `model`
+        or its fallback. Returns the OpenAI response. Raises CircuitOpen,
+        rate_limit.Throttled, or the last OpenAI error.
+        """
+        deadline_at = time.monotonic() + (deadline or LLM_DEFAULT_DEADLINE)
+
+        def run(candidate, breaker):
+            if hedge and self.hedge_enabled:
+                return self._hedged(candidate, purpose, messages, params, deadline_at, breaker, slot_wait)
+            return self._attempt(candidate, purpose, 'primary', messages, params, deadline_at, breaker, slot_wait)
+
+        return self._with_fallback(model, purpose, deadline_at, run)
+
+    def stream(self, purpose, model, messages, deadline=None, slot_wait=None, **params):
+        """
+        Streamed ChatCompletion; returns an LLMStream to iterate (its model
+        attribute is the model that answered). The deadline covers the whole
+        stream. Only opening the stream falls back to another model; errors
+        while reading are raised to the caller. Call close() when done.
+        """
+        deadline_at = time.monotonic() + (deadline or LLM_DEFAULT_DEADLINE)
+
+        def run(candidate, breaker):
+            return self._open_stream(candidate, purpose, messages, params, deadline_at, breaker, slot_wait)
+
+        return self._with_fallback(model, purpose, deadline_at, run)
+
+    def embed(self, purpose, model, texts, deadline=None, slot_wait=None):
+        """
+        Embedding of texts on `model` only. Returns the OpenAI response.
+        Raises CircuitOpen, rate_limit.Throttled, or the OpenAI error.
+        """
+        deadline_at = time.monotonic() + (deadline or LLM_DEFAULT_DEADLINE)
+        breaker = self.breaker(model)
+        if not breaker.allow():
+            self._count(model, purpose, 'rejected')
+            raise CircuitOpen(model, breaker.retry_after())
+        try:
+            remaining = self._remaining(deadline_at, model)
+            lease = rate_limiter.acquire(model, wait=min(CONCURRENCY_WAIT if slot_wait is None else slot_wait, remaining))
+            try:
+                remaining = self._remaining(deadline_at, model)
+                with tracing.span(f'llm.{purpose}', model=model, texts=len(texts)) as span:
+                    span.bytes_out = sum(len(text) for text in texts)
+                    start = time.perf_counter()
+                    try:
+                        response = self._embed_fn()(model=model, input=texts, request_timeout=remaining)
+                    except Exception as e:
+                        self._failed(model, purpose, breaker, e, span)
+                        raise
+                    elapsed = time.perf_counter() - start
+                    usage = tracing.token_usage(response)
+                    span.set(**usage)
+            finally:
+                rate_limiter.release(lease)
+        finally:
+            breaker.end_trial()
+        breaker.success()
+        self._observe(model, purpose, elapsed, usage)
+        return response
+
+    def _with_fallback(self, model, purpose, deadline_at, run):
+        """Run on the model, then on its fallback if it is refused or fails in time."""
+        candidates = [model]
+        if self.fallbacks.get(model):
+            candidates.append(self.fallbacks[model])
+        error = None
+        for i, candidate in enumerate(candidates):
+            if i and deadline_at - time.monotonic() < MIN_ATTEMPT_TIME:
+                break
+            breaker = self.breaker(candidate)
+            if not breaker.allow():
+                self._count(candidate, purpose, 'rejected')
+                error = error or CircuitOpen(candidate, breaker.retry_after())
+                continue
+            if i:
+                self._count(candidate, purpose, 'fallbacks')
+                tracing.log('llm_fallback', model=model, fallback=candidate, purpose=purpose,
+                            reason=type(error).__name__)
+            try:
+                return run(candidate, breaker)
+            except Throttled:
+                raise
+            except RETRYABLE_ERRORS as e:
+                error = e
+            finally:
+                breaker.end_trial()
+        raise error
+
+    def _remaining(self, deadline_at, model):
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"No time left for a {model} call")
+        return remaining
+
+    def _attempt(self, model, purpose, kind, messages, params, deadline_at, breaker, slot_wait):
+        """One request to one model, with its own model slot."""
+        remaining = self._remaining(deadline_at, model)
+        if kind == 'hedge':
+            # Only hedge when a slot is free right away
+            slot_wait = 0
+        lease = rate_limiter.acquire(model, wait=min(CONCURRENCY_WAIT if slot_wait is None else slot_wait, remaining))
+        try:
+            remaining = self._remaining(deadline_at, model)
+            span = tracing.Span()
+            span.set(model=model, attempt=kind)
+            span.bytes_out = sum(len(m['content']) for m in messages)
+            start = time.perf_counter()
+            try:
+                response = self._create_fn()(model=model, messages=messages, request_timeout=remaining, **params)
+            except Exception as e:
+                self._failed(model, purpose, breaker, e, span)
+                tracing.record(f'llm.{purpose}', start, time.perf_counter() - start, span)
+                raise
+            elapsed = time.perf_counter() - start
+            usage = tracing.token_usage(response)
+            span.set(**usage)
+            tracing.record(f'llm.{purpose}', start, elapsed, span)
+            breaker.success()
+            self._observe(model, purpose, elapsed, usage)
+            return response
+        finally:
+            rate_limiter.release(lease)
+
+    def _open_stream(self, model, purpose, messages, params, deadline_at, breaker, slot_wait):
+        remaining = self._remaining(deadline_at, model)
+        lease = rate_limiter.acquire(model, wait=min(CONCURRENCY_WAIT if slot_wait is None else slot_wait, remaining))
+        try:
+            # Read timeout between events; the total is checked by LLMStream
+            remaining = self._remaining(deadline_at, model)
+            with tracing.span(f'llm.{purpose}.open', model=model) as span:
+                span.bytes_out = sum(len(m['content']) for m in messages)
+                start = time.perf_counter()
+                try:
+                    response = self._create_fn()(model=model, messages=messages, stream=True,
+                                                 request_timeout=remaining, **params)
+                except Exception as e:
+                    self._failed(model, purpose, breaker, e, span)
+                    raise
+        except BaseException:
+            rate_limiter.release(lease)
+            raise
+        # The model answered; failures while reading are counted by LLMStream
+        breaker.success()
+        return LLMStream(self, response, model, purpose, breaker, lease, deadline_at, start)
+
+    async def chat_async(self, purpose, model, messages, deadline=None, hedge=False, slot_wait=None, **params):
+        """chat() for async code."""
+        deadline_at = time.monotonic() + (deadline or LLM_DEFAULT_DEADLINE)
+
+        async def run(candidate, breaker):
+            if hedge and self.hedge_enabled:
+                return await self._hedged_async(candidate, purpose, messages, params, deadline_at, breaker, slot_wait)
+            return await self._attempt_async(candidate, purpose, 'primary', messages, params, deadline_at,
+                                             breaker, slot_wait)
+
+        return await self._with_fallback_async(model, purpose, deadline_at, run)
+
+    async def stream_async(self, purpose, model, messages, deadline=None, slot_wait=None, **params):
+        """stream() for async code; returns an AsyncLLMStream. Await its aclose() when done."""
+        deadline_at = time.monotonic() + (deadline or LLM_DEFAULT_DEADLINE)
+
+        async def run(candidate, breaker):
+            return await self._open_stream_async(candidate, purpose, messages, params, deadline_at, breaker,
+                                                 slot_wait)
+
+        return await self._with_fallback_async(model, purpose, deadline_at, run)
+
+    async def _with_fallback_async(self, model, purpose, deadline_at, run):
+        """_with_fallback() for async code."""
+        candidates = [model]
+        if self.fallbacks.get(model):
+            candidates.append(self.fallbacks[model])
+        error = None
+        for i, candidate in enumerate(candidates):
+            if i and deadline_at - time.monotonic() < MIN_ATTEMPT_TIME:
+                break
+            breaker = self.breaker(candidate)
+            if not breaker.allow():
+                self._count(candidate, purpose, 'rejected')
+                error = error or CircuitOpen(candidate, breaker.retry_after())
+                continue
+            if i:
+                self._count(candidate, purpose, 'fallbacks')
+                tracing.log('llm_fallback', model=model, fallback=candidate, purpose=purpose,
+                            reason=type(error).__name__)
+            try:
+                return await run(candidate, breaker)
+            except Throttled:
+                raise
+            except RETRYABLE_ERRORS as e:
+                error = e
+            finally:
+                breaker.end_trial()
+        raise error
+
+    async def _attempt_async(self, model, purpose, kind, messages, params, deadline_at, breaker, slot_wait):
+        """_attempt() for async code."""
+        remaining = self._remaining(deadline_at, model)
+        if kind == 'hedge':
+            slot_wait = 0
+        lease = await rate_limiter.acquire_async(
+            model, wait=min(CONCURRENCY_WAIT if slot_wait is None else slot_wait, remaining))
+        try:
+            remaining = self._remaining(deadline_at, model)
+            span = tracing.Span()
+            span.set(model=model, attempt=kind)
+            span.bytes_out = sum(len(m['content']) for m in messages)
+            start = time.perf_counter()
+            try:
+                response = await self._call_async(model=model, messages=messages, request_timeout=remaining, **params)
+            except Exception as e:
+                self._failed(model, purpose, breaker, e, span)
+                tracing.record(f'llm.{purpose}', start, time.perf_counter() - start, span)
+                raise
+            elapsed = time.perf_counter() - start
+            usage = tracing.token_usage(response)
+            span.set(**usage)
+            tracing.record(f'llm.{purpose}', start, elapsed, span)
+            breaker.success()
+            self._observe(model, purpose, elapsed, usage)
+            return response
+        finally:
+            rate_limiter.release(lease)
+
+    async def _open_stream_async(self, model, purpose, messages, params, deadline_at, breaker, slot_wait):
+        """_open_stream() for async code."""
+        remaining = self._remaining(deadline_at, model)
+        lease = await rate_limiter.acquire_async(
+            model, wait=min(CONCURRENCY_WAIT if slot_wait is None else slot_wait, remaining))
+        try:
+            # Total timeout for the whole stream, which aiohttp enforces while reading
+            remaining = self._remaining(deadline_at, model)
+            with tracing.span(f'llm.{purpose}.open', model=model) as span:
+                span.bytes_out = sum(len(m['content']) for m in messages)
+                start = time.perf_counter()
+                try:
+                    response = await self._call_async(model=model, messages=messages, stream=True,
+                                                      request_timeout=remaining, **params)
+                except Exception as e:
+                    self._failed(model, purpose, breaker, e, span)
+                    raise
+        except BaseException:
+            rate_limiter.release(lease)
+            raise
+        breaker.success()
+        return AsyncLLMStream(self, response, model, purpose, breaker, lease, deadline_at, start)
+
+    async def _hedged_async(self, model, purpose, messages, params, deadline_at, breaker, slot_wait):
+        """_hedged() for async code; the attempt that loses is cancelled."""
+        delay = self.hedge_delay(model, purpose)
+        if delay is None or breaker.state != CLOSED or deadline_at - time.monotonic() < delay + MIN_ATTEMPT_TIME:
+            return await self._attempt_async(model, purpose, 'primary', messages, params, deadline_at, breaker,
+                                             slot_wait)
+
+        primary = asyncio.ensure_future(self._attempt_async(model, purpose, 'primary', messages, params,
+                                                            deadline_at, breaker, slot_wait))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+
+            self._count(model, purpose, 'hedges')
+            hedge = asyncio.ensure_future(self._attempt_async(model, purpose, 'hedge', messages, params,
+                                                              deadline_at, breaker, slot_wait))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            self._count(model, purpose, 'hedge_wins')
+                        return future.result()
+            # Both failed; the hedge may only have found no free slot
+            raise primary.exception()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _call_async(self, **kwargs):
+        """ChatCompletion.acreate on this process's shared aiohttp session."""
+        if self._acreate:
+            return await self._acreate(**kwargs)
+        token = openai.aiosession.set(self._get_aiohttp())
+        try:
+            return await openai.ChatCompletion.acreate(**kwargs)
+        finally:
+            openai.aiosession.reset(token)
+
+    def _get_aiohttp(self):
+        """Keep-alive session for the async calls (a new one after a fork or on another event loop)."""
+        owner = (os.getpid(), asyncio.get_running_loop())
+        if self._aiohttp is None or self._aiohttp_owner != owner:
+            self._aiohttp = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=LLM_ASYNC_MAX_CONNECTIONS))
+            self._aiohttp_owner = owner
+        return self._aiohttp
+
+    async def aclose(self):
+        """Close this loop's OpenAI connections (on ASGI shutdown)."""
+        session, self._aiohttp, self._aiohttp_owner = self._aiohttp, None, None
+        if session is not None:
+            await session.close()
+
+    def _create_fn(self):
+        return self._create or openai.ChatCompletion.create
+
+    def _embed_fn(self):
+        return self._embed or openai.Embedding.create
+
+    def _failed(self, model, purpose, breaker, error, span):
+        if isinstance(error, RETRYABLE_ERRORS):
+            breaker.failure()
+            timeout = is_timeout(error)
+            span.status = 'timeout' if timeout else 'error'
+            self._count(model, purpose, 'timeouts' if timeout else 'errors')
+        else:
+            # The model answered, the request was wrong: not a reason to open the breaker
+            breaker.success()
+            span.status = 'rejected'
+            self._count(model, purpose, 'errors')
+
+    def _hedged(self, model, purpose, messages, params, deadline_at, breaker, slot_wait):
+        """First attempt, plus a second one if the first is slower than the hedge delay."""
+        delay = self.hedge_delay(model, purpose)
+        if delay is None or breaker.state != CLOSED or deadline_at - time.monotonic() < delay + MIN_ATTEMPT_TIME:
+            return self._attempt(model, purpose, 'primary', messages, params, deadline_at, breaker, slot_wait)
+
+        executor = self._get_executor()
+        # One context copy per thread: a context can't be entered by two threads at once
+        primary = executor.submit(tracing.wrap_context(self._attempt), model, purpose, 'primary', messages, params, deadline_at,
+                                  breaker, slot_wait)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self._count(model, purpose, 'hedges')
+        hedge = executor.submit(tracing.wrap_context(self._attempt), model, purpose, 'hedge', messages, params, deadline_at,
+                                breaker, slot_wait)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count(model, purpose, 'hedge_wins')
+                    return future.result()
+        # Both failed; the hedge may only have found no free slot
+        raise primary.exception()
+
+    def hedge_delay(self, model, purpose):
+        """Seconds to wait before hedging, or None until enough latencies are known."""
+        with self._lock:
+            samples = list(self._latency.get((model, purpose), ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, percentile(samples, self.hedge_percentile))
+
+    def _observe(self, model, purpose, seconds, usage):
+        with self._lock:
+            window = self._latency.get((model, purpose))
+            if window is None:
+                window = self._latency[(model, purpose)] = deque(maxlen=LATENCY_WINDOW)
+            window.append(seconds)
+            counts = self._counts.setdefault((model, purpose), {})
+            counts['ok'] = counts.get('ok', 0) + 1
+            counts['input_tokens'] = counts.get('input_tokens', 0) + usage.get('input_tokens', 0)
+            counts['output_tokens'] = counts.get('output_tokens', 0) + usage.get('output_tokens', 0)
+
+    def _count(self, model, purpose, event):
+        with self._lock:
+            counts = self._counts.setdefault((model, purpose), {})
+            counts[event] = counts.get(event, 0) + 1
+
+    def metrics(self):
+        """Breaker state per model; calls, tokens and latency per model and purpose."""
+        with self._lock:
+            counts = {key: dict(value) for key, value in self._counts.items()}
+            latency = {key: list(value) for key, value in self._latency.items()}
+            breakers = dict(self._breakers)
+
+        calls = {}
+        for (model, purpose), events in sorted(counts.items()):
+            samples = latency.get((model, purpose), [])
+            entry = {event: events.get(event, 0) for event in
+                     ('ok', 'errors', 'timeouts', 'rejected', 'fallbacks', 'hedges', 'hedge_wins',
+                      'input_tokens', 'output_tokens')}
+            entry['p50_ms'] = round(percentile(samples, 50) * 1000, 1) if samples else None
+            entry['p95_ms'] = round(percentile(samples, 95) * 1000, 1) if samples else None
+            hedge_delay = self.hedge_delay(model, purpose)
+            entry['hedge_delay_ms'] = round(hedge_delay * 1000, 1) if hedge_delay else None
+            calls[f'{model}/{purpose}'] = entry
+        return {
+            'hedge_enabled': self.hedge_enabled,
+            'fallbacks': self.fallbacks,
+            'breakers': {model: {'state': breaker.state, 'opened': breaker.opened,
+                                 'retry_after': round(breaker.retry_after(), 1)}
+                         for model, breaker in sorted(breakers.items())},
+            'calls': calls
+        }
+
+    def render(self):
+        """Prometheus lines for GET /metrics."""
+        with self._lock:
+            counts = sorted((key, dict(value)) for key, value in self._counts.items())
+            breakers = sorted(self._breakers.items())
+        lines = ['# HELP app_llm_calls_total OpenAI attempts and gateway decisions by model and purpose',
+                 '# TYPE app_llm_calls_total counter']
+        for (model, purpose), events in counts:
+            for event in ('ok', 'errors', 'timeouts', 'rejected', 'fallbacks', 'hedges', 'hedge_wins'):
+                if events.get(event):
+                    lines.append(f'app_llm_calls_total{{model="{model}",purpose="{purpose}",'
+                                 f'event="{event}"}} {events[event]}')
+        lines += ['# HELP app_llm_tokens_total Tokens used by successful OpenAI calls',
+                  '# TYPE app_llm_tokens_total counter']
+        for (model, purpose), events in counts:
+            for direction in ('input', 'output'):
+                lines.append(f'app_llm_tokens_total{{model="{model}",purpose="{purpose}",'
+                             f'direction="{direction}"}} {events.get(direction + "_tokens", 0)}')
+        lines += ['# HELP app_llm_breaker_open Whether the model\'s circuit breaker refuses calls',
+                  '# TYPE app_llm_breaker_open gauge']
+        for model, breaker in breakers:
+            lines.append(f'app_llm_breaker_open{{model="{model}"}} {0 if breaker.state == CLOSED else 1}')
+        return lines
+
+
+# Shared instance for the whole process
+llm_gateway = LLMGateway()
+tracing.register_collector(llm_gateway)
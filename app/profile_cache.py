@@ -0,0 +1,83 @@
+"""
+Per-user cache of profile rows (is_admin, tier, voice_preference,
+cefr_level, ...).
+
+Admin checks, the voice preference lookup in webrtc_session and the level
+lookup in analyze_session all read the same cached row. Routes that change
+a profile call invalidate() so the next read goes back to Supabase.
+Profiles edited directly from the frontend are picked up after the TTL.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+import tracing
+from supabase_client import supabase, async_supabase
+from ttl_cache import TTLCache
+
+load_dotenv()
+
+# Seconds a cached profile is trusted
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "60"))
+
+# Max number of profiles kept in memory
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "5000"))
+
+_profiles = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+
+def get_profile(user_id):
+    """
+    Return (profile, error) for a user.
+
+    profile is the user's profiles row as a dict, or {} if they have no
+    profile. error is set (and profile is None) if Supabase could not be
+    queried. Missing profiles and errors are not cached.
+    """
+    with tracing.span('profile') as span:
+        profile = _profiles.get(user_id)
+        if profile is not None:
+            span.status = 'hit'
+            return profile, None
+
+        span.status = 'miss'
+        profile_resp = supabase.get(f'/rest/v1/profiles?id=eq.{user_id}&select=*')
+        return _store(user_id, profile_resp, span)
+
+
+async def get_profile_async(user_id):
+    """get_profile() for the async routes."""
+    with tracing.span('profile') as span:
+        profile = _profiles.get(user_id)
+        if profile is not None:
+            span.status = 'hit'
+            return profile, None
+
+        span.status = 'miss'
+        profile_resp = await async_supabase.get(f'/rest/v1/profiles?id=eq.{user_id}&select=*')
+        return _store(user_id, profile_resp, span)
+
+
+def _store(user_id, profile_resp, span):
+    """Cache and return the profile from a profiles query, as (profile, error)."""
+    if profile_resp.status_code != 200:
+        span.status = 'error'
+        return None, "Failed to fetch profile"
+
+    profiles = profile_resp.json()
+    if not profiles:
+        return {}, None
+
+    profile = profiles[0]
+    _profiles.set(user_id, profile)
+    return profile, None
+
+
+def invalidate(user_id):
+    """Drop a user's cached profile after it changes."""
+    _profiles.pop(user_id)
+
+
+def stats():
+    return _profiles.stats()
@@ -0,0 +1,142 @@
+"""
+Process-wide cache for the tutor system prompt (prompt.json).
+
+The prompt is loaded and validated once, serialized once, and kept as a
+ready-to-send string. The file mtime is checked at most every few seconds
+so edits to prompt.json are picked up without a restart.
+
+Topic-specific variants (used by the voice tutor) are spliced into the
+pre-serialized prompt instead of re-serializing the whole document, and
+are kept in a small LRU cache keyed by topic.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import tracing
+
+PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompt.json')
+
+# How many topic-specific prompts to keep around
+TOPIC_CACHE_SIZE = int(os.getenv("PROMPT_TOPIC_CACHE_SIZE", "128"))
+
+# Minimum seconds between mtime checks of prompt.json
+RELOAD_CHECK_INTERVAL = float(os.getenv("PROMPT_RELOAD_CHECK_INTERVAL", "2"))
+
+TOPIC_INSTRUCTIONS = "Please start the conversation by introducing this topic and engaging the user in a natural, friendly way remember always in english."
+
+# Placeholder used to find where the topic goes in the serialized prompt
+_TOPIC_MARKER = "__current_topic_placeholder__"
+
+
+class PromptStore:
+    """Holds the serialized system prompt and its topic variants."""
+
+    def __init__(self, path=PROMPT_PATH, topic_cache_size=TOPIC_CACHE_SIZE,
+                 check_interval=RELOAD_CHECK_INTERVAL):
+        self.path = path
+        self.topic_cache_size = topic_cache_size
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._last_check = 0.0
+        self._base = None
+        self._topic_prefix = None
+        self._topic_suffix = None
+        self._version = None
+        self._topics = OrderedDict()
+
+    def _load(self, mtime):
+        """Read, validate and serialize prompt.json. Caller holds the lock."""
+        with open(self.path, 'r') as f:
+            prompt_data = json.load(f)
+
+        if not isinstance(prompt_data, dict):
+            raise ValueError("prompt.json must contain a JSON object")
+        if not isinstance(prompt_data.get('behavior'), dict):
+            raise ValueError("prompt.json must contain a 'behavior' object")
+
+        base = json.dumps(prompt_data)
+
+        # Serialize once more with a marker where current_topic goes, so
+        # topic variants only need to serialize the small topic dict
+        prompt_data['behavior']['current_topic'] = _TOPIC_MARKER
+        prefix, suffix = json.dumps(prompt_data).split(json.dumps(_TOPIC_MARKER), 1)
+
+        self._base = base
+        self._topic_prefix = prefix
+        self._topic_suffix = suffix
+        self._version = hashlib.sha256(base.encode('utf-8')).hexdigest()[:12]
+        self._topics.clear()
+        self._mtime = mtime
+
+    def _refresh(self):
+        """Load the prompt on first use and reload it when the file changes."""
+        now = time.monotonic()
+        if self._base is not None and now - self._last_check < self.check_interval:
+            return
+
+        with self._lock:
+            if self._base is not None and now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError as e:
+                if self._base is None:
+                    raise
+                tracing.log_error('prompt_check', e, fallback='cached')
+                return
+
+            if mtime == self._mtime:
+                return
+
+            try:
+                self._load(mtime)
+            except (OSError, ValueError) as e:
+                if self._base is None:
+                    raise
+                # Keep serving the last good prompt if an edit is broken
+                tracing.log_error('prompt_reload', e, fallback='cached')
+
+    @property
+    def version(self):
+        """Short content hash of the current prompt."""
+        self._refresh()
+        return self._version
+
+    def base_instructions(self):
+        """Return the full prompt as a JSON string."""
+        self._refresh()
+        return self._base
+
+    def topic_instructions(self, topic):
+        """Return the prompt with behavior.current_topic set for the given topic."""
+        self._refresh()
+        key = (topic.get('title', ''), topic.get('description', ''))
+
+        with self._lock:
+            cached = self._topics.get(key)
+            if cached is not None:
+                self._topics.move_to_end(key)
+                return cached
+
+            current_topic = {
+                "title": key[0],
+                "description": key[1],
+                "instructions": TOPIC_INSTRUCTIONS
+            }
+            instructions = self._topic_prefix + json.dumps(current_topic) + self._topic_suffix
+
+            self._topics[key] = instructions
+            if len(self._topics) > self.topic_cache_size:
+                self._topics.popitem(last=False)
+            return instructions
+
+
+# Shared instance for the whole process
+prompt_store = PromptStore()
@@ -0,0 +1,593 @@
+"""
+Rate limits and upstream concurrency caps for the endpoints that call OpenAI.
+
+Two independent guards:
+- Token buckets per endpoint ("chat", "voice", "analysis"), one per
+  authenticated user (RATE_LIMITS_USER) and one per client IP
+  (RATE_LIMITS_IP). A request takes a token from every bucket that applies,
+  or from none of them; when one is empty it is refused with the number of
+  seconds until a token is back (sent as Retry-After with a 429).
+- A cap on calls in flight per upstream model (MODEL_CONCURRENCY), so one
+  busy endpoint can't use up the OpenAI rate limit for the others. Callers
+  wait up to CONCURRENCY_WAIT seconds for a slot before giving up
+  (async callers wait on the event loop, with acquire_async()).
+
+State lives in one of three backends chosen with RATE_LIMIT_STORE, as for
+the conversation store:
+- "memory" (default): per process, so each worker has its own limits
+- "sqlite": a local SQLite file (RATE_LIMIT_DB), shared by the worker
+  processes on one host
+- a "redis://..." URL: shared between hosts (needs the redis package)
+
+If a shared backend fails, requests are let through and the error is
+logged, so the limiter never takes the API down with it.
+"""
+
+import asyncio
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+import tracing
+from ttl_cache import TTLCache
+
+load_dotenv()
+
+try:
+    import redis
+except ImportError:  # redis is optional, only needed for a redis:// store
+    redis = None
+
+# Set to 0 to turn off rate limits and concurrency caps
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+
+RATE_LIMIT_DB = os.getenv(
+    "RATE_LIMIT_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rate_limits.db')
+)
+
+# Requests per authenticated user: "endpoint:requests/seconds,..."; the bucket holds `requests` tokens
+RATE_LIMITS_USER = os.getenv("RATE_LIMITS_USER", "chat:20/60,voice:6/60,analysis:10/60")
+
+# Requests per client IP; higher than per user since a classroom shares one address
+RATE_LIMITS_IP = os.getenv("RATE_LIMITS_IP", "chat:120/60,voice:30/60,analysis:60/60")
+
+# Upstream calls in flight per model: "model:calls,..."; models not listed are not capped
+MODEL_CONCURRENCY = os.getenv(
+    "MODEL_CONCURRENCY",
+    "gpt-4o-mini:32,gpt-4o:8,gpt-4o-realtime-preview:8"
+)
+
+# Seconds a request waits for a model slot before it is refused
+CONCURRENCY_WAIT = float(os.getenv("CONCURRENCY_WAIT", "2"))
+
+# Seconds a background job (analysis) waits for a model slot
+CONCURRENCY_BACKGROUND_WAIT = float(os.getenv("CONCURRENCY_BACKGROUND_WAIT", "60"))
+
+# Slots not released after this many seconds (crashed worker) are freed by the shared backends
+SLOT_LEASE_TTL = int(os.getenv("SLOT_LEASE_TTL", "300"))
+
+# Proxies in front of the app whose X-Forwarded-For entries are trusted (0: use the socket address)
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+
+# Max number of buckets kept by the in-memory backend
+RATE_LIMIT_CACHE_SIZE = int(os.getenv("RATE_LIMIT_CACHE_SIZE", "50000"))
+
+# How often the shared backends check for a free slot (seconds)
+SLOT_POLL_INTERVAL = 0.05
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS model_slots (
+    id TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_model_slots_model ON model_slots(model, expires_at);
+"""
+
+
+class Throttled(Exception):
+    """A request was refused by a rate limit or a concurrency cap."""
+
+    def __init__(self, message, retry_after, scope):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.scope = scope
+
+    @property
+    def retry_after_header(self):
+        """Whole seconds for the Retry-After header (at least 1)."""
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+def parse_rules(spec):
+    """'chat:20/60,voice:6/60' -> {'chat': (20.0, 60.0), 'voice': (6.0, 60.0)}"""
+    rules = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, _, rule = item.partition(':')
+        requests_, _, seconds = rule.partition('/')
+        rules[name.strip()] = (float(requests_), float(seconds or 1))
+    return rules
+
+
+def parse_caps(spec):
+    """'gpt-4o:8,gpt-4o-mini:32' -> {'gpt-4o': 8, 'gpt-4o-mini': 32}"""
+    caps = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, _, limit = item.rpartition(':')
+        caps[name.strip()] = int(limit)
+    return caps
+
+
+def client_ip(remote_addr, forwarded_for=None, trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES):
+    """The client address, skipping the trusted proxies' X-Forwarded-For entries."""
+    if trusted_proxies and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+        if len(hops) >= trusted_proxies:
+            return hops[-trusted_proxies]
+    return remote_addr or 'unknown'
+
+
+def refill(tokens, updated_at, capacity, period, now):
+    """Tokens in a bucket at `now`, refilled at capacity/period per second."""
+    if tokens is None:
+        return capacity
+    return min(capacity, tokens + (now - updated_at) * capacity / period)
+
+
+def take_tokens(states, buckets, now):
+    """
+    Take one token from every bucket, or none if one of them is empty.
+    states are the stored (tokens, updated_at) pairs (or None) in bucket order.
+    Returns (new token counts or None, seconds until all buckets have a
+    token, index of the bucket that takes longest to refill).
+    """
+    levels = [refill(*(state or (None, None)), capacity, period, now)
+              for state, (_, capacity, period) in zip(states, buckets)]
+    waits = [(1 - level) * period / capacity for level, (_, capacity, period) in zip(levels, buckets)]
+    wait = max(waits)
+    if wait > 0:
+        return None, wait, waits.index(wait)
+    return [level - 1 for level in levels], 0.0, None
+
+
+class MemoryBackend:
+    """Buckets and slots in this process only."""
+
+    def __init__(self, maxsize=RATE_LIMIT_CACHE_SIZE):
+        # A bucket left alone for a whole period is full again, so it can be dropped
+        self._buckets = TTLCache(maxsize, 3600)
+        self._lock = threading.Lock()
+        self._slots = {}  # model -> calls in flight
+        self._slots_free = threading.Condition()
+
+    def take(self, buckets):
+        now = time.time()
+        with self._lock:
+            states = [self._buckets.get(key) for key, _, _ in buckets]
+            levels, wait, empty = take_tokens(states, buckets, now)
+            if levels is None:
+                return wait, empty
+            for (key, _, period), level in zip(buckets, levels):
+                self._buckets.set(key, (level, now), expires_at=now + period)
+        return 0.0, None
+
+    def acquire(self, model, limit, lease_id, timeout):
+        deadline = time.monotonic() + timeout
+        with self._slots_free:
+            while self._slots.get(model, 0) >= limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._slots_free.wait(remaining)
+            self._slots[model] = self._slots.get(model, 0) + 1
+        return True
+
+    def release(self, model, lease_id):
+        with self._slots_free:
+            self._slots[model] = max(0, self._slots.get(model, 0) - 1)
+            # Waiters for every model share the condition
+            self._slots_free.notify_all()
+
+
+class _PollingSlots:
+    """Waiting for a slot by polling, for backends shared between processes."""
+
+    def acquire(self, model, limit, lease_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.try_acquire(model, limit, lease_id):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # Jitter so waiting workers don't poll in lockstep
+            time.sleep(min(remaining, SLOT_POLL_INTERVAL * random.uniform(0.5, 1.5)))
+
+
+class SQLiteBackend(_PollingSlots):
+    """Buckets and slots in a local SQLite file, shared between processes."""
+
+    def __init__(self, db_path=RATE_LIMIT_DB, lease_ttl=SLOT_LEASE_TTL):
+        self.db_path = db_path
+        self.lease_ttl = lease_ttl
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _db(self):
+        """Return this process's connection, opening a new one after a fork."""
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            db = self._db()
+            # Take the write lock up front so the read-modify-write is atomic across processes
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def take(self, buckets):
+        now = time.time()
+        with self._transaction() as db:
+            states = [db.execute('SELECT tokens, updated_at FROM rate_buckets WHERE key = ?',
+                                 (key,)).fetchone() for key, _, _ in buckets]
+            levels, wait, empty = take_tokens(states, buckets, now)
+            if levels is None:
+                return wait, empty
+            db.executemany(
+                'INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+                [(key, level, now) for (key, _, _), level in zip(buckets, levels)]
+            )
+            # Buckets idle for an hour are full again; removed at most once a minute
+            if now - self._last_purge > 60:
+                db.execute('DELETE FROM rate_buckets WHERE updated_at < ?', (now - 3600,))
+                self._last_purge = now
+        return 0.0, None
+
+    def try_acquire(self, model, limit, lease_id):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('DELETE FROM model_slots WHERE model = ? AND expires_at <= ?', (model, now))
+            (in_flight,) = db.execute('SELECT COUNT(*) FROM model_slots WHERE model = ?', (model,)).fetchone()
+            if in_flight >= limit:
+                return False
+            db.execute('INSERT INTO model_slots (id, model, expires_at) VALUES (?, ?, ?)',
+                       (lease_id, model, now + self.lease_ttl))
+        return True
+
+    def release(self, model, lease_id):
+        with self._lock:
+            self._db().execute('DELETE FROM model_slots WHERE id = ?', (lease_id,))
+
+
+# KEYS: bucket keys; ARGV: now, then capacity and period per key.
+# Same all-or-nothing rule as take_tokens; returns "wait:index" (index from 0).
+_TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+local empty = 0
+for i, key in ipairs(KEYS) do
+  local capacity = tonumber(ARGV[i * 2])
+  local period = tonumber(ARGV[i * 2 + 1])
+  local state = redis.call('HMGET', key, 'tokens', 'updated_at')
+  local level = capacity
+  if state[1] then
+    level = math.min(capacity, tonumber(state[1]) + (now - tonumber(state[2])) * capacity / period)
+  end
+  levels[i] = level
+  local bucket_wait = (1 - level) * period / capacity
+  if bucket_wait > wait then
+    wait = bucket_wait
+    empty = i - 1
+  end
+end
+if wait > 0 then
+  return tostring(wait) .. ':' .. empty
+end
+for i, key in ipairs(KEYS) do
+  redis.call('HSET', key, 'tokens', levels[i] - 1, 'updated_at', now)
+  redis.call('EXPIRE', key, math.ceil(tonumber(ARGV[i * 2 + 1])))
+end
+return '0:'
+"""
+
+# KEYS[1]: the model's lease set; ARGV: now, limit, lease id, lease ttl
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+  return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[4]), ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[4])))
+return 1
+"""
+
+
+class RedisBackend(_PollingSlots):
+    """Buckets and slots in a Redis-compatible server, shared between hosts."""
+
+    def __init__(self, url, lease_ttl=SLOT_LEASE_TTL, prefix='ratelimit:'):
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_STORE is a redis:// URL but the redis package is not installed")
+        self.lease_ttl = lease_ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(_TAKE_SCRIPT)
+        self._acquire = self._client.register_script(_ACQUIRE_SCRIPT)
+
+    def take(self, buckets):
+        args = [time.time()]
+        for _, capacity, period in buckets:
+            args.extend([capacity, period])
+        keys = [self.prefix + 'bucket:' + key for key, _, _ in buckets]
+        wait, _, empty = self._take(keys=keys, args=args).decode().partition(':')
+        return float(wait), int(empty) if empty else None
+
+    def try_acquire(self, model, limit, lease_id):
+        return bool(self._acquire(keys=[self.prefix + 'slots:' + model],
+                                  args=[time.time(), limit, lease_id, self.lease_ttl]))
+
+    def release(self, model, lease_id):
+        self._client.zrem(self.prefix + 'slots:' + model, lease_id)
+
+
+def make_backend(spec=RATE_LIMIT_STORE):
+    """Build the backend named by RATE_LIMIT_STORE."""
+    if spec.startswith(('redis://', 'rediss://')):
+        return RedisBackend(spec)
+    if spec == 'sqlite':
+        return SQLiteBackend()
+    if spec == 'memory':
+        return MemoryBackend()
+    raise ValueError(f"Unknown RATE_LIMIT_STORE: {spec}")
+
+
+class RateLimiter:
+    """Per-user/per-IP token buckets and per-model concurrency caps."""
+
+    def __init__(self, backend=None, enabled=RATE_LIMIT_ENABLED, user_rules=RATE_LIMITS_USER,
+                 ip_rules=RATE_LIMITS_IP, caps=MODEL_CONCURRENCY, wait=CONCURRENCY_WAIT):
+        self.enabled = enabled
+        self.user_rules = parse_rules(user_rules)
+        self.ip_rules = parse_rules(ip_rules)
+        self.caps = parse_caps(caps)
+        self.wait = wait
+        self._backend = backend
+        self._backend_lock = threading.Lock()
+
+        self._metrics_lock = threading.Lock()
+        self._requests = {}  # (endpoint, outcome) -> count
+        self._slots = {}     # (model, outcome) -> count
+        self._in_flight = {}  # model -> calls holding a slot in this process
+        self._wait_total = {}  # model -> seconds spent waiting for a slot
+        self._store_errors = 0
+
+    @property
+    def backend(self):
+        # Built on first use, so a misconfigured store fails the request that needs it, not the import
+        if self._backend is None:
+            with self._backend_lock:
+                if self._backend is None:
+                    self._backend = make_backend()
+        return self._backend
+
+    def hit(self, endpoint, user_id=None, ip=None):
+        """
+        Count a request to an endpoint against the user's and the IP's
+        buckets. Raises Throttled if either is empty.
+        """
+        if not self.enabled:
+            return
+        buckets = []
+        if user_id and endpoint in self.user_rules:
+            buckets.append((f'{endpoint}:user:{user_id}', *self.user_rules[endpoint]))
+        if ip and endpoint in self.ip_rules:
+            buckets.append((f'{endpoint}:ip:{ip}', *self.ip_rules[endpoint]))
+        if not buckets:
+            return
+
+        try:
+            wait, empty = self.backend.take(buckets)
+        except Exception as e:
+            self._store_error('rate_limit_take', e, endpoint=endpoint)
+            wait, empty = 0.0, None
+
+        if wait <= 0:
+            self._count(self._requests, (endpoint, 'admitted'))
+            return
+        scope = buckets[empty][0].split(':')[1]
+        self._count(self._requests, (endpoint, f'throttled_{scope}'))
+        tracing.log('rate_limited', sampled=True, endpoint=endpoint, scope=scope, retry_after=round(wait, 2))
+        raise Throttled("Too many requests, please slow down", wait, scope)
+
+    def acquire(self, model, wait=None):
+        """
+        Take a slot for an upstream call to `model`, waiting up to `wait`
+        seconds (CONCURRENCY_WAIT by default). Returns a lease to pass to
+        release(), or None when the model is not capped. Raises Throttled
+        if no slot frees up in time.
+        """
+        limit = self.caps.get(model)
+        if not self.enabled or limit is None:
+            return None
+        timeout = self.wait if wait is None else wait
+        lease_id = uuid.uuid4().hex
+        start = time.perf_counter()
+        try:
+            acquired = self.backend.acquire(model, limit, lease_id, timeout)
+        except Exception as e:
+            self._store_error('rate_limit_acquire', e, model=model)
+            return None
+        return self._admit(model, limit, lease_id, acquired, start, timeout)
+
+    async def acquire_async(self, model, wait=None):
+        """
+        acquire() for async code: waits for a slot on the event loop,
+        checking the backend every SLOT_POLL_INTERVAL, instead of blocking
+        a thread.
+        """
+        limit = self.caps.get(model)
+        if not self.enabled or limit is None:
+            return None
+        timeout = self.wait if wait is None else wait
+        lease_id = uuid.uuid4().hex
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        backend = self.backend
+        try:
+            while True:
+                if isinstance(backend, MemoryBackend):
+                    acquired = backend.acquire(model, limit, lease_id, 0)
+                else:
+                    # A shared store is a round trip; keep it off the event loop
+                    acquired = await asyncio.to_thread(backend.acquire, model, limit, lease_id, 0)
+                remaining = deadline - time.monotonic()
+                if acquired or remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, SLOT_POLL_INTERVAL * random.uniform(0.5, 1.5)))
+        except Exception as e:
+            self._store_error('rate_limit_acquire', e, model=model)
+            return None
+        return self._admit(model, limit, lease_id, acquired, start, timeout)
+
+    def _admit(self, model, limit, lease_id, acquired, start, timeout):
+        """Account for a slot request; returns the lease or raises Throttled."""
+        waited = time.perf_counter() - start
+
+        with self._metrics_lock:
+            self._wait_total[model] = self._wait_total.get(model, 0.0) + waited
+            if acquired:
+                self._in_flight[model] = self._in_flight.get(model, 0) + 1
+        if waited > 0.001:
+            handle = tracing.Span()
+            handle.status = 'acquired' if acquired else 'timeout'
+            tracing.record('model_slot.wait', start, waited, handle)
+
+        if not acquired:
+            self._count(self._slots, (model, 'throttled'))
+            tracing.log('model_slot_timeout', sampled=True, model=model, limit=limit, waited=round(waited, 2))
+            raise Throttled(f"Too many {model} requests in progress, please try again shortly", timeout, 'model')
+        self._count(self._slots, (model, 'admitted'))
+        return (model, lease_id)
+
+    def release(self, lease):
+        """Give back a slot taken with acquire(). Safe to call with None."""
+        if lease is None:
+            return
+        model, lease_id = lease
+        with self._metrics_lock:
+            self._in_flight[model] = max(0, self._in_flight.get(model, 0) - 1)
+        try:
+            self.backend.release(model, lease_id)
+        except Exception as e:
+            # The shared backends free the slot when its lease expires
+            self._store_error('rate_limit_release', e, model=model)
+
+    @contextmanager
+    def slot(self, model, wait=None):
+        """Hold a slot for `model` for the duration of the with block."""
+        lease = self.acquire(model, wait)
+        try:
+            yield
+        finally:
+            self.release(lease)
+
+    def _count(self, series, key):
+        with self._metrics_lock:
+            series[key] = series.get(key, 0) + 1
+
+    def _store_error(self, event, error, **fields):
+        with self._metrics_lock:
+            self._store_errors += 1
+        tracing.log_error(event, error, fail_open=True, **fields)
+
+    def metrics(self):
+        """Admitted/throttled counts per endpoint and per model, and slots in use."""
+        with self._metrics_lock:
+            requests_ = dict(self._requests)
+            slots = dict(self._slots)
+            in_flight = dict(self._in_flight)
+            wait_total = dict(self._wait_total)
+            store_errors = self._store_errors
+
+        endpoints = {}
+        for (endpoint, outcome), count in requests_.items():
+            endpoints.setdefault(endpoint, {'admitted': 0, 'throttled_user': 0, 'throttled_ip': 0})[outcome] = count
+        models = {}
+        for model, limit in self.caps.items():
+            admitted = slots.get((model, 'admitted'), 0)
+            throttled = slots.get((model, 'throttled'), 0)
+            calls = admitted + throttled
+            models[model] = {
+                'limit': limit,
+                'in_flight': in_flight.get(model, 0),
+                'admitted': admitted,
+                'throttled': throttled,
+                'avg_wait_ms': round(wait_total.get(model, 0.0) * 1000 / calls, 2) if calls else 0.0
+            }
+        return {
+            'enabled': self.enabled,
+            'store': type(self._backend).__name__ if self._backend else None,
+            'endpoints': endpoints,
+            'models': models,
+            'store_errors': store_errors
+        }
+
+    def render(self):
+        """Prometheus lines for GET /metrics."""
+        with self._metrics_lock:
+            requests_ = sorted(self._requests.items())
+            slots = sorted(self._slots.items())
+            in_flight = dict(self._in_flight)
+        lines = ['# HELP app_rate_limit_requests_total Requests to rate-limited endpoints by outcome',
+                 '# TYPE app_rate_limit_requests_total counter']
+        for (endpoint, outcome), count in requests_:
+            lines.append(f'app_rate_limit_requests_total{{endpoint="{endpoint}",outcome="{outcome}"}} {count}')
+        lines += ['# HELP app_model_slot_requests_total Upstream calls admitted or refused by the concurrency cap',
+                  '# TYPE app_model_slot_requests_total counter']
+        for (model, outcome), count in slots:
+            lines.append(f'app_model_slot_requests_total{{model="{model}",outcome="{outcome}"}} {count}')
+        lines += ['# HELP app_model_slots_in_flight Upstream calls holding a slot in this process',
+                  '# TYPE app_model_slots_in_flight gauge']
+        for model in sorted(self.caps):
+            lines.append(f'app_model_slots_in_flight{{model="{model}"}} {in_flight.get(model, 0)}')
+        return lines
+
+
+# Shared instance for the whole process
+rate_limiter = RateLimiter()
+tracing.register_collector(rate_limiter)
@@ -0,0 +1,343 @@
+"""
+Pool of pre-created OpenAI Realtime sessions for the voice tutor.
+
+Creating a Realtime session (POST /v1/realtime/sessions) takes a few
+seconds, and used to happen while the learner waited after clicking
+"start". The pool keeps up to REALTIME_POOL_SIZE ready sessions per
+(voice, prompt version), created with the base tutor prompt, and hands
+one out with a deque pop. A background thread replaces sessions before
+their ephemeral client_secret expires and tops the pools up after each
+hand-out. When a pool is empty the session is created on demand, as
+before.
+
+Pooled sessions all carry the base prompt. For a topic, the response
+includes a session.update event with the topic prompt, which the client
+sends as soon as its connection opens, instead of waiting for a new
+session to be created.
+
+Only (voice, prompt version) pairs that were asked for in the last
+REALTIME_POOL_IDLE seconds, plus the voices in REALTIME_WARM_VOICES, are
+kept warm, so unused voices cost nothing.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+
+import tracing
+from prompt_store import prompt_store
+from rate_limit import rate_limiter
+
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+REALTIME_MODEL = "gpt-4o-realtime-preview"
+
+REALTIME_SESSIONS_URL = os.getenv("OPENAI_REALTIME_SESSIONS_URL", "https://api.openai.com/v1/realtime/sessions")
+
+REALTIME_WEBSOCKET_URL = f"wss://api.openai.com/v1/realtime?model={REALTIME_MODEL}"
+
+# Turn the pool off to create every session on demand
+REALTIME_POOL_ENABLED = os.getenv("REALTIME_POOL_ENABLED", "1") == "1"
+
+# Ready sessions kept per (voice, prompt version)
+REALTIME_POOL_SIZE = int(os.getenv("REALTIME_POOL_SIZE", "2"))
+
+# Voices kept warm from the first request on, whether asked for or not
+REALTIME_WARM_VOICES = [v.strip() for v in os.getenv("REALTIME_WARM_VOICES", "sage").split(',') if v.strip()]
+
+# Seconds a (voice, prompt version) stays warm after it was last asked for
+REALTIME_POOL_IDLE = int(os.getenv("REALTIME_POOL_IDLE", "600"))
+
+# Sessions are not handed out (and are replaced) this close to expiry (seconds)
+REALTIME_REFRESH_MARGIN = 20
+
+# Lifetime assumed when the response has no client_secret.expires_at (seconds)
+REALTIME_DEFAULT_TTL = 60
+
+# How often the refill thread checks the pools (seconds)
+REFILL_INTERVAL = 5
+
+# Sessions created at the same time while refilling
+REFILL_CONCURRENCY = 4
+
+REALTIME_CREATE_TIMEOUT = 30
+
+
+class RealtimeSessionError(Exception):
+    """OpenAI did not return a usable Realtime session."""
+
+
+def session_config(voice, instructions):
+    """Body of the session creation request."""
+    return {
+        "model": REALTIME_MODEL,
+        "voice": voice,
+        "modalities": ["audio", "text"],
+        "instructions": instructions,
+        # Audio format configuration
+        "input_audio_format": "pcm16",
+        "output_audio_format": "pcm16",
+        # Enable input audio transcription
+        "input_audio_transcription": {
+            "model": "whisper-1"
+        },
+        # VAD configuration (server-side voice activity detection)
+        "turn_detection": {
+            "type": "server_vad",
+            "threshold": 0.5,
+            "prefix_padding_ms": 300,
+            "silence_duration_ms": 1000,
+            "create_response": True,
+            "interrupt_response": True
+        }
+    }
+
+
+_http = None
+_http_pid = None
+_http_lock = threading.Lock()
+
+
+def _get_http():
+    """Return this process's keep-alive session, creating a new one after a fork."""
+    global _http, _http_pid
+    pid = os.getpid()
+    if _http is None or _http_pid != pid:
+        with _http_lock:
+            if _http is None or _http_pid != pid:
+                _http = requests.Session()
+                _http_pid = pid
+    return _http
+
+
+def create_session(voice, instructions):
+    """
+    Create a Realtime session and return {"session_id", "ephemeral_token",
+    "expires_at", "websocket_url"}. Raises requests.HTTPError for error
+    responses, RealtimeSessionError for incomplete ones and
+    rate_limit.Throttled when too many sessions are being created.
+    """
+    with rate_limiter.slot(REALTIME_MODEL), tracing.span('realtime.session_create', voice=voice) as span:
+        resp = _get_http().post(
+            REALTIME_SESSIONS_URL,
+            headers={
+                "Authorization": f"Bearer {OPENAI_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json=session_config(voice, instructions),
+            timeout=REALTIME_CREATE_TIMEOUT
+        )
+        span.status = resp.status_code
+        span.bytes_in = len(resp.content)
+    resp.raise_for_status()
+    session_json = resp.json()
+
+    session_id = session_json.get('id')
+    client_secret = session_json.get('client_secret') or {}
+    if not session_id:
+        raise RealtimeSessionError(f"Session ID not found in OpenAI response: {session_json}")
+    if not client_secret.get('value'):
+        raise RealtimeSessionError(f"Ephemeral token not found in OpenAI response: {session_json}")
+
+    return {
+        "session_id": session_id,
+        "ephemeral_token": client_secret['value'],
+        "expires_at": client_secret.get('expires_at') or time.time() + REALTIME_DEFAULT_TTL,
+        "websocket_url": REALTIME_WEBSOCKET_URL
+    }
+
+
+def topic_update(instructions):
+    """session.update event that switches a session to the given instructions."""
+    return {"type": "session.update", "session": {"instructions": instructions}}
+
+
+class RealtimeSessionPool:
+    """Ready Realtime sessions per (voice, prompt version), refilled in the background."""
+
+    def __init__(self, size=REALTIME_POOL_SIZE, enabled=REALTIME_POOL_ENABLED, create_fn=create_session,
+                 prompts=prompt_store, warm_voices=REALTIME_WARM_VOICES, idle=REALTIME_POOL_IDLE,
+                 refresh_margin=REALTIME_REFRESH_MARGIN, refill_interval=REFILL_INTERVAL):
+        self.size = size
+        self.enabled = enabled and size > 0
+        self.create_fn = create_fn
+        self.prompts = prompts
+        self.warm_voices = list(warm_voices)
+        self.idle = idle
+        self.refresh_margin = refresh_margin
+        self.refill_interval = refill_interval
+
+        self._pools = {}   # (voice, prompt version) -> deque of sessions, oldest first
+        self._wanted = {}  # (voice, prompt version) -> last time it was asked for
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+
+        self._metrics_lock = threading.Lock()
+        self._metrics = {
+            'hits': 0, 'misses': 0, 'expired': 0, 'created': 0, 'create_errors': 0,
+            'hit_ms_total': 0.0, 'miss_ms_total': 0.0, 'max_ms': 0.0, 'last_ms': 0.0
+        }
+
+    def _ensure_refiller(self):
+        """Start the refill thread in this process (again after a fork)."""
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._thread_pid != pid:
+                self._thread = threading.Thread(target=self._refill_loop, name='realtime-pool', daemon=True)
+                self._thread_pid = pid
+                self._thread.start()
+
+    def _fresh(self, session, now):
+        return session['expires_at'] - self.refresh_margin > now
+
+    def _pop_fresh(self, key):
+        now = time.time()
+        with self._lock:
+            self._wanted[key] = now
+            pool = self._pools.get(key)
+            while pool:
+                session = pool.popleft()
+                if self._fresh(session, now):
+                    return session
+                self._count('expired')
+        return None
+
+    def acquire(self, voice, topic=None):
+        """
+        Return a session for the voice tutor: {"session_id", "ephemeral_token",
+        "websocket_url", "session_update"}. session_update is the
+        session.update event the client must send first (for a topic on a
+        pooled session), or None.
+        """
+        start = time.perf_counter()
+        session = None
+        if self.enabled:
+            self._ensure_refiller()
+            session = self._pop_fresh((voice, self.prompts.version))
+            # Replace the session just handed out
+            self._wake.set()
+
+        hit = session is not None
+        if hit:
+            update = topic_update(self.prompts.topic_instructions(topic)) if topic else None
+        else:
+            instructions = self.prompts.topic_instructions(topic) if topic else self.prompts.base_instructions()
+            session = self.create_fn(voice, instructions)
+            update = None
+
+        elapsed = time.perf_counter() - start
+        self._record(hit, elapsed * 1000)
+        handle = tracing.Span()
+        handle.status = 'hit' if hit else 'miss'
+        tracing.record('realtime.acquire', start, elapsed, handle)
+        return {
+            "session_id": session['session_id'],
+            "ephemeral_token": session['ephemeral_token'],
+            "websocket_url": session['websocket_url'],
+            "session_update": update
+        }
+
+    def _refill_loop(self):
+        while True:
+            self._wake.wait(self.refill_interval)
+            self._wake.clear()
+            try:
+                self._refill()
+            except Exception as e:
+                tracing.log_error('realtime_pool_refill', e)
+
+    def _refill(self):
+        """Drop idle pools and expiring sessions, then create what is missing."""
+        now = time.time()
+        version = self.prompts.version
+        needed = []
+        with self._lock:
+            for voice in self.warm_voices:
+                self._wanted.setdefault((voice, version), now)
+            for key in list(self._wanted):
+                voice, key_version = key
+                idle = now - self._wanted[key] > self.idle and voice not in self.warm_voices
+                if idle or key_version != version:
+                    del self._wanted[key]
+                    self._pools.pop(key, None)
+                    continue
+                pool = self._pools.setdefault(key, deque())
+                while pool and not self._fresh(pool[0], now):
+                    pool.popleft()
+                    self._count('expired')
+                needed.extend([key] * (self.size - len(pool)))
+
+        if not needed:
+            return
+        instructions = self.prompts.base_instructions()
+
+        def create(key):
+            try:
+                session = self.create_fn(key[0], instructions)
+            except Exception as e:
+                self._count('create_errors')
+                tracing.log_error('realtime_pool_create', e, voice=key[0])
+                return  # Tried again on the next round
+            self._count('created')
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is not None and len(pool) < self.size:
+                    pool.append(session)
+
+        with ThreadPoolExecutor(max_workers=min(REFILL_CONCURRENCY, len(needed))) as executor:
+            list(executor.map(create, needed))
+
+    def _count(self, name):
+        with self._metrics_lock:
+            self._metrics[name] += 1
+
+    def _record(self, hit, elapsed_ms):
+        with self._metrics_lock:
+            m = self._metrics
+            if hit:
+                m['hits'] += 1
+                m['hit_ms_total'] += elapsed_ms
+            else:
+                m['misses'] += 1
+                m['miss_ms_total'] += elapsed_ms
+            m['last_ms'] = elapsed_ms
+            if elapsed_ms > m['max_ms']:
+                m['max_ms'] = elapsed_ms
+
+    def metrics(self):
+        """Hit rate, time-to-token (ms) and pool sizes."""
+        with self._metrics_lock:
+            m = dict(self._metrics)
+        with self._lock:
+            ready = {f'{voice}:{version}': len(pool) for (voice, version), pool in self._pools.items()}
+        requests_total = m['hits'] + m['misses']
+        return {
+            'enabled': self.enabled,
+            'requests': requests_total,
+            'hits': m['hits'],
+            'misses': m['misses'],
+            'hit_rate': round(m['hits'] / requests_total, 3) if requests_total else 0.0,
+            'avg_hit_ms': round(m['hit_ms_total'] / m['hits'], 2) if m['hits'] else 0.0,
+            'avg_miss_ms': round(m['miss_ms_total'] / m['misses'], 2) if m['misses'] else 0.0,
+            'max_ms': round(m['max_ms'], 2),
+            'last_ms': round(m['last_ms'], 2),
+            'created': m['created'],
+            'expired': m['expired'],
+            'create_errors': m['create_errors'],
+            'ready': ready
+        }
+
+
+# Shared instance for the whole process
+realtime_pool = RealtimeSessionPool()
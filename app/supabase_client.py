@@ -0,0 +1,393 @@
+"""
+Shared HTTP client for Supabase REST (PostgREST) and Auth calls.
+
+One pooled keep-alive requests.Session per worker process, service-role
+headers built once, per-endpoint timeouts, bounded retries with jittered
+backoff, and per-endpoint latency metrics.
+
+gather() runs independent calls at the same time on a small shared
+thread pool, so a route waits for the slowest call instead of the sum.
+
+AsyncSupabaseClient is the same client on httpx.AsyncClient, for the
+async routes in asgi.py; gather_async() runs its calls concurrently on
+the event loop instead of on threads.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+load_dotenv()
+
+try:
+    import httpx
+except ImportError:  # httpx is optional, only needed for the async routes (asgi.py)
+    httpx = None
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+# Connections kept open per host
+POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "20"))
+
+# Threads shared by all gather() calls in this process
+FANOUT_WORKERS = int(os.getenv("SUPABASE_FANOUT_WORKERS", "16"))
+
+# Connections the async client may open per host (requests beyond this wait for one)
+ASYNC_MAX_CONNECTIONS = int(os.getenv("SUPABASE_ASYNC_MAX_CONNECTIONS", "100"))
+
+# Extra attempts after the first one
+MAX_RETRIES = int(os.getenv("SUPABASE_MAX_RETRIES", "2"))
+
+# Base delay for exponential backoff between retries (seconds)
+RETRY_BACKOFF = float(os.getenv("SUPABASE_RETRY_BACKOFF", "0.2"))
+
+# (connect, read) timeouts in seconds per endpoint group
+TIMEOUTS = {
+    'auth': (3.05, 10),
+    'admin': (3.05, 20),
+    'rest': (3.05, 15),
+}
+
+# Status codes worth retrying (gateway/overload errors)
+RETRY_STATUSES = {502, 503, 504}
+
+# Methods that are safe to resend after the request may have reached the server
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+
+def span_name(method, path):
+    """Trace span for a call: supabase.<table or auth endpoint>.<read|write>."""
+    if path.startswith('/rest/v1/'):
+        resource = path[len('/rest/v1/'):].split('?', 1)[0].split('/', 1)[0]
+    elif path.startswith('/auth/v1/admin'):
+        resource = 'auth_admin'
+    elif path.startswith('/auth/v1'):
+        resource = 'auth'
+    else:
+        resource = 'other'
+    kind = 'read' if method in ('GET', 'HEAD') else 'write'
+    return f'supabase.{resource}.{kind}'
+
+
+def endpoint_group(path):
+    """Classify a Supabase path into 'admin', 'auth' or 'rest'."""
+    if path.startswith('/auth/v1/admin'):
+        return 'admin'
+    if path.startswith('/auth/v1'):
+        return 'auth'
+    return 'rest'
+
+
+class SupabaseClient:
+    """Pooled client for the Supabase REST and Auth APIs."""
+
+    def __init__(self, url=SUPABASE_URL, service_key=SUPABASE_SERVICE_KEY,
+                 pool_size=POOL_SIZE, max_retries=MAX_RETRIES,
+                 retry_backoff=RETRY_BACKOFF, timeouts=None):
+        self.url = (url or '').rstrip('/')
+        self.service_key = service_key
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+
+        # Prebuilt headers for service-role calls
+        self.service_headers = {
+            'Authorization': f'Bearer {service_key}',
+            'apikey': service_key,
+            'Content-Type': 'application/json'
+        }
+
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {}
+
+    @property
+    def configured(self):
+        return bool(self.url and self.service_key)
+
+    def _get_session(self):
+        """Return this process's session, creating a new one after a fork."""
+        pid = os.getpid()
+        if self._session is not None and self._session_pid == pid:
+            return self._session
+
+        with self._session_lock:
+            if self._session is None or self._session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+                self._session_pid = pid
+        return self._session
+
+    def _headers(self, user_token=None, extra=None):
+        if user_token:
+            headers = {
+                'Authorization': f'Bearer {user_token}',
+                'apikey': self.service_key
+            }
+        else:
+            headers = dict(self.service_headers)
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def _record(self, group, elapsed_ms, error=False, retried=False):
+        with self._metrics_lock:
+            m = self._metrics.get(group)
+            if m is None:
+                m = self._metrics[group] = {
+                    'calls': 0, 'errors': 0, 'retries': 0,
+                    'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0
+                }
+            m['calls'] += 1
+            m['total_ms'] += elapsed_ms
+            m['last_ms'] = elapsed_ms
+            if elapsed_ms > m['max_ms']:
+                m['max_ms'] = elapsed_ms
+            if error:
+                m['errors'] += 1
+            if retried:
+                m['retries'] += 1
+
+    def metrics(self):
+        """Snapshot of per-endpoint-group call counts and latencies (ms)."""
+        with self._metrics_lock:
+            snapshot = {}
+            for group, m in self._metrics.items():
+                snapshot[group] = dict(m, avg_ms=round(m['total_ms'] / m['calls'], 2) if m['calls'] else 0.0)
+            return snapshot
+
+    def _sleep_before_retry(self, attempt):
+        # Exponential backoff with full jitter
+        time.sleep(random.uniform(0, self.retry_backoff * (2 ** attempt)))
+
+    def request(self, method, path, user_token=None, headers=None, timeout=None, **kwargs):
+        """
+        Send a request to SUPABASE_URL + path and return the requests.Response.
+
+        Uses the service-role key unless user_token is given. Gateway errors
+        and connection failures are retried for idempotent methods; other
+        methods are only retried when the connection could not be opened.
+        Raises the last requests exception if every attempt fails.
+        """
+        method = method.upper()
+        with tracing.span(span_name(method, path), method=method) as span:
+            resp = self._request(method, path, user_token, headers, timeout, **kwargs)
+            span.status = resp.status_code
+            body = resp.request.body if resp.request is not None else None
+            span.bytes_out = len(body) if body else 0
+            span.bytes_in = len(resp.content)
+            return resp
+
+    def _request(self, method, path, user_token, headers, timeout, **kwargs):
+        group = endpoint_group(path)
+        url = f'{self.url}{path}'
+        request_headers = self._headers(user_token, headers)
+        timeout = timeout or self.timeouts[group]
+        idempotent = method in IDEMPOTENT_METHODS
+        session = self._get_session()
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                resp = session.request(method, url, headers=request_headers, timeout=timeout, **kwargs)
+            except requests.exceptions.RequestException as e:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                can_retry = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+                if attempt < self.max_retries and can_retry:
+                    self._record(group, elapsed_ms, error=True, retried=True)
+                    self._sleep_before_retry(attempt)
+                    attempt += 1
+                    continue
+                self._record(group, elapsed_ms, error=True)
+                raise
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if resp.status_code in RETRY_STATUSES and idempotent and attempt < self.max_retries:
+                self._record(group, elapsed_ms, error=True, retried=True)
+                self._sleep_before_retry(attempt)
+                attempt += 1
+                continue
+
+            self._record(group, elapsed_ms, error=resp.status_code >= 500)
+            return resp
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('PATCH', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+
+class AsyncSupabaseClient(SupabaseClient):
+    """SupabaseClient for async code: the same headers, timeouts, retries and metrics, on httpx."""
+
+    def __init__(self, *args, max_connections=ASYNC_MAX_CONNECTIONS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_connections = max_connections
+        self._client = None
+        self._client_owner = None
+
+    def _get_client(self):
+        """Return the AsyncClient of this process and event loop, creating a new one after a fork."""
+        if httpx is None:
+            raise RuntimeError("The async Supabase client needs the httpx package")
+        owner = (os.getpid(), asyncio.get_running_loop())
+        if self._client is None or self._client_owner != owner:
+            # No lock needed: only code running on this loop gets here
+            self._client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.pool_size
+            ))
+            self._client_owner = owner
+        return self._client
+
+    async def aclose(self):
+        """Close this loop's connections (on ASGI shutdown)."""
+        client, self._client, self._client_owner = self._client, None, None
+        if client is not None:
+            await client.aclose()
+
+    async def _sleep_before_retry_async(self, attempt):
+        await asyncio.sleep(random.uniform(0, self.retry_backoff * (2 ** attempt)))
+
+    async def request(self, method, path, user_token=None, headers=None, timeout=None, **kwargs):
+        """
+        Send a request to SUPABASE_URL + path and return the httpx.Response.
+        Same retry rules as SupabaseClient.request(); raises the last httpx
+        exception if every attempt fails.
+        """
+        method = method.upper()
+        with tracing.span(span_name(method, path), method=method) as span:
+            resp = await self._request(method, path, user_token, headers, timeout, **kwargs)
+            span.status = resp.status_code
+            span.bytes_out = len(resp.request.content)
+            span.bytes_in = len(resp.content)
+            return resp
+
+    async def _request(self, method, path, user_token, headers, timeout, **kwargs):
+        group = endpoint_group(path)
+        url = f'{self.url}{path}'
+        request_headers = self._headers(user_token, headers)
+        connect, read = timeout or self.timeouts[group]
+        idempotent = method in IDEMPOTENT_METHODS
+        client = self._get_client()
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                resp = await client.request(method, url, headers=request_headers,
+                                            timeout=httpx.Timeout(read, connect=connect), **kwargs)
+            except httpx.TransportError as e:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                can_retry = idempotent or isinstance(e, httpx.ConnectTimeout)
+                if attempt < self.max_retries and can_retry:
+                    self._record(group, elapsed_ms, error=True, retried=True)
+                    await self._sleep_before_retry_async(attempt)
+                    attempt += 1
+                    continue
+                self._record(group, elapsed_ms, error=True)
+                raise
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if resp.status_code in RETRY_STATUSES and idempotent and attempt < self.max_retries:
+                self._record(group, elapsed_ms, error=True, retried=True)
+                await self._sleep_before_retry_async(attempt)
+                attempt += 1
+                continue
+
+            self._record(group, elapsed_ms, error=resp.status_code >= 500)
+            return resp
+
+
+# Shared instances for the whole worker process
+supabase = SupabaseClient()
+async_supabase = AsyncSupabaseClient()
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Return this process's fan-out pool, creating a new one after a fork."""
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='supabase-fanout')
+                _executor_pid = pid
+    return _executor
+
+
+def submit(call, *args):
+    """Run call(*args) on the shared fan-out pool and return its Future."""
+    return _get_executor().submit(tracing.wrap_context(call), *args)
+
+
+def gather(*calls):
+    """
+    Run zero-argument callables concurrently and return their results in
+    order. The first call runs on the calling thread. If any call raises,
+    the first exception (in call order) is re-raised once all have finished.
+    """
+    if len(calls) < 2:
+        return [call() for call in calls]
+
+    futures = [_get_executor().submit(tracing.wrap_context(call)) for call in calls[1:]]
+    results = []
+    errors = []
+    try:
+        results.append(calls[0]())
+    except Exception as e:
+        results.append(None)
+        errors.append(e)
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(None)
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+async def gather_async(*awaitables):
+    """
+    gather() for async code: await all of them concurrently and return
+    their results in order. If any raises, the first exception (in call
+    order) is re-raised once all have finished.
+    """
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
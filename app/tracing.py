@@ -0,0 +1,354 @@
+"""
+Per-request latency tracing, Prometheus metrics and structured logs.
+
+Each Flask request gets a trace (a contextvar, copied into the Supabase
+fan-out threads), and so does each async route wrapped in traced(). Code wraps the steps worth timing in span(): every
+Supabase call (supabase.<resource>.<read|write>), token checks (auth),
+profile lookups (profile), catalog loads (catalog.load), and every
+OpenAI call (llm.*, realtime.*). Each span records its duration, status
+and payload sizes into:
+- the current request's trace, summarized in a Server-Timing header when
+  TRACE_SERVER_TIMING=1 and in the request log line
+- process-wide histograms and counters served at GET /metrics in the
+  Prometheus text format (per worker process)
+
+Logs are JSON lines on the "teaching_assistant" logger. Request logs are
+sampled (TRACE_LOG_SAMPLE_RATE); errors and requests slower than
+TRACE_SLOW_MS are always logged.
+"""
+
+import contextvars
+import functools
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Turn tracing hooks and span recording off entirely
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+
+# Add a Server-Timing header with the request's spans to every response
+TRACE_SERVER_TIMING = os.getenv("TRACE_SERVER_TIMING", "0") == "1"
+
+# Fraction of ordinary requests that get a log line
+TRACE_LOG_SAMPLE_RATE = float(os.getenv("TRACE_LOG_SAMPLE_RATE", "0.1"))
+
+# Requests slower than this are always logged (ms)
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "2000"))
+
+# If set, GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Histogram bucket upper bounds (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Spans kept per request trace
+MAX_SPANS_PER_TRACE = 200
+
+logger = logging.getLogger("teaching_assistant")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """Spans recorded during one request."""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration_ms, status, attrs):
+        with self._lock:
+            if len(self.spans) < MAX_SPANS_PER_TRACE:
+                self.spans.append({
+                    'name': name,
+                    'start_ms': round((start - self.start) * 1000, 2),
+                    'ms': round(duration_ms, 2),
+                    'status': status,
+                    **attrs
+                })
+
+    def summary(self):
+        """Total ms and count per span name, slowest first."""
+        totals = {}
+        with self._lock:
+            for s in self.spans:
+                entry = totals.setdefault(s['name'], {'ms': 0.0, 'count': 0})
+                entry['ms'] += s['ms']
+                entry['count'] += 1
+        return dict(sorted(((name, {'ms': round(v['ms'], 2), 'count': v['count']})
+                            for name, v in totals.items()), key=lambda item: -item[1]['ms']))
+
+
+class Histogram:
+    """Prometheus-style histogram keyed by a tuple of label values."""
+
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items()]
+        for labels, (counts, total, count) in sorted(items):
+            base = _labels(self.label_names, labels)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{base}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{base}}} {count}')
+        return lines
+
+
+class Counter:
+    """Prometheus-style counter keyed by a tuple of label values."""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._series.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{{{_labels(self.label_names, labels)}}} {value}')
+        return lines
+
+
+def _labels(names, values):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+REQUEST_DURATION = Histogram('app_request_duration_seconds', 'HTTP request duration',
+                             ('route', 'method', 'status'))
+SPAN_DURATION = Histogram('app_span_duration_seconds', 'Duration of traced steps (upstream calls, lookups)',
+                          ('span', 'status'))
+PAYLOAD_BYTES = Counter('app_span_payload_bytes_total', 'Bytes sent and received by traced upstream calls',
+                        ('span', 'direction'))
+
+_collectors = [REQUEST_DURATION, SPAN_DURATION, PAYLOAD_BYTES]
+
+
+def register_collector(collector):
+    """Add anything with a render() method returning metric lines to GET /metrics."""
+    _collectors.append(collector)
+
+
+def current_trace():
+    return _current.get()
+
+
+class Span:
+    """Handle yielded by span() to attach status, payload sizes and attributes."""
+
+    def __init__(self):
+        self.status = 'ok'
+        self.attrs = {}
+        self.bytes_out = 0
+        self.bytes_in = 0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Time the enclosed block as a span. Exceptions mark it as an error and
+    propagate. The yielded Span takes status, bytes_out, bytes_in and
+    extra attributes (kept in the trace only, not in metric labels).
+    """
+    handle = Span()
+    handle.attrs.update(attrs)
+    if not TRACING_ENABLED:
+        yield handle
+        return
+    start = time.perf_counter()
+    try:
+        yield handle
+    except BaseException:
+        handle.status = 'error'
+        raise
+    finally:
+        record(name, start, time.perf_counter() - start, handle)
+
+
+def record(name, start, seconds, handle):
+    """Record a finished span (for code that measures time itself)."""
+    status = str(handle.status)
+    SPAN_DURATION.observe((name, status), seconds)
+    if handle.bytes_out:
+        PAYLOAD_BYTES.inc((name, 'out'), handle.bytes_out)
+    if handle.bytes_in:
+        PAYLOAD_BYTES.inc((name, 'in'), handle.bytes_in)
+    trace = _current.get()
+    if trace is not None:
+        attrs = dict(handle.attrs)
+        if handle.bytes_out:
+            attrs['bytes_out'] = handle.bytes_out
+        if handle.bytes_in:
+            attrs['bytes_in'] = handle.bytes_in
+        trace.add(name, start, seconds * 1000, status, attrs)
+
+
+def token_usage(response):
+    """Span attributes with the token counts of an OpenAI response."""
+    usage = response.get('usage') or {}
+    return {'input_tokens': usage.get('prompt_tokens', 0), 'output_tokens': usage.get('completion_tokens', 0)}
+
+
+def wrap_context(call):
+    """Bind call to the current context, so spans in another thread join this trace."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(call, *args, **kwargs)
+
+
+def log(event, level=logging.INFO, sampled=False, **fields):
+    """
+    Emit a JSON log line. sampled=True lines are only written for
+    TRACE_LOG_SAMPLE_RATE of calls.
+    """
+    if sampled and random.random() >= TRACE_LOG_SAMPLE_RATE:
+        return
+    trace = _current.get()
+    record_fields = {'ts': round(time.time(), 3), 'level': logging.getLevelName(level), 'event': event}
+    if trace is not None:
+        record_fields['request_id'] = trace.request_id
+    record_fields.update(fields)
+    logger.log(level, json.dumps(record_fields, default=str))
+
+
+def log_error(event, error, **fields):
+    """Error log line, never sampled."""
+    log(event, level=logging.ERROR, error=str(error), error_type=type(error).__name__, **fields)
+
+
+def render_metrics():
+    lines = []
+    for collector in _collectors:
+        lines.extend(collector.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _server_timing(trace, total_ms):
+    parts = []
+    for name, entry in trace.summary().items():
+        desc = f';desc="x{entry["count"]}"' if entry['count'] > 1 else ''
+        parts.append(f'{name}{desc};dur={entry["ms"]}')
+    parts.append(f'total;dur={round(total_ms, 2)}')
+    return ', '.join(parts)
+
+
+def _finish(trace, route, method, status, headers):
+    """Observe and log a finished request, and add the trace headers to its response."""
+    total_ms = (time.perf_counter() - trace.start) * 1000
+    REQUEST_DURATION.observe((route, method, str(status)), total_ms / 1000)
+
+    headers['X-Request-ID'] = trace.request_id
+    if TRACE_SERVER_TIMING:
+        headers['Server-Timing'] = _server_timing(trace, total_ms)
+
+    important = status >= 500 or total_ms >= TRACE_SLOW_MS
+    log('request', level=logging.WARNING if important else logging.INFO, sampled=not important,
+        route=route, method=method, status=status, ms=round(total_ms, 2), spans=trace.summary())
+
+
+def traced(route):
+    """
+    Decorator giving an async (Starlette) endpoint the trace, metrics and
+    headers init_app() gives Flask routes. route is the metrics label, in
+    Flask's rule syntax so both apps' routes line up.
+    """
+    def decorate(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request):
+            if not TRACING_ENABLED:
+                return await endpoint(request)
+            trace = Trace(request.headers.get('X-Request-ID') or os.urandom(8).hex())
+            token = _current.set(trace)
+            try:
+                response = await endpoint(request)
+            finally:
+                _current.reset(token)
+            _finish(trace, route, request.method, response.status_code, response.headers)
+            return response
+        return wrapper
+    return decorate
+
+
+def init_app(app):
+    """Register the request hooks and the /metrics route on a Flask app."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_trace():
+        if not TRACING_ENABLED:
+            return
+        trace = Trace(request.headers.get('X-Request-ID') or os.urandom(8).hex())
+        _current.set(trace)
+        g.trace = trace
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = g.get('trace')
+        if trace is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        _finish(trace, route, request.method, response.status_code, response.headers)
+        return response
+
+    @app.teardown_request
+    def _end_trace(exc):
+        if g.pop('trace', None) is not None:
+            _current.set(None)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        """Prometheus metrics for this worker process."""
+        if METRICS_TOKEN:
+            auth_header = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(auth_header, f'Bearer {METRICS_TOKEN}'):
+                return Response("Unauthorized\n", status=401, mimetype='text/plain')
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,521 @@
+"""
+Chunked (map-reduce) Can-Do analysis of session transcripts.
+
+A long session no longer goes to the model as one prompt. The transcript
+is split on speaker turns into windows of at most ANALYSIS_CHUNK_TOKENS
+estimated tokens (the last few turns of a window are repeated at the
+start of the next one for context), each window is analyzed against the
+same candidate statements, at most ANALYSIS_CHUNK_CONCURRENCY at a time,
+and the detections are merged per cando_id, keeping the highest
+confidence and the evidence that came with it.
+
+Latency follows the longest window rather than the whole session, no
+prompt grows past the model's context, and each window's answer fits in
+its output budget. Short transcripts are a single window.
+
+Answers are constrained with a strict JSON schema (response_format) whose
+cando_id is an enum of the candidate ids, and streamed. DetectionStream
+picks each detection out of the stream as soon as it is complete, and it
+is validated right away. A broken, truncated or invalid answer is not
+thrown away: the confirmed detections are kept and only the statements
+still missing (or invalid) are asked about again.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import tracing
+from conversation_store import estimate_tokens
+from llm_gateway import llm_gateway
+from rate_limit import CONCURRENCY_BACKGROUND_WAIT
+
+load_dotenv()
+
+ANALYSIS_MODEL = os.getenv("ANALYSIS_MODEL", "gpt-4o")
+
+# Seconds one analysis call (a whole streamed answer) may take
+ANALYSIS_DEADLINE = float(os.getenv("ANALYSIS_DEADLINE", "120"))
+ANALYSIS_PROMPT_VERSION = "v1.2"
+
+# Max estimated transcript tokens per analysis window
+ANALYSIS_CHUNK_TOKENS = int(os.getenv("ANALYSIS_CHUNK_TOKENS", "4000"))
+
+# Windows of one transcript analyzed at the same time
+ANALYSIS_CHUNK_CONCURRENCY = int(os.getenv("ANALYSIS_CHUNK_CONCURRENCY", "4"))
+
+# Turns repeated from the end of one window at the start of the next
+ANALYSIS_CHUNK_OVERLAP_TURNS = 2
+
+# Output budget per window
+ANALYSIS_MAX_OUTPUT_TOKENS = 2000
+
+# Follow-up calls per window for statements missing from, or invalid in, the answer
+ANALYSIS_PART_RETRIES = int(os.getenv("ANALYSIS_PART_RETRIES", "2"))
+
+# Lowest confidence the prompt asks for; detections below it are dropped
+MIN_CONFIDENCE = 0.6
+
+# Above this many candidates the schema no longer lists the ids (an API
+# limit on enum size); detections are still checked against them
+MAX_ENUM_IDS = 500
+
+_SPEAKER = re.compile(r'^\s*(User|Learner|Student|Assistant|Tutor|AI|Bot)\s*:', re.IGNORECASE)
+
+
+def split_turns(transcript):
+    """
+    Split a transcript into speaker turns. A line starting with a speaker
+    label opens a new turn; other lines continue the current one. Without
+    any labels, every non-empty line is a turn.
+    """
+    turns = []
+    for line in transcript.splitlines():
+        if not line.strip():
+            continue
+        if _SPEAKER.match(line) or not turns:
+            turns.append(line.strip())
+        else:
+            turns[-1] += '\n' + line.strip()
+
+    if not any(_SPEAKER.match(turn) for turn in turns):
+        return [line.strip() for line in transcript.splitlines() if line.strip()]
+    return turns
+
+
+def _split_long_turn(turn, max_tokens):
+    """Cut a turn that alone exceeds the window budget at word boundaries."""
+    pieces = []
+    piece = ''
+    for word in turn.split(' '):
+        if piece and estimate_tokens(f'{piece} {word}') > max_tokens:
+            pieces.append(piece)
+            piece = word
+        else:
+            piece = f'{piece} {word}' if piece else word
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+def chunk_transcript(transcript, max_tokens=ANALYSIS_CHUNK_TOKENS, overlap_turns=ANALYSIS_CHUNK_OVERLAP_TURNS):
+    """Group whole turns into windows of at most max_tokens estimated tokens."""
+    turns = []
+    for turn in split_turns(transcript):
+        if estimate_tokens(turn) > max_tokens:
+            turns.extend(_split_long_turn(turn, max_tokens))
+        else:
+            turns.append(turn)
+
+    chunks = []
+    window, used = [], 0
+    for turn in turns:
+        cost = estimate_tokens(turn)
+        if window and used + cost > max_tokens:
+            chunks.append('\n'.join(window))
+            # Carry the last turns over as context, as long as they leave room
+            window = window[-overlap_turns:] if overlap_turns else []
+            used = sum(estimate_tokens(t) for t in window)
+            while window and used + cost > max_tokens:
+                used -= estimate_tokens(window.pop(0))
+        window.append(turn)
+        used += cost
+    if window:
+        chunks.append('\n'.join(window))
+    return chunks
+
+
+def build_prompt(transcript, statements, user_level, part=1, parts=1):
+    statements_text = "\n".join([
+        f"{i+1}. [{stmt.id}] ({stmt.level} - {stmt.skill_type}): {stmt.descriptor}"
+        for i, stmt in enumerate(statements)
+    ])
+
+    if parts > 1:
+        transcript_heading = (f"TRANSCRIPT (part {part} of {parts} of a longer conversation; "
+                              f"judge only what happens in this part):")
+    else:
+        transcript_heading = "TRANSCRIPT:"
+
+    return f"""You are an expert CEFR language assessor analyzing a learner's English conversation transcript for a PhD research project on senior language learners.
+
+The learner's assigned level is: {user_level}
+IMPORTANT: The learner may demonstrate capabilities ABOVE this assigned level. Recognize ALL achievements.
+
+Analyze the conversation transcript and identify which Can-Do statements the learner has DEMONSTRATED through their language production.
+
+ASSESSMENT CRITERIA:
+- The learner must have PRODUCED the language (speaking/interaction), not just comprehended it
+- Look for evidence of the capability described in the Can-Do statement
+- The learner may perform ABOVE their assigned level - recognize this
+- Use confidence scores to indicate strength of evidence (0.6+ = demonstrated, 0.8+ = clearly demonstrated, 0.95+ = exceptionally demonstrated)
+- Focus on what the learner ACTUALLY DID in the conversation
+
+{transcript_heading}
+{transcript}
+
+CAN-DO STATEMENTS TO EVALUATE:
+{statements_text}
+
+For each Can-Do statement demonstrated in the transcript, respond with:
+1. The statement ID (in brackets from above)
+2. Confidence score (0.6-1.0, where 0.6 = minimal evidence, 1.0 = perfect demonstration)
+3. A brief excerpt from the transcript showing the evidence (max 100 words)
+
+Put each one in "detected_achievements" as {{"cando_id", "confidence", "evidence"}}.
+
+Include any statement with confidence >= 0.6. If no statements were demonstrated, return an empty array."""
+
+
+def response_schema(candidate_ids):
+    """
+    Strict JSON schema for the answer. Listing the candidate ids as an enum
+    means the model cannot name a statement it was not given.
+    """
+    cando_id = {"type": "string"}
+    if len(candidate_ids) <= MAX_ENUM_IDS:
+        cando_id["enum"] = list(candidate_ids)
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "cando_detections",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "detected_achievements": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "cando_id": cando_id,
+                                "confidence": {"type": "number"},
+                                "evidence": {"type": "string"}
+                            },
+                            "required": ["cando_id", "confidence", "evidence"],
+                            "additionalProperties": False
+                        }
+                    }
+                },
+                "required": ["detected_achievements"],
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+class DetectionStream:
+    """
+    Incremental parser for a streamed {"detected_achievements": [...]}
+    answer. feed() returns each detection object as soon as its closing
+    brace arrives, so it can be validated (and saved) before the answer
+    is finished.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.malformed = 0
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._item_start = None
+
+    def feed(self, delta):
+        self.text += delta
+        items = []
+        for i in range(self._pos, len(self.text)):
+            ch = self.text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._depth += 1
+                # Depth 3: an object inside the array inside the root object
+                if ch == '{' and self._depth == 3:
+                    self._item_start = i
+            elif ch in '}]':
+                if ch == '}' and self._depth == 3 and self._item_start is not None:
+                    items.append(self.text[self._item_start:i + 1])
+                    self._item_start = None
+                self._depth -= 1
+        self._pos = len(self.text)
+
+        detections = []
+        for item in items:
+            try:
+                detections.append(json.loads(item))
+            except ValueError:
+                self.malformed += 1
+        return detections
+
+    def complete(self):
+        """Whether the whole answer arrived and is the expected JSON object."""
+        try:
+            result = json.loads(self.text)
+        except ValueError:
+            return False
+        return isinstance(result, dict) and isinstance(result.get('detected_achievements'), list)
+
+
+def validate_detection(item, valid_ids):
+    """Return an error message for a detection that can't be used, or None."""
+    if not isinstance(item, dict):
+        return "not an object"
+    if item.get('cando_id') not in valid_ids:
+        return f"unknown cando_id {item.get('cando_id')!r}"
+    confidence = item.get('confidence')
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)) \
+            or not 0.0 <= confidence <= 1.0:
+        return f"confidence out of range: {confidence!r}"
+    if not isinstance(item.get('evidence'), str) or not item['evidence'].strip():
+        return "missing evidence"
+    return None
+
+
+def _stream_detections(chunk, statements, user_level, part, parts, on_detection):
+    """
+    One streamed model call. Returns a dict with the valid detections
+    (by cando_id), the ids of statements whose detection was invalid, the
+    ids of those answered below MIN_CONFIDENCE (dropped, not invalid), an
+    error if the answer was not complete, the tokens used and the model
+    that answered (ANALYSIS_MODEL or its fallback; None if none did).
+    """
+    valid_ids = {stmt.id for stmt in statements}
+    prompt = build_prompt(chunk, statements, user_level, part, parts)
+    outcome = {'detections': {}, 'invalid_ids': set(), 'low_confidence_ids': set(), 'error': None,
+               'input_tokens': estimate_tokens(prompt), 'output_tokens': 0, 'model': None}
+    parser = DetectionStream()
+    finish_reason = None
+    usage = None
+
+    span = tracing.Span()
+    start = time.perf_counter()
+    response = None
+    try:
+        # Analysis runs in the background, so it can wait longer for a model slot than a request
+        response = llm_gateway.stream(
+            'analysis', ANALYSIS_MODEL,
+            messages=[
+                {"role": "system", "content": "You are an expert CEFR language assessor."},
+                {"role": "user", "content": prompt}
+            ],
+            deadline=ANALYSIS_DEADLINE,
+            slot_wait=CONCURRENCY_BACKGROUND_WAIT,
+            temperature=0.3,
+            max_tokens=ANALYSIS_MAX_OUTPUT_TOKENS,
+            response_format=response_schema([stmt.id for stmt in statements]),
+            stream_options={"include_usage": True}
+        )
+        outcome['model'] = response.model
+        for event in response:
+            if event.get('usage'):
+                usage = event['usage']
+            if not event.get('choices'):
+                continue
+            choice = event['choices'][0]
+            finish_reason = choice.get('finish_reason') or finish_reason
+            delta = choice.get('delta', {}).get('content')
+            if not delta:
+                continue
+            for item in parser.feed(delta):
+                error = validate_detection(item, valid_ids)
+                if error:
+                    tracing.log('analysis_invalid_detection', part=part, parts=parts, reason=error)
+                    if isinstance(item, dict) and item.get('cando_id') in valid_ids \
+                            and item['cando_id'] not in outcome['detections']:
+                        outcome['invalid_ids'].add(item['cando_id'])
+                    continue
+                cando_id = item['cando_id']
+                if item['confidence'] < MIN_CONFIDENCE:
+                    # A valid answer, just not confident enough to count; asking again won't help
+                    tracing.log('analysis_low_confidence', part=part, parts=parts, cando_id=cando_id,
+                                confidence=item['confidence'])
+                    outcome['low_confidence_ids'].add(cando_id)
+                    outcome['invalid_ids'].discard(cando_id)
+                    continue
+                if cando_id in outcome['detections']:
+                    # The first detection may be saved already, so it stays as it is
+                    tracing.log('analysis_duplicate_detection', part=part, parts=parts, cando_id=cando_id)
+                    continue
+                outcome['detections'][cando_id] = item
+                outcome['invalid_ids'].discard(cando_id)
+                if on_detection:
+                    on_detection(item)
+    except Exception as e:
+        outcome['error'] = f"Part {part}/{parts}: {e}"
+        span.status = 'error'
+        return outcome
+    finally:
+        if response is not None:
+            response.close()
+        if usage:
+            outcome['input_tokens'] = usage.get('prompt_tokens', outcome['input_tokens'])
+            outcome['output_tokens'] = usage.get('completion_tokens', 0)
+        else:
+            outcome['output_tokens'] = estimate_tokens(parser.text)
+        # The whole stream, including parsing, is one llm.analysis span
+        span.bytes_out = len(prompt)
+        span.bytes_in = len(parser.text)
+        span.set(part=part, model=outcome['model'], input_tokens=outcome['input_tokens'], output_tokens=outcome['output_tokens'])
+        tracing.record('llm.analysis', start, time.perf_counter() - start, span)
+
+    if finish_reason == 'length':
+        outcome['error'] = f"Part {part}/{parts}: answer truncated at {ANALYSIS_MAX_OUTPUT_TOKENS} tokens"
+    elif not parser.complete() or parser.malformed:
+        outcome['error'] = f"Part {part}/{parts}: incomplete or malformed answer"
+    return outcome
+
+
+def analyze_chunk(chunk, statements, user_level, part=1, parts=1, on_detection=None):
+    """
+    Analyze one window and return (detections, input_tokens, output_tokens,
+    error, models), models being the set of models that answered.
+
+    Detections are kept as soon as they are validated. If the answer breaks
+    off, is truncated or malformed, only the statements not confirmed yet
+    are asked about again; if some detections were invalid, only those
+    statements are. Statements answered below MIN_CONFIDENCE are dropped
+    and never asked about again. error is None unless parts are still
+    missing after ANALYSIS_PART_RETRIES retries.
+    """
+    confirmed = {}
+    dropped = set()
+    input_tokens = output_tokens = 0
+    models = set()
+    remaining = list(statements)
+    error = None
+
+    def report(item):
+        # Statements confirmed by an earlier attempt were reported already
+        if on_detection and item['cando_id'] not in confirmed:
+            on_detection(item)
+
+    for attempt in range(ANALYSIS_PART_RETRIES + 1):
+        if attempt:
+            tracing.log('analysis_retry', level=logging.WARNING, part=part, parts=parts,
+                        statements=len(remaining), reason=error)
+        outcome = _stream_detections(chunk, remaining, user_level, part, parts, report)
+        input_tokens += outcome['input_tokens']
+        output_tokens += outcome['output_tokens']
+        if outcome['model']:
+            models.add(outcome['model'])
+        for cando_id, item in outcome['detections'].items():
+            # Reported detections are final (they may be saved already)
+            confirmed.setdefault(cando_id, item)
+        dropped |= outcome['low_confidence_ids']
+
+        error = outcome['error']
+        if error:
+            remaining = [stmt for stmt in remaining if stmt.id not in confirmed and stmt.id not in dropped]
+        elif outcome['invalid_ids']:
+            error = f"Part {part}/{parts}: {len(outcome['invalid_ids'])} invalid detections"
+            remaining = [stmt for stmt in remaining if stmt.id in outcome['invalid_ids']]
+        else:
+            break
+        if not remaining:
+            error = None
+            break
+
+    return list(confirmed.values()), input_tokens, output_tokens, error, models
+
+
+def merge_detections(detection_lists):
+    """
+    One detection per cando_id across all windows: the highest confidence
+    wins, together with its evidence. Order follows first detection.
+    """
+    merged = {}
+    for detections in detection_lists:
+        for achievement in detections:
+            cando_id = achievement.get('cando_id')
+            if not cando_id:
+                continue
+            current = merged.get(cando_id)
+            if current is None or (achievement.get('confidence') or 0) > (current.get('confidence') or 0):
+                merged[cando_id] = achievement
+    return list(merged.values())
+
+
+def analyze_transcript(transcript, statements, user_level, on_detection=None):
+    """
+    Detect Can-Do achievements in a transcript, window by window.
+
+    Returns:
+    {
+        "detected_achievements": [
+            {"cando_id", "descriptor", "level", "confidence", "evidence"}
+        ],
+        "chunks": 3,
+        "input_tokens": 12345,
+        "output_tokens": 678,
+        "models": ["gpt-4o"]
+    }
+    If any window is still incomplete after its retries, "error" and
+    "error_message" are set as well; every detection confirmed so far is
+    still returned.
+
+    on_detection(achievement) is called once per detection as soon as it
+    is final: while the answer streams in for a single-window transcript,
+    or after the merge when there are several windows (a later window may
+    still raise the confidence).
+    """
+    chunks = chunk_transcript(transcript) or [transcript]
+    parts = len(chunks)
+
+    if parts == 1:
+        outcomes = [analyze_chunk(chunks[0], statements, user_level, on_detection=on_detection)]
+    else:
+        with ThreadPoolExecutor(max_workers=min(ANALYSIS_CHUNK_CONCURRENCY, parts)) as executor:
+            outcomes = list(executor.map(
+                lambda item: analyze_chunk(item[1], statements, user_level, item[0], parts),
+                enumerate(chunks, start=1)
+            ))
+
+    detection_lists, errors = [], []
+    input_tokens = output_tokens = 0
+    models = set()
+    for detections, used_in, used_out, error, used_models in outcomes:
+        models |= used_models
+        if error is not None:
+            tracing.log('analysis_part_failed', level=logging.ERROR, reason=error)
+            errors.append(error)
+        detection_lists.append(detections)
+        input_tokens += used_in
+        output_tokens += used_out
+
+    detected = merge_detections(detection_lists)
+    if parts > 1 and on_detection:
+        for achievement in detected:
+            on_detection(achievement)
+
+    # Add descriptor to each achievement for frontend display
+    stmt_dict = {s.id: s for s in statements}
+    for achievement in detected:
+        stmt = stmt_dict.get(achievement['cando_id'])
+        if stmt:
+            achievement['descriptor'] = stmt.descriptor
+            achievement['level'] = stmt.level
+
+    result = {
+        "detected_achievements": detected,
+        "chunks": parts,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "models": sorted(models)
+    }
+    if errors:
+        result["error"] = True
+        result["error_message"] = '; '.join(errors)
+    return result
@@ -0,0 +1,61 @@
+"""
+Small thread-safe LRU cache with per-entry expiry, shared by the
+in-process caches (tokens, profiles, ...).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire after a TTL."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        """Store value until expires_at (epoch seconds), or for the default TTL."""
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
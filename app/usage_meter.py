@@ -0,0 +1,654 @@
+"""
+Voice-minute metering and monthly quota checks.
+
+webrtc_session checks the learner's quota and opens a metered session
+before handing out a Realtime token. The client then reports heartbeats
+every USAGE_HEARTBEAT_INTERVAL seconds and the end of the session. Each
+event adds the time since the previous one to an in-memory counter per
+(user, month). A background thread writes the accumulated seconds and
+the finished sessions to Supabase in one record_voice_usage RPC call
+every USAGE_FLUSH_INTERVAL seconds (see ADD_VOICE_USAGE_METERING.sql),
+instead of one write per event.
+
+The quota check reads the in-memory counter: the month's total as last
+read from Supabase, plus what this process has metered but not yet
+written. A counter is seeded from the user's (cached) profile the first
+time the user is seen, and updated from the totals each flush returns.
+Starting a session therefore costs no database round-trip in the common
+case.
+
+Counters roll over at the start of each UTC month. The first event of
+the new month resets the counter under the lock. Seconds still pending
+for the old month are flushed to that month's logs, not the new total.
+
+Open sessions live in a store shared by the workers, chosen with
+USAGE_SESSION_STORE as for the conversation store:
+- "sqlite" (default): a local SQLite file (USAGE_SESSION_DB), shared by
+  the worker processes on one host
+- "memory": this process only; only for a single worker
+- a "redis://..." URL: shared between hosts (needs the redis package)
+so a heartbeat or end event can land on any worker. Sessions that stop
+sending events for USAGE_SESSION_TIMEOUT seconds are closed by whichever
+worker flushes next, and charged as connected until they timed out.
+
+Counters are per process. With several workers, each one sees the
+others' usage after its next flush, so a learner can go over by about
+what the other workers metered since then.
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+import tracing
+from supabase_client import supabase
+
+load_dotenv()
+
+try:
+    import redis
+except ImportError:  # redis is optional, only needed for a redis:// store
+    redis = None
+
+# Turn metering and quota checks off
+USAGE_METERING_ENABLED = os.getenv("USAGE_METERING_ENABLED", "1") == "1"
+
+# Monthly voice minutes per tier (-1 = unlimited); admins are never limited
+VOICE_TIER_MINUTES = {
+    tier.strip(): int(minutes)
+    for tier, minutes in (item.split(':') for item in
+                          os.getenv("VOICE_TIER_MINUTES", "free:30,starter:150,premium:300,enterprise:-1").split(','))
+}
+
+# Tier used for unknown tiers, expired premium and missing profiles
+DEFAULT_TIER = 'free'
+
+# OpenAI Realtime cost per minute (USD), logged with each session
+VOICE_COST_PER_MINUTE = float(os.getenv("VOICE_COST_PER_MINUTE", "0.06"))
+
+# Seconds between client heartbeats
+USAGE_HEARTBEAT_INTERVAL = int(os.getenv("USAGE_HEARTBEAT_INTERVAL", "30"))
+
+# Sessions with no event for this long are closed (seconds)
+USAGE_SESSION_TIMEOUT = int(os.getenv("USAGE_SESSION_TIMEOUT", "90"))
+
+# Seconds between flushes to Supabase
+USAGE_FLUSH_INTERVAL = int(os.getenv("USAGE_FLUSH_INTERVAL", "15"))
+
+# Reject webrtc_session without an Authorization header even when metering is off
+USAGE_REQUIRE_AUTH = os.getenv("USAGE_REQUIRE_AUTH", "0") == "1"
+
+USAGE_SESSION_STORE = os.getenv("USAGE_SESSION_STORE", "sqlite")
+
+USAGE_SESSION_DB = os.getenv(
+    "USAGE_SESSION_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usage_sessions.db')
+)
+
+RECORD_USAGE_PATH = '/rest/v1/rpc/record_voice_usage'
+
+_SESSION_FIELDS = ('user_id', 'limit', 'started_at', 'last_event', 'seconds')
+_SESSION_COLUMNS = 'user_id, limit_seconds, started_at, last_event, seconds'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_sessions (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    limit_seconds REAL,
+    started_at REAL NOT NULL,
+    last_event REAL NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_usage_sessions_user_id ON usage_sessions(user_id);
+CREATE INDEX IF NOT EXISTS idx_usage_sessions_last_event ON usage_sessions(last_event);
+"""
+
+
+class QuotaExceeded(Exception):
+    """The learner has used all voice minutes of their tier this month."""
+
+
+def month_key(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m')
+
+
+def month_start(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def limit_seconds(profile, now):
+    """Monthly allowance in seconds for a profile, or None if unlimited."""
+    profile = profile or {}
+    if profile.get('is_admin'):
+        return None
+    tier = profile.get('tier') or DEFAULT_TIER
+    premium_until = _parse_time(profile.get('premium_until'))
+    if tier == 'premium' and premium_until is not None and premium_until < now:
+        tier = DEFAULT_TIER
+    minutes = VOICE_TIER_MINUTES.get(tier, VOICE_TIER_MINUTES.get(DEFAULT_TIER, 0))
+    return None if minutes < 0 else minutes * 60
+
+
+def used_seconds(profile, month):
+    """This month's usage recorded in Supabase, from a profile row."""
+    profile = profile or {}
+    reset_at = _parse_time(profile.get('last_usage_reset'))
+    if reset_at is not None and month_key(reset_at) != month:
+        # Not reset yet this month: the stored total belongs to an earlier month
+        return 0.0
+    if profile.get('monthly_voice_seconds_used') is not None:
+        return float(profile['monthly_voice_seconds_used'])
+    return float(profile.get('monthly_voice_minutes_used') or 0) * 60
+
+
+def _advance(record, now, cap):
+    """Move a session record to now. Returns the seconds to charge (at most cap)."""
+    elapsed = min(max(0.0, now - record['last_event']), cap)
+    record['seconds'] += elapsed
+    record['last_event'] = now
+    return elapsed
+
+
+class MemorySessions:
+    """Open usage sessions in this process only."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}  # usage_session_id -> record
+        self._by_user = {}   # user_id -> set of open usage_session_ids
+
+    def _pop(self, usage_session_id):
+        record = self._sessions.pop(usage_session_id)
+        user_sessions = self._by_user.get(record['user_id'])
+        if user_sessions is not None:
+            user_sessions.discard(usage_session_id)
+            if not user_sessions:
+                del self._by_user[record['user_id']]
+        return record
+
+    def open(self, usage_session_id, record):
+        with self._lock:
+            self._sessions[usage_session_id] = dict(record)
+            self._by_user.setdefault(record['user_id'], set()).add(usage_session_id)
+
+    def advance(self, usage_session_id, now, cap, end):
+        with self._lock:
+            record = self._sessions.get(usage_session_id)
+            if record is None:
+                return None
+            elapsed = _advance(record, now, cap)
+            if end:
+                self._pop(usage_session_id)
+            return dict(record), elapsed
+
+    def expire(self, cutoff):
+        with self._lock:
+            expired = [usage_session_id for usage_session_id, record in self._sessions.items()
+                       if record['last_event'] < cutoff]
+            return [(usage_session_id, self._pop(usage_session_id)) for usage_session_id in expired]
+
+    def for_user(self, user_id):
+        with self._lock:
+            return [dict(self._sessions[usage_session_id]) for usage_session_id in self._by_user.get(user_id, ())]
+
+    def count(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+class SQLiteSessions:
+    """Open usage sessions in a local SQLite file, shared between processes."""
+
+    def __init__(self, db_path=USAGE_SESSION_DB):
+        self.db_path = db_path
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        """Return this process's connection, opening a new one after a fork."""
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            db = self._db()
+            # Take the write lock up front so the read-modify-write is atomic across processes
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def open(self, usage_session_id, record):
+        with self._lock:
+            self._db().execute(
+                f'INSERT INTO usage_sessions (id, {_SESSION_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)',
+                (usage_session_id, *(record[field] for field in _SESSION_FIELDS))
+            )
+
+    def advance(self, usage_session_id, now, cap, end):
+        with self._transaction() as db:
+            row = db.execute(f'SELECT {_SESSION_COLUMNS} FROM usage_sessions WHERE id = ?',
+                             (usage_session_id,)).fetchone()
+            if row is None:
+                return None
+            record = dict(zip(_SESSION_FIELDS, row))
+            elapsed = _advance(record, now, cap)
+            if end:
+                db.execute('DELETE FROM usage_sessions WHERE id = ?', (usage_session_id,))
+            else:
+                db.execute('UPDATE usage_sessions SET last_event = ?, seconds = ? WHERE id = ?',
+                           (record['last_event'], record['seconds'], usage_session_id))
+        return record, elapsed
+
+    def expire(self, cutoff):
+        with self._transaction() as db:
+            rows = db.execute(f'SELECT id, {_SESSION_COLUMNS} FROM usage_sessions WHERE last_event < ?',
+                              (cutoff,)).fetchall()
+            db.execute('DELETE FROM usage_sessions WHERE last_event < ?', (cutoff,))
+        return [(row[0], dict(zip(_SESSION_FIELDS, row[1:]))) for row in rows]
+
+    def for_user(self, user_id):
+        with self._lock:
+            rows = self._db().execute(f'SELECT {_SESSION_COLUMNS} FROM usage_sessions WHERE user_id = ?',
+                                      (user_id,)).fetchall()
+        return [dict(zip(_SESSION_FIELDS, row)) for row in rows]
+
+    def count(self):
+        with self._lock:
+            return self._db().execute('SELECT COUNT(*) FROM usage_sessions').fetchone()[0]
+
+
+# KEYS[1]: the session hash, KEYS[2]: the last-event index; ARGV: now, cap, end, id, user set prefix.
+# Same as _advance; returns the updated record fields and the seconds to charge.
+_ADVANCE_SCRIPT = """
+local s = redis.call('HMGET', KEYS[1], 'user_id', 'limit', 'started_at', 'last_event', 'seconds')
+if not s[1] then
+  return false
+end
+local now = tonumber(ARGV[1])
+local elapsed = math.min(math.max(0, now - tonumber(s[4])), tonumber(ARGV[2]))
+local seconds = tonumber(s[5]) + elapsed
+if ARGV[3] == '1' then
+  redis.call('DEL', KEYS[1])
+  redis.call('ZREM', KEYS[2], ARGV[4])
+  redis.call('SREM', ARGV[5] .. s[1], ARGV[4])
+else
+  redis.call('HSET', KEYS[1], 'last_event', ARGV[1], 'seconds', tostring(seconds))
+  redis.call('ZADD', KEYS[2], now, ARGV[4])
+end
+return {s[1], s[2], s[3], ARGV[1], tostring(seconds), tostring(elapsed)}
+"""
+
+# KEYS[1]: the last-event index; ARGV: cutoff, key prefix. Removes and returns the expired sessions.
+_EXPIRE_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+local expired = {}
+for _, id in ipairs(ids) do
+  local key = ARGV[2] .. 'session:' .. id
+  local s = redis.call('HMGET', key, 'user_id', 'limit', 'started_at', 'last_event', 'seconds')
+  redis.call('DEL', key)
+  redis.call('ZREM', KEYS[1], id)
+  if s[1] then
+    redis.call('SREM', ARGV[2] .. 'user:' .. s[1], id)
+    table.insert(expired, {id, s[1], s[2], s[3], s[4], s[5]})
+  end
+end
+return expired
+"""
+
+
+def _redis_record(values):
+    user_id, limit, started_at, last_event, seconds = (
+        value.decode() if isinstance(value, bytes) else value for value in values)
+    return {'user_id': user_id, 'limit': float(limit) if limit else None, 'started_at': float(started_at),
+            'last_event': float(last_event), 'seconds': float(seconds)}
+
+
+class RedisSessions:
+    """Open usage sessions in a Redis-compatible server, shared between hosts."""
+
+    def __init__(self, url, prefix='usage:'):
+        if redis is None:
+            raise RuntimeError("USAGE_SESSION_STORE is a redis:// URL but the redis package is not installed")
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._advance = self._client.register_script(_ADVANCE_SCRIPT)
+        self._expire = self._client.register_script(_EXPIRE_SCRIPT)
+
+    def open(self, usage_session_id, record):
+        pipe = self._client.pipeline()
+        pipe.hset(self.prefix + 'session:' + usage_session_id, mapping={
+            **{field: record[field] for field in _SESSION_FIELDS if field != 'limit'},
+            'limit': '' if record['limit'] is None else record['limit']
+        })
+        pipe.zadd(self.prefix + 'last_event', {usage_session_id: record['last_event']})
+        pipe.sadd(self.prefix + 'user:' + record['user_id'], usage_session_id)
+        pipe.execute()
+
+    def advance(self, usage_session_id, now, cap, end):
+        result = self._advance(keys=[self.prefix + 'session:' + usage_session_id, self.prefix + 'last_event'],
+                               args=[repr(now), cap, '1' if end else '0', usage_session_id, self.prefix + 'user:'])
+        if not result:
+            return None
+        return _redis_record(result[:5]), float(result[5])
+
+    def expire(self, cutoff):
+        rows = self._expire(keys=[self.prefix + 'last_event'], args=[repr(cutoff), self.prefix])
+        return [(row[0].decode(), _redis_record(row[1:])) for row in rows]
+
+    def for_user(self, user_id):
+        ids = [usage_session_id.decode() for usage_session_id in self._client.smembers(self.prefix + 'user:' + user_id)]
+        pipe = self._client.pipeline()
+        for usage_session_id in ids:
+            pipe.hmget(self.prefix + 'session:' + usage_session_id, *_SESSION_FIELDS)
+        return [_redis_record(values) for values in pipe.execute() if values[0] is not None]
+
+    def count(self):
+        return self._client.zcard(self.prefix + 'last_event')
+
+
+def make_sessions(spec=USAGE_SESSION_STORE):
+    """Build the session store named by USAGE_SESSION_STORE."""
+    if spec.startswith(('redis://', 'rediss://')):
+        return RedisSessions(spec)
+    if spec == 'sqlite':
+        return SQLiteSessions()
+    if spec == 'memory':
+        return MemorySessions()
+    raise ValueError(f"Unknown USAGE_SESSION_STORE: {spec}")
+
+
+class UsageMeter:
+    """Voice usage counters, flushed to Supabase in batches, and the open sessions feeding them."""
+
+    def __init__(self, enabled=USAGE_METERING_ENABLED, flush_interval=USAGE_FLUSH_INTERVAL,
+                 heartbeat_interval=USAGE_HEARTBEAT_INTERVAL, session_timeout=USAGE_SESSION_TIMEOUT,
+                 cost_per_minute=VOICE_COST_PER_MINUTE, clock=time.time, sessions=None):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.session_timeout = session_timeout
+        self.cost_per_minute = cost_per_minute
+        self.clock = clock
+        self._sessions = sessions
+        self._sessions_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._counters = {}   # user_id -> {'month', 'base'}: Supabase total as of the last sync
+        self._pending = {}    # (user_id, month) -> seconds not flushed yet
+        self._inflight = {}   # (user_id, month) -> seconds in the flush being sent
+        self._closed = []     # finished sessions waiting to be logged
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+
+        self._metrics = {'flushes': 0, 'flush_errors': 0, 'events': 0, 'rejected': 0, 'timed_out': 0}
+
+    @property
+    def sessions(self):
+        # Built on first use, so a misconfigured store fails the request that needs it, not the import
+        if self._sessions is None:
+            with self._sessions_lock:
+                if self._sessions is None:
+                    self._sessions = make_sessions()
+        return self._sessions
+
+    # Counters (call with self._lock held) --------------------------------
+
+    def _counter(self, user_id, profile, month):
+        counter = self._counters.get(user_id)
+        if counter is None:
+            counter = self._counters[user_id] = {'month': month, 'base': used_seconds(profile, month)}
+        elif counter['month'] != month:
+            # New month: pending seconds of the old month stay keyed to it
+            counter['month'] = month
+            counter['base'] = 0.0
+        return counter
+
+    def _used(self, user_id, month, now, open_sessions):
+        counter = self._counters.get(user_id)
+        used = counter['base'] if counter and counter['month'] == month else 0.0
+        used += self._pending.get((user_id, month), 0.0) + self._inflight.get((user_id, month), 0.0)
+        # Time since the last event of the user's open sessions
+        for record in open_sessions:
+            used += min(max(0.0, now - record['last_event']), self.session_timeout)
+        return used
+
+    def _remaining(self, user_id, limit, month, now, open_sessions):
+        if limit is None:
+            return None
+        return max(0.0, limit - self._used(user_id, month, now, open_sessions))
+
+    def _add(self, user_id, month, seconds):
+        key = (user_id, month)
+        self._pending[key] = self._pending.get(key, 0.0) + seconds
+
+    def _accrue(self, user_id, now, elapsed):
+        """Add a stretch of elapsed seconds ending at now to the user's counter."""
+        self._counter(user_id, None, month_key(now))
+        boundary = month_start(now)
+        if now - elapsed < boundary:
+            # The stretch started last month: split it at the boundary
+            self._add(user_id, month_key(now - elapsed), boundary - (now - elapsed))
+            self._add(user_id, month_key(now), now - boundary)
+        else:
+            self._add(user_id, month_key(now), elapsed)
+
+    def _close(self, usage_session_id, record, now):
+        self._closed.append({
+            'usage_session_id': usage_session_id,
+            'user_id': record['user_id'],
+            'started_at': datetime.fromtimestamp(record['started_at'], timezone.utc).isoformat(),
+            'ended_at': datetime.fromtimestamp(now, timezone.utc).isoformat(),
+            'month': month_key(record['started_at']),
+            'seconds': round(record['seconds'], 1),
+            'cost_usd': round(record['seconds'] / 60 * self.cost_per_minute, 4)
+        })
+
+    def _open_sessions(self, user_id, limit):
+        # Only needed for the remaining time of limited users
+        return [] if limit is None else self.sessions.for_user(user_id)
+
+    def _expire(self, now):
+        """Close sessions that stopped sending events, in whichever process opened them."""
+        expired = self.sessions.expire(now - self.session_timeout)
+        with self._lock:
+            for usage_session_id, record in expired:
+                # The client went away: it is charged as connected until the session timed out
+                ended_at = record['last_event'] + self.session_timeout
+                record['seconds'] += self.session_timeout
+                self._accrue(record['user_id'], ended_at, self.session_timeout)
+                self._close(usage_session_id, record, ended_at)
+                self._metrics['timed_out'] += 1
+
+    # Public API -----------------------------------------------------------
+
+    def check(self, user_id, profile):
+        """
+        Return the learner's remaining seconds this month (None if
+        unlimited), or raise QuotaExceeded. Uses only the in-memory counter,
+        the session store and the profile passed in.
+        """
+        now = self.clock()
+        month = month_key(now)
+        limit = limit_seconds(profile, now)
+        open_sessions = self._open_sessions(user_id, limit)
+        with self._lock:
+            self._counter(user_id, profile, month)
+            remaining = self._remaining(user_id, limit, month, now, open_sessions)
+            if remaining is not None and remaining <= 0:
+                self._metrics['rejected'] += 1
+                raise QuotaExceeded("Monthly voice minutes used up")
+        return remaining
+
+    def start_session(self, user_id, profile):
+        """
+        Open a metered session. Returns {"usage_session_id",
+        "remaining_seconds", "heartbeat_interval"} for the client.
+        """
+        now = self.clock()
+        month = month_key(now)
+        limit = limit_seconds(profile, now)
+        usage_session_id = uuid.uuid4().hex
+        open_sessions = self._open_sessions(user_id, limit)
+        with self._lock:
+            self._counter(user_id, profile, month)
+            remaining = self._remaining(user_id, limit, month, now, open_sessions)
+            self._metrics['events'] += 1
+        self.sessions.open(usage_session_id, {
+            'user_id': user_id, 'limit': limit, 'started_at': now, 'last_event': now, 'seconds': 0.0
+        })
+        self._ensure_flusher()
+        return {
+            'usage_session_id': usage_session_id,
+            'remaining_seconds': None if remaining is None else int(remaining),
+            'heartbeat_interval': self.heartbeat_interval
+        }
+
+    def _event(self, usage_session_id, end):
+        now = self.clock()
+        month = month_key(now)
+        # Any worker can take the event: the session lives in the shared store
+        advanced = self.sessions.advance(usage_session_id, now, self.session_timeout, end)
+        if advanced is None:
+            return None
+        record, elapsed = advanced
+        user_id, limit = record['user_id'], record['limit']
+        open_sessions = self._open_sessions(user_id, limit)
+        with self._lock:
+            self._accrue(user_id, now, elapsed)
+            self._metrics['events'] += 1
+            if end:
+                self._close(usage_session_id, record, now)
+            remaining = self._remaining(user_id, limit, month, now, open_sessions)
+        self._ensure_flusher()
+        return {
+            'remaining_seconds': None if remaining is None else int(remaining),
+            'limit_reached': remaining is not None and remaining <= 0
+        }
+
+    def heartbeat(self, usage_session_id):
+        """Meter the time since the last event. Returns None for unknown or timed-out sessions."""
+        return self._event(usage_session_id, end=False)
+
+    def end_session(self, usage_session_id):
+        """Meter the last stretch and close the session. Returns None if it is unknown."""
+        return self._event(usage_session_id, end=True)
+
+    # Flushing -------------------------------------------------------------
+
+    def _ensure_flusher(self):
+        """Start the flush thread in this process (again after a fork)."""
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid:
+            return
+        with self._lock:
+            if self._thread is None or self._thread_pid != pid:
+                self._thread = threading.Thread(target=self._flush_loop, name='usage-meter', daemon=True)
+                self._thread_pid = pid
+                self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                tracing.log_error('usage_meter_flush', e)
+
+    def flush(self):
+        """
+        Write pending seconds and finished sessions in one RPC call. On
+        failure everything is kept for the next flush.
+        """
+        with self._flush_lock:
+            # A process that never used the session store has nothing to expire
+            if self._sessions is not None:
+                try:
+                    self._expire(self.clock())
+                except Exception as e:
+                    # Still write what was metered; the next flush expires them
+                    tracing.log_error('usage_meter_expire', e)
+            with self._lock:
+                if not self._pending and not self._closed:
+                    return
+                batch, self._pending = self._pending, {}
+                sessions, self._closed = self._closed, []
+                self._inflight = dict(batch)
+
+            usage = [{'user_id': user_id, 'month': month, 'seconds': round(seconds, 1)}
+                     for (user_id, month), seconds in batch.items() if seconds > 0]
+            try:
+                resp = supabase.post(RECORD_USAGE_PATH, json={'usage': usage, 'sessions': sessions})
+                if resp.status_code != 200:
+                    raise RuntimeError(f"record_voice_usage failed: {resp.status_code} {resp.text[:200]}")
+                totals = resp.json()
+            except Exception:
+                with self._lock:
+                    for key, seconds in batch.items():
+                        self._pending[key] = self._pending.get(key, 0.0) + seconds
+                    self._closed = sessions + self._closed
+                    self._inflight = {}
+                    self._metrics['flush_errors'] += 1
+                raise
+
+            with self._lock:
+                # The returned totals include this batch and other workers' flushes
+                for row in totals:
+                    counter = self._counters.get(row['user_id'])
+                    if counter is not None and counter['month'] == row['month']:
+                        counter['base'] = float(row['seconds_used'] or 0)
+                self._inflight = {}
+                self._metrics['flushes'] += 1
+
+    def metrics(self):
+        open_sessions = self.sessions.count()
+        with self._lock:
+            return {
+                **self._metrics,
+                'enabled': self.enabled,
+                'open_sessions': open_sessions,
+                'pending_users': len(self._pending),
+                'pending_sessions': len(self._closed),
+                'counters': len(self._counters)
+            }
+
+
+# Shared instance for the whole process
+usage_meter = UsageMeter()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        usage_meter.flush()
+    except Exception as e:
+        tracing.log_error('usage_meter_flush', e, at_exit=True)
@@ -0,0 +1,524 @@
+"""
+In-process stand-ins for Supabase and OpenAI, for the benchmarks.
+
+FakeSupabase serves the subset of PostgREST (/rest/v1/<table>) and
+GoTrue (/auth/v1/user, /auth/v1/admin/users) that the backend uses, from
+in-memory tables. FakeOpenAI serves /v1/chat/completions (plain,
+streamed, and structured Can-Do analysis answers), /v1/embeddings and
+/v1/realtime/sessions.
+
+Both answer after an injected latency (seconds, with +/- jitter as a
+fraction of it) and count the calls they receive per endpoint group, so
+a benchmark can tell how many upstream round-trips its requests cost.
+"""
+
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+_LEVELS = ['A1', 'A2', 'B1', 'B2', 'C1', 'C2']
+
+
+class FakeServer:
+    """ThreadingHTTPServer on a free local port with latency and call counts."""
+
+    def __init__(self, latency=0.0, jitter=0.2):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = {}
+        self._calls_lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; without this, reused
+            # keep-alive connections wait ~40ms for a delayed ACK on each answer
+            disable_nagle_algorithm = True
+
+            def _dispatch(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                body = json.loads(raw) if raw else None
+                parts = urlsplit(self.path)
+                fake.count(fake.group(self.command, parts.path))
+                fake.handle(self, self.command, parts.path, parts.query, body)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _dispatch
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def wait(self, latency):
+        """Sleep for the injected latency, with jitter."""
+        if latency > 0:
+            time.sleep(max(0.0, latency * (1 + random.uniform(-self.jitter, self.jitter))))
+
+    def count(self, group):
+        with self._calls_lock:
+            self.calls[group] = self.calls.get(group, 0) + 1
+
+    def snapshot(self):
+        with self._calls_lock:
+            return dict(self.calls)
+
+    def group(self, method, path):
+        return f'{method} {path}'
+
+    def handle(self, handler, method, path, query, body):
+        raise NotImplementedError
+
+    def close(self):
+        self.server.shutdown()
+
+
+def send_json(handler, status, payload, headers=None):
+    data = json.dumps(payload).encode('utf-8')
+    handler.send_response(status)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Length', str(len(data)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(data)
+
+
+# ---------------------------------------------------------------------------
+# Supabase
+# ---------------------------------------------------------------------------
+
+def _parse_value(value):
+    if value == 'null':
+        return None
+    if value == 'true':
+        return True
+    if value == 'false':
+        return False
+    return value
+
+
+def _matches(row, column, condition):
+    op, _, value = condition.partition('.')
+    current = row.get(column)
+    if op == 'eq':
+        return str(current) == value if current is not None else False
+    if op == 'neq':
+        return str(current) != value
+    if op == 'in':
+        return str(current) in value.strip('()').split(',')
+    if op == 'is':
+        return current is _parse_value(value)
+    if op == 'not' and value.startswith('is.'):
+        return current is not _parse_value(value[3:])
+    if op in ('gt', 'gte', 'lt', 'lte'):
+        if current is None:
+            return False
+        return {'gt': current > value, 'gte': current >= value,
+                'lt': current < value, 'lte': current <= value}[op]
+    raise ValueError(f'Unsupported filter {column}={condition}')
+
+
+class FakeSupabase(FakeServer):
+    """PostgREST and GoTrue subset backed by in-memory tables."""
+
+    RESERVED = {'select', 'order', 'limit', 'offset', 'on_conflict'}
+
+    def __init__(self, latency=0.0, jitter=0.2):
+        self.tables = {}
+        self.auth_users = []
+        self._lock = threading.Lock()
+        super().__init__(latency, jitter)
+
+    def group(self, method, path):
+        if path.startswith('/rest/v1/'):
+            return f"rest.{path[len('/rest/v1/'):].split('/')[0]}.{'read' if method == 'GET' else 'write'}"
+        if path.startswith('/auth/v1/admin'):
+            return 'auth.admin'
+        return 'auth.user' if path.startswith('/auth/v1') else 'other'
+
+    # Seeding --------------------------------------------------------------
+
+    def seed(self, statements_path, users=100, achievements_per_user=20, seed=0):
+        """
+        Load the Can-Do statements from statements_path and create users
+        (the first one is an admin) with profiles and achievements.
+        """
+        rng = random.Random(seed)
+        with open(statements_path, 'r', encoding='utf-8') as f:
+            source = json.load(f)
+        now = datetime.now(timezone.utc)
+        statements = []
+        for order, row in enumerate(source, start=1):
+            statements.append({
+                'id': str(uuid.UUID(hashlib.md5(f"{row['level']}|{row['descriptor']}".encode()).hexdigest())),
+                'level': row['level'],
+                'skill_type': row.get('skill_type'),
+                'mode': row.get('mode'),
+                'activity': row.get('activity'),
+                'scale': row.get('scale'),
+                'descriptor': row['descriptor'],
+                'keywords': [],
+                'display_order': order,
+                'updated_at': now.isoformat()
+            })
+
+        profiles, achievements = [], []
+        for i in range(users):
+            user_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            created_at = (now - timedelta(days=users - i)).isoformat()
+            self.auth_users.append({
+                'id': user_id,
+                'email': f'learner{i:05d}@example.com',
+                'created_at': created_at,
+                'email_confirmed_at': created_at,
+                'role': 'authenticated'
+            })
+            profiles.append({
+                'id': user_id,
+                'email': f'learner{i:05d}@example.com',
+                'full_name': f'Learner {i}',
+                'cefr_level': rng.choice(_LEVELS[:4]),
+                'tier': rng.choice(['free', 'premium']),
+                'is_admin': i == 0,
+                'voice_preference': rng.choice(['sage', 'sage', 'alloy']),
+                'monthly_voice_seconds_used': 0,
+                'last_usage_reset': now.isoformat(),
+                'created_at': created_at
+            })
+            for stmt in rng.sample(statements, min(achievements_per_user, len(statements))):
+                achievements.append({
+                    'user_id': user_id,
+                    'cando_id': stmt['id'],
+                    'session_id': None,
+                    'admin_approved': rng.random() < 0.3,
+                    'achieved_at': (now - timedelta(minutes=rng.randint(0, 100000))).isoformat(),
+                    'detected_by': 'ai_automatic',
+                    'confidence_score': round(rng.uniform(0.6, 1.0), 2),
+                    'evidence_text': 'seeded'
+                })
+
+        self.tables = {
+            'cando_statements': statements,
+            'profiles': profiles,
+            'user_cando_achievements': achievements,
+            'session_cando_analysis': []
+        }
+
+    # PostgREST ------------------------------------------------------------
+
+    def _select(self, rows, params):
+        select = params.get('select', '*')
+        if select == '*':
+            return [dict(row) for row in rows]
+        columns = select.split(',')
+        return [{c: row.get(c) for c in columns} for row in rows]
+
+    def _filter(self, rows, params):
+        filters = [(k, v) for k, v in params.items() if k not in self.RESERVED]
+        return [row for row in rows if all(_matches(row, k, v) for k, v in filters)]
+
+    def _rest(self, handler, method, table, params, body):
+        if table not in self.tables:
+            return send_json(handler, 404, {'message': f'relation "{table}" does not exist'})
+        prefer = handler.headers.get('Prefer', '')
+
+        if method == 'GET':
+            with self._lock:
+                rows = self._filter(self.tables[table], params)
+            total = len(rows)
+            for clause in reversed([c for c in params.get('order', '').split(',') if c]):
+                column, *flags = clause.split('.')
+                descending = 'desc' in flags
+                nulls_last = 'nullslast' in flags or ('nullsfirst' not in flags and not descending)
+                present = [r for r in rows if r.get(column) is not None]
+                missing = [r for r in rows if r.get(column) is None]
+                present.sort(key=lambda r: r[column], reverse=descending)
+                rows = present + missing if nulls_last else missing + present
+            offset = int(params.get('offset', 0))
+            rows = rows[offset:offset + int(params['limit'])] if 'limit' in params else rows[offset:]
+            headers = {}
+            if 'count=exact' in prefer:
+                end = offset + len(rows) - 1
+                headers['Content-Range'] = f'{offset}-{end}/{total}' if rows else f'*/{total}'
+            return send_json(handler, 200, self._select(rows, params), headers)
+
+        if method == 'POST':
+            return self._insert(handler, table, params, prefer, body)
+
+        if method in ('PATCH', 'DELETE'):
+            with self._lock:
+                matched = self._filter(self.tables[table], params)
+                if method == 'PATCH':
+                    for row in matched:
+                        row.update(body)
+                else:
+                    ids = {id(row) for row in matched}
+                    self.tables[table] = [row for row in self.tables[table] if id(row) not in ids]
+            if 'return=representation' in prefer:
+                return send_json(handler, 200, self._select(matched, params))
+            return send_json(handler, 204 if method == 'DELETE' else 200, [])
+
+        return send_json(handler, 405, {'message': 'Method not allowed'})
+
+    def _insert(self, handler, table, params, prefer, body):
+        rows = body if isinstance(body, list) else [body]
+        conflict = [c for c in params.get('on_conflict', '').split(',') if c]
+        inserted = []
+        with self._lock:
+            existing = {}
+            if conflict:
+                existing = {tuple(r.get(c) for c in conflict): r for r in self.tables[table]}
+            for row in rows:
+                row = dict(row)
+                key = tuple(row.get(c) for c in conflict)
+                current = existing.get(key) if conflict else None
+                if current is not None:
+                    if 'merge-duplicates' in prefer:
+                        current.update(row)
+                        inserted.append(current)
+                    continue
+                row.setdefault('id', str(uuid.uuid4()))
+                row.setdefault('achieved_at', datetime.now(timezone.utc).isoformat())
+                self.tables[table].append(row)
+                if conflict:
+                    existing[key] = row
+                inserted.append(row)
+        if 'return=representation' in prefer:
+            return send_json(handler, 201, self._select(inserted, params))
+        return send_json(handler, 201, [])
+
+    def _record_voice_usage(self, handler, body):
+        """The record_voice_usage RPC (ADD_VOICE_USAGE_METERING.sql), without the month rollover."""
+        month = datetime.now(timezone.utc).strftime('%Y-%m')
+        with self._lock:
+            profiles = {p['id']: p for p in self.tables['profiles']}
+            for item in body.get('usage', []):
+                profile = profiles.get(item['user_id'])
+                if profile is not None and item['month'] == month:
+                    profile['monthly_voice_seconds_used'] = profile.get('monthly_voice_seconds_used', 0) + item['seconds']
+            self.tables.setdefault('usage_logs', []).extend(body.get('sessions', []))
+            totals = [{'user_id': user_id, 'month': month,
+                       'seconds_used': profiles[user_id].get('monthly_voice_seconds_used', 0)}
+                      for user_id in {item['user_id'] for item in body.get('usage', [])} if user_id in profiles]
+        return send_json(handler, 200, totals)
+
+    # GoTrue ---------------------------------------------------------------
+
+    def _auth_user(self, handler):
+        token = handler.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        try:
+            payload = token.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        except (IndexError, ValueError):
+            return send_json(handler, 401, {'message': 'invalid JWT'})
+        user = next((u for u in self.auth_users if u['id'] == claims.get('sub')), None)
+        if user is None:
+            return send_json(handler, 401, {'message': 'user not found'})
+        return send_json(handler, 200, user)
+
+    def _admin_users(self, handler, params):
+        page = int(params.get('page', 1))
+        per_page = int(params.get('per_page', 50))
+        users = self.auth_users
+        if params.get('filter'):
+            users = [u for u in users if params['filter'].lower() in u['email']]
+        return send_json(handler, 200, {'users': users[(page - 1) * per_page:page * per_page]})
+
+    def _create_admin_user(self, handler, body):
+        with self._lock:
+            if any(u['email'] == body.get('email') for u in self.auth_users):
+                return send_json(handler, 422, {'msg': 'A user with this email address has already been registered'})
+            now = datetime.now(timezone.utc).isoformat()
+            user = {'id': str(uuid.uuid4()), 'email': body.get('email'), 'created_at': now,
+                    'email_confirmed_at': now if body.get('email_confirm') else None, 'role': 'authenticated'}
+            self.auth_users.append(user)
+        return send_json(handler, 200, user)
+
+    def handle(self, handler, method, path, query, body):
+        self.wait(self.latency)
+        params = dict(parse_qsl(query, keep_blank_values=True))
+        if path == '/rest/v1/rpc/record_voice_usage' and method == 'POST':
+            return self._record_voice_usage(handler, body)
+        if path.startswith('/rest/v1/'):
+            return self._rest(handler, method, unquote(path[len('/rest/v1/'):]), params, body)
+        if path == '/auth/v1/user':
+            return self._auth_user(handler)
+        if path == '/auth/v1/admin/users' and method == 'GET':
+            return self._admin_users(handler, params)
+        if path == '/auth/v1/admin/users' and method == 'POST':
+            return self._create_admin_user(handler, body)
+        return send_json(handler, 404, {'message': 'not found'})
+
+
+# ---------------------------------------------------------------------------
+# OpenAI
+# ---------------------------------------------------------------------------
+
+_BRACKETED_ID = re.compile(r'\[([0-9a-f-]{36})\]')
+_WORD = re.compile(r"[a-z']+")
+
+EMBEDDING_DIM = 64
+
+
+def fake_embedding(text):
+    """Bag of hashed words, so texts that share words get similar vectors."""
+    vector = [0.0] * EMBEDDING_DIM
+    for word in _WORD.findall(text.lower()):
+        digest = hashlib.md5(word.encode()).digest()
+        vector[digest[0] % EMBEDDING_DIM] += 1.0 if digest[1] % 2 else -1.0
+    return vector
+
+
+class FakeOpenAI(FakeServer):
+    """
+    Chat completions, embeddings and Realtime sessions. inject() makes a
+    share of the chat calls (for one model, or all) fail or slow down.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.2, realtime_latency=None, session_ttl=60,
+                 detections=3, stream_chunk_delay=0.0):
+        self.realtime_latency = latency if realtime_latency is None else realtime_latency
+        self.session_ttl = session_ttl
+        self.detections = detections
+        self.stream_chunk_delay = stream_chunk_delay
+        self.faults = {}  # model (None: any model) -> fault settings
+        super().__init__(latency, jitter)
+
+    def inject(self, model=None, error_rate=0.0, status=500, slow_rate=0.0, slow_latency=0.0):
+        """
+        Fail error_rate of the chat calls with `status`, and delay slow_rate
+        of them by slow_latency extra seconds (before the first byte, also
+        for streams). Call with no rates to clear the model's faults.
+        """
+        if error_rate or slow_rate:
+            self.faults[model] = {'error_rate': error_rate, 'status': status,
+                                  'slow_rate': slow_rate, 'slow_latency': slow_latency}
+        else:
+            self.faults.pop(model, None)
+
+    def _fault(self, handler, model):
+        """Apply the model's faults; returns True if an error was sent."""
+        fault = self.faults.get(model) or self.faults.get(None)
+        if not fault:
+            return False
+        if random.random() < fault['slow_rate']:
+            self.count('chat_slow')
+            time.sleep(fault['slow_latency'])
+        if random.random() < fault['error_rate']:
+            self.count('chat_errors')
+            send_json(handler, fault['status'], {'error': {
+                'message': f'Injected error for {model}', 'type': 'server_error', 'code': None
+            }})
+            return True
+        return False
+
+    def group(self, method, path):
+        return {
+            '/v1/chat/completions': 'chat',
+            '/v1/embeddings': 'embeddings',
+            '/v1/realtime/sessions': 'realtime_sessions'
+        }.get(path, 'other')
+
+    def _answer(self, body):
+        """Content of the reply: detections for analysis prompts, a sentence otherwise."""
+        response_format = body.get('response_format') or {}
+        if response_format.get('type') != 'json_schema':
+            last = body['messages'][-1]['content']
+            return f"That's great! Tell me more about {' '.join(last.split()[:6])}."
+        schema = response_format['json_schema']['schema']
+        candidate_ids = schema['properties']['detected_achievements']['items']['properties']['cando_id'].get('enum')
+        if not candidate_ids:
+            candidate_ids = _BRACKETED_ID.findall(body['messages'][-1]['content'])
+        rng = random.Random(hashlib.md5(body['messages'][-1]['content'].encode()).hexdigest())
+        picked = rng.sample(candidate_ids, min(self.detections, len(candidate_ids)))
+        return json.dumps({'detected_achievements': [
+            {'cando_id': cando_id, 'confidence': round(rng.uniform(0.65, 0.95), 2),
+             'evidence': 'The learner described their weekend plans in detail.'}
+            for cando_id in picked
+        ]})
+
+    def _chat(self, handler, body):
+        self.wait(self.latency)
+        if self._fault(handler, body.get('model')):
+            return
+        content = self._answer(body)
+        prompt_tokens = sum(len(m['content']) for m in body['messages']) // 4
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4,
+                 'total_tokens': prompt_tokens + len(content) // 4}
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:12]}'
+        if not body.get('stream'):
+            return send_json(handler, 200, {
+                'id': completion_id, 'object': 'chat.completion', 'created': int(time.time()),
+                'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                             'finish_reason': 'stop'}],
+                'usage': usage
+            })
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+
+        def event(choices, **extra):
+            chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': body.get('model'), 'choices': choices, **extra}
+            handler.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            handler.wfile.flush()
+
+        pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+        for piece in pieces:
+            event([{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}])
+            if self.stream_chunk_delay:
+                time.sleep(self.stream_chunk_delay)
+        event([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if (body.get('stream_options') or {}).get('include_usage'):
+            event([], usage=usage)
+        handler.wfile.write(b'data: [DONE]\n\n')
+        handler.wfile.flush()
+        handler.close_connection = True
+
+    def _embeddings(self, handler, body):
+        self.wait(self.latency)
+        texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+        send_json(handler, 200, {
+            'object': 'list',
+            'model': body.get('model'),
+            'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text)}
+                     for i, text in enumerate(texts)],
+            'usage': {'prompt_tokens': sum(len(t) for t in texts) // 4, 'total_tokens': 0}
+        })
+
+    def _realtime_session(self, handler, body):
+        self.wait(self.realtime_latency)
+        send_json(handler, 200, {
+            'id': f'sess_{uuid.uuid4().hex[:12]}',
+            'object': 'realtime.session',
+            'model': body.get('model'),
+            'voice': body.get('voice'),
+            'client_secret': {'value': f'ek_{uuid.uuid4().hex}', 'expires_at': int(time.time() + self.session_ttl)}
+        })
+
+    def handle(self, handler, method, path, query, body):
+        if method == 'POST' and path == '/v1/chat/completions':
+            return self._chat(handler, body)
+        if method == 'POST' and path == '/v1/embeddings':
+            return self._embeddings(handler, body)
+        if method == 'POST' and path == '/v1/realtime/sessions':
+            return self._realtime_session(handler, body)
+        return send_json(handler, 404, {'error': {'message': f'Unknown path {path}'}})
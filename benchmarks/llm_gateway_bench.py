@@ -0,0 +1,194 @@
+"""
+Fault-injection report for the OpenAI gateway (app/llm_gateway.py).
+
+Starts FakeOpenAI (benchmarks/fakes.py) with --latency seconds per chat
+call, points the openai module at it and runs three scenarios against
+fresh gateways:
+
+    tail      --slow-rate of the chat calls take --slow-latency seconds
+              longer. Runs --requests chat calls at --concurrency with
+              hedging off, then on (after --warmup calls to learn the
+              p95), and compares the latency percentiles and the extra
+              upstream calls hedging costs.
+    outage    every call to the analysis model fails with a 500. Runs
+              streamed analysis calls and reports how many went to the
+              fallback model, how often the breaker opened and how many
+              calls still reached the failing model.
+    deadline  every call is slower than --deadline. Reports how long the
+              callers waited before the gateway gave up.
+
+Usage (from the repository root):
+    python benchmarks/llm_gateway_bench.py [--requests 200] [--concurrency 8]
+                                           [--latency 0.2] [--slow-rate 0.02]
+                                           [--slow-latency 2] [--deadline 1]
+                                           [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import FakeOpenAI  # noqa: E402
+
+CHAT_MODEL = 'gpt-4o-mini'
+ANALYSIS_MODEL = 'gpt-4o'
+
+MESSAGES = [
+    {'role': 'system', 'content': 'You are a friendly English tutor.'},
+    {'role': 'user', 'content': 'I went to the beach last weekend with my family.'}
+]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def latency_report(latencies):
+    return {
+        'p50': round(percentile(latencies, 50) * 1000, 1),
+        'p95': round(percentile(latencies, 95) * 1000, 1),
+        'p99': round(percentile(latencies, 99) * 1000, 1),
+        'max': round(max(latencies) * 1000, 1)
+    }
+
+
+def drive(call, requests, concurrency):
+    """
+    Run call() requests times. Returns (seconds per call, failed calls
+    by exception type).
+    """
+    def timed(_):
+        start = time.perf_counter()
+        try:
+            call()
+        except Exception as e:
+            return time.perf_counter() - start, type(e).__name__
+        return time.perf_counter() - start, None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(requests)))
+    errors = {}
+    for _, error in results:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+    return [seconds for seconds, _ in results], errors
+
+
+def upstream_calls(gateway, model):
+    calls = gateway.metrics()['calls']
+    return sum(entry['ok'] + entry['errors'] + entry['timeouts']
+               for key, entry in calls.items() if key.split('/')[0] == model)
+
+
+def run_tail(llm_gateway, fake, args):
+    fake.inject(CHAT_MODEL, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    reports = []
+    for hedge in (False, True):
+        gateway = llm_gateway.LLMGateway(hedge_enabled=hedge, hedge_min_samples=args.warmup)
+
+        def call():
+            gateway.chat('chat', CHAT_MODEL, MESSAGES, deadline=args.slow_latency * 4, hedge=True)
+
+        drive(call, args.warmup, 1)
+        warm_calls = upstream_calls(gateway, CHAT_MODEL)
+        latencies, errors = drive(call, args.requests, args.concurrency)
+        entry = gateway.metrics()['calls'][f'{CHAT_MODEL}/chat']
+        reports.append({
+            'scenario': 'tail',
+            'hedging': hedge,
+            'latency_ms': latency_report(latencies),
+            'errors': errors,
+            'upstream_calls_per_request': round((upstream_calls(gateway, CHAT_MODEL) - warm_calls) / args.requests, 3),
+            'hedges': entry['hedges'],
+            'hedge_wins': entry['hedge_wins'],
+            'hedge_delay_ms': entry['hedge_delay_ms']
+        })
+    fake.inject(CHAT_MODEL)
+    return reports
+
+
+def run_outage(llm_gateway, fake, args):
+    fake.inject(ANALYSIS_MODEL, error_rate=1.0, status=500)
+    gateway = llm_gateway.LLMGateway(fallbacks=f'{ANALYSIS_MODEL}:{CHAT_MODEL}', breaker_cooldown=60)
+
+    def call():
+        stream = gateway.stream('analysis', ANALYSIS_MODEL, MESSAGES, deadline=30)
+        try:
+            for _ in stream:
+                pass
+        finally:
+            stream.close()
+
+    latencies, errors = drive(call, args.requests, args.concurrency)
+    metrics = gateway.metrics()
+    fake.inject(ANALYSIS_MODEL)
+    return [{
+        'scenario': 'outage',
+        'latency_ms': latency_report(latencies) if latencies else None,
+        'errors': errors,
+        'answered_by_fallback': metrics['calls'].get(f'{CHAT_MODEL}/analysis', {}).get('ok', 0),
+        'calls_to_failing_model': upstream_calls(gateway, ANALYSIS_MODEL),
+        'breaker_opened': metrics['breakers'][ANALYSIS_MODEL]['opened'],
+        'breaker_rejections': metrics['calls'][f'{ANALYSIS_MODEL}/analysis']['rejected']
+    }]
+
+
+def run_deadline(llm_gateway, fake, args):
+    fake.inject(None, slow_rate=1.0, slow_latency=args.deadline * 3)
+    gateway = llm_gateway.LLMGateway(fallbacks='')
+
+    def call():
+        gateway.chat('chat', CHAT_MODEL, MESSAGES, deadline=args.deadline)
+
+    # Few calls: each one holds a fake server thread for the whole slow answer
+    requests = max(args.concurrency, args.requests // 20)
+    waits, errors = drive(call, requests, args.concurrency)
+    fake.inject(None)
+    return [{
+        'scenario': 'deadline',
+        'deadline_ms': args.deadline * 1000,
+        'requests': requests,
+        'errors': errors,
+        'wait_ms': latency_report(waits)
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='calls per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=40, help='calls that teach the gateway the latency')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per fake chat call')
+    parser.add_argument('--slow-rate', type=float, default=0.02, help='share of slow calls in the tail scenario')
+    parser.add_argument('--slow-latency', type=float, default=2.0, help='extra seconds for a slow call')
+    parser.add_argument('--deadline', type=float, default=1.0, help='call deadline in the deadline scenario')
+    parser.add_argument('--output', help='Write the report as JSON to this file')
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(latency=args.latency, jitter=0.2)
+    os.environ.update({'OPENAI_API_KEY': 'sk-fake', 'OPENAI_API_BASE': f'{fake.url}/v1'})
+    # Only the gateway is measured here, not the model concurrency caps
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    os.environ.setdefault('TRACE_LOG_SAMPLE_RATE', '0')
+    import llm_gateway  # noqa: E402  (the openai module reads OPENAI_API_BASE at import)
+
+    reports = run_tail(llm_gateway, fake, args) + run_outage(llm_gateway, fake, args) + run_deadline(llm_gateway, fake, args)
+    for report in reports:
+        print(json.dumps(report))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
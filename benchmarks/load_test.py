@@ -0,0 +1,345 @@
+"""
+Throughput and latency report for the backend's main routes.
+
+Starts FakeSupabase and FakeOpenAI (benchmarks/fakes.py) with the given
+injected latencies, seeds Supabase with the statements from
+cefr_statements_filtered.json and --users learners (the first one an
+admin), points the app at the fakes and serves it on a local port. Then
+it drives each scenario with --requests requests at --concurrency:
+
+    chat_text       POST /chat_text (each client keeps its own conversation)
+    webrtc_session  POST /webrtc_session (two in three with a topic)
+    users_cando     GET /users/<id>/cando with the learner's own token
+    analyze_session POST /analyze_session with a new transcript each time
+    admin_users     GET /admin/users?limit=50 with the admin's token
+
+For each scenario it reports requests per second, latency percentiles,
+errors, and upstream calls per request, counted two ways:
+- in_request: spans listed in the app's Server-Timing header (the calls
+  the request itself waited for)
+- total: calls the fakes received during the scenario divided by the
+  requests, which includes background work (job workers, pool refills,
+  catalog refreshes)
+
+--output saves the report as JSON; --compare prints the change against a
+report saved earlier, e.g. from another commit.
+
+Usage (from the repository root):
+    python benchmarks/load_test.py [--scenarios chat_text,users_cando]
+                                   [--requests 200] [--concurrency 8]
+                                   [--supabase-latency 0.03] [--openai-latency 0.5]
+                                   [--realtime-latency 1.5] [--remote-auth] [--rate-limits]
+                                   [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import FakeOpenAI, FakeSupabase  # noqa: E402
+
+STATEMENTS = os.path.join(ROOT, 'cefr_statements_filtered.json')
+
+SCENARIOS = ['chat_text', 'webrtc_session', 'users_cando', 'analyze_session', 'admin_users']
+
+JWT_SECRET = 'load-test-secret'
+
+# Server-Timing spans that are upstream round-trips
+UPSTREAM_PREFIXES = ('supabase.', 'llm.', 'realtime.session_create')
+
+TOPICS = [
+    {'title': 'Ordering Coffee', 'description': 'Practice ordering at a cafe'},
+    {'title': 'Job Interview', 'description': 'Answer common interview questions'},
+    None
+]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def configure_environment(args, supabase, openai_fake, workdir):
+    """Point the app at the fakes. Must run before the app modules are imported."""
+    os.environ.update({
+        'SUPABASE_URL': supabase.url,
+        'SUPABASE_SERVICE_ROLE_KEY': 'service-role-key',
+        'SUPABASE_JWT_SECRET': JWT_SECRET,
+        'AUTH_VERIFY_REMOTE': '1' if args.remote_auth else '0',
+        # Every simulated client shares one IP, which the per-IP limits would throttle
+        'RATE_LIMIT_ENABLED': '1' if args.rate_limits else '0',
+        'OPENAI_API_KEY': 'sk-fake',
+        'OPENAI_API_BASE': f'{openai_fake.url}/v1',
+        'OPENAI_REALTIME_SESSIONS_URL': f'{openai_fake.url}/v1/realtime/sessions',
+        'ANALYSIS_CACHE_DB': os.path.join(workdir, 'analysis_cache.db'),
+        'ANALYSIS_JOBS_DB': os.path.join(workdir, 'analysis_jobs.db'),
+        'CONVERSATION_DB': os.path.join(workdir, 'conversations.db'),
+        'USAGE_SESSION_DB': os.path.join(workdir, 'usage_sessions.db'),
+        'CANDO_INDEX_DIR': workdir,
+        'TRACE_SERVER_TIMING': '1',
+    })
+    # Keep the console for the report; errors are still logged
+    os.environ.setdefault('TRACE_LOG_SAMPLE_RATE', '0')
+    os.environ.setdefault('TRACE_SLOW_MS', '600000')
+
+
+def serve(app):
+    from werkzeug.serving import make_server
+    # No access log line per request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def make_transcript(rng, statements, turns, marker):
+    lines = [f'Assistant: Hi! What would you like to talk about today? ({marker})']
+    for stmt in rng.sample(statements, turns):
+        lines.append(f"User: {stmt['descriptor']}")
+        lines.append('Assistant: Interesting, can you tell me more about that?')
+    return '\n'.join(lines)
+
+
+class Scenarios:
+    """Builds the request for each scenario, given the request index."""
+
+    def __init__(self, base_url, supabase, args):
+        from auth import encode_hs256
+
+        self.base_url = base_url
+        self.args = args
+        self.statements = supabase.tables['cando_statements']
+        self.users = [u['id'] for u in supabase.auth_users]
+        expires = int(time.time()) + 24 * 3600
+        self.tokens = {
+            user_id: encode_hs256({'sub': user_id, 'exp': expires, 'role': 'authenticated'}, JWT_SECRET)
+            for user_id in self.users
+        }
+        self.admin_token = self.tokens[self.users[0]]
+
+    def _auth(self, user_id):
+        return {'Authorization': f'Bearer {self.tokens[user_id]}'}
+
+    def chat_text(self, i):
+        return 'POST', '/chat_text', {'json': {'text': f'Message {i}: I went to the market and bought some apples.'}}
+
+    def webrtc_session(self, i):
+        user_id = self.users[i % len(self.users)]
+        body = {'user_id': user_id}
+        topic = TOPICS[i % len(TOPICS)]
+        if topic:
+            body['topic'] = topic
+        return 'POST', '/webrtc_session', {'headers': self._auth(user_id), 'json': body}
+
+    def users_cando(self, i):
+        user_id = self.users[i % len(self.users)]
+        return 'GET', f'/users/{user_id}/cando', {'headers': self._auth(user_id)}
+
+    def analyze_session(self, i):
+        user_id = self.users[i % len(self.users)]
+        session_id = str(uuid.uuid4())
+        transcript = make_transcript(random.Random(i), self.statements, self.args.transcript_turns, session_id)
+        return 'POST', '/analyze_session', {
+            'headers': self._auth(user_id),
+            'json': {'session_id': session_id, 'user_id': user_id, 'transcript': transcript}
+        }
+
+    def admin_users(self, i):
+        return 'GET', '/admin/users?limit=50', {'headers': {'Authorization': f'Bearer {self.admin_token}'}}
+
+
+def parse_server_timing(header):
+    """{span name: count} from a Server-Timing header written by tracing.py."""
+    spans = {}
+    for entry in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, *params = entry.split(';')
+        count = 1
+        for param in params:
+            if param.startswith('desc="x'):
+                count = int(param[len('desc="x'):-1])
+        if name != 'total':
+            spans[name] = count
+    return spans
+
+
+def run_scenario(name, scenarios, fakes, args):
+    build = getattr(scenarios, name)
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    def call(i):
+        method, path, kwargs = build(i)
+        start = time.perf_counter()
+        try:
+            resp = client().request(method, scenarios.base_url + path, timeout=args.timeout, **kwargs)
+        except requests.RequestException as e:
+            return (time.perf_counter() - start) * 1000, f'{type(e).__name__}', {}
+        return (time.perf_counter() - start) * 1000, resp.status_code, parse_server_timing(resp.headers.get('Server-Timing'))
+
+    for i in range(args.warmup):
+        call(-1 - i)
+
+    before = {fake_name: fake.snapshot() for fake_name, fake in fakes.items()}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(call, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    # Let background work started by the last requests reach the fakes
+    time.sleep(args.settle)
+
+    latencies = [ms for ms, _, _ in results]
+    statuses = {}
+    span_calls = {}
+    for _, status, spans in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        for span, count in spans.items():
+            if span.startswith(UPSTREAM_PREFIXES):
+                span_calls[span] = span_calls.get(span, 0) + count
+
+    total_calls = {}
+    for fake_name, fake in fakes.items():
+        after = fake.snapshot()
+        for group, count in after.items():
+            delta = count - before[fake_name].get(group, 0)
+            if delta:
+                total_calls[f'{fake_name}.{group}'] = round(delta / args.requests, 2)
+
+    errors = sum(count for status, count in statuses.items() if not status.startswith(('2', '3')))
+    return {
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'errors': errors,
+        'statuses': statuses,
+        'rps': round(args.requests / elapsed, 2),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+            'max': round(max(latencies), 2),
+            'mean': round(statistics.mean(latencies), 2)
+        },
+        'upstream_calls_per_request': {
+            'in_request': round(sum(span_calls.values()) / args.requests, 2),
+            'in_request_by_span': {span: round(count / args.requests, 2) for span, count in sorted(span_calls.items())},
+            'total': round(sum(total_calls.values()), 2),
+            'total_by_endpoint': dict(sorted(total_calls.items()))
+        }
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    for name, result in report['scenarios'].items():
+        lat = result['latency_ms']
+        calls = result['upstream_calls_per_request']
+        print(f"{name:>16}: {result['rps']:>8} req/s  p50 {lat['p50']:>8} ms  p95 {lat['p95']:>8} ms  "
+              f"p99 {lat['p99']:>8} ms  errors {result['errors']:>3}  "
+              f"upstream/req {calls['in_request']} in request, {calls['total']} total")
+
+
+def print_comparison(report, baseline):
+    print(f"\nChange against {baseline.get('commit') or 'baseline'}:")
+    for name, result in report['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if not old:
+            continue
+
+        def change(new_value, old_value):
+            return f'{(new_value - old_value) / old_value * 100:+.1f}%' if old_value else 'n/a'
+
+        lat, old_lat = result['latency_ms'], old['latency_ms']
+        print(f"{name:>16}: req/s {change(result['rps'], old['rps'])}  "
+              f"p50 {change(lat['p50'], old_lat['p50'])}  p95 {change(lat['p95'], old_lat['p95'])}  "
+              f"p99 {change(lat['p99'], old_lat['p99'])}  upstream/req "
+              f"{old['upstream_calls_per_request']['total']} -> {result['upstream_calls_per_request']['total']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated, default all')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests before each scenario')
+    parser.add_argument('--users', type=int, default=100, help='learners seeded in the fake Supabase')
+    parser.add_argument('--achievements', type=int, default=20, help='seeded achievements per learner')
+    parser.add_argument('--transcript-turns', type=int, default=20, help='learner turns per analyzed transcript')
+    parser.add_argument('--supabase-latency', type=float, default=0.03, help='seconds per Supabase call')
+    parser.add_argument('--openai-latency', type=float, default=0.5, help='seconds per chat/embedding call')
+    parser.add_argument('--realtime-latency', type=float, default=1.5, help='seconds per Realtime session')
+    parser.add_argument('--jitter', type=float, default=0.2, help='latency jitter as a fraction')
+    parser.add_argument('--remote-auth', action='store_true', help='verify tokens through /auth/v1/user')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the rate limits and model concurrency caps on (429s count as errors)')
+    parser.add_argument('--timeout', type=float, default=120, help='client timeout per request (seconds)')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds to wait after a scenario before reading the fakes\' call counts')
+    parser.add_argument('--output', help='Write the report as JSON to this file')
+    parser.add_argument('--compare', help='JSON report from an earlier run to compare against')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    supabase = FakeSupabase(args.supabase_latency, args.jitter)
+    supabase.seed(STATEMENTS, users=args.users, achievements_per_user=args.achievements)
+    openai_fake = FakeOpenAI(args.openai_latency, args.jitter, realtime_latency=args.realtime_latency)
+
+    with tempfile.TemporaryDirectory(prefix='load_test_') as workdir:
+        configure_environment(args, supabase, openai_fake, workdir)
+        from app import app  # noqa: E402  (reads the environment at import)
+
+        server, base_url = serve(app)
+        scenarios = Scenarios(base_url, supabase, args)
+        fakes = {'supabase': supabase, 'openai': openai_fake}
+
+        report = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'config': vars(args),
+            'scenarios': {}
+        }
+        for name in names:
+            report['scenarios'][name] = run_scenario(name, scenarios, fakes, args)
+        server.shutdown()
+
+    print_report(report)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print_comparison(report, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
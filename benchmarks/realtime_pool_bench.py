@@ -0,0 +1,112 @@
+"""
+Time-to-token report for the Realtime session pool.
+
+Starts a local fake of POST /v1/realtime/sessions that answers after
+--create-latency seconds with sessions expiring --ttl seconds later,
+points app/realtime_pool.py at it, and requests --requests voice
+sessions --interval seconds apart (every other one with a topic), once
+with the pool and once creating every session on demand. Reports the
+pool hit rate, time to token and the number of sessions created
+upstream. Also checks that topic requests on pooled sessions come back
+with a session.update event.
+
+Usage (from the repository root):
+    python benchmarks/realtime_pool_bench.py [--requests 20] [--interval 0.5]
+                                             [--create-latency 1.5] [--ttl 60]
+                                             [--pool-size 2] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import FakeOpenAI  # noqa: E402
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def sessions_created(fake):
+    return fake.snapshot().get('realtime_sessions', 0)
+
+
+def run(realtime_pool, fake, pooled, args):
+    pool = realtime_pool.RealtimeSessionPool(size=args.pool_size, enabled=pooled, refill_interval=1.0)
+    topic = {'title': 'Ordering Coffee', 'description': 'Practice ordering at a cafe'}
+    created_before = sessions_created(fake)
+
+    if pooled:
+        # Let the warm voice fill up, as after the first request of the day
+        pool.acquire('sage')
+        time.sleep(args.create_latency * args.pool_size + 1.5)
+
+    latencies = []
+    hits = 0
+    missing_updates = 0
+    for i in range(args.requests):
+        with_topic = i % 2 == 1
+        hits_before = pool.metrics()['hits']
+        start = time.perf_counter()
+        session = pool.acquire('sage', topic if with_topic else None)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hit = pool.metrics()['hits'] > hits_before
+        hits += hit
+        if hit and with_topic and session['session_update'] is None:
+            missing_updates += 1
+        time.sleep(args.interval)
+
+    return {
+        'mode': 'pool' if pooled else 'on_demand',
+        'requests': args.requests,
+        'hit_rate': round(hits / args.requests, 3),
+        'time_to_token_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'max': round(max(latencies), 2),
+            'mean': round(statistics.mean(latencies), 2)
+        },
+        'upstream_sessions_created': sessions_created(fake) - created_before,
+        'topic_requests_without_update': missing_updates
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between session requests')
+    parser.add_argument('--create-latency', type=float, default=1.5, help='seconds the fake takes per session')
+    parser.add_argument('--ttl', type=int, default=60, help='seconds until a fake client_secret expires')
+    parser.add_argument('--pool-size', type=int, default=2)
+    parser.add_argument('--output', help='Write the report as JSON to this file')
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(jitter=0, realtime_latency=args.create_latency, session_ttl=args.ttl)
+    os.environ['OPENAI_REALTIME_SESSIONS_URL'] = f'{fake.url}/v1/realtime/sessions'
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+    import realtime_pool  # noqa: E402  (reads the URL at import)
+
+    reports = [run(realtime_pool, fake, False, args), run(realtime_pool, fake, True, args)]
+    for report in reports:
+        ttt = report['time_to_token_ms']
+        print(f"{report['mode']:>9}: hit rate {report['hit_rate']}, time to token p50 {ttt['p50']} ms, "
+              f"p95 {ttt['p95']} ms, {report['upstream_sessions_created']} sessions created upstream")
+        if report['topic_requests_without_update']:
+            print(f"           {report['topic_requests_without_update']} pooled topic requests had no session.update")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
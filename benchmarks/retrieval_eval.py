@@ -0,0 +1,135 @@
+"""
+Recall/latency report for the Can-Do candidate pre-filter.
+
+Runs app/cando_retrieval.py over the cases in
+fixtures/cando_retrieval_cases.json, using the statements from
+cefr_statements_filtered.json, and reports for each ranking method how
+many of the expected statements survive the pre-filter, how many
+statements are sent to the model, and how long the selection takes.
+
+Usage (from the repository root):
+    python benchmarks/retrieval_eval.py [--method lexical|embedding|both]
+                                        [--top-k 40] [--margin 0.03]
+                                        [--output results.json]
+
+The embedding method calls the OpenAI embeddings API and is skipped when
+OPENAI_API_KEY is not set.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+
+import openai  # noqa: E402
+
+import cando_retrieval  # noqa: E402
+from cando_catalog import CandoStatement, relevant_levels  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'cando_retrieval_cases.json')
+STATEMENTS = os.path.join(ROOT, 'cefr_statements_filtered.json')
+
+
+def load_statements():
+    with open(STATEMENTS, 'r', encoding='utf-8') as f:
+        rows = json.load(f)
+    return [CandoStatement(dict(row, id=str(idx + 1), display_order=idx + 1)) for idx, row in enumerate(rows)]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def evaluate(method, statements, cases, top_k, margin):
+    retriever = cando_retrieval.CandoRetriever(
+        top_k=top_k, margin=margin, enabled=True,
+        source=lambda: ('fixtures', statements)
+    )
+    if method == 'lexical':
+        # Never try the embeddings API
+        retriever._embeddings_down_until = float('inf')
+
+    found = 0
+    expected_total = 0
+    selected_counts = []
+    considered_counts = []
+    latencies = []
+    per_case = []
+    for case in cases:
+        candidates_in = [stmt for stmt in statements if stmt.level in relevant_levels(case['level'])]
+        start = time.perf_counter()
+        candidates, info = retriever.select(case['transcript'], candidates_in)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        selected = {stmt.descriptor for stmt in candidates}
+        hits = [descriptor for descriptor in case['expected'] if descriptor in selected]
+        found += len(hits)
+        expected_total += len(case['expected'])
+        selected_counts.append(info['selected'])
+        considered_counts.append(info['considered'])
+        per_case.append({
+            'name': case['name'],
+            'method': info['method'],
+            'considered': info['considered'],
+            'selected': info['selected'],
+            'recall': round(len(hits) / len(case['expected']), 3),
+            'missed': [d for d in case['expected'] if d not in selected]
+        })
+
+    return {
+        'method': method,
+        'top_k': top_k,
+        'margin': margin,
+        'cases': len(cases),
+        'recall': round(found / expected_total, 3) if expected_total else None,
+        'mean_considered': round(statistics.mean(considered_counts), 1),
+        'mean_selected': round(statistics.mean(selected_counts), 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'max': round(max(latencies), 2)
+        },
+        'per_case': per_case
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', choices=['lexical', 'embedding', 'both'], default='both')
+    parser.add_argument('--top-k', type=int, default=cando_retrieval.CANDO_PREFILTER_TOP_K)
+    parser.add_argument('--margin', type=float, default=cando_retrieval.CANDO_PREFILTER_MARGIN)
+    parser.add_argument('--output', help='Write the report as JSON to this file')
+    args = parser.parse_args()
+
+    with open(FIXTURES, 'r', encoding='utf-8') as f:
+        cases = json.load(f)
+    statements = load_statements()
+
+    methods = ['lexical', 'embedding'] if args.method == 'both' else [args.method]
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    if 'embedding' in methods and not openai.api_key:
+        print("OPENAI_API_KEY not set, skipping the embedding method")
+        methods.remove('embedding')
+
+    reports = [evaluate(method, statements, cases, args.top_k, args.margin) for method in methods]
+    for report in reports:
+        print(f"{report['method']:>9}: recall {report['recall']}, "
+              f"{report['mean_selected']} of {report['mean_considered']} statements sent, "
+              f"p50 {report['latency_ms']['p50']} ms, p95 {report['latency_ms']['p95']} ms")
+        for case in report['per_case']:
+            if case['missed']:
+                print(f"           missed in {case['name']}: {case['missed']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
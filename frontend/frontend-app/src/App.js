@@ -161,38 +161,10 @@ import { supabase } from "./supabaseClient";
     if (error) {
       console.error('Error ending session:', error.message);
     } else {
+      // Voice minutes and usage_logs are recorded by the backend from the
+      // /voice_usage heartbeats (see stopListening)
       console.log('Session ended. Duration:', durationMinutes, 'minutes');
 
-      // Log usage for cost tracking
-      const costUsd = durationMinutes * 0.06; // $0.06 per minute for OpenAI Realtime API
-
-      await supabase
-        .from('usage_logs')
-        .insert([{
-          user_id: user.id,
-          action_type: 'voice_conversation',
-          duration_minutes: durationMinutes,
-          cost_usd: costUsd,
-          metadata: { session_id: capturedSessionLogId }
-        }]);
-
-      // Update user's monthly total
-      const { data: profile } = await supabase
-        .from('profiles')
-        .select('monthly_voice_minutes_used')
-        .eq('id', user.id)
-        .single();
-
-      const currentUsage = profile?.monthly_voice_minutes_used || 0;
-      const newTotal = currentUsage + durationMinutes;
-
-      await supabase
-        .from('profiles')
-        .update({ monthly_voice_minutes_used: newTotal })
-        .eq('id', user.id);
-
-      console.log(`Monthly usage: ${currentUsage} + ${durationMinutes} = ${newTotal} minutes`);
-
       // Analyze conversation for Can-Do achievements if we have a transcript
       // DISABLED FOR NOW - Can-Do system not in use
       // if (conversation && conversation.length > 0) {
@@ -232,8 +204,8 @@ import { supabase } from "./supabaseClient";
         return;
       }
 
-      // Call backend /analyze_session endpoint
-      const response = await fetch(`${API_BASE_URL}/analyze_session`, {
+      // Queue the analysis on the backend (it returns a job id right away)
+      const submitAnalysis = () => fetch(`${API_BASE_URL}/analyze_session`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -245,6 +217,14 @@ import { supabase } from "./supabaseClient";
           transcript: transcript
         })
       });
+      let response = await submitAnalysis();
+
+      // Rate limited: try once more when the backend says a slot is free
+      if (response.status === 429) {
+        const retryAfter = Math.min(parseInt(response.headers.get('Retry-After') || '10', 10), 60);
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        response = await submitAnalysis();
+      }
 
       if (!response.ok) {
         const errorBody = await response.text();
@@ -256,7 +236,26 @@ import { supabase } from "./supabaseClient";
         return;
       }
 
-      const result = await response.json();
+      // Poll the job until the analysis is done (or give up after ~3 minutes)
+      let job = await response.json();
+      for (let i = 0; i < 60 && (job.status === 'queued' || job.status === 'running'); i++) {
+        await new Promise(resolve => setTimeout(resolve, 3000));
+        const jobResponse = await fetch(`${API_BASE_URL}/analyze_session/${job.job_id}`, {
+          headers: { 'Authorization': `Bearer ${session.access_token}` }
+        });
+        if (!jobResponse.ok) {
+          console.error('Failed to fetch Can-Do analysis job:', jobResponse.status);
+          return;
+        }
+        job = await jobResponse.json();
+      }
+
+      if (job.status !== 'done') {
+        console.error('Can-Do analysis did not finish:', job);
+        return;
+      }
+
+      const result = job.result;
       console.log('Can-Do analysis result:', result);
 
       // Show achievements to user if any were detected
@@ -1793,6 +1792,8 @@ import { supabase } from "./supabaseClient";
     // Use refs for WebSocket resources to avoid re-render loops
     const mediaStreamRef = useRef(null);
     const webSocketRef = useRef(null);
+    const usageSessionRef = useRef(null); // Backend voice metering session
+    const usageHeartbeatRef = useRef(null);
     const audioContextRef = useRef(null);
     const scriptProcessorRef = useRef(null);
     const audioQueueRef = useRef([]); // Queue for bot audio playback
@@ -1968,6 +1969,30 @@ import { supabase } from "./supabaseClient";
       source.start(startTime);
     }, []);
 
+    // Backend usage meter heartbeat; ends the conversation when the monthly limit is reached
+    const sendUsageHeartbeat = async () => {
+      const usage = usageSessionRef.current;
+      if (!usage) return;
+      try {
+        const response = await fetch(`${API_BASE_URL}/voice_usage/heartbeat`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ usage_session_id: usage.usage_session_id })
+        });
+        if (!response.ok) return;
+        const data = await response.json();
+        if (data.limit_reached) {
+          console.log('Monthly voice limit reached (backend). Stopping conversation.');
+          alert('Your time is up! The conversation will now end.');
+          stopListening();
+          setSpeaking(false);
+          setLimitReached(true);
+        }
+      } catch (err) {
+        console.error('Error sending usage heartbeat:', err);
+      }
+    };
+
     const startListening = async () => {
       // Check if user has reached their limit
       if (limitReached) {
@@ -2000,14 +2025,19 @@ import { supabase } from "./supabaseClient";
         const controller = new AbortController();
         const timeoutId = setTimeout(() => controller.abort(), 120000); // 2 minute timeout
 
-        let sessionResponse, session_id, websocket_url, ephemeral_token;
+        let sessionResponse, session_id, websocket_url, ephemeral_token, session_update;
         try {
           // Get current user ID
           const { data: { user } } = await supabase.auth.getUser();
+          const { data: { session: authSession } } = await supabase.auth.getSession();
 
           sessionResponse = await fetch(`${API_BASE_URL}/webrtc_session`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: {
+              'Content-Type': 'application/json',
+              // Lets the backend meter voice minutes against this account
+              ...(authSession ? { 'Authorization': `Bearer ${authSession.access_token}` } : {})
+            },
             body: JSON.stringify({
               topic: selectedTopic,
               user_id: user?.id
@@ -2019,6 +2049,20 @@ import { supabase } from "./supabaseClient";
           setConnectingToBackend(false);
           console.log('Backend response received:', sessionResponse.status);
 
+          if (sessionResponse.status === 403) {
+            const errorData = await sessionResponse.json().catch(() => ({}));
+            if (errorData.limit_reached) {
+              setLimitReached(true);
+              setUsageRemaining(0);
+              throw new Error('You have used all your voice minutes for this month.');
+            }
+          }
+
+          if (sessionResponse.status === 429) {
+            const retryAfter = sessionResponse.headers.get('Retry-After') || '60';
+            throw new Error(`Too many voice sessions started. Please try again in ${retryAfter} seconds.`);
+          }
+
           if (!sessionResponse.ok) {
             const errorText = await sessionResponse.text();
             console.error('Backend error response:', errorText);
@@ -2031,6 +2075,16 @@ import { supabase } from "./supabaseClient";
           session_id = responseData.session_id;
           websocket_url = responseData.websocket_url;
           ephemeral_token = responseData.ephemeral_token;
+          session_update = responseData.session_update;
+
+          // Report the session to the backend's usage meter until it ends
+          usageSessionRef.current = responseData.usage || null;
+          if (usageSessionRef.current) {
+            usageHeartbeatRef.current = setInterval(
+              sendUsageHeartbeat,
+              usageSessionRef.current.heartbeat_interval * 1000
+            );
+          }
         } catch (fetchError) {
           clearTimeout(timeoutId);
           setConnectingToBackend(false);
@@ -2056,8 +2110,12 @@ import { supabase } from "./supabaseClient";
         ws.onopen = () => {
           console.log('WebSocket opened.');
 
-          // Session is already configured by backend's ephemeral token
-          // Just start streaming audio - no session.update needed
+          // Session is already configured by backend's ephemeral token.
+          // A pre-warmed session gets the topic through this session.update,
+          // sent before any audio
+          if (session_update) {
+            ws.send(JSON.stringify(session_update));
+          }
 
           // 4. Stream Audio Data
           // OpenAI Realtime API requires 24kHz sample rate for PCM16
@@ -2273,6 +2331,19 @@ import { supabase } from "./supabaseClient";
       // Use conversationRef to avoid re-creating this function when conversation changes
       endSession(conversationRef.current);
 
+      // Close the backend usage session; keepalive lets it finish on page unload
+      clearInterval(usageHeartbeatRef.current);
+      usageHeartbeatRef.current = null;
+      if (usageSessionRef.current) {
+        fetch(`${API_BASE_URL}/voice_usage/end`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ usage_session_id: usageSessionRef.current.usage_session_id }),
+          keepalive: true
+        }).catch(err => console.error('Error ending usage session:', err));
+        usageSessionRef.current = null;
+      }
+
       // Clear audio queue and reset playback state
       audioQueueRef.current = [];
       isPlayingRef.current = false;
@@ -3272,22 +3343,30 @@ import { supabase } from "./supabaseClient";
           return;
         }
 
-        // Call backend API
-        const response = await fetch(`${API_BASE_URL}/admin/users`, {
-          method: 'GET',
-          headers: {
-            'Authorization': `Bearer ${session.access_token}`,
-            'Content-Type': 'application/json'
-          }
-        });
+        // Call backend API, following next_cursor through every page
+        const users = [];
+        let cursor = null;
+        do {
+          const params = new URLSearchParams({ limit: '200' });
+          if (cursor) params.set('cursor', cursor);
+          const response = await fetch(`${API_BASE_URL}/admin/users?${params}`, {
+            method: 'GET',
+            headers: {
+              'Authorization': `Bearer ${session.access_token}`,
+              'Content-Type': 'application/json'
+            }
+          });
 
-        if (!response.ok) {
-          const error = await response.json();
-          throw new Error(error.error || 'Failed to load users');
-        }
+          if (!response.ok) {
+            const error = await response.json();
+            throw new Error(error.error || 'Failed to load users');
+          }
 
-        const data = await response.json();
-        setAllUsers(data.users || []);
+          const data = await response.json();
+          users.push(...(data.users || []));
+          cursor = data.next_cursor;
+        } while (cursor);
+        setAllUsers(users);
       } catch (error) {
         console.error('Error loading users:', error);
         setMessage('Error loading users: ' + error.message);
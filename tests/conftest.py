@@ -0,0 +1,64 @@
+"""
+Shared setup for the backend tests.
+
+The app modules read their configuration at import, so the fakes from
+benchmarks/fakes.py are started and the environment pointed at them here,
+before any test module imports app code. Every test talks to the same
+FakeSupabase and FakeOpenAI; faults injected by a test are cleared after it.
+
+Run from the repository root:
+    python -m pytest -q tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fakes import FakeOpenAI, FakeSupabase  # noqa: E402
+
+JWT_SECRET = 'test-jwt-secret'
+
+_supabase = FakeSupabase()
+_openai = FakeOpenAI()
+_workdir = tempfile.mkdtemp(prefix='app-tests-')
+
+os.environ.update({
+    'SUPABASE_URL': _supabase.url,
+    'SUPABASE_SERVICE_ROLE_KEY': 'service-role-key',
+    'SUPABASE_JWT_SECRET': JWT_SECRET,
+    'AUTH_VERIFY_REMOTE': '0',
+    'RATE_LIMIT_ENABLED': '0',
+    'OPENAI_API_KEY': 'sk-fake',
+    'OPENAI_API_BASE': f'{_openai.url}/v1',
+    'OPENAI_REALTIME_SESSIONS_URL': f'{_openai.url}/v1/realtime/sessions',
+    'ANALYSIS_CACHE_DB': os.path.join(_workdir, 'analysis_cache.db'),
+    'ANALYSIS_JOBS_DB': os.path.join(_workdir, 'analysis_jobs.db'),
+    'CONVERSATION_DB': os.path.join(_workdir, 'conversations.db'),
+    'USAGE_SESSION_DB': os.path.join(_workdir, 'usage_sessions.db'),
+    'CANDO_INDEX_DIR': _workdir,
+    'TRACE_LOG_SAMPLE_RATE': '0',
+})
+
+
+def pytest_unconfigure(config):
+    _supabase.close()
+    _openai.close()
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+@pytest.fixture
+def fake_supabase():
+    return _supabase
+
+
+@pytest.fixture
+def fake_openai():
+    yield _openai
+    _openai.faults.clear()
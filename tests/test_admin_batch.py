@@ -0,0 +1,70 @@
+"""Validation and partial failures of batch admin operations (app/admin_batch.py) against FakeSupabase."""
+
+import uuid
+
+import pytest
+
+import admin_batch
+import tracing
+
+
+def email():
+    return f'{uuid.uuid4().hex[:12]}@example.com'
+
+
+@pytest.mark.parametrize('op, error', [
+    ({'op': 'create_user', 'email': 'a@example.com', 'password': 1234567}, 'Fields must be strings: password'),
+    ({'op': 'create_user', 'email': ['a@example.com'], 'password': 'secret1'}, 'Fields must be strings: email'),
+    ({'op': 'update_tier', 'user_id': {'id': 1}, 'tier': 'free'}, 'Fields must be strings: user_id'),
+    ({'op': 'reset_password', 'user_id': 'u1', 'password': 'short'}, 'Password must be at least 6 characters'),
+    ({'op': 'create_user', 'email': 'a@example.com', 'password': 'secret1', 'tier': 'gold'},
+     "Invalid tier. Must be 'free', 'premium', or 'admin'"),
+    ({'op': ['create_user']}, "Unknown op: ['create_user']"),
+    ({'op': 'create_user', 'email': 'a@example.com'}, 'Missing required fields: password'),
+])
+def test_malformed_operations_fail_alone(op, error):
+    results = admin_batch.run_batch([op])
+    assert results[0]['success'] is False
+    assert results[0]['error'] == error
+
+
+def test_created_user_gets_a_profile(fake_supabase, monkeypatch):
+    monkeypatch.setitem(fake_supabase.tables, 'profiles', [])
+    address = email()
+
+    result, = admin_batch.run_batch([{'op': 'create_user', 'email': address, 'password': 'secret1', 'tier': 'premium'}])
+
+    assert result['success'] is True
+    assert result['user']['email'] == address
+    assert fake_supabase.tables['profiles'][0]['id'] == result['user']['id']
+
+
+def test_failed_profile_insert_fails_the_created_users(fake_supabase, monkeypatch):
+    # Without the table the profile insert gets a 404
+    monkeypatch.delitem(fake_supabase.tables, 'profiles', raising=False)
+    monkeypatch.setitem(fake_supabase.tables, 'user_cando_achievements', [])
+
+    results = admin_batch.run_batch([
+        {'op': 'create_user', 'email': email(), 'password': 'secret1'},
+        {'op': 'remove_cando', 'user_id': str(uuid.uuid4()), 'cando_id': str(uuid.uuid4())},
+    ])
+
+    created, removed = results
+    assert created['success'] is False
+    assert 'profile was not saved' in created['error']
+    # The Auth user exists, so its id is still reported
+    assert any(user['id'] == created['user']['id'] for user in fake_supabase.auth_users)
+    assert removed['success'] is True
+
+
+def test_auth_calls_join_the_request_trace(fake_supabase, monkeypatch):
+    monkeypatch.setitem(fake_supabase.tables, 'profiles', [])
+    trace = tracing.Trace('batch-test')
+    token = tracing._current.set(trace)
+    try:
+        admin_batch.run_batch([{'op': 'create_user', 'email': email(), 'password': 'secret1'},
+                               {'op': 'create_user', 'email': email(), 'password': 'secret1'}])
+    finally:
+        tracing._current.reset(token)
+
+    assert trace.summary()['supabase.auth_admin.write']['count'] == 2
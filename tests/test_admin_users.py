@@ -0,0 +1,40 @@
+"""Query validation of GET /admin/users (app/admin_users.py)."""
+
+import time
+import uuid
+
+import pytest
+
+import admin_users
+import auth
+from conftest import JWT_SECRET
+
+
+def test_known_fields_are_accepted():
+    query = admin_users.parse_query({'fields': 'id, email,tier,cefr_level'})
+    assert query['fields'] == ['id', 'email', 'tier', 'cefr_level']
+
+
+@pytest.mark.parametrize('fields, message', [
+    ('id,password_hash', 'Unknown fields: password_hash'),
+    ('email,tier;drop', 'Unknown fields: tier;drop'),
+])
+def test_unknown_fields_are_rejected(fields, message):
+    with pytest.raises(ValueError, match=message):
+        admin_users.parse_query({'fields': fields})
+
+
+def test_unknown_field_is_a_400(fake_supabase, monkeypatch):
+    import app
+    admin_id = str(uuid.uuid4())
+    monkeypatch.setitem(fake_supabase.tables, 'profiles', [{'id': admin_id, 'is_admin': True}])
+    token = auth.encode_hs256({'sub': admin_id, 'exp': int(time.time()) + 3600}, JWT_SECRET)
+    before = fake_supabase.snapshot()
+
+    response = app.app.test_client().get('/admin/users?fields=id,not_a_column',
+                                         headers={'Authorization': f'Bearer {token}'})
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Unknown fields: not_a_column'}
+    # Rejected before any user or profile query
+    assert fake_supabase.snapshot().get('auth.admin', 0) == before.get('auth.admin', 0)
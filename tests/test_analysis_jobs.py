@@ -0,0 +1,133 @@
+"""SQLite analysis job queue (app/analysis_jobs.py), driven without worker threads."""
+
+import time
+
+import pytest
+
+import analysis_jobs
+from analysis_jobs import DONE, FAILED, QUEUED, RUNNING, JobQueue
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    def make(handler=lambda payload, final_attempt: {'ok': True}, **kwargs):
+        return JobQueue(handler, db_path=str(tmp_path / 'jobs.db'), workers=0, **kwargs)
+    return make
+
+
+def set_column(queue, job_id, column, value):
+    queue._db().execute(f'UPDATE analysis_jobs SET {column} = ? WHERE id = ?', (value, job_id))
+
+
+def test_submit_is_idempotent_per_user_and_session(make_queue):
+    queue = make_queue()
+    job, created = queue.submit('session-1', 'user-1', {'transcript': 'Hello'})
+    again, created_again = queue.submit('session-1', 'user-1', {'transcript': 'Hello again'})
+
+    assert created and not created_again
+    assert again['id'] == job['id']
+    assert again['payload'] == {'transcript': 'Hello'}
+
+    # Another user's job for the same session id is a separate job
+    other, created_other = queue.submit('session-1', 'user-2', {'transcript': 'Hi'})
+    assert created_other
+    assert other['id'] != job['id']
+
+
+def test_claim_runs_each_job_once(make_queue):
+    queue = make_queue()
+    job, _ = queue.submit('session-1', 'user-1', {})
+
+    claimed = queue._claim()
+    assert claimed['id'] == job['id']
+    assert claimed['status'] == RUNNING
+    assert claimed['attempts'] == 1
+    # The lease is still live, so nobody else gets the job
+    assert queue._claim() is None
+
+    queue._run(claimed)
+    finished = queue.get(job['id'])
+    assert finished['status'] == DONE
+    assert finished['result'] == {'ok': True}
+    assert queue.submit('session-1', 'user-1', {})[1] is False
+
+
+def test_reclaimed_job_cannot_be_finished_by_the_old_worker(make_queue):
+    queue = make_queue()
+    job, _ = queue.submit('session-1', 'user-1', {})
+    stale = queue._claim()
+    set_column(queue, job['id'], 'lease_expires', time.time() - 1)
+
+    fresh = queue._claim()
+    assert fresh['id'] == job['id']
+    assert fresh['attempts'] == 2
+
+    assert queue._finish(stale, DONE, result={'from': 'stale'}) is False
+    assert queue.get(job['id'])['status'] == RUNNING
+    assert queue._finish(fresh, DONE, result={'from': 'fresh'}) is True
+    assert queue.get(job['id'])['result'] == {'from': 'fresh'}
+
+
+def test_running_job_keeps_its_lease(make_queue, monkeypatch):
+    monkeypatch.setattr(analysis_jobs, 'JOB_LEASE_SECONDS', 0.3)
+    reclaimed = []
+
+    def slow(payload, final_attempt):
+        time.sleep(0.6)
+        reclaimed.append(queue._claim())
+        return {'ok': True}
+
+    queue = make_queue(slow)
+    job, _ = queue.submit('session-1', 'user-1', {})
+    queue._run(queue._claim())
+
+    assert reclaimed == [None]
+    assert queue.get(job['id'])['status'] == DONE
+    assert queue.get(job['id'])['attempts'] == 1
+
+
+def test_failed_attempt_is_retried_then_fails_for_good(make_queue, monkeypatch):
+    monkeypatch.setattr(analysis_jobs, 'RETRY_BACKOFF', 0)
+    finals = []
+
+    def broken(payload, final_attempt):
+        finals.append(final_attempt)
+        raise RuntimeError('upstream down')
+
+    queue = make_queue(broken, max_attempts=2)
+    job, _ = queue.submit('session-1', 'user-1', {})
+
+    queue._run(queue._claim())
+    retry = queue.get(job['id'])
+    assert retry['status'] == QUEUED
+    assert retry['error'] == 'upstream down'
+
+    queue._run(queue._claim())
+    assert queue.get(job['id'])['status'] == FAILED
+    assert finals == [False, True]
+    assert queue._claim() is None
+
+    # Resubmitting a failed session queues it again from scratch
+    resubmitted, created = queue.submit('session-1', 'user-1', {})
+    assert created
+    assert resubmitted['id'] == job['id']
+    assert resubmitted['status'] == QUEUED
+    assert resubmitted['attempts'] == 0
+
+
+def test_finished_jobs_are_purged_after_retention(make_queue):
+    queue = make_queue()
+    old, _ = queue.submit('session-old', 'user-1', {})
+    queue._run(queue._claim())
+    recent, _ = queue.submit('session-recent', 'user-1', {})
+    queue._run(queue._claim())
+    waiting, _ = queue.submit('session-waiting', 'user-1', {})
+
+    long_ago = time.time() - analysis_jobs.ANALYSIS_JOB_RETENTION - 1
+    set_column(queue, old['id'], 'updated_at', long_ago)
+    set_column(queue, waiting['id'], 'updated_at', long_ago)
+    queue._purge()
+
+    assert queue.get(old['id']) is None
+    assert queue.get(recent['id'])['status'] == DONE
+    assert queue.get(waiting['id'])['status'] == QUEUED
@@ -0,0 +1,199 @@
+"""Async routes of app/asgi.py, and the Flask routes mounted behind them, against the fakes."""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+
+import pytest
+from starlette.testclient import TestClient
+
+import auth
+import llm_gateway
+from conftest import JWT_SECRET, ROOT
+
+ORIGIN = 'http://localhost:3000'
+
+
+def mint(user_id):
+    return auth.encode_hs256({'sub': user_id, 'exp': int(time.time()) + 3600}, JWT_SECRET)
+
+
+def bearer(user_id):
+    return {'Authorization': f'Bearer {mint(user_id)}'}
+
+
+def parse_events(body):
+    """SSE body -> list of (event name or None, JSON payload)."""
+    events = []
+    for block in body.strip().split('\n\n'):
+        name = None
+        data = None
+        for line in block.split('\n'):
+            if line.startswith('event: '):
+                name = line[len('event: '):]
+            elif line.startswith('data: '):
+                data = json.loads(line[len('data: '):])
+        events.append((name, data))
+    return events
+
+
+@pytest.fixture(scope='module')
+def users():
+    """Seeded learners: (admin id, learner id, another learner's id)."""
+    from conftest import _supabase
+    _supabase.seed(os.path.join(ROOT, 'cefr_statements_filtered.json'), users=3, achievements_per_user=5)
+    return [profile['id'] for profile in _supabase.tables['profiles']]
+
+
+@pytest.fixture(scope='module')
+def asgi(users):
+    import asgi
+    return asgi
+
+
+@pytest.fixture
+def client(asgi):
+    with TestClient(asgi.app) as client:
+        yield client
+
+
+def test_chat_reply_is_saved_under_the_session_cookie(client, asgi):
+    response = client.post('/chat_text', json={'text': 'My favourite food is ramen'})
+    assert response.status_code == 200
+    reply = response.json()['response_text']
+    assert reply
+
+    session = asgi.load_session(client)
+    messages = asgi.conversations.load(session['conversation_id'])['messages']
+    assert messages[-2:] == [{'role': 'user', 'content': 'My favourite food is ramen'},
+                             {'role': 'assistant', 'content': reply}]
+
+    # The next turn continues the same conversation
+    client.post('/chat_text', json={'text': 'And sushi'})
+    assert asgi.load_session(client) == session
+    assert len(asgi.conversations.load(session['conversation_id'])['messages']) == 4
+
+
+def test_flask_routes_share_the_session(client, asgi):
+    client.post('/chat_text', json={'text': 'Hello there'})
+    conversation_id = asgi.load_session(client)['conversation_id']
+
+    # POST /clear_context is served by Flask from the same cookie
+    assert client.post('/clear_context').json() == {'message': 'Context cleared.'}
+    assert asgi.conversations.load(conversation_id)['messages'] == []
+
+
+def test_stream_relays_deltas_then_done(client, asgi):
+    response = client.post('/chat_text/stream', json={'text': 'I went to the beach last weekend'})
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+    assert response.headers['X-Accel-Buffering'] == 'no'
+    events = parse_events(response.text)
+    deltas = [data['delta'] for name, data in events[:-1]]
+    assert len(deltas) > 1
+    assert events[-1] == ('done', {'response_text': ''.join(deltas).strip()})
+
+    messages = asgi.conversations.load(asgi.load_session(client)['conversation_id'])['messages']
+    assert messages[-1] == {'role': 'assistant', 'content': events[-1][1]['response_text']}
+
+
+def test_query_flag_streams_too(client):
+    response = client.post('/chat_text?stream=1', json={'text': 'Hello there'})
+    assert parse_events(response.text)[-1][0] == 'done'
+
+
+def test_upstream_error_is_a_json_error(client, fake_openai, asgi):
+    fake_openai.inject(asgi.CHAT_MODEL, error_rate=1.0, status=400)
+    for path in ('/chat_text', '/chat_text/stream'):
+        response = client.post(path, json={'text': 'Hello'})
+        assert response.status_code == 500
+        assert 'error' in response.json()
+
+
+def test_missing_text_is_rejected(client):
+    assert client.post('/chat_text', json={}).status_code == 400
+    assert client.post('/chat_text/stream', content=b'not json').status_code == 400
+
+
+def test_native_routes_send_cors_headers(client):
+    response = client.post('/chat_text', json={'text': 'Hello'}, headers={'Origin': ORIGIN})
+    assert response.headers['Access-Control-Allow-Origin'] == ORIGIN
+    assert response.headers['Access-Control-Allow-Credentials'] == 'true'
+    assert 'Retry-After' in response.headers['Access-Control-Expose-Headers']
+    assert response.headers['X-Request-ID']
+
+    # Preflights fall through to Flask-Cors
+    preflight = client.options('/chat_text', headers={'Origin': ORIGIN, 'Access-Control-Request-Method': 'POST'})
+    assert preflight.status_code == 200
+    assert preflight.headers['Access-Control-Allow-Origin'] == ORIGIN
+
+
+def test_other_routes_fall_through_to_flask(client):
+    client.post('/chat_text', json={'text': 'Hello'})
+    metrics = client.get('/metrics')
+    assert metrics.status_code == 200
+    # The async routes are in the same metrics, labelled like Flask rules
+    assert 'route="/chat_text",method="POST",status="200"' in metrics.text
+    assert client.get('/admin/users').status_code == 401
+
+
+def test_cando_progress_for_own_user(client, users):
+    _, learner, _ = users
+    response = client.get(f'/users/{learner}/cando', headers=bearer(learner))
+    assert response.status_code == 200
+    assert response.json()['user_id'] == learner
+
+    summary = client.get(f'/users/{learner}/cando?summary=1', headers=bearer(learner))
+    assert summary.status_code == 200
+
+
+def test_cando_progress_of_others_needs_admin(client, users):
+    admin, learner, other = users
+    assert client.get(f'/users/{other}/cando').status_code == 401
+    assert client.get(f'/users/{other}/cando', headers=bearer(learner)).status_code == 403
+    response = client.get(f'/users/{other}/cando', headers=bearer(admin))
+    assert response.status_code == 200
+    assert response.json()['user_id'] == other
+
+
+def test_analyze_session_queues_a_job(client, users):
+    _, learner, other = users
+    body = {'session_id': str(uuid.uuid4()), 'user_id': learner, 'transcript': 'I like to cook pasta.'}
+
+    assert client.post('/analyze_session', json=body).status_code == 401
+    assert client.post('/analyze_session', json={'user_id': learner}, headers=bearer(learner)).status_code == 400
+    forbidden = client.post('/analyze_session', json={**body, 'user_id': other}, headers=bearer(learner))
+    assert forbidden.status_code == 403
+
+    # No ?wait=N: the job id comes back without waiting for the analysis
+    queued = client.post('/analyze_session', json=body, headers=bearer(learner))
+    assert queued.status_code == 202
+    assert queued.json()['session_id'] == body['session_id']
+
+    bad_wait = client.post('/analyze_session?wait=soon', json=body, headers=bearer(learner))
+    assert bad_wait.status_code == 400
+
+
+def test_hundreds_of_llm_calls_in_flight(fake_openai):
+    fake_openai.inject(None, slow_rate=1.0, slow_latency=1)
+    gateway = llm_gateway.LLMGateway(fallbacks='')
+    messages = [{'role': 'user', 'content': 'Hello there'}]
+
+    async def run():
+        try:
+            return await asyncio.gather(*[gateway.chat_async('chat', 'gpt-4o-mini', messages, deadline=20)
+                                          for _ in range(200)])
+        finally:
+            await gateway.aclose()
+
+    start = time.monotonic()
+    responses = asyncio.run(run())
+    waited = time.monotonic() - start
+
+    assert len(responses) == 200
+    # One at a time this would take 200s; a thread per call would need 200 threads
+    assert waited < 10
+    assert gateway.metrics()['calls']['gpt-4o-mini/chat']['ok'] == 200
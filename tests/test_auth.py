@@ -0,0 +1,114 @@
+"""Local verification of Supabase access tokens (app/auth.py), with tokens minted offline."""
+
+import time
+import uuid
+
+import pytest
+
+import auth
+from conftest import JWT_SECRET
+
+
+def mint(secret=JWT_SECRET, **claims):
+    claims.setdefault('sub', str(uuid.uuid4()))
+    claims.setdefault('exp', int(time.time()) + 3600)
+    return auth.encode_hs256(claims, secret)
+
+
+@pytest.fixture
+def verifier():
+    return auth.TokenVerifier(jwt_secret=JWT_SECRET, jwks_file=None, verify_remote=False)
+
+
+def test_valid_token_is_verified_locally(verifier, fake_supabase):
+    token = mint(sub='user-1', email='learner@example.com')
+    before = fake_supabase.snapshot().get('auth.user', 0)
+
+    claims = verifier.verify(token)
+
+    assert claims['sub'] == 'user-1'
+    assert claims['email'] == 'learner@example.com'
+    assert fake_supabase.snapshot().get('auth.user', 0) == before
+
+
+def test_verified_claims_are_cached(verifier):
+    token = mint()
+    verifier.verify(token)
+    verifier.verify(token)
+    assert verifier._cache.hits == 1
+
+
+def test_invalidate_forgets_the_token(verifier):
+    token = mint()
+    verifier.verify(token)
+    verifier.invalidate(token)
+    verifier.verify(token)
+    assert verifier._cache.hits == 0
+
+
+def test_bad_signature_is_rejected(verifier):
+    with pytest.raises(auth.TokenError, match='signature'):
+        verifier.verify(mint(secret='some-other-secret'))
+
+
+def test_tampered_claims_are_rejected(verifier):
+    header, _, signature = mint(sub='user-1').split('.')
+    _, forged_payload, _ = mint(sub='admin').split('.')
+    with pytest.raises(auth.TokenError):
+        verifier.verify(f'{header}.{forged_payload}.{signature}')
+
+
+def test_expired_token_is_rejected(verifier):
+    with pytest.raises(auth.TokenError, match='expired'):
+        verifier.verify(mint(exp=int(time.time()) - auth.CLOCK_SKEW - 5))
+
+
+def test_expiry_within_clock_skew_is_accepted(verifier):
+    assert verifier.verify(mint(sub='user-1', exp=int(time.time()) - 1))['sub'] == 'user-1'
+
+
+def test_token_not_yet_valid_is_rejected(verifier):
+    with pytest.raises(auth.TokenError, match='not yet valid'):
+        verifier.verify(mint(nbf=int(time.time()) + auth.CLOCK_SKEW + 60))
+
+
+@pytest.mark.parametrize('claims', [{'exp': None}, {'sub': ''}])
+def test_token_without_expiry_or_subject_is_rejected(verifier, claims):
+    token = mint(**claims)
+    with pytest.raises(auth.TokenError):
+        verifier.verify(token)
+
+
+def test_malformed_token_is_rejected(verifier):
+    with pytest.raises(auth.TokenError, match='Malformed'):
+        verifier.verify('not-a-jwt')
+
+
+def test_cache_expires_with_the_token(verifier):
+    token = mint(exp=int(time.time()) + 1)
+    verifier.verify(token)
+    time.sleep(1.1)
+    # Still inside the clock skew, so verified again rather than served from the cache
+    verifier.verify(token)
+    assert verifier._cache.hits == 0
+
+
+def test_remote_verification_on_request(fake_supabase):
+    user_id = str(uuid.uuid4())
+    fake_supabase.auth_users.append({'id': user_id, 'email': 'remote@example.com', 'role': 'authenticated'})
+    verifier = auth.TokenVerifier(jwt_secret=JWT_SECRET, jwks_file=None, verify_remote=True)
+    token = mint(sub=user_id)
+    before = fake_supabase.snapshot().get('auth.user', 0)
+
+    assert verifier.verify(token)['email'] == 'remote@example.com'
+    verifier.verify(token)
+
+    assert fake_supabase.snapshot().get('auth.user', 0) == before + 1
+
+
+def test_get_user_id():
+    user_id, error = auth.get_user_id(mint(sub='user-2'))
+    assert (user_id, error) == ('user-2', None)
+
+    user_id, error = auth.get_user_id(mint(secret='wrong'))
+    assert (user_id, error) == (None, 'Invalid token')
@@ -0,0 +1,111 @@
+"""Streaming reads and import plans of the Can-Do statement import (app/cando_import.py)."""
+
+import json
+
+import pytest
+
+from cando_import import Checkpoint, build_row, iter_statements, natural_key, plan_import
+
+
+def statement(descriptor, level='B1', scale='Overall oral comprehension'):
+    return {'level': level, 'descriptor': descriptor, 'scale': scale, 'skill_type': 'listening',
+            'mode': 'Reception', 'activity': 'Oral comprehension'}
+
+
+STATEMENTS = [
+    statement('Can understand the main points of clear standard speech on familiar matters.'),
+    statement('Can follow a lecture or talk within their own field, if the subject matter is familiar.'),
+    statement('Can understand {simple} "technical" information, such as operating instructions\\manuals.'),
+]
+
+
+@pytest.fixture
+def source(tmp_path):
+    def write(statements, lines=False):
+        path = tmp_path / ('statements.jsonl' if lines else 'statements.json')
+        if lines:
+            path.write_text(''.join(json.dumps(stmt) + '\n' for stmt in statements), encoding='utf-8')
+        else:
+            path.write_text(json.dumps(statements, indent=2), encoding='utf-8')
+        return str(path)
+    return write
+
+
+@pytest.mark.parametrize('lines', [False, True])
+@pytest.mark.parametrize('chunk_size', [7, 64, 65536])
+def test_statements_are_streamed_across_chunks(source, lines, chunk_size):
+    path = source(STATEMENTS, lines=lines)
+    assert list(iter_statements(path, chunk_size=chunk_size)) == STATEMENTS
+
+
+def test_empty_array_yields_nothing(source):
+    assert list(iter_statements(source([]), chunk_size=1)) == []
+
+
+def test_truncated_file_is_an_error(tmp_path):
+    path = tmp_path / 'broken.json'
+    path.write_text(json.dumps(STATEMENTS)[:-40], encoding='utf-8')
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_statements(str(path), chunk_size=16))
+
+
+def existing_rows(path):
+    """Rows as fetch_existing() would return them after importing path as is."""
+    new, _, _, _, _ = plan_import(path, {}, Checkpoint(None, 'hash'))
+    return {natural_key(row): row for row in new}
+
+
+def test_first_import_plans_every_row_as_new(source):
+    new, changed, unchanged, skipped, duplicates = plan_import(source(STATEMENTS), {}, Checkpoint(None, 'hash'))
+
+    assert [row['descriptor'] for row in new] == [stmt['descriptor'] for stmt in STATEMENTS]
+    assert [row['display_order'] for row in new] == [1, 2, 3]
+    assert all(row['keywords'] for row in new)
+    assert (changed, unchanged, skipped, duplicates) == ([], 0, 0, 0)
+
+
+def test_rerun_sends_only_new_and_changed_rows(source):
+    added = statement('Can understand most TV news and current affairs programmes.', level='B2')
+    path = source(STATEMENTS + [added])
+    # Supabase has the first three statements, the second one with an older skill_type
+    existing = existing_rows(path)
+    del existing[natural_key(build_row(added, 4, []))]
+    outdated = existing[natural_key(build_row(STATEMENTS[1], 2, []))]
+    outdated['skill_type'] = 'spoken_interaction'
+
+    new, changed, unchanged, skipped, duplicates = plan_import(path, existing, Checkpoint(None, 'hash'))
+
+    assert [row['descriptor'] for row in new] == [added['descriptor']]
+    assert [row['skill_type'] for row in changed] == ['listening']
+    assert (unchanged, skipped, duplicates) == (2, 0, 0)
+
+
+def test_unchanged_source_plans_nothing(source):
+    path = source(STATEMENTS)
+    new, changed, unchanged, _, _ = plan_import(path, existing_rows(path), Checkpoint(None, 'hash'))
+    assert (new, changed, unchanged) == ([], [], 3)
+
+
+def test_duplicates_and_checkpointed_rows_are_skipped(source):
+    spaced = {**STATEMENTS[0], 'descriptor': '  ' + STATEMENTS[0]['descriptor'].replace(' ', '\n  ', 1)}
+    other_scale = {**STATEMENTS[0], 'scale': 'Understanding conversation between other people'}
+    path = source(STATEMENTS + [spaced, other_scale])
+    checkpoint = Checkpoint(None, 'hash')
+    checkpoint.done = {natural_key(build_row(STATEMENTS[1], 2, []))}
+
+    new, changed, unchanged, skipped, duplicates = plan_import(path, {}, checkpoint)
+
+    # Whitespace doesn't make a new statement; the same words under another scale do
+    assert duplicates == 1
+    assert skipped == 1
+    assert [row['scale'] for row in new] == [STATEMENTS[0]['scale'], STATEMENTS[2]['scale'], other_scale['scale']]
+
+
+def test_checkpoint_resumes_only_the_same_source(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    Checkpoint(path, 'v1').add(['B1|abc', 'B2|def'])
+
+    assert Checkpoint(path, 'v1').done == {'B1|abc', 'B2|def'}
+    assert Checkpoint(path, 'v2').done == set()
+    Checkpoint(path, 'v1').clear()
+    assert Checkpoint(path, 'v1').done == set()
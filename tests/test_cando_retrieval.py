@@ -0,0 +1,56 @@
+"""Candidate pre-filter (app/cando_retrieval.py) with a small in-memory catalog."""
+
+import pytest
+
+import cando_retrieval
+from cando_catalog import CandoStatement
+
+DESCRIPTORS = [
+    'Can order food and drink in a restaurant',
+    'Can describe their family and where they live',
+    'Can talk about a trip to the beach',
+    'Can give directions to a train station',
+    'Can explain a problem with a hotel room',
+]
+STATEMENTS = [CandoStatement({'id': f'stmt-{i}', 'level': 'A2', 'skill_type': 'speaking', 'descriptor': d})
+              for i, d in enumerate(DESCRIPTORS)]
+TRANSCRIPT = 'User: Last weekend I went to the beach with my family.\nAssistant: Nice!'
+
+
+def broken_embeddings(texts):
+    raise RuntimeError('embeddings are down')
+
+
+@pytest.fixture
+def retriever():
+    def make(**kwargs):
+        kwargs.setdefault('top_k', 2)
+        kwargs.setdefault('margin', 0)
+        return cando_retrieval.CandoRetriever(enabled=True, source=lambda: ('v1', STATEMENTS), **kwargs)
+    return make
+
+
+def test_lexical_fallback_is_reported(retriever):
+    selector = retriever(method='embedding', embed_fn=broken_embeddings)
+    candidates, info = selector.select(TRANSCRIPT, STATEMENTS)
+
+    assert info['method'] == 'lexical'
+    assert selector.fell_back(info)
+    assert 'stmt-2' in [stmt.id for stmt in candidates]
+
+
+def test_configured_lexical_is_not_a_fallback(retriever):
+    selector = retriever(method='lexical')
+    _, info = selector.select(TRANSCRIPT, STATEMENTS)
+
+    assert info['method'] == 'lexical'
+    assert not selector.fell_back(info)
+
+
+def test_small_catalogs_are_not_filtered(retriever):
+    selector = retriever(method='embedding', embed_fn=broken_embeddings, top_k=10)
+    candidates, info = selector.select(TRANSCRIPT, STATEMENTS)
+
+    assert info['method'] == 'all'
+    assert len(candidates) == len(STATEMENTS)
+    assert not selector.fell_back(info)
@@ -0,0 +1,119 @@
+"""SSE relay of streamed chat replies (app/chat_stream.py, POST /chat_text/stream) against FakeOpenAI."""
+
+import json
+import time
+
+import pytest
+from openai.openai_object import OpenAIObject
+
+import chat_stream
+
+
+def parse_events(body):
+    """SSE body -> list of (event name or None, JSON payload)."""
+    events = []
+    for block in body.strip().split('\n\n'):
+        name = None
+        data = None
+        for line in block.split('\n'):
+            if line.startswith('event: '):
+                name = line[len('event: '):]
+            elif line.startswith('data: '):
+                data = json.loads(line[len('data: '):])
+        events.append((name, data))
+    return events
+
+
+@pytest.fixture
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.app.config['TESTING'] = True
+    return app_module.app.test_client()
+
+
+def test_stream_relays_deltas_then_done(client, fake_openai):
+    before = fake_openai.snapshot().get('chat', 0)
+    response = client.post('/chat_text/stream', json={'text': 'I went to the beach last weekend'})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert response.headers['X-Accel-Buffering'] == 'no'
+
+    events = parse_events(response.get_data(as_text=True))
+    deltas = [data['delta'] for name, data in events[:-1]]
+    assert len(deltas) > 1
+    assert all(name is None for name, _ in events[:-1])
+    assert events[-1] == ('done', {'response_text': ''.join(deltas).strip()})
+    assert fake_openai.snapshot().get('chat', 0) == before + 1
+
+
+def test_query_flag_streams_too(client):
+    response = client.post('/chat_text?stream=1', json={'text': 'Hello there'})
+    assert response.mimetype == 'text/event-stream'
+    assert parse_events(response.get_data(as_text=True))[-1][0] == 'done'
+
+
+def test_finished_reply_is_saved_to_the_conversation(client, app_module):
+    response = client.post('/chat_text/stream', json={'text': 'My favourite food is ramen'})
+    reply = parse_events(response.get_data(as_text=True))[-1][1]['response_text']
+
+    with client.session_transaction() as session:
+        conversation_id = session['conversation_id']
+    messages = app_module.conversations.load(conversation_id)['messages']
+    assert messages[-2:] == [{'role': 'user', 'content': 'My favourite food is ramen'},
+                             {'role': 'assistant', 'content': reply}]
+
+
+def test_first_delta_arrives_before_the_reply_is_finished(client, fake_openai, monkeypatch):
+    monkeypatch.setattr(fake_openai, 'stream_chunk_delay', 0.1)
+    start = time.perf_counter()
+    response = client.post('/chat_text/stream', json={'text': 'Tell me about your day'}, buffered=False)
+    chunks = iter(response.response)
+
+    first = next(chunks)
+    first_at = time.perf_counter() - start
+    rest = b''.join(chunks)
+    total = time.perf_counter() - start
+    response.close()
+
+    assert b'"delta"' in (first if isinstance(first, bytes) else first.encode())
+    assert b'event: done' in rest
+    # The reply takes several chunk delays; the first token doesn't wait for them
+    assert first_at < total - 0.2
+
+
+def test_upstream_error_before_streaming_is_a_json_error(client, fake_openai, app_module):
+    fake_openai.inject(app_module.CHAT_MODEL, error_rate=1.0, status=400)
+    response = client.post('/chat_text/stream', json={'text': 'Hello'})
+    assert response.status_code == 500
+    assert 'error' in response.get_json()
+
+
+def test_missing_text_is_rejected(client):
+    assert client.post('/chat_text/stream', json={}).status_code == 400
+
+
+class BrokenStream:
+    """Two chunks, then the upstream connection drops."""
+
+    def __iter__(self):
+        yield OpenAIObject.construct_from({'choices': [{'delta': {'content': 'Hello'}}]})
+        yield OpenAIObject.construct_from({'choices': []})
+        yield OpenAIObject.construct_from({'choices': [{'delta': {'content': ' there'}}]})
+        raise ConnectionError('upstream went away')
+
+
+def test_broken_upstream_ends_with_an_error_event():
+    completed = []
+    events = parse_events(''.join(chat_stream.relay_completion(BrokenStream(), completed.append)))
+
+    assert events[:2] == [(None, {'delta': 'Hello'}), (None, {'delta': ' there'})]
+    assert events[2] == ('error', {'error': 'upstream went away'})
+    # Half a reply is not saved
+    assert completed == []
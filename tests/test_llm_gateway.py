@@ -0,0 +1,215 @@
+"""Deadlines, breakers, hedging and fallback of app/llm_gateway.py, with faults injected into FakeOpenAI."""
+
+import time
+
+import openai
+import pytest
+
+import llm_gateway
+
+PRIMARY = 'gpt-4o'
+FALLBACK = 'gpt-4o-mini'
+
+MESSAGES = [
+    {'role': 'system', 'content': 'You are a friendly English tutor.'},
+    {'role': 'user', 'content': 'I went to the beach last weekend with my family.'}
+]
+
+
+def chat_calls(fake):
+    return fake.snapshot().get('chat', 0)
+
+
+def read_stream(stream):
+    try:
+        return ''.join(event['choices'][0]['delta'].get('content', '') for event in stream if event['choices'])
+    finally:
+        stream.close()
+
+
+def test_chat_accounts_tokens_and_latency(fake_openai):
+    gateway = llm_gateway.LLMGateway(fallbacks='')
+    response = gateway.chat('chat', FALLBACK, MESSAGES, deadline=10)
+
+    assert response.choices[0].message.content
+    entry = gateway.metrics()['calls'][f'{FALLBACK}/chat']
+    assert entry['ok'] == 1
+    assert entry['input_tokens'] == response['usage']['prompt_tokens']
+    assert entry['output_tokens'] == response['usage']['completion_tokens']
+    assert entry['p50_ms'] is not None
+
+
+def test_slow_call_gives_up_at_the_deadline(fake_openai):
+    fake_openai.inject(FALLBACK, slow_rate=1.0, slow_latency=3)
+    gateway = llm_gateway.LLMGateway(fallbacks='')
+
+    start = time.monotonic()
+    with pytest.raises(openai.error.Timeout):
+        gateway.chat('chat', FALLBACK, MESSAGES, deadline=0.5)
+    waited = time.monotonic() - start
+
+    assert waited < 1.5
+    assert gateway.metrics()['calls'][f'{FALLBACK}/chat']['timeouts'] == 1
+
+
+def test_no_call_is_made_without_time_left(fake_openai):
+    gateway = llm_gateway.LLMGateway(fallbacks='')
+    before = chat_calls(fake_openai)
+    with pytest.raises(llm_gateway.DeadlineExceeded):
+        gateway._attempt(FALLBACK, 'chat', 'primary', MESSAGES, {}, time.monotonic() - 1,
+                         gateway.breaker(FALLBACK), None)
+    assert chat_calls(fake_openai) == before
+
+
+def test_stream_deadline_covers_the_whole_stream(fake_openai, monkeypatch):
+    monkeypatch.setattr(fake_openai, 'stream_chunk_delay', 0.3)
+    gateway = llm_gateway.LLMGateway(fallbacks='')
+
+    stream = gateway.stream('chat_stream', FALLBACK, MESSAGES, deadline=0.5)
+    with pytest.raises(llm_gateway.DeadlineExceeded):
+        read_stream(stream)
+    assert gateway.metrics()['calls'][f'{FALLBACK}/chat_stream']['timeouts'] == 1
+
+
+def test_breaker_opens_after_repeated_failures(fake_openai):
+    fake_openai.inject(PRIMARY, error_rate=1.0, status=500)
+    gateway = llm_gateway.LLMGateway(fallbacks='', breaker_failures=2, breaker_cooldown=0.5)
+
+    for _ in range(2):
+        with pytest.raises(openai.error.APIError):
+            gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+    before = chat_calls(fake_openai)
+    with pytest.raises(llm_gateway.CircuitOpen) as raised:
+        gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+
+    # Refused without reaching the model
+    assert chat_calls(fake_openai) == before
+    assert raised.value.model == PRIMARY
+    assert raised.value.retry_after > 0
+    metrics = gateway.metrics()
+    assert metrics['breakers'][PRIMARY]['state'] == llm_gateway.OPEN
+    assert metrics['calls'][f'{PRIMARY}/analysis']['rejected'] == 1
+
+
+def test_breaker_closes_after_a_successful_trial(fake_openai):
+    fake_openai.inject(PRIMARY, error_rate=1.0, status=500)
+    gateway = llm_gateway.LLMGateway(fallbacks='', breaker_failures=1, breaker_cooldown=0.3)
+    with pytest.raises(openai.error.APIError):
+        gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+    assert gateway.breaker(PRIMARY).state == llm_gateway.OPEN
+
+    fake_openai.inject(PRIMARY)
+    time.sleep(0.35)
+    gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+    assert gateway.breaker(PRIMARY).state == llm_gateway.CLOSED
+
+
+def test_bad_requests_do_not_open_the_breaker(fake_openai):
+    fake_openai.inject(PRIMARY, error_rate=1.0, status=400)
+    gateway = llm_gateway.LLMGateway(fallbacks=f'{PRIMARY}:{FALLBACK}', breaker_failures=1)
+
+    with pytest.raises(openai.error.InvalidRequestError):
+        gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+    assert gateway.breaker(PRIMARY).state == llm_gateway.CLOSED
+    # Not the model's fault, so not retried on the fallback either
+    assert f'{FALLBACK}/analysis' not in gateway.metrics()['calls']
+
+
+def test_failing_model_falls_back(fake_openai):
+    fake_openai.inject(PRIMARY, error_rate=1.0, status=500)
+    gateway = llm_gateway.LLMGateway(fallbacks=f'{PRIMARY}:{FALLBACK}')
+
+    response = gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+
+    assert response['model'] == FALLBACK
+    calls = gateway.metrics()['calls']
+    assert calls[f'{PRIMARY}/analysis']['errors'] == 1
+    assert calls[f'{FALLBACK}/analysis']['fallbacks'] == 1
+    assert calls[f'{FALLBACK}/analysis']['ok'] == 1
+
+
+def test_open_breaker_goes_straight_to_the_fallback(fake_openai):
+    fake_openai.inject(PRIMARY, error_rate=1.0, status=500)
+    gateway = llm_gateway.LLMGateway(fallbacks=f'{PRIMARY}:{FALLBACK}', breaker_failures=1, breaker_cooldown=60)
+    gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+
+    before = fake_openai.snapshot().get('chat_errors', 0)
+    stream = gateway.stream('analysis', PRIMARY, MESSAGES, deadline=10)
+
+    assert stream.model == FALLBACK
+    assert read_stream(stream)
+    assert fake_openai.snapshot().get('chat_errors', 0) == before
+    assert gateway.metrics()['calls'][f'{PRIMARY}/analysis']['rejected'] == 1
+
+
+def test_no_fallback_when_both_breakers_are_open(fake_openai):
+    fake_openai.inject(None, error_rate=1.0, status=500)
+    gateway = llm_gateway.LLMGateway(fallbacks=f'{PRIMARY}:{FALLBACK}', breaker_failures=1, breaker_cooldown=60)
+    with pytest.raises(openai.error.APIError):
+        gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+
+    with pytest.raises(llm_gateway.CircuitOpen):
+        gateway.chat('analysis', PRIMARY, MESSAGES, deadline=10)
+
+
+class SlowFirstAttempt:
+    """
+    ChatCompletion.create that leaves the injected slowness on for the
+    primary attempt and clears it before the hedge is sent.
+    """
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.armed = False
+        self.attempts = 0
+
+    def __call__(self, **kwargs):
+        if self.armed:
+            self.attempts += 1
+            if self.attempts == 2:
+                self.fake.inject(FALLBACK)
+        return openai.ChatCompletion.create(**kwargs)
+
+
+def test_slow_attempt_is_hedged(fake_openai):
+    create = SlowFirstAttempt(fake_openai)
+    gateway = llm_gateway.LLMGateway(fallbacks='', hedge_min_samples=5, hedge_min_delay=0.1, create_fn=create)
+    for _ in range(5):
+        gateway.chat('chat', FALLBACK, MESSAGES, deadline=10, hedge=True)
+    assert gateway.hedge_delay(FALLBACK, 'chat') == pytest.approx(0.1, abs=0.05)
+
+    fake_openai.inject(FALLBACK, slow_rate=1.0, slow_latency=3)
+    create.armed = True
+    start = time.monotonic()
+    gateway.chat('chat', FALLBACK, MESSAGES, deadline=10, hedge=True)
+    waited = time.monotonic() - start
+
+    assert waited < 1.5
+    entry = gateway.metrics()['calls'][f'{FALLBACK}/chat']
+    assert (entry['hedges'], entry['hedge_wins']) == (1, 1)
+
+
+def test_no_hedge_until_latency_is_known(fake_openai):
+    gateway = llm_gateway.LLMGateway(fallbacks='', hedge_min_samples=5)
+    gateway.chat('chat', FALLBACK, MESSAGES, deadline=10, hedge=True)
+
+    assert gateway.hedge_delay(FALLBACK, 'chat') is None
+    assert gateway.metrics()['calls'][f'{FALLBACK}/chat']['hedges'] == 0
+
+
+def test_embed_uses_the_breaker_without_fallback(fake_openai):
+    calls = []
+
+    def failing_embed(**kwargs):
+        calls.append(kwargs)
+        raise openai.error.APIError('embeddings are down')
+
+    gateway = llm_gateway.LLMGateway(breaker_failures=1, breaker_cooldown=60, embed_fn=failing_embed)
+    with pytest.raises(openai.error.APIError):
+        gateway.embed('embedding', 'text-embedding-3-small', ['hello'], deadline=5)
+    with pytest.raises(llm_gateway.CircuitOpen):
+        gateway.embed('embedding', 'text-embedding-3-small', ['hello'], deadline=5)
+    assert len(calls) == 1
+
+    response = llm_gateway.LLMGateway().embed('embedding', 'text-embedding-3-small', ['a', 'b'], deadline=5)
+    assert [item['index'] for item in response['data']] == [0, 1]
@@ -0,0 +1,150 @@
+"""Token buckets and model concurrency caps (app/rate_limit.py), on the memory and SQLite backends."""
+
+import asyncio
+import threading
+
+import pytest
+
+from rate_limit import (MemoryBackend, RateLimiter, SQLiteBackend, Throttled, client_ip, parse_caps,
+                        parse_rules)
+
+
+def make_limiter(backend=None, user_rules='chat:2/60', ip_rules='chat:3/60', caps='gpt-4o:2', wait=0.1):
+    return RateLimiter(backend=backend or MemoryBackend(), enabled=True, user_rules=user_rules,
+                       ip_rules=ip_rules, caps=caps, wait=wait)
+
+
+class BrokenBackend:
+    def take(self, buckets):
+        raise ConnectionError('store unavailable')
+
+    def acquire(self, model, limit, lease_id, timeout):
+        raise ConnectionError('store unavailable')
+
+
+def test_rules_and_caps_are_parsed():
+    assert parse_rules('chat:20/60, voice:6/60,,analysis:5') == {
+        'chat': (20.0, 60.0), 'voice': (6.0, 60.0), 'analysis': (5.0, 1.0)}
+    assert parse_caps('gpt-4o:8,ft:gpt-4o:org:2') == {'gpt-4o': 8, 'ft:gpt-4o:org': 2}
+
+
+def test_client_ip_trusts_only_the_configured_proxies():
+    assert client_ip('10.0.0.1', '203.0.113.7, 10.0.0.2', trusted_proxies=0) == '10.0.0.1'
+    assert client_ip('10.0.0.1', '203.0.113.7, 10.0.0.2', trusted_proxies=1) == '10.0.0.2'
+    assert client_ip('10.0.0.1', '198.51.100.1, 203.0.113.7, 10.0.0.2', trusted_proxies=2) == '203.0.113.7'
+    # Fewer hops than proxies: the header can't be trusted
+    assert client_ip('10.0.0.1', '203.0.113.7', trusted_proxies=2) == '10.0.0.1'
+    assert client_ip(None) == 'unknown'
+
+
+def test_user_bucket_runs_out_with_a_retry_after():
+    limiter = make_limiter()
+    limiter.hit('chat', user_id='user-1', ip='10.0.0.1')
+    limiter.hit('chat', user_id='user-1', ip='10.0.0.1')
+
+    with pytest.raises(Throttled) as throttled:
+        limiter.hit('chat', user_id='user-1', ip='10.0.0.1')
+    assert throttled.value.scope == 'user'
+    # Two tokens per minute: the next one is back in 30 seconds
+    assert throttled.value.retry_after == pytest.approx(30, abs=1)
+    assert throttled.value.retry_after_header == '30'
+
+    # Another user is not affected, and endpoints without a rule are not limited
+    limiter.hit('chat', user_id='user-2', ip='10.0.0.2')
+    limiter.hit('voice', user_id='user-1', ip='10.0.0.1')
+    assert limiter.metrics()['endpoints']['chat'] == {'admitted': 3, 'throttled_user': 1, 'throttled_ip': 0}
+
+
+def test_a_refused_request_takes_no_token():
+    limiter = make_limiter(user_rules='chat:5/60', ip_rules='chat:1/60')
+    limiter.hit('chat', user_id='user-1', ip='10.0.0.1')
+
+    with pytest.raises(Throttled) as throttled:
+        limiter.hit('chat', user_id='user-1', ip='10.0.0.1')
+    assert throttled.value.scope == 'ip'
+
+    # The refused request left user-1's bucket alone: four tokens remain
+    for i in range(4):
+        limiter.hit('chat', user_id='user-1', ip=f'10.0.1.{i}')
+    with pytest.raises(Throttled) as throttled:
+        limiter.hit('chat', user_id='user-1', ip='10.0.2.1')
+    assert throttled.value.scope == 'user'
+
+
+def test_disabled_limiter_lets_everything_through():
+    limiter = RateLimiter(backend=MemoryBackend(), enabled=False, user_rules='chat:1/60', caps='gpt-4o:1')
+    for _ in range(5):
+        limiter.hit('chat', user_id='user-1')
+    assert limiter.acquire('gpt-4o') is None
+
+
+def test_model_cap_waits_then_refuses():
+    limiter = make_limiter()
+    first = limiter.acquire('gpt-4o')
+    second = limiter.acquire('gpt-4o')
+    assert limiter.acquire('gpt-4o-mini') is None  # not capped
+
+    with pytest.raises(Throttled) as throttled:
+        limiter.acquire('gpt-4o')
+    assert throttled.value.scope == 'model'
+
+    # A slot released while waiting is handed to the waiter
+    threading.Timer(0.05, limiter.release, args=(first,)).start()
+    third = limiter.acquire('gpt-4o', wait=2)
+    assert third is not None
+
+    limiter.release(second)
+    limiter.release(third)
+    limiter.release(None)
+    assert limiter.metrics()['models']['gpt-4o'] | {'avg_wait_ms': 0} == {
+        'limit': 2, 'in_flight': 0, 'admitted': 3, 'throttled': 1, 'avg_wait_ms': 0}
+
+
+def test_async_acquire_waits_on_the_event_loop():
+    limiter = make_limiter(caps='gpt-4o:1')
+
+    async def run():
+        held = await limiter.acquire_async('gpt-4o')
+        asyncio.get_running_loop().call_later(0.05, limiter.release, held)
+        second = await limiter.acquire_async('gpt-4o', wait=2)
+        limiter.release(second)
+        with limiter.slot('gpt-4o'):
+            with pytest.raises(Throttled):
+                await limiter.acquire_async('gpt-4o', wait=0.05)
+
+    asyncio.run(run())
+    assert limiter.metrics()['models']['gpt-4o']['throttled'] == 1
+
+
+def test_sqlite_backend_is_shared_between_workers(tmp_path):
+    db_path = str(tmp_path / 'rate_limits.db')
+    one = make_limiter(SQLiteBackend(db_path), caps='gpt-4o:1')
+    other = make_limiter(SQLiteBackend(db_path), caps='gpt-4o:1')
+
+    one.hit('chat', user_id='user-1')
+    other.hit('chat', user_id='user-1')
+    with pytest.raises(Throttled):
+        one.hit('chat', user_id='user-1')
+
+    lease = one.acquire('gpt-4o')
+    with pytest.raises(Throttled):
+        other.acquire('gpt-4o', wait=0.1)
+    one.release(lease)
+    other.release(other.acquire('gpt-4o'))
+
+
+def test_sqlite_slots_of_a_crashed_worker_expire(tmp_path):
+    db_path = str(tmp_path / 'rate_limits.db')
+    crashed = make_limiter(SQLiteBackend(db_path, lease_ttl=0.1), caps='gpt-4o:1')
+    other = make_limiter(SQLiteBackend(db_path), caps='gpt-4o:1')
+
+    crashed.acquire('gpt-4o')  # never released
+    assert other.acquire('gpt-4o', wait=2) is not None
+
+
+def test_broken_store_fails_open():
+    limiter = make_limiter(BrokenBackend())
+    for _ in range(5):
+        limiter.hit('chat', user_id='user-1', ip='10.0.0.1')
+    assert limiter.acquire('gpt-4o') is None
+    assert limiter.metrics()['store_errors'] == 6
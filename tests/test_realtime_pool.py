@@ -0,0 +1,163 @@
+"""Realtime session pool (app/realtime_pool.py) against FakeOpenAI's /v1/realtime/sessions."""
+
+import time
+
+import pytest
+
+import realtime_pool
+from prompt_store import prompt_store
+
+TOPIC = {'title': 'Ordering Coffee', 'description': 'Practice ordering at a cafe'}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class RecordingCreate:
+    """create_session, remembering the instructions each session was created with."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, voice, instructions):
+        self.calls.append((voice, instructions))
+        return realtime_pool.create_session(voice, instructions)
+
+
+@pytest.fixture
+def create():
+    return RecordingCreate()
+
+
+@pytest.fixture
+def pools():
+    """Pools made by a test; emptied afterwards so their refill threads go quiet."""
+    made = []
+    yield made
+    for pool in made:
+        with pool._lock:
+            pool.warm_voices = []
+            pool._wanted.clear()
+            pool._pools.clear()
+
+
+@pytest.fixture
+def make_pool(create, pools):
+    def make(create_fn=create, **kwargs):
+        kwargs.setdefault('size', 2)
+        kwargs.setdefault('warm_voices', [])
+        kwargs.setdefault('refill_interval', 0.1)
+        pool = realtime_pool.RealtimeSessionPool(create_fn=create_fn, **kwargs)
+        pools.append(pool)
+        return pool
+    return make
+
+
+def ready(pool, voice='sage'):
+    return pool.metrics()['ready'].get(f'{voice}:{prompt_store.version}', 0)
+
+
+def test_create_session_against_fake(fake_openai):
+    before = fake_openai.snapshot().get('realtime_sessions', 0)
+    session = realtime_pool.create_session('sage', prompt_store.base_instructions())
+
+    assert session['session_id'].startswith('sess_')
+    assert session['ephemeral_token'].startswith('ek_')
+    assert session['expires_at'] > time.time()
+    assert fake_openai.snapshot().get('realtime_sessions', 0) == before + 1
+
+
+def test_first_request_misses_then_pool_hits(make_pool):
+    pool = make_pool()
+
+    first = pool.acquire('sage')
+    assert first['session_update'] is None
+    assert wait_for(lambda: ready(pool) == 2)
+
+    second = pool.acquire('sage')
+
+    assert second['session_id'] != first['session_id']
+    metrics = pool.metrics()
+    assert (metrics['hits'], metrics['misses']) == (1, 1)
+    assert metrics['hit_rate'] == 0.5
+    assert metrics['avg_hit_ms'] < metrics['avg_miss_ms']
+    # The session handed out is replaced in the background
+    assert wait_for(lambda: ready(pool) == 2)
+
+
+def test_warm_voices_are_filled_without_a_request(make_pool):
+    pool = make_pool(warm_voices=['sage'])
+    pool.acquire('alloy')
+    assert wait_for(lambda: ready(pool, 'sage') == 2 and ready(pool, 'alloy') == 2)
+
+
+def test_topic_on_pooled_session_comes_with_session_update(make_pool, create):
+    pool = make_pool()
+    pool.acquire('sage')
+    assert wait_for(lambda: ready(pool) == 2)
+
+    session = pool.acquire('sage', topic=TOPIC)
+
+    assert session['session_update'] == {
+        'type': 'session.update',
+        'session': {'instructions': prompt_store.topic_instructions(TOPIC)}
+    }
+    # Pooled sessions are only ever created with the base prompt
+    assert all(instructions == prompt_store.base_instructions() for _, instructions in create.calls[1:])
+
+
+def test_topic_on_miss_is_created_with_topic_prompt(make_pool, create):
+    pool = make_pool()
+    session = pool.acquire('sage', topic=TOPIC)
+
+    assert session['session_update'] is None
+    assert create.calls[0] == ('sage', prompt_store.topic_instructions(TOPIC))
+
+
+def test_sessions_are_replaced_before_they_expire(make_pool, fake_openai, monkeypatch):
+    # Sessions live 3s and are retired 1.5s before expiry
+    monkeypatch.setattr(fake_openai, 'session_ttl', 3)
+    pool = make_pool(refresh_margin=1.5)
+    pool.acquire('sage')
+    assert wait_for(lambda: ready(pool) == 2)
+    key = ('sage', prompt_store.version)
+    first_batch = {session['session_id'] for session in pool._pools[key]}
+
+    assert wait_for(lambda: pool.metrics()['expired'] >= 2)
+    assert wait_for(lambda: ready(pool) == 2)
+
+    session = pool.acquire('sage')
+    assert session['session_id'] not in first_batch
+    assert pool.metrics()['hits'] == 1
+
+
+def test_disabled_pool_creates_on_demand(make_pool, create):
+    pool = make_pool(enabled=False)
+    pool.acquire('sage')
+    pool.acquire('sage')
+
+    assert len(create.calls) == 2
+    metrics = pool.metrics()
+    assert (metrics['enabled'], metrics['hits'], metrics['misses']) == (False, 0, 2)
+    assert metrics['ready'] == {}
+
+
+def test_failed_refills_are_counted_and_retried(make_pool, create):
+    failures = []
+
+    def flaky(voice, instructions):
+        if voice == 'sage' and len(failures) < 2:
+            failures.append(voice)
+            raise realtime_pool.RealtimeSessionError('no session')
+        return create(voice, instructions)
+
+    pool = make_pool(create_fn=flaky, warm_voices=['sage'])
+    pool.acquire('alloy')
+    assert wait_for(lambda: ready(pool, 'sage') == 2)
+    assert pool.metrics()['create_errors'] == 2
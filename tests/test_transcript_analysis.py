@@ -0,0 +1,69 @@
+"""Incremental parsing of streamed analysis answers (app/transcript_analysis.py)."""
+
+import json
+
+import pytest
+
+from transcript_analysis import MIN_CONFIDENCE, DetectionStream, validate_detection
+
+DETECTIONS = [
+    {'cando_id': 'A2-1', 'confidence': 0.8, 'evidence': 'I like to cook {pasta}.'},
+    {'cando_id': 'B1-7', 'confidence': 0.9, 'evidence': 'She said "it\'s [great]" \\ really'},
+]
+ANSWER = json.dumps({'detected_achievements': DETECTIONS})
+
+
+def feed_all(parser, deltas):
+    detections = []
+    for delta in deltas:
+        detections.extend(parser.feed(delta))
+    return detections
+
+
+@pytest.mark.parametrize('size', [1, 3, 17, len(ANSWER)])
+def test_detections_come_out_whatever_the_delta_size(size):
+    parser = DetectionStream()
+    deltas = [ANSWER[i:i + size] for i in range(0, len(ANSWER), size)]
+
+    assert feed_all(parser, deltas) == DETECTIONS
+    assert parser.complete()
+    assert parser.malformed == 0
+
+
+def test_each_detection_is_returned_once_its_object_closes():
+    parser = DetectionStream()
+    first_end = ANSWER.index('}, {') + 1
+
+    assert parser.feed(ANSWER[:first_end - 1]) == []
+    assert parser.feed(ANSWER[first_end - 1:first_end]) == [DETECTIONS[0]]
+    # The rest of the answer doesn't return the first detection again
+    assert parser.feed(ANSWER[first_end:]) == [DETECTIONS[1]]
+
+
+def test_truncated_answer_keeps_the_finished_detections():
+    parser = DetectionStream()
+    cut = ANSWER.index('B1-7')
+
+    assert parser.feed(ANSWER[:cut]) == [DETECTIONS[0]]
+    assert not parser.complete()
+
+
+def test_malformed_detection_is_counted_and_skipped():
+    parser = DetectionStream()
+    answer = '{"detected_achievements": [{"cando_id": "A2-1", "confidence": .8}, ' + json.dumps(DETECTIONS[1]) + ']}'
+
+    assert parser.feed(answer) == [DETECTIONS[1]]
+    assert parser.malformed == 1
+
+
+def test_answer_of_the_wrong_shape_is_not_complete():
+    parser = DetectionStream()
+    assert parser.feed('{"detected_achievements": {"cando_id": "A2-1"}}') == []
+    assert not parser.complete()
+
+
+def test_low_confidence_is_not_invalid():
+    low = {'cando_id': 'A2-1', 'confidence': MIN_CONFIDENCE / 2, 'evidence': 'I cook.'}
+    assert validate_detection(low, {'A2-1'}) is None
+    assert validate_detection({**low, 'confidence': 1.5}, {'A2-1'}) is not None
+    assert validate_detection({**low, 'cando_id': 'Z9-9'}, {'A2-1'}) is not None
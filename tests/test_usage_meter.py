@@ -0,0 +1,158 @@
+"""Voice-minute metering and quotas (app/usage_meter.py), flushed to the fake record_voice_usage RPC."""
+
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+import supabase_client
+from usage_meter import (MemorySessions, QuotaExceeded, SQLiteSessions, UsageMeter, limit_seconds,
+                         month_key, month_start, used_seconds)
+
+
+class Clock:
+    def __init__(self, now=None):
+        self.now = time.time() if now is None else now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def profile(fake_supabase, monkeypatch):
+    """A free-tier learner in the fake profiles table, with nothing used this month."""
+    row = {'id': str(uuid.uuid4()), 'tier': 'free', 'is_admin': False, 'monthly_voice_seconds_used': 0}
+    monkeypatch.setitem(fake_supabase.tables, 'profiles', [row])
+    monkeypatch.setitem(fake_supabase.tables, 'usage_logs', [])
+    return row
+
+
+def make_meter(clock, sessions=None, **kwargs):
+    return UsageMeter(enabled=True, flush_interval=3600, session_timeout=90, cost_per_minute=0.06,
+                      clock=clock, sessions=sessions or MemorySessions(), **kwargs)
+
+
+def test_limits_follow_the_tier():
+    now = time.time()
+    expired = datetime.fromtimestamp(now - 60, timezone.utc).isoformat()
+
+    assert limit_seconds({'tier': 'free'}, now) == 30 * 60
+    assert limit_seconds({'tier': 'premium'}, now) == 300 * 60
+    assert limit_seconds({'tier': 'premium', 'premium_until': expired}, now) == 30 * 60
+    assert limit_seconds({'tier': 'enterprise'}, now) is None
+    assert limit_seconds({'tier': 'free', 'is_admin': True}, now) is None
+    assert limit_seconds(None, now) == 30 * 60
+
+
+def test_usage_from_an_earlier_month_does_not_count():
+    now = time.time()
+    last_month = datetime.fromtimestamp(month_start(now) - 1, timezone.utc).isoformat()
+    profile = {'monthly_voice_seconds_used': 600, 'last_usage_reset': last_month}
+
+    assert used_seconds(profile, month_key(now)) == 0.0
+    assert used_seconds({'monthly_voice_minutes_used': 2}, month_key(now)) == 120.0
+
+
+def test_session_is_metered_and_flushed_in_one_call(clock, profile, fake_supabase):
+    meter = make_meter(clock)
+    session = meter.start_session(profile['id'], profile)
+    assert session['remaining_seconds'] == 30 * 60
+
+    clock.advance(30)
+    assert meter.heartbeat(session['usage_session_id'])['remaining_seconds'] == 30 * 60 - 30
+    clock.advance(20)
+    assert meter.end_session(session['usage_session_id']) == {'remaining_seconds': 30 * 60 - 50,
+                                                             'limit_reached': False}
+    assert meter.heartbeat(session['usage_session_id']) is None
+
+    meter.flush()
+
+    assert profile['monthly_voice_seconds_used'] == 50
+    [logged] = fake_supabase.tables['usage_logs']
+    assert logged['seconds'] == 50
+    assert logged['cost_usd'] == pytest.approx(0.05)
+    # Nothing left to write: the next flush makes no call
+    meter.flush()
+    assert meter.metrics()['flushes'] == 1
+
+
+def test_quota_is_checked_without_a_round_trip(clock, profile, fake_supabase):
+    meter = make_meter(clock)
+    used_up = {**profile, 'monthly_voice_seconds_used': 30 * 60}
+    calls = sum(fake_supabase.snapshot().values())
+
+    with pytest.raises(QuotaExceeded):
+        meter.check(profile['id'], used_up)
+    assert meter.metrics()['rejected'] == 1
+    assert sum(fake_supabase.snapshot().values()) == calls
+
+
+def test_open_sessions_count_against_the_quota(clock, profile):
+    meter = make_meter(clock)
+    almost = {**profile, 'monthly_voice_seconds_used': 30 * 60 - 40}
+    session = meter.start_session(profile['id'], almost)
+
+    clock.advance(30)
+    assert meter.check(profile['id'], almost) == pytest.approx(10)
+    clock.advance(15)
+    assert meter.heartbeat(session['usage_session_id'])['limit_reached'] is True
+    with pytest.raises(QuotaExceeded):
+        meter.check(profile['id'], almost)
+
+
+def test_silent_session_is_closed_and_charged_until_it_timed_out(clock, profile):
+    meter = make_meter(clock)
+    meter.start_session(profile['id'], profile)
+
+    clock.advance(500)
+    meter.flush()
+
+    assert meter.metrics()['timed_out'] == 1
+    assert meter.metrics()['open_sessions'] == 0
+    assert profile['monthly_voice_seconds_used'] == 90
+
+
+def test_failed_flush_keeps_the_usage_for_the_next_one(clock, profile, monkeypatch):
+    meter = make_meter(clock)
+    session = meter.start_session(profile['id'], profile)
+    clock.advance(40)
+    meter.end_session(session['usage_session_id'])
+
+    def unavailable(*args, **kwargs):
+        raise ConnectionError('supabase unavailable')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(supabase_client.supabase, 'post', unavailable)
+        with pytest.raises(ConnectionError):
+            meter.flush()
+    assert meter.metrics()['flush_errors'] == 1
+    assert meter.metrics()['pending_sessions'] == 1
+    # Still counted while it waits to be written
+    assert meter.check(profile['id'], profile) == pytest.approx(30 * 60 - 40)
+
+    meter.flush()
+    assert profile['monthly_voice_seconds_used'] == 40
+    assert meter.metrics()['pending_users'] == 0
+
+
+def test_events_can_land_on_another_worker(clock, profile, tmp_path):
+    db_path = str(tmp_path / 'usage_sessions.db')
+    opener = make_meter(clock, SQLiteSessions(db_path))
+    other = make_meter(clock, SQLiteSessions(db_path))
+
+    session = opener.start_session(profile['id'], profile)
+    clock.advance(25)
+    assert other.end_session(session['usage_session_id'])['remaining_seconds'] == 30 * 60 - 25
+    assert opener.heartbeat(session['usage_session_id']) is None
+
+    other.flush()
+    assert profile['monthly_voice_seconds_used'] == 25